@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+複数のバックエンド（Geminiの各モデル、ローカルのOllama）で1つのジョブキューを同時に処理するルーター
+各バックエンドは自分の同時実行数とレート制限の範囲で、空きができ次第キューから次の行を取り出します
+"""
+
+import asyncio
+import statistics
+import time
+from collections import Counter, deque
+
+from llm_errors import response_text
+from llm_executor import RateLimiter, estimate_tokens, handle_failure
+from llm_telemetry import Telemetry
+from ollama_client import OllamaClient
+from quota_planner import DailyUsage
+
+
+class GeminiBackend:
+    """Gemini APIのモデル1つ分のバックエンド"""
+
+    backend_type = 'gemini'
+
+    def __init__(self, name, model_name, requests_per_minute, tokens_per_minute=None,
+                 max_in_flight=5, generation_config=None, requests_per_day=None, api_key=None):
+        import google.generativeai as genai
+
+        self.name = name
+        self.model_name = model_name
+        self.max_in_flight = max_in_flight
+        self.generation_config = generation_config or {}
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # 1日の使用量はモデルとAPIキーの組ごとに全ランナー共通のファイルに記録し、上限に達したらリセットまでこのバックエンドだけ止める
+        self.daily_usage = DailyUsage(model_name, requests_per_day, api_key=api_key)
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute, daily_usage=self.daily_usage)
+        self.model = genai.GenerativeModel(model_name, generation_config=self.generation_config)
+
+    async def generate(self, prompt, meta):
+        started = time.monotonic()
+        response = await self.model.generate_content_async(prompt, stream=True)
+        async for _ in response:
+            if 'first_token_seconds' not in meta:
+                meta['first_token_seconds'] = time.monotonic() - started
+        metadata = response.usage_metadata
+        meta['prompt_tokens'] = metadata.prompt_token_count
+        meta['output_tokens'] = metadata.total_token_count - metadata.prompt_token_count
+        return response_text(response), metadata.total_token_count
+
+    def count_tokens(self, prompt):
+        """APIでプロンプトのトークン数を数える（見積もりの補正用）"""
+        return self.model.count_tokens(prompt).total_tokens
+
+    def close(self):
+        self.daily_usage.close()
+
+
+class OllamaBackend:
+    """ローカルのOllamaサーバー1台分のバックエンド"""
+
+    backend_type = 'ollama'
+
+    def __init__(self, name, endpoint, model_name, max_in_flight=4, deadline_seconds=600, keep_alive='30m'):
+        self.name = name
+        self.model_name = model_name
+        self.max_in_flight = max_in_flight
+        self.generation_config = {}
+        self.deadline_seconds = deadline_seconds
+        # ローカルサーバーにはRPMや1日の上限がないので、同時実行数だけで負荷を制御する
+        self.requests_per_minute = None
+        self.tokens_per_minute = None
+        self.daily_usage = None
+        self.limiter = RateLimiter(None)
+        self.client = OllamaClient(endpoint, model_name, pool_size=max_in_flight, keep_alive=keep_alive)
+
+    async def generate(self, prompt, meta):
+        messages = [{"role": "user", "content": prompt}]
+        result = await asyncio.to_thread(self.client.chat, messages, self.deadline_seconds)
+        meta['first_token_seconds'] = result.first_token_seconds
+        meta['prompt_tokens'] = result.prompt_eval_count
+        meta['output_tokens'] = result.eval_count
+        return result.text, result.prompt_eval_count + result.eval_count
+
+    def close(self):
+        self.client.close()
+
+
+def create_backend(config, api_key=None):
+    """
+    設定の辞書からバックエンドを作成する
+
+    Args:
+        config: {'type': 'gemini' または 'ollama', 'name': ..., 'model': ..., ...}
+        api_key: Geminiのバックエンドが使うAPIキー（1日の使用量をキーごとに数えるために渡す）
+
+    Returns:
+        GeminiBackend または OllamaBackend
+    """
+    config = dict(config)
+    backend_type = config.pop('type')
+    name = config.pop('name', None) or config['model']
+    model_name = config.pop('model')
+    if backend_type == 'gemini':
+        return GeminiBackend(name, model_name, api_key=api_key, **config)
+    if backend_type == 'ollama':
+        return OllamaBackend(name, config.pop('endpoint'), model_name, **config)
+    raise ValueError(f"未対応のバックエンドです: {backend_type}")
+
+
+class _JobPool:
+    """
+    全バックエンドで共有する未処理ジョブの置き場
+
+    失敗したジョブは、そのバックエンド以外が取り出せるように先頭に戻します。
+    段階実行では、各ジョブの job.meta['tier'] と同じ段のバックエンドだけが取り出します。
+    すべてのジョブが終わると drained がセットされます（一度終わったら、ジョブが戻ってくることはありません）。
+    """
+
+    def __init__(self, jobs):
+        self.pending = deque(jobs)
+        for job in self.pending:
+            job.meta['enqueued_at'] = time.monotonic()
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.retry_tasks = set()
+        self.drained = asyncio.Event()
+        if not self.pending:
+            self.drained.set()
+
+    async def take(self, backend_name, tier=None):
+        """
+        backend_name がまだ失敗していないジョブを1件取り出す
+
+        Args:
+            backend_name: 取り出すバックエンドの名前
+            tier: 段階実行での段の番号（Noneならすべてのジョブが対象）
+
+        Returns:
+            Job or None: すべてのジョブが終わっていればNone
+        """
+        async with self.condition:
+            while True:
+                for i, job in enumerate(self.pending):
+                    if tier is not None and job.meta.get('tier', 0) != tier:
+                        continue
+                    if backend_name not in job.meta.get('failed_backends', ()):
+                        del self.pending[i]
+                        self.in_flight += 1
+                        return job
+                if not self.pending and self.in_flight == 0:
+                    return None
+                await self.condition.wait()
+
+    async def release(self, job=None):
+        """
+        取り出したジョブの処理を終える
+
+        Args:
+            job: キューに戻すジョブ（完了した場合はNone）
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if job is not None:
+                job.meta['enqueued_at'] = time.monotonic()
+                self.pending.appendleft(job)
+            elif not self.pending and self.in_flight == 0:
+                self.drained.set()
+            self.condition.notify_all()
+
+    async def unless_drained(self, awaitable):
+        """
+        awaitable を待つ。その間にすべてのジョブが終わったら、待つのをやめる
+
+        1日の上限に達したバックエンドは、リセットまで wait_for_daily_room() から戻りません。
+        ほかのバックエンドがすべてのジョブを終えたら、そのワーカーも待たずに終われるようにします。
+
+        Returns:
+            bool: awaitable が完了した場合はTrue、先にすべてのジョブが終わった場合はFalse
+        """
+        task = asyncio.ensure_future(awaitable)
+        drained = asyncio.ensure_future(self.drained.wait())
+        try:
+            done, _ = await asyncio.wait({task, drained}, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            task.cancel()
+            raise
+        finally:
+            drained.cancel()
+        if task not in done:
+            task.cancel()
+            return False
+        task.result()
+        return True
+
+    def release_later(self, job, delay):
+        """delay 秒待ってからジョブをキューに戻す（待っている間も処理中として数える）"""
+        async def _release():
+            await asyncio.sleep(delay)
+            await self.release(job)
+
+        task = asyncio.create_task(_release())
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+
+async def _backend_worker(pool, backend, backend_count, on_done, retry_policy, telemetry, tier=None):
+    while True:
+        # 1日の上限に達したバックエンドは行を取り出さない
+        # （ほかのバックエンドがすべての行を終えたら、リセットを待たずにそのまま終わる）
+        if not await pool.unless_drained(backend.limiter.wait_for_daily_room()):
+            return
+        job = await pool.take(backend.name, tier)
+        if job is None:
+            return
+        taken_at = time.monotonic()
+
+        # RPM・TPMの枠と1日の使用量は、送る行が決まってから取る（行を待つだけのワーカーは枠を使わない）
+        if not job.estimated_tokens:
+            job.estimated_tokens = estimate_tokens(job.prompt)
+        await backend.limiter.acquire_tokens(job.estimated_tokens)
+        await backend.limiter.acquire_request()
+        if not backend.limiter.count_request():
+            # 待っている間に、同じバックエンドのほかのワーカーが今日の上限を使い切った
+            await pool.release(job)
+            continue
+        sent_at = time.monotonic()
+        try:
+            result_text, used_tokens = await backend.generate(job.prompt, job.meta)
+            error = None
+        except Exception as e:
+            result_text, used_tokens, error = None, 0, e
+        finished_at = time.monotonic()
+        backend.limiter.record_usage(job.estimated_tokens, used_tokens)
+
+        timings = {
+            'queue_wait': taken_at - job.meta.get('enqueued_at', taken_at),
+            'rate_limit_wait': sent_at - taken_at,
+            'latency': finished_at - sent_at,
+            'backend': backend.name,
+            'model': backend.model_name,
+        }
+        if error is None:
+            backend.limiter.recover()
+        else:
+            if telemetry is not None:
+                telemetry.record_job(job, error=error, **timings)
+            failed_backends = job.meta.setdefault('failed_backends', set())
+            failed_backends.add(backend.name)
+            if len(failed_backends) < backend_count:
+                # まだ試していないバックエンドにすぐ回す（429ならこのバックエンドだけ減速する）
+                handle_failure(job, error, backend.limiter, None)
+                print(f"\nID {job.key} が {backend.name} で失敗したため、別のバックエンドに回します: {error}")
+                await pool.release(job)
+                continue
+            # すべてのバックエンドで失敗した場合は、再試行できるエラーならバックオフ後に全バックエンドで再挑戦する
+            delay = handle_failure(job, error, backend.limiter, retry_policy)
+            if delay is not None:
+                failed_backends.clear()
+                pool.release_later(job, delay)
+                continue
+
+        # on_done がTrueを返したジョブは（段階実行で次の段に上げるため）キューに戻す
+        requeue = False
+        try:
+            requeue = bool(on_done(job, result_text, error, backend))
+        finally:
+            if telemetry is not None and error is None:
+                telemetry.record_job(job, postprocess_seconds=time.monotonic() - finished_at, **timings)
+            await pool.release(job if requeue else None)
+
+
+async def route_jobs_async(jobs, backends, on_done, retry_policy=None, telemetry=None):
+    """
+    ジョブを複数のバックエンドで分担して実行する
+
+    Args:
+        jobs: Jobのイテラブル
+        backends: バックエンドのリスト
+        on_done: 完了ごとに on_done(job, result_text, error, backend) を呼び出すコールバック。
+                 error は全バックエンドで失敗し、再試行も使い切った場合のみ設定されます
+        retry_policy: RetryPolicy（Noneなら全バックエンドで失敗した時点で打ち切る）
+        telemetry: Telemetry。指定すると呼び出し1回ごとの待ち時間とレイテンシをバックエンド名付きで記録します
+    """
+    pool = _JobPool(jobs)
+    workers = [
+        asyncio.create_task(_backend_worker(pool, backend, len(backends), on_done, retry_policy, telemetry))
+        for backend in backends
+        for _ in range(max(1, backend.max_in_flight))
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+def route_jobs(jobs, backends, on_done, retry_policy=None, telemetry=None):
+    """
+    route_jobs_async を同期コードから呼び出すためのラッパー
+
+    Args:
+        route_jobs_async と同じ
+    """
+    asyncio.run(route_jobs_async(jobs, backends, on_done, retry_policy, telemetry))
+
+
+class LadderStats:
+    """段階実行の段ごとの集計"""
+
+    def __init__(self, backends, telemetry, total_rows):
+        self.backends = backends
+        self.telemetry = telemetry
+        self.total_rows = total_rows
+        self.entered = Counter()
+        self.settled = Counter()
+        self.errors = Counter()
+        self.rejected = {backend.name: Counter() for backend in backends}
+
+    def report(self):
+        """段ごとの確定した行の割合・レイテンシ・トークン数をまとめる"""
+        total_rows = self.total_rows
+        lines = ["--- モデルの段階実行のレポート ---"]
+        for tier, backend in enumerate(self.backends):
+            name = backend.name
+            calls = [r for r in self.telemetry.records if r['backend'] == name]
+            latencies = sorted(r['latency'] for r in calls if r['status'] == 'ok')
+            prompt_tokens = sum(r['prompt_tokens'] for r in calls)
+            output_tokens = sum(r['output_tokens'] for r in calls)
+            settled = self.settled[name]
+            line = (
+                f"{tier + 1}. {name} ({backend.model_name}): 処理 {self.entered[name]} 行 → "
+                f"確定 {settled} 行 (全体の {settled / max(total_rows, 1):.0%}), "
+                f"検証NG {sum(self.rejected[name].values())} 行, エラー {self.errors[name]} 行"
+            )
+            if latencies:
+                p95 = latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+                line += f" / レイテンシ p50 {statistics.median(latencies):.2f} 秒 p95 {p95:.2f} 秒"
+            line += f" / 入力 {prompt_tokens} トークン, 出力 {output_tokens} トークン"
+            if settled:
+                line += f" (確定1行あたり {(prompt_tokens + output_tokens) / settled:.0f} トークン)"
+            lines.append(line)
+            if self.rejected[name]:
+                lines.append("   検証NGの理由: " + ", ".join(
+                    f"{reason} {count} 行" for reason, count in self.rejected[name].most_common()
+                ))
+        unsettled = total_rows - sum(self.settled.values())
+        lines.append(f"どの段でも確定しなかった行: {unsettled} 行")
+        return '\n'.join(lines)
+
+
+async def route_ladder_async(jobs, backends, validate, on_done, retry_policy=None, telemetry=None):
+    """
+    ジョブを安いモデルから順に試し、ローカルの検証に通らなかった行だけを次の段のモデルに回す
+
+    各段のバックエンドは同時に動き、上の段は下の段から上がってきた行を空き次第処理します。
+    ある段で再試行を使い切ったエラーも次の段に回します。
+
+    Args:
+        jobs: Jobのイテラブル
+        backends: 段の順（安くて速いものから）に並べたバックエンドのリスト
+        validate: validate(job, result_text) が (採用する結果 or None, 不合格の理由) を返す関数
+        on_done: 行が確定するか最後の段でも失敗したときに on_done(job, result, error, backend) を呼び出すコールバック。
+                 error は最後の段での例外、または検証に通らなかった理由の文字列です
+        retry_policy: RetryPolicy（各段で再試行できるエラーに適用）
+        telemetry: Telemetry（Noneならレポート用にファイルに書き出さないものを使います）
+
+    Returns:
+        LadderStats: 段ごとの集計
+    """
+    jobs = list(jobs)
+    if telemetry is None:
+        telemetry = Telemetry()
+    stats = LadderStats(backends, telemetry, len(jobs))
+    last_tier = len(backends) - 1
+
+    def on_tier_done(job, result_text, error, backend):
+        tier = job.meta.get('tier', 0)
+        stats.entered[backend.name] += 1
+        if error is None:
+            result, problem = validate(job, result_text)
+            if result is not None:
+                stats.settled[backend.name] += 1
+                on_done(job, result, None, backend)
+                return False
+            stats.rejected[backend.name][problem] += 1
+            error = problem
+        else:
+            stats.errors[backend.name] += 1
+        if tier < last_tier:
+            # 次の段のモデルに回す（試行回数は段ごとに数え直す）
+            job.meta['tier'] = tier + 1
+            job.meta.pop('attempts', None)
+            job.meta.pop('failed_backends', None)
+            return True
+        on_done(job, None, error, backend)
+        return False
+
+    pool = _JobPool(jobs)
+    workers = [
+        asyncio.create_task(_backend_worker(pool, backend, 1, on_tier_done, retry_policy, telemetry, tier))
+        for tier, backend in enumerate(backends)
+        for _ in range(max(1, backend.max_in_flight))
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+    return stats
+
+
+def route_ladder(jobs, backends, validate, on_done, retry_policy=None, telemetry=None):
+    """
+    route_ladder_async を同期コードから呼び出すためのラッパー
+
+    Args:
+        route_ladder_async と同じ
+    """
+    return asyncio.run(route_ladder_async(jobs, backends, validate, on_done, retry_policy, telemetry))
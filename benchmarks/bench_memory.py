@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+通常の処理とストリーミング処理のメモリ使用量（最大RSS）を比較するベンチマーク
+input_data.csv の 1倍 / 10倍 / 100倍 の行数の合成データで、
+結果CSVからのJSON変換（convert_to_json.py）と日記の生成（flash-liteランナー）を実行します
+
+各計測は別プロセスで行い、プロセスの最大RSSを報告します（Linux / macOS のみ）。
+日記の生成はAPIを呼ばずに、プロセス内の偽のモデルが固定の日記を返します。
+
+使い方:
+    python benchmarks/bench_memory.py --scales 1 10 --scenarios convert
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(project_root)
+sys.path.append(script_dir)
+from mock_llm_server import MockConfig, build_diary_text
+from run_benchmarks import SAMPLE_CSV_FILE, load_runner
+
+# --- 設定項目 ---
+DEFAULT_SCALES = [1, 10, 100] # input_data.csv の何倍の行数で計測するか
+SCENARIOS = ['convert', 'generate']
+MODES = ['batch', 'stream']
+CHUNK_ROWS = 1000 # ストリーミングで一度に読み書きする行数
+GENERATE_CONCURRENCY = 50 # 日記の生成で同時に送信中にしておくリクエスト数
+WORLDS = 9 # JSON変換で行を振り分けるパラレルワールドの数
+
+# --- ここからスクリプト本体 ---
+
+
+class InstantModel:
+    """APIを呼ばずに、固定の日記をすぐに返す genai.GenerativeModel の代わり"""
+
+    text = build_diary_text(MockConfig().output_tokens)
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    async def generate_content_async(self, prompt, stream=False):
+        return _InstantResponse(self.text, len(prompt))
+
+
+class _InstantResponse:
+    def __init__(self, text, prompt_length):
+        self.text = text
+        self.usage_metadata = _Usage(prompt_length, prompt_length + len(text))
+
+    def __aiter__(self):
+        async def chunks():
+            await asyncio.sleep(0)
+            yield self
+        return chunks()
+
+
+class _Usage:
+    def __init__(self, prompt_token_count, total_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.total_token_count = total_token_count
+
+
+def write_synthetic_csv(path, rows, with_results=False):
+    """
+    input_data.csv の行を繰り返して、rows 行の合成データを少しずつ書き出す（親プロセスのメモリを増やさない）
+
+    Args:
+        path: 出力先のCSV
+        rows: 作成する行数
+        with_results: Trueなら convert_to_json.py に渡す結果CSV（生成結果・パラレルワールド名の列つき）の形にする
+    """
+    sample = pd.read_csv(SAMPLE_CSV_FILE)
+    written = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        while written < rows:
+            df = sample.head(rows - written).copy()
+            index = pd.RangeIndex(written, written + len(df))
+            df['ID'] = [f'bench{i:06d}' for i in index]
+            # 同じ行でもプロンプトが変わるように、エピソードタイトルに通し番号を付ける
+            df['エピソードタイトル'] = df['エピソードタイトル'].astype(str) + ' #' + index.astype(str)
+            if with_results:
+                df['生成結果'] = InstantModel.text
+                df['パラレルワールド名'] = [f'パラレルワールド{i % WORLDS + 1}' for i in index]
+            df.to_csv(f, index=False, header=written == 0)
+            written += len(df)
+
+
+def peak_rss_mb():
+    """このプロセスの最大RSS（MB）を返す（ru_maxrss は Linux ではKB、macOS ではバイト単位）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_convert(mode, work_dir):
+    """結果CSVをパラレルワールドごとのJSONに変換する"""
+    sys.path.append(os.path.join(project_root, 'conan-diary-project', 'data'))
+    import convert_to_json
+
+    os.chdir(work_dir)
+    convert_to_json.convert_csv_to_json(stream=mode == 'stream', chunksize=CHUNK_ROWS)
+
+
+def run_generate(mode, work_dir):
+    """flash-liteランナーで入力CSVのすべての行の日記を生成する"""
+    os.environ['LLM_CACHE_PATH'] = os.path.join(work_dir, 'cache.sqlite3')
+    os.environ['LLM_USAGE_PATH'] = os.path.join(work_dir, 'usage.json')
+    module = load_runner('flash-lite')
+    module.genai.GenerativeModel = InstantModel
+    module.INPUT_CSV_FILE = os.path.join(work_dir, 'input.csv')
+    module.OUTPUT_CSV_FILE = os.path.join(work_dir, 'results.csv')
+    module.JOURNAL_FILE = os.path.join(work_dir, 'results.journal.jsonl')
+    module.METRICS_FILE = os.path.join(work_dir, 'metrics.jsonl')
+    module.REQUESTS_PER_MINUTE = 10 ** 9
+    module.TOKENS_PER_MINUTE = 10 ** 12
+    module.REQUESTS_PER_DAY = None
+    module.MAX_CONCURRENT_REQUESTS = GENERATE_CONCURRENCY
+    module.process_prompts(stream=mode == 'stream', chunksize=CHUNK_ROWS)
+
+
+def run_child(scenario, mode, work_dir):
+    """子プロセスとして1つの計測を実行し、結果をJSONで標準出力の最終行に書く"""
+    started = time.monotonic()
+    with open(os.devnull, 'w') as output, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        if scenario == 'convert':
+            run_convert(mode, work_dir)
+        else:
+            run_generate(mode, work_dir)
+    print(json.dumps({'peak_rss_mb': round(peak_rss_mb(), 1), 'seconds': round(time.monotonic() - started, 2)}))
+
+
+def measure(scenario, mode, work_dir):
+    """別プロセスで1つの計測を実行し、最大RSSと所要時間を返す"""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', scenario, mode, work_dir],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_scale(scale, scenarios, sample_rows):
+    """1つの倍率で、各シナリオを通常処理とストリーミング処理の両方で計測する"""
+    rows = sample_rows * scale
+    results = []
+    for scenario in scenarios:
+        for mode in MODES:
+            # 生成結果が前の計測から引き継がれないように、計測ごとに新しい作業ディレクトリを使う
+            with tempfile.TemporaryDirectory() as work_dir:
+                if scenario == 'convert':
+                    input_path = os.path.join(work_dir, 'results.csv')
+                    write_synthetic_csv(input_path, rows, with_results=True)
+                else:
+                    input_path = os.path.join(work_dir, 'input.csv')
+                    write_synthetic_csv(input_path, rows)
+                input_mb = os.path.getsize(input_path) / (1024 * 1024)
+                print(f"{scenario} / {mode} を {rows} 行（{scale}倍, {input_mb:.0f}MB）で計測中...")
+                result = measure(scenario, mode, work_dir)
+            results.append({'scenario': scenario, 'mode': mode, 'scale': scale, 'rows': rows,
+                            'input_mb': round(input_mb, 1), **result})
+    return results
+
+
+def format_table(results):
+    """計測結果を表形式の文字列にする"""
+    header = f"{'シナリオ':<10}{'方式':<8}{'倍率':>6}{'行数':>10}{'入力MB':>10}{'最大RSS MB':>12}{'秒':>10}"
+    lines = [header, '-' * 72]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<12}{r['mode']:<10}{r['scale']:>6}{r['rows']:>12}"
+            f"{r['input_mb']:>12}{r['peak_rss_mb']:>14}{r['seconds']:>11}"
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="通常処理とストリーミング処理の最大RSSを比較します。")
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help="input_data.csv の何倍の行数で計測するか（複数指定可）")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--output', help="計測結果をJSONで保存するファイル")
+    parser.add_argument('--child', nargs=3, metavar=('SCENARIO', 'MODE', 'WORK_DIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    sample_rows = len(pd.read_csv(SAMPLE_CSV_FILE))
+    results = []
+    for scale in args.scales:
+        results += run_scale(scale, args.scenarios, sample_rows)
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n計測結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全文検索の索引（conan-diary-project/data/search_index.py）のベンチマーク
+公開しているJSON（conan-diary-project/data/json_data）の全件から索引を作り直し、
+索引の大きさと、検索語ごとの検索時間・読み込むファイルの量・件数を報告します
+
+件数は、すべての日記の本文を毎回走査して検索語を探した場合（総当たり）と比べます。
+bigramの索引は、検索語のbigramがすべて含まれていれば一致とみなすため、総当たりより多い分が誤検出です。
+
+使い方:
+    python benchmarks/bench_search.py
+    python benchmarks/bench_search.py --queries 毛利蘭 密室 --repeat 50
+"""
+
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(project_root, 'conan-diary-project', 'data'))
+from search_index import SEARCH_COLUMNS, SearchIndex, SearchIndexBuilder, normalize, text_runs
+
+# --- 設定項目 ---
+JSON_DIR = os.path.join(project_root, 'conan-diary-project', 'data', 'json_data')
+# 人物・トリック・場所・1文字・複数語・半角カナ・英字・見つからない語
+DEFAULT_QUERIES = ['毛利蘭', '黒ずくめ', '密室', 'アリバイ', '米花町', '蘭', '灰原 博士', 'ｱﾘﾊﾞｲ', 'APTX', '存在しない語句']
+DEFAULT_REPEAT = 20 # 索引を読み込んだ後の検索時間を何回の中央値にするか
+
+# --- ここからスクリプト本体 ---
+
+
+def load_corpus(json_dir):
+    """公開しているJSONから、Webサイトの表示順に (ID, 検索の対象の文字列のリスト) を読み込む"""
+    with open(os.path.join(json_dir, 'worlds.json'), encoding='utf-8') as f:
+        worlds = json.load(f)
+    corpus = []
+    for world in worlds:
+        with open(os.path.join(json_dir, world['index']), encoding='utf-8') as f:
+            entries = json.load(f)['entries']
+        bodies = {}
+        for chunk in sorted({entry['本文'] for entry in entries}):
+            with open(os.path.join(json_dir, world['bodies'], f'{chunk}.json'), encoding='utf-8') as f:
+                bodies.update(json.load(f))
+        for entry in entries:
+            body = bodies.get(entry['ID'], {})
+            corpus.append((entry['ID'], [body.get(column) for column in SEARCH_COLUMNS]))
+    return corpus
+
+
+def build_index(corpus, search_dir):
+    """索引を作って書き出し、所要時間と大きさを返す"""
+    started = time.perf_counter()
+    builder = SearchIndexBuilder()
+    for entry_id, texts in corpus:
+        builder.add(entry_id, texts)
+    files = builder.files([entry_id for entry_id, _ in corpus])
+    seconds = time.perf_counter() - started
+
+    sizes, gzip_bytes, bigrams = {}, 0, 0
+    for filename, value in files.items():
+        data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with open(os.path.join(search_dir, filename), 'wb') as f:
+            f.write(data)
+        sizes[filename] = len(data)
+        gzip_bytes += len(gzip.compress(data))
+        if filename != 'docs.json':
+            bigrams += len(value)
+    shard_sizes = [size for filename, size in sizes.items() if filename != 'docs.json']
+    return {
+        'documents': len(corpus),
+        'bigrams': bigrams,
+        'build_seconds': round(seconds, 2),
+        'files': len(sizes),
+        'total_kb': round(sum(sizes.values()) / 1024, 1),
+        'gzip_kb': round(gzip_bytes / 1024, 1),
+        'median_shard_kb': round(statistics.median(shard_sizes) / 1024, 1),
+        'max_shard_kb': round(max(shard_sizes) / 1024, 1),
+    }
+
+
+def brute_force(texts, query):
+    """正規化した本文をすべて走査して、検索語をすべて含む日記の番号を返す"""
+    terms = text_runs(query)
+    return [number for number, text in enumerate(texts) if terms and all(term in text for term in terms)]
+
+
+def measure_query(search_dir, texts, query, repeat):
+    """1つの検索語について、初回（索引のファイルの読み込みを含む）と2回目以降の検索時間を計る"""
+    index = SearchIndex(search_dir)
+    started = time.perf_counter()
+    results = index.search(query)
+    cold_ms = (time.perf_counter() - started) * 1000
+    warm = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        index.search(query)
+        warm.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    exact = brute_force(texts, query)
+    scan_ms = (time.perf_counter() - started) * 1000
+    return {
+        'query': query,
+        'results': len(results),
+        'exact': len(exact),
+        'cold_ms': round(cold_ms, 2),
+        'warm_ms': round(statistics.median(warm), 2),
+        'scan_ms': round(scan_ms, 2),
+        'shards': index.shards_loaded,
+        'read_kb': round(index.bytes_read / 1024, 1),
+    }
+
+
+def display_width(text):
+    """端末での表示幅（全角文字は2、半角カナと英数字は1）"""
+    return sum(1 if ord(char) < 0x80 or 0xff61 <= ord(char) <= 0xff9f else 2 for char in text)
+
+
+def cell(value, width, left=False):
+    """表示幅を考えて、値を width 桁にそろえる"""
+    text = str(value)
+    padding = ' ' * max(0, width - display_width(text))
+    return text + padding if left else padding + text
+
+
+def format_report(size, queries):
+    """計測結果を表形式の文字列にする"""
+    columns = [('検索語', 'query', 16), ('件数', 'results', 6), ('総当たり', 'exact', 10), ('初回ms', 'cold_ms', 9),
+               ('2回目ms', 'warm_ms', 9), ('総当たりms', 'scan_ms', 12), ('ファイル', 'shards', 10), ('読込KB', 'read_kb', 9)]
+    lines = [
+        f"日記 {size['documents']} 件, bigram {size['bigrams']} 種類, 作成 {size['build_seconds']} 秒",
+        f"索引: ファイル {size['files']} 個, 合計 {size['total_kb']} KB（gzip {size['gzip_kb']} KB）, "
+        f"1ファイルの中央値 {size['median_shard_kb']} KB, 最大 {size['max_shard_kb']} KB",
+        '',
+        ''.join(cell(title, width, left=key == 'query') for title, key, width in columns),
+        '-' * sum(width for _, _, width in columns),
+    ]
+    for q in queries:
+        lines.append(''.join(cell(q[key], width, left=key == 'query') for _, key, width in columns))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全文検索の索引の大きさと検索時間を計測します。")
+    parser.add_argument('--json-dir', default=JSON_DIR, help="convert_to_json.py の出力先（worlds.json のあるディレクトリ）")
+    parser.add_argument('--queries', nargs='+', default=DEFAULT_QUERIES, help="計測する検索語")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="2回目以降の検索時間を何回の中央値にするか")
+    parser.add_argument('--output', help="計測結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.json_dir)
+    texts = [normalize('\n'.join(text for text in texts if isinstance(text, str))) for _, texts in corpus]
+    with tempfile.TemporaryDirectory() as search_dir:
+        size = build_index(corpus, search_dir)
+        queries = [measure_query(search_dir, texts, query, max(1, args.repeat)) for query in args.queries]
+
+    print(format_report(size, queries))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'index': size, 'queries': queries}, f, ensure_ascii=False, indent=2)
+        print(f"\n計測結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gemini API（REST）とOllamaの /api/chat を模したローカルのモックサーバー
+レイテンシの分布、トークンの生成速度、429の発生、5xx、壊れた応答を設定でき、
+実際のクォータを使わずにバッチ処理のスループットを計測できます
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+from llm_executor import estimate_tokens
+
+_GEMINI_PATH = re.compile(r'^/v1beta/models/(?P<model>[^:]+):(?P<method>generateContent|streamGenerateContent)')
+
+# 生成する日記の見出し（本文はトークン数に合わせて埋める）
+_DIARY_SECTIONS = [
+    '導入 - 平穏と予感',
+    '遭遇 - 事件の第一印象',
+    '捜査と違和感 - 見えざるヒント',
+    '閃き - 真実への道筋',
+    '真相解明 - 探偵の役割',
+    '結びと内省 - 事件の後に',
+]
+
+
+@dataclass
+class MockConfig:
+    """モックサーバーの振る舞いの設定"""
+    latency_median: float = 0.2  # 最初のトークンまでの時間の中央値（秒）
+    latency_sigma: float = 0.5  # 最初のトークンまでの時間の対数正規分布のばらつき
+    tokens_per_second: float = 400.0  # 1リクエストあたりの出力トークンの生成速度
+    output_tokens: int = 800  # 1リクエストあたりの出力トークン数
+    stream_chunks: int = 4  # ストリーミング時に分割して送るチャンク数
+    quota_rpm: int = None  # 直近60秒のリクエスト数がこれを超えると429を返す（Noneなら無制限）
+    burst_429_rate: float = 0.0  # 1秒ごとに429のバーストが始まる確率
+    burst_429_seconds: float = 5.0  # 429のバーストが続く秒数
+    error_5xx_rate: float = 0.0  # 503を返す確率
+    malformed_rate: float = 0.0  # 壊れた応答を返す確率
+    retry_after: float = 2.0  # 429のときに返す再試行までの待ち時間（秒）
+
+
+def build_diary_text(output_tokens):
+    """出力トークン数に見合う長さの、日記のテンプレートに沿ったテキストを作る"""
+    per_section = max(1, output_tokens // len(_DIARY_SECTIONS))
+    lines = ['## 2024年1月1日', '', '### モックのエピソード', '']
+    for section in _DIARY_SECTIONS:
+        lines += [f'### **{section}**', '', 'あ' * per_section, '']
+    return '\n'.join(lines)
+
+
+class MockLLMServer:
+    """
+    設定に従って応答するモックサーバー
+
+    start() で別スレッドで起動し、gemini_endpoint / ollama_endpoint を各クライアントに渡します。
+    stats に応答の種類ごとの件数を数えます。
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._burst_until = 0.0
+        self._burst_checked_at = time.monotonic()
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def gemini_endpoint(self):
+        """genai.configure(client_options={'api_endpoint': ...}) に渡すURL"""
+        return self.base_url
+
+    @property
+    def ollama_endpoint(self):
+        """Ollamaクライアントに渡す /api/chat のURL"""
+        return f'{self.base_url}/api/chat'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+            self._recent.clear()
+
+    def decide(self):
+        """
+        次のリクエストに返す応答の種類を決める
+
+        Returns:
+            str: 'ok', 'quota', 'server_error', 'malformed' のいずれか
+        """
+        config = self.config
+        now = time.monotonic()
+        with self._lock:
+            self.stats['requests'] += 1
+            # 1秒ごとに429のバーストを始めるかを抽選する
+            while self._burst_checked_at + 1 <= now:
+                self._burst_checked_at += 1
+                if config.burst_429_rate and random.random() < config.burst_429_rate:
+                    self._burst_until = max(self._burst_until, self._burst_checked_at + config.burst_429_seconds)
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+
+            if now < self._burst_until or (config.quota_rpm and len(self._recent) >= config.quota_rpm):
+                kind = 'quota'
+            elif random.random() < config.error_5xx_rate:
+                kind = 'server_error'
+            elif random.random() < config.malformed_rate:
+                kind = 'malformed'
+            else:
+                kind = 'ok'
+            if kind != 'quota':
+                self._recent.append(now)
+            self.stats[kind] += 1
+        return kind
+
+    def first_token_delay(self):
+        config = self.config
+        if config.latency_median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(config.latency_median), config.latency_sigma)
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # Ollamaはルートにアクセスすると "Ollama is running" と返す
+        self._send(200, b'Ollama is running', 'text/plain')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            payload = json.loads(body or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {'error': 'invalid json'})
+            return
+
+        gemini = _GEMINI_PATH.match(self.path)
+        if gemini:
+            self._gemini(payload, stream=gemini.group('method') == 'streamGenerateContent')
+        elif self.path.startswith('/api/chat'):
+            self._ollama(payload)
+        else:
+            self._send_json(404, {'error': f'unknown path: {self.path}'})
+
+    # --- Gemini ---
+
+    def _gemini(self, payload, stream):
+        kind = self.mock.decide()
+        config = self.mock.config
+        if kind == 'quota':
+            message = f'Resource has been exhausted (e.g. check quota). Please retry in {config.retry_after}s.'
+            self._send_json(429, {'error': {'code': 429, 'message': message, 'status': 'RESOURCE_EXHAUSTED'}},
+                            {'Retry-After': str(config.retry_after)})
+            return
+        if kind == 'server_error':
+            self._send_json(503, {'error': {'code': 503, 'message': 'The model is overloaded.', 'status': 'UNAVAILABLE'}})
+            return
+
+        prompt = ''.join(
+            part.get('text', '') for content in payload.get('contents', []) for part in content.get('parts', [])
+        )
+        prompt_tokens = estimate_tokens(prompt)
+        text = build_diary_text(config.output_tokens)
+        chunks = _split(text, config.stream_chunks if stream else 1)
+        usage = {
+            'promptTokenCount': prompt_tokens,
+            'candidatesTokenCount': config.output_tokens,
+            'totalTokenCount': prompt_tokens + config.output_tokens,
+        }
+
+        time.sleep(self.mock.first_token_delay())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        if kind == 'malformed':
+            self.wfile.write(b'[{"candidates": [{"content": {"parts": [{"te' if stream else b'{"candidates": [')
+            return
+
+        responses = [
+            {
+                'candidates': [{
+                    'content': {'parts': [{'text': chunk}], 'role': 'model'},
+                    **({'finishReason': 'STOP'} if i == len(chunks) - 1 else {}),
+                }],
+                'usageMetadata': usage,
+            }
+            for i, chunk in enumerate(chunks)
+        ]
+        if not stream:
+            self.wfile.write(json.dumps(responses[0], ensure_ascii=False).encode('utf-8'))
+            return
+        # REST版のストリーミングはJSON配列を少しずつ送る形式
+        for i, response in enumerate(responses):
+            if i:
+                time.sleep(self._chunk_seconds(len(chunks)))
+            prefix = b'[' if i == 0 else b','
+            self.wfile.write(prefix + json.dumps(response, ensure_ascii=False).encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b']')
+
+    # --- Ollama ---
+
+    def _ollama(self, payload):
+        kind = self.mock.decide()
+        config = self.mock.config
+        if kind == 'quota':
+            self._send_json(429, {'error': 'server busy'}, {'Retry-After': str(config.retry_after)})
+            return
+        if kind == 'server_error':
+            self._send_json(503, {'error': 'model is loading'})
+            return
+
+        prompt = ''.join(message.get('content', '') for message in payload.get('messages', []))
+        chunks = _split(build_diary_text(config.output_tokens), config.stream_chunks)
+
+        time.sleep(self.mock.first_token_delay())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        started = time.monotonic()
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self._chunk_seconds(len(chunks)))
+            if kind == 'malformed' and i == len(chunks) // 2:
+                self.wfile.write(b'{"message": {"content": \n')
+                return
+            line = {'model': payload.get('model'), 'message': {'role': 'assistant', 'content': chunk}, 'done': False}
+            self.wfile.write(json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        eval_duration = time.monotonic() - started
+        done = {
+            'model': payload.get('model'),
+            'message': {'role': 'assistant', 'content': ''},
+            'done': True,
+            'prompt_eval_count': estimate_tokens(prompt),
+            'eval_count': config.output_tokens,
+            'eval_duration': int(eval_duration * 1e9),
+        }
+        self.wfile.write(json.dumps(done).encode('utf-8') + b'\n')
+
+    # --- 共通 ---
+
+    def _chunk_seconds(self, chunk_count):
+        config = self.mock.config
+        if not config.tokens_per_second or chunk_count < 2:
+            return 0.0
+        return config.output_tokens / config.tokens_per_second / (chunk_count - 1)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+
+def _split(text, count):
+    count = max(1, count)
+    size = math.ceil(len(text) / count)
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini / Ollama を模したモックサーバーを起動します。")
+    parser.add_argument('--port', type=int, default=8089)
+    for field in fields(MockConfig):
+        option_type = float if field.type in (float, 'float') else int
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=option_type, default=field.default)
+    args = parser.parse_args()
+
+    config = MockConfig(**{field.name: getattr(args, field.name) for field in fields(MockConfig)})
+    server = MockLLMServer(config, port=args.port).start()
+    print(f"モックサーバーを起動しました: Gemini {server.gemini_endpoint} / Ollama {server.ollama_endpoint}")
+    print("Ctrl+C で終了します。")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+各バッチ処理スクリプトをモックサーバーに向けて実行し、スループットを計測するベンチマーク
+input_data.csv の形式で合成した 100 / 1,000 / 10,000 行を処理して、
+1分あたりの処理行数・クォータの使用率・1行あたりのオーバーヘッドを報告します
+
+使い方:
+    python benchmarks/run_benchmarks.py --rows 100 1000 --runners flash local
+"""
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(project_root)
+sys.path.append(script_dir)
+from diary_prompt import build_prompt
+from llm_telemetry import load_records
+from mock_llm_server import MockConfig, MockLLMServer
+
+# --- 設定項目 ---
+SAMPLE_CSV_FILE = os.path.join(project_root, 'create-dailylog-flash-lite-v2', 'input_data.csv')
+DEFAULT_ROWS = [100, 1000, 10000]
+DEFAULT_RPM = 3000 # ベンチマーク中に各Geminiランナーに設定するRPM（実際のクォータとは無関係）
+DEFAULT_TPM = 10000000 # 同じくTPM
+
+# ランナー名 -> (スクリプトのパス, 入力の形式, バックエンドの種類)
+RUNNERS = {
+    'flash-lite': ('create-dailylog-flash-lite-v2/run_gemini_batch-lite.py', 'episodes', 'gemini'),
+    'flash': ('create-dailylog-flash/run_gemini_batch-flash.py', 'prompts', 'gemini'),
+    'pro': ('create-dailylog-pro/run_gemini_batch.py', 'prompts', 'gemini'),
+    'local': ('create-dailylog-local/run_gemini_batch-local.py', 'prompts', 'ollama'),
+    'router': ('create-dailylog-router/run_batch_router.py', 'episodes', 'mixed'),
+}
+
+# --- ここからスクリプト本体 ---
+
+
+class ThreadedRestModel:
+    """
+    REST接続の genai.GenerativeModel をスレッドで呼び出し、generate_content_async と同じ形で返すモデル
+
+    google.generativeai の非同期クライアントはgRPC専用で、任意のエンドポイントには向けられないため、
+    ベンチマークでは同期のRESTクライアントをスレッドで並列に呼び出します。
+    ストリーミングの応答はスレッド内で最後まで受け取ってから返すので、最初のトークンまでの時間は
+    全体のレイテンシとほぼ同じになります。
+    """
+
+    original_class = None
+
+    def __init__(self, model_name, **kwargs):
+        self._model = self.original_class(model_name, **kwargs)
+        self.model_name = self._model.model_name
+
+    def generate_content(self, prompt, **kwargs):
+        return self._model.generate_content(prompt, **kwargs)
+
+    async def generate_content_async(self, prompt, stream=False):
+        response = await asyncio.to_thread(self._resolve, prompt, stream)
+        return _ResolvedResponse(response)
+
+    def _resolve(self, prompt, stream):
+        response = self._model.generate_content(prompt, stream=stream)
+        if stream:
+            for _ in response:
+                pass
+        return response
+
+
+class _ResolvedResponse:
+    """受け取り済みの応答を async for で1回だけ返す"""
+
+    def __init__(self, response):
+        self._response = response
+        self.text = response.text
+        self.usage_metadata = response.usage_metadata
+
+    def __aiter__(self):
+        async def chunks():
+            yield self._response
+        return chunks()
+
+
+def configure_mock_gemini(server):
+    """google.generativeai をモックサーバーに向ける"""
+    import google.generativeai as genai
+
+    genai.configure(api_key='benchmark', transport='rest', client_options={'api_endpoint': server.gemini_endpoint})
+    if ThreadedRestModel.original_class is None:
+        ThreadedRestModel.original_class = genai.GenerativeModel
+    genai.GenerativeModel = ThreadedRestModel
+
+
+def make_synthetic_rows(rows, sample_csv=SAMPLE_CSV_FILE):
+    """
+    input_data.csv の行を繰り返し使い、IDを振り直した合成データを作る
+
+    Args:
+        rows: 作成する行数
+        sample_csv: 元にするCSV
+
+    Returns:
+        pandas.DataFrame: input_data.csv と同じ列を持つ合成データ
+    """
+    sample = pd.read_csv(sample_csv)
+    repeats = -(-rows // len(sample))
+    df = pd.concat([sample] * repeats, ignore_index=True).head(rows).copy()
+    df['ID'] = [f'bench{i:06d}' for i in range(rows)]
+    # 同じ行でもプロンプトが変わるように、エピソードタイトルに通し番号を付ける
+    df['エピソードタイトル'] = df['エピソードタイトル'].astype(str) + ' #' + df.index.astype(str)
+    return df
+
+
+def load_runner(name):
+    """ランナーのスクリプトをモジュールとして読み込む（ファイル名にハイフンを含むため importlib で読む）"""
+    path = os.path.join(project_root, RUNNERS[name][0])
+    spec = importlib.util.spec_from_file_location(f'benchmark_{name.replace("-", "_")}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def configure_runner(name, module, server, work_dir, input_csv, rpm, tpm):
+    """ランナーの設定項目を、ベンチマーク用の入出力とモックサーバーに差し替える"""
+    module.INPUT_CSV_FILE = input_csv
+    module.OUTPUT_CSV_FILE = os.path.join(work_dir, 'results.csv')
+    module.JOURNAL_FILE = os.path.join(work_dir, 'results.journal.jsonl')
+    module.METRICS_FILE = os.path.join(work_dir, 'metrics.jsonl')
+
+    if name == 'local':
+        module.LOCAL_API_ENDPOINT = server.ollama_endpoint
+        return {'max_in_flight': module.MAX_PARALLEL_REQUESTS, 'local_backends': {'ollama'}}
+    if name == 'router':
+        backends = copy.deepcopy(module.BACKENDS)
+        for backend in backends:
+            if backend['type'] == 'ollama':
+                backend['endpoint'] = server.ollama_endpoint
+            else:
+                backend['requests_per_minute'] = rpm
+                backend['tokens_per_minute'] = tpm
+                backend['requests_per_day'] = None
+        module.BACKENDS = backends
+        return {
+            'rpm': sum(b['requests_per_minute'] for b in backends if b['type'] == 'gemini'),
+            'tpm': sum(b['tokens_per_minute'] for b in backends if b['type'] == 'gemini'),
+            'max_in_flight': sum(b['max_in_flight'] for b in backends),
+            'local_backends': {b['name'] for b in backends if b['type'] == 'ollama'},
+        }
+    module.REQUESTS_PER_MINUTE = rpm
+    module.TOKENS_PER_MINUTE = tpm
+    module.REQUESTS_PER_DAY = None
+    return {'rpm': rpm, 'tpm': tpm, 'max_in_flight': module.MAX_CONCURRENT_REQUESTS, 'local_backends': set()}
+
+
+def run_benchmark(name, rows, server, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, verbose=False):
+    """
+    1つのランナーを rows 行で実行して計測する
+
+    Returns:
+        dict: 計測結果
+    """
+    input_kind = RUNNERS[name][1]
+    with tempfile.TemporaryDirectory() as work_dir:
+        df = make_synthetic_rows(rows)
+        if input_kind == 'prompts':
+            df = pd.DataFrame({'ID': df['ID'], '生成プロンプト': [build_prompt(r) for r in df.to_dict('records')]})
+        input_csv = os.path.join(work_dir, 'input.csv')
+        df.to_csv(input_csv, index=False)
+
+        # 前回のベンチマークの結果がキャッシュから返らないように、実行ごとに空のキャッシュを使う
+        os.environ['LLM_CACHE_PATH'] = os.path.join(work_dir, 'cache.sqlite3')
+        # 1日の使用量も実行ごとに空のファイルに記録する（実際のクォータの記録を増やさない）
+        os.environ['LLM_USAGE_PATH'] = os.path.join(work_dir, 'usage.json')
+        module = load_runner(name)
+        limits = configure_runner(name, module, server, work_dir, input_csv, rpm, tpm)
+        server.reset_stats()
+
+        output = None if verbose else open(os.devnull, 'w')
+        started = time.monotonic()
+        with contextlib.ExitStack() as stack:
+            if output is not None:
+                stack.enter_context(output)
+                stack.enter_context(contextlib.redirect_stdout(output))
+                stack.enter_context(contextlib.redirect_stderr(output))
+            module.process_prompts()
+        wall_seconds = time.monotonic() - started
+
+        results = pd.read_csv(module.OUTPUT_CSV_FILE)
+        records = load_records(module.METRICS_FILE) if os.path.exists(module.METRICS_FILE) else []
+
+    completed = int((results['ステータス'] == '完了').sum())
+    calls = len(records)
+    latency_total = sum(r['latency'] for r in records)
+    # TPMの対象になるのはGeminiへの呼び出しだけ
+    tokens = sum(r['prompt_tokens'] + r['output_tokens'] for r in records if r['backend'] not in limits['local_backends'])
+    max_in_flight = limits['max_in_flight']
+    # 理想的な所要時間: RPM・TPMで決まる時間と、全レイテンシを同時実行数で割った時間の長い方
+    ideal_seconds = latency_total / max_in_flight
+    quota_utilisation = None
+    if limits.get('rpm'):
+        ideal_seconds = max(ideal_seconds, calls * 60 / limits['rpm'], tokens * 60 / limits['tpm'])
+        # RPMとTPMのうち、使い切りに近い方をクォータの使用率とする
+        quota_utilisation = max(calls / limits['rpm'], tokens / limits['tpm']) * 60 / wall_seconds
+
+    return {
+        'runner': name,
+        'rows': rows,
+        'completed': completed,
+        'wall_seconds': round(wall_seconds, 2),
+        'rows_per_minute': round(completed * 60 / wall_seconds, 1) if wall_seconds else 0.0,
+        'calls': calls,
+        'server_stats': dict(server.stats),
+        'quota_utilisation': round(quota_utilisation, 3) if quota_utilisation is not None else None,
+        'slot_utilisation': round(latency_total / (wall_seconds * max_in_flight), 3) if wall_seconds else 0.0,
+        'overhead_ms_per_row': round(max(0.0, wall_seconds - ideal_seconds) * 1000 / max(rows, 1), 2),
+    }
+
+
+def format_table(results):
+    """計測結果を表形式の文字列にする"""
+    header = f"{'ランナー':<12}{'行数':>8}{'完了':>8}{'秒':>10}{'行/分':>10}{'クォータ使用率':>14}{'同時実行使用率':>14}{'ms/行':>10}"
+    lines = [header, '-' * 86]
+    for r in results:
+        quota = f"{r['quota_utilisation']:.0%}" if r['quota_utilisation'] is not None else '-'
+        lines.append(
+            f"{r['runner']:<12}{r['rows']:>10}{r['completed']:>10}{r['wall_seconds']:>11}"
+            f"{r['rows_per_minute']:>12}{quota:>18}{r['slot_utilisation']:>18.0%}{r['overhead_ms_per_row']:>12}"
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モックサーバーに対して各ランナーのスループットを計測します。")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help="処理する行数（複数指定可）")
+    parser.add_argument('--runners', nargs='+', choices=sorted(RUNNERS), default=sorted(RUNNERS))
+    parser.add_argument('--rpm', type=int, default=DEFAULT_RPM, help="各Geminiランナーに設定するRPM")
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TPM, help="各Geminiランナーに設定するTPM")
+    parser.add_argument('--latency', type=float, default=0.05, help="最初のトークンまでの時間の中央値（秒）")
+    parser.add_argument('--tokens-per-second', type=float, default=20000.0)
+    parser.add_argument('--quota-rpm', type=int, default=None, help="モックサーバー側のRPM上限（超えると429）")
+    parser.add_argument('--burst-429-rate', type=float, default=0.0)
+    parser.add_argument('--error-5xx-rate', type=float, default=0.0)
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--output', help="計測結果をJSONで保存するファイル")
+    parser.add_argument('--verbose', action='store_true', help="ランナーの出力を表示する")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_median=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        quota_rpm=args.quota_rpm,
+        burst_429_rate=args.burst_429_rate,
+        error_5xx_rate=args.error_5xx_rate,
+        malformed_rate=args.malformed_rate,
+        retry_after=0.5,
+    )
+    server = MockLLMServer(config).start()
+    configure_mock_gemini(server)
+    print(f"モックサーバー: {server.base_url}")
+
+    results = []
+    try:
+        for rows in args.rows:
+            for name in args.runners:
+                print(f"{name} を {rows} 行で計測中...")
+                results.append(run_benchmark(name, rows, server, args.rpm, args.tpm, args.verbose))
+    finally:
+        server.stop()
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n計測結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
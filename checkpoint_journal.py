@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+追記専用のチェックポイントジャーナル
+処理済みの行を1行ずつJSONLに追記・fsyncし、結果CSVはジャーナルから再構築します
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+
+from results_store import ATTEMPTS_COLUMN, MODEL_COLUMN, read_table, write_table
+
+KEY_COLUMN = 'ID'
+
+# 生成結果とは別に、行ごとの処理状態と失敗理由を記録する列
+STATUS_COLUMN = 'ステータス'
+ERROR_COLUMN = 'エラー内容'
+STATUS_DONE = '完了'
+STATUS_FAILED = '失敗'
+
+# ステータス列を導入する前に、エラーメッセージを生成結果に書き込んでいた頃の接頭辞
+LEGACY_ERROR_PREFIXES = ('APIエラー:', 'タイムアウト:', 'APIリクエストエラー:', 'レスポンス形式エラー:', '予期せぬエラー:')
+
+
+def _is_legacy_error(text):
+    return isinstance(text, str) and text.startswith(LEGACY_ERROR_PREFIXES)
+
+
+def _parse_record(raw_line):
+    line = raw_line.strip()
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        # 書き込み途中で中断された行
+        return None
+    if STATUS_COLUMN not in record:
+        # ステータス列がない古いジャーナルは、生成結果の内容から判定する
+        failed = _is_legacy_error(record.get('生成結果'))
+        record[STATUS_COLUMN] = STATUS_FAILED if failed else STATUS_DONE
+    return record
+
+
+def row_keys(df):
+    """
+    DataFrameの各行をジャーナル上で識別するキーを返す
+
+    ID列があればその値を、なければ行番号を文字列にして使います。
+
+    Args:
+        df: 入力データのDataFrame
+
+    Returns:
+        pandas.Series: 行ごとのキー
+    """
+    if KEY_COLUMN in df.columns:
+        return df[KEY_COLUMN].astype(str)
+    return df.index.to_series().astype(str)
+
+
+class CheckpointJournal:
+    """
+    キーごとの処理結果をJSONL形式で追記していくジャーナル
+
+    同じキーが複数回記録された場合は、後に書かれたものが有効になります。
+    書き込み途中でクラッシュした末尾の壊れた行は読み込み時に無視します。
+    ステータスが「失敗」の行は未処理として扱われ、次回の実行で再試行されます。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._reader = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def iter_records(self):
+        """
+        ジャーナルのレコードを先頭から1件ずつ読み込む（ファイル全体をメモリに載せない）
+
+        Yields:
+            tuple: (ファイル内の位置, レコード)。同じキーのレコードは後のものほど後に出てきます
+        """
+        if not self.exists():
+            return
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for raw_line in f:
+                line_offset, offset = offset, offset + len(raw_line)
+                record = _parse_record(raw_line)
+                if record is not None:
+                    yield line_offset, record
+
+    def load(self):
+        """
+        ジャーナルを読み込む
+
+        Returns:
+            dict: キー -> 最新のレコード
+        """
+        return {str(record[KEY_COLUMN]): record for _, record in self.iter_records()}
+
+    def index(self):
+        """
+        本文を保持せずに、キーごとの最新のレコードの位置とステータスを読み込む
+
+        大きなジャーナルから結果を少しずつ書き出す場合に、read_at() と組み合わせて使います。
+
+        Returns:
+            dict: キー -> (ステータス, 記録時刻, ファイル内の位置)
+        """
+        return {
+            str(record[KEY_COLUMN]): (record[STATUS_COLUMN], record.get('completed_at', ''), offset)
+            for offset, record in self.iter_records()
+        }
+
+    def read_at(self, offset):
+        """index() で得た位置のレコードを読み込む"""
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        self._reader.seek(offset)
+        return _parse_record(self._reader.readline())
+
+    def _open_for_append(self):
+        # 書き込み途中で中断された行が末尾に残っていたら、改行で終わらせてから追記する
+        # （そのまま続けて書くと、追記したレコードも壊れた行の一部になって読み込めなくなる）
+        truncated = False
+        if self.exists() and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b'\n'
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if truncated:
+            self._file.write('\n')
+
+    def append(self, key, **fields):
+        """
+        1件分のレコードを追記し、ディスクに確実に書き出す
+
+        Args:
+            key: 行のキー
+            **fields: 保存する列名と値（ステータスを省略した場合は「完了」になります）
+        """
+        if self._file is None:
+            self._open_for_append()
+        fields.setdefault(STATUS_COLUMN, STATUS_DONE)
+        record = {KEY_COLUMN: str(key), **fields, 'completed_at': datetime.now().isoformat(timespec='seconds')}
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append_failure(self, key, error_message, **fields):
+        """
+        再試行を使い切って失敗した行を記録する（生成結果は空のまま）
+
+        Args:
+            key: 行のキー
+            error_message: 失敗の理由
+            **fields: 追加で保存する列名と値
+        """
+        self.append(key, **{STATUS_COLUMN: STATUS_FAILED, ERROR_COLUMN: error_message, **fields})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def seed_from_results(self, df_results, result_column='生成結果'):
+        """
+        既存の結果CSVから処理済みの行をジャーナルに取り込む（旧形式からの移行用）
+
+        Args:
+            df_results: 既存の結果CSVのDataFrame
+            result_column: 結果が入っている列名
+
+        Returns:
+            int: 取り込んだ行数
+        """
+        if result_column not in df_results.columns:
+            return 0
+        done = ~results_pending_mask(df_results, result_column)
+        df_done = df_results[done]
+        # 結果ストアから取り込む場合は、試行回数とモデル名も引き継ぐ
+        carried = [column for column in (ATTEMPTS_COLUMN, MODEL_COLUMN) if column in df_done.columns]
+        for key, row in zip(row_keys(df_done), df_done[[result_column, *carried]].to_dict('records')):
+            self.append(key, **{column: value for column, value in row.items() if not pd.isna(value)})
+        return int(done.sum())
+
+
+def pending_mask(df_input, records):
+    """
+    ジャーナルに記録されていない、または失敗として記録された（未処理の）行を示すブール配列を返す
+
+    Args:
+        df_input: 入力データのDataFrame
+        records: CheckpointJournal.load() の戻り値
+
+    Returns:
+        pandas.Series: 未処理ならTrue
+    """
+    done_keys = [key for key, record in records.items() if record.get(STATUS_COLUMN) != STATUS_FAILED]
+    return ~row_keys(df_input).isin(done_keys)
+
+
+def results_pending_mask(df_results, result_column='生成結果'):
+    """
+    結果テーブル（CSVまたは結果ストア）で、まだ完了していない行を示すブール配列を返す
+
+    ステータス列があればその列だけで判定します。ステータス列がない古いCSVでは、
+    生成結果が空の行とエラーメッセージが書き込まれた行を未処理として扱います。
+
+    Args:
+        df_results: 結果のDataFrame
+        result_column: 結果が入っている列名
+
+    Returns:
+        pandas.Series: 未処理ならTrue
+    """
+    if STATUS_COLUMN in df_results.columns:
+        return df_results[STATUS_COLUMN].astype(str) != STATUS_DONE
+    results = df_results[result_column]
+    return results.isna() | (results.astype(str).str.strip() == '') | results.map(_is_legacy_error)
+
+
+def rebuild_results(df_input, records, result_columns=('生成結果',)):
+    """
+    入力データとジャーナルから結果テーブルを再構築する
+
+    結果列の後ろにステータス列とエラー内容列、試行回数とモデル名の列を加えます
+    （試行回数とモデル名の列は結果ストアにだけ保存されます）。
+
+    Args:
+        df_input: 入力データのDataFrame
+        records: CheckpointJournal.load() の戻り値
+        result_columns: ジャーナルから取り出す列名
+
+    Returns:
+        pandas.DataFrame: 入力データの列に結果列を加えたもの
+    """
+    df = df_input.copy()
+    keys = row_keys(df)
+    for column in (*result_columns, STATUS_COLUMN, ERROR_COLUMN, MODEL_COLUMN):
+        df[column] = keys.map(lambda k: records.get(k, {}).get(column, ''))
+    df[ATTEMPTS_COLUMN] = keys.map(lambda k: records.get(k, {}).get(ATTEMPTS_COLUMN)).astype('Int32')
+    return df
+
+
+def write_results(df_input, journal, output_csv, result_columns=('生成結果',), **to_csv_kwargs):
+    """
+    ジャーナルから結果CSV（または結果ストア）を再構築して一時ファイル経由で書き出す
+
+    Args:
+        df_input: 入力データのDataFrame
+        journal: CheckpointJournal
+        output_csv: 出力先のパス（拡張子が .parquet なら結果ストア）
+        result_columns: ジャーナルから取り出す列名
+        **to_csv_kwargs: DataFrame.to_csv に渡す追加の引数
+    """
+    df = rebuild_results(df_input, journal.load(), result_columns)
+    write_table(df, output_csv, **to_csv_kwargs)
+    return df
+
+
+if __name__ == "__main__":
+    # 使い方: python checkpoint_journal.py <journal.jsonl> <input.csv> <results.csv>
+    if len(sys.argv) != 4:
+        print("使い方: python checkpoint_journal.py <journal.jsonl> <input.csv> <results.csv>")
+        sys.exit(1)
+    journal_path, input_csv, output_csv = sys.argv[1:]
+    df = write_results(read_table(input_csv), CheckpointJournal(journal_path), output_csv)
+    print(f"'{output_csv}' をジャーナルから再構築しました。({len(df)} 行)")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公開用のデータの束（バンドル）を作るスクリプト（convert_to_json.py の後に実行する）
+
+json_data の各JSONを空白なしにして、内容のハッシュを入れたファイル名（例: index/パラレルワールド1.3f2a9c01d4.json）で
+bundle に書き出し、gzip（.gz）と brotli（.br）で圧縮したものを隣に置きます。
+ファイル名は内容が変わると変わるため、Webサーバーで長期間の immutable キャッシュを設定できます。
+Webサイト（script.js）は最初に bundle/manifest.json（元のパス -> ハッシュ付きのパス）を読み、ここからファイルを探します。
+manifest.json だけは毎回確認されるよう、キャッシュしない設定にしてください。
+
+brotli で圧縮するには brotli パッケージが必要です（pip install brotli）。ない場合は .gz だけを作ります。
+
+使い方:
+    python build_bundle.py
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+# --- 設定 ---
+SOURCE_DIR = 'json_data' # convert_to_json.py の出力先
+BUNDLE_DIR = 'bundle'
+MANIFEST_FILE = 'manifest.json'
+HASH_LENGTH = 10 # ファイル名に入れるハッシュの桁数
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# --- 設定ここまで ---
+
+
+def load_brotli():
+    """brotli モジュールを返す（インストールされていなければ None）"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def minify(path):
+    """JSONを読み込み、空白なしのUTF-8のバイト列にする"""
+    with open(path, encoding='utf-8') as f:
+        value = json.load(f)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def hashed_name(relative_path, data):
+    """内容のハッシュを入れたファイル名（index/パラレルワールド1.json -> index/パラレルワールド1.<ハッシュ>.json）"""
+    stem, ext = os.path.splitext(relative_path)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+
+def write_bytes(path, data):
+    """一時ファイルに書いてから置き換える"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def source_files(source_dir):
+    """source_dir の下のJSONの相対パス（'/' 区切り）を順に返す（.build など '.' で始まるディレクトリは除く）"""
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for filename in sorted(files):
+            if filename.endswith('.json'):
+                yield os.path.relpath(os.path.join(root, filename), source_dir).replace(os.sep, '/')
+
+
+def report_group(relative_path):
+    """サイズの報告でまとめる単位（パラレルワールドごと、全文検索、その他）"""
+    parts = relative_path.split('/')
+    if parts[0] == 'index':
+        return os.path.splitext(parts[1])[0]
+    if parts[0] == 'bodies':
+        return parts[1]
+    if parts[0] == 'search':
+        return '全文検索'
+    return 'その他'
+
+
+def read_manifest(bundle_dir):
+    path = os.path.join(bundle_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('files', {})
+
+
+def build_bundle(source_dir=SOURCE_DIR, bundle_dir=BUNDLE_DIR):
+    """
+    バンドルを作り、パラレルワールドごとのサイズを返す
+
+    内容が変わっていないファイルは書き直しません。一つ前の manifest.json が指すファイルは、
+    古いページを開いたままのWebサイトのために残し、それより古いものを消します。
+
+    Returns:
+        dict: まとめる単位 -> {'files', 'source', 'raw', 'gzip', 'brotli'}（バイト数）
+    """
+    brotli = load_brotli()
+    if brotli is None:
+        print("注意: brotli がインストールされていないため、.br は作成しません (pip install brotli)")
+    previous = read_manifest(bundle_dir)
+    files = {}
+    sizes = {}
+    for relative_path in source_files(source_dir):
+        source_path = os.path.join(source_dir, relative_path)
+        data = minify(source_path)
+        name = hashed_name(relative_path, data)
+        files[relative_path] = name
+        target = os.path.join(bundle_dir, name)
+        gzipped = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY) if brotli else None
+        if not os.path.exists(target):
+            write_bytes(target + '.gz', gzipped)
+            if compressed is not None:
+                write_bytes(target + '.br', compressed)
+            write_bytes(target, data)  # 本体を最後に書き、本体があれば圧縮したものもそろっているようにする
+        elif compressed is not None and not os.path.exists(target + '.br'):
+            write_bytes(target + '.br', compressed)
+
+        size = sizes.setdefault(report_group(relative_path), {'files': 0, 'source': 0, 'raw': 0, 'gzip': 0, 'brotli': None})
+        size['files'] += 1
+        size['source'] += os.path.getsize(source_path)
+        size['raw'] += len(data)
+        size['gzip'] += len(gzipped)
+        if compressed is not None:
+            size['brotli'] = (size['brotli'] or 0) + len(compressed)
+
+    # ファイルがそろってから manifest.json を置き換える
+    write_bytes(os.path.join(bundle_dir, MANIFEST_FILE),
+                json.dumps({'files': files}, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    keep = {MANIFEST_FILE} | set(files.values()) | set(previous.values())
+    removed = 0
+    for relative_path in list(source_files(bundle_dir)):
+        if relative_path not in keep:
+            for suffix in ('', '.gz', '.br'):
+                path = os.path.join(bundle_dir, relative_path + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+            removed += 1
+    print(f"'{bundle_dir}' に {len(files)} 個のファイルを書き出しました（古いファイル {removed} 個を削除）。")
+    return sizes
+
+
+def pad(value, width, left=False):
+    """全角文字を2桁として、値を width 桁にそろえる"""
+    text = str(value)
+    padding = ' ' * max(0, width - sum(1 if ord(char) < 0x80 else 2 for char in text))
+    return text + padding if left else padding + text
+
+
+def format_sizes(sizes):
+    """パラレルワールドごとの元のサイズ・空白なし・gzip・brotli のバイト数を表にする"""
+    widths = [10, 10, 12, 10, 11]
+
+    def row(name, size):
+        columns = [size['files'], size['source'], size['raw'], size['gzip'], size['brotli']]
+        values = [columns[0]] + ['-' if value is None else f'{value / 1024:.1f}' for value in columns[1:]]
+        return pad(name, 20, left=True) + ''.join(pad(value, width) for value, width in zip(values, widths))
+
+    header = pad('', 20) + ''.join(pad(title, width) for title, width in
+                                   zip(['ファイル', '元のKB', '空白なしKB', 'gzip KB', 'brotli KB'], widths))
+    lines = [header, '-' * (20 + sum(widths))]
+    total = {'files': 0, 'source': 0, 'raw': 0, 'gzip': 0, 'brotli': None}
+    for group, size in sizes.items():
+        lines.append(row(group, size))
+        for key in ('files', 'source', 'raw', 'gzip'):
+            total[key] += size[key]
+        if size['brotli'] is not None:
+            total['brotli'] = (total['brotli'] or 0) + size['brotli']
+    lines.append('-' * (20 + sum(widths)))
+    lines.append(row('合計', total))
+    return '\n'.join(lines)
+
+
+# スクリプトを実行
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='json_data から、圧縮済みでハッシュ付きのファイル名の公開用データを作ります。')
+    parser.add_argument('--source', default=SOURCE_DIR, help='convert_to_json.py の出力先')
+    parser.add_argument('--output', default=BUNDLE_DIR, help='バンドルの出力先')
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(args.source, 'worlds.json')):
+        print(f"エラー: '{args.source}/worlds.json' が見つかりません。先に convert_to_json.py を実行してください。")
+    else:
+        print(format_sizes(build_bundle(args.source, args.output)))
@@ -1,40 +1,624 @@
 import pandas as pd
+import argparse
+import filecmp
+import hashlib
+import json
 import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+# プロジェクトルートのパスを追加して結果ストアのモジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(project_root)
+from results_store import STORE_ONLY_COLUMNS, iter_table_chunks, read_table
+from search_index import DOCS_FILE, END_MARK, SEARCH_COLUMNS, SEARCH_DIR, SHARD_COUNT, SearchIndexBuilder, index_files, patch_files
 
 # --- 設定 ---
 CSV_FILE_PATH = 'results.csv'
+STORE_FILE_PATH = 'results.parquet' # 列指向の結果ストア（あればCSVより優先して読み込む）
 OUTPUT_DIR = 'json_data'
+STREAM_CHUNK_ROWS = 1000 # --stream のときに一度に読み込む行数
+WRITE_FULL_JSON = False # Trueにすると、本文まですべて入った従来の1ワールド1ファイルのJSONも出力する
+BODY_CHUNK_ENTRIES = 5 # 本文ファイル1つにまとめる日記の数
+# 一覧・カレンダー・絞り込みに使う列（索引に入れる）。それ以外の列は本文ファイルに入れ、記事を開いたときに読み込む
+INDEX_COLUMNS = ['ID', '事件の発生日', 'エピソードタイトル', '主要登場人物', '事件種別', 'コナン一行の目的']
+BODY_KEY = '本文' # 索引の各要素で、その日記の本文が入っている本文ファイルの番号を表すキー
+FACET_COLUMNS = ['主要登場人物', '事件種別', 'コナン一行の目的'] # 絞り込みに使う列（値 -> IDのリストを索引に入れる）
+DATE_COLUMN = '事件の発生日' # 並べ替えとカレンダーに使う日付の列
+DATE_COLUMNS = ['事件の発生日', '事件の終了日'] # ISO形式（YYYY-MM-DD）にそろえる日付の列（放送日は複数の日付が入ることがあるのでそのまま）
+MISSING_VALUES = {'', 'nan', 'NaN', 'None', 'null'} # 欠損値として null にする文字列
+WORLDS_FILE = 'worlds.json' # パラレルワールドの一覧（Webサイトが最初に読み込む）
+WRITE_SEARCH_INDEX = True # Trueなら日記の本文と事件の概要の全文検索用の索引（search/）も出力する
+BUILD_STATE_DIR = '.build' # 前回の変換の記録を置くディレクトリ（OUTPUT_DIR の下。Webサイトでは使わない）
+BUILD_FORMAT = 2 # 出力の形式を変えたら上げる（次の変換ですべて作り直す）
+WATCH_INTERVAL_SECONDS = 0.1 # --watch で入力の変更を確認する間隔（秒）
 # --- 設定ここまで ---
 
-def convert_csv_to_json():
+def is_missing(value):
+    """欠損値（NaN や 'nan' などの文字列）かどうか"""
+    if isinstance(value, str):
+        return value.strip() in MISSING_VALUES
+    return value is None or (not isinstance(value, list) and pd.isna(value))
+
+def prepare_frame(df):
+    """
+    Webサイトで使う形に列を整える
+
+    結果ストアだけの列を外し、'nan' などの文字列を null にし、日付をISO形式（YYYY-MM-DD）にそろえ、
+    主要登場人物をリストにします。Webサイト側ではこれらの後始末をしません。
+    """
+    # 結果ストアにだけある列（試行回数・モデル名）はWebサイトでは使わない
+    df = df.drop(columns=list(STORE_ONLY_COLUMNS), errors='ignore')
+    # 辞書エンコードされた列は、JSONにする前に通常の列に戻す
+    df = df.astype({column: object for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+    for column in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype(object).map(lambda x: None if is_missing(x) else x)
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            dates = pd.to_datetime(df[column], errors='coerce', format='mixed')
+            # 日付として読めない値は元の文字列のまま残す
+            df[column] = dates.dt.strftime('%Y-%m-%d').astype(object).where(dates.notna(), df[column])
+    if '主要登場人物' in df.columns:
+        # 文字列をカンマで分割し、前後の空白を削除してリストに変換
+        df['主要登場人物'] = df['主要登場人物'].apply(
+            lambda x: [person.strip() for person in str(x).split(',') if not is_missing(person)] if x is not None else []
+        )
+    return df
+
+def world_file_stem(world_name):
+    """パラレルワールド名から、出力するファイル名に使う部分を作る"""
+    # ファイル名をサニタイズ（安全なファイル名に変換）
+    return "".join(c for c in world_name if c.isalnum() or c in ('_', '-')).rstrip()
+
+def world_json_path(world_name):
+    """パラレルワールド名から出力するJSONファイルのパスを作る"""
+    return os.path.join(OUTPUT_DIR, f'{world_file_stem(world_name)}.json')
+
+def world_sort_key(world_name):
+    """パラレルワールド名を番号の順に並べるためのキー（'パラレルワールド10' を '9' の後にする）"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', world_name)]
+
+def records_json(df):
+    """レコード形式（オブジェクトの配列）のJSON文字列を返す"""
+    return df.to_json(
+        orient='records',   # レコード形式
+        force_ascii=False,  # 日本語をそのまま出力
+        indent=4            # 見やすいようにインデントを適用
+    )
+
+def compact_json(value):
+    """空白を入れない、Webサイトで読み込む用のJSON文字列を返す"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def content_hash(text):
+    """差分の検出に使う、文字列の短いハッシュ"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def write_text_file(path, text):
     """
-    results.csv（カンマ区切り）を読み込み、
-    パラレルワールドごとにJSONファイルに変換して出力する関数
+    一時ファイルに書いてから置き換える（書き込み中のファイルをWebサイトが読まないように）
+
+    同じ内容のファイルがすでにある場合は書き直しません（更新日時が変わらないので、配信のキャッシュも無駄に切れません）。
+
+    Returns:
+        bool: 書き直した場合はTrue
+    """
+    data = text.encode('utf-8')
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+def remove_path(path):
+    """ファイルまたはディレクトリがあれば消す"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class BuildState:
+    """
+    前回の変換の記録（OUTPUT_DIR/.build/state.json）
+
+    パラレルワールドごとに、入力の行のハッシュ・本文ファイルごとのハッシュ・索引の情報を残しておき、
+    次の変換では内容が変わったワールドの、変わった本文ファイルだけを書き直します。
+    全文検索の索引の材料（bigram -> 日記の番号のビット列）もワールドごとに .build/search/ に残し、変わったワールドだけ作り直します。
+    列の構成や本文ファイルの大きさなど、出力の形式に関わる設定が変わった場合は記録を使わずにすべて作り直します。
     """
-    print(f"'{CSV_FILE_PATH}' の読み込みを開始します...")
+
+    def __init__(self, output_dir=OUTPUT_DIR, rebuild=False):
+        self.dir = os.path.join(output_dir, BUILD_STATE_DIR)
+        self.path = os.path.join(self.dir, 'state.json')
+        self.settings = content_hash(compact_json([
+            BUILD_FORMAT, INDEX_COLUMNS, BODY_KEY, FACET_COLUMNS, DATE_COLUMN, SEARCH_COLUMNS, SHARD_COUNT, END_MARK,
+        ]))
+        state = {}
+        if not rebuild and os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    state = json.load(f)
+            except ValueError:
+                print(f"注意: '{self.path}' が読み込めないため、すべて作り直します。")
+        if state.get('settings') != self.settings:
+            state = {}
+        self.previous = state.get('worlds', {})  # 前回の変換のパラレルワールド名 -> 記録
+        self.worlds = {}  # 今回の変換のパラレルワールド名 -> 記録
+        self.search = state.get('search')  # 前回の全文検索の索引の元になったワールドのハッシュ
+
+    def search_cache_path(self, stem):
+        """パラレルワールドごとの全文検索の索引の材料を残すファイル"""
+        return os.path.join(self.dir, SEARCH_DIR, f'{stem}.json')
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        write_text_file(self.path, compact_json({'settings': self.settings, 'worlds': self.worlds, 'search': self.search}))
+
+class FullWorldWriter:
+    """1つのパラレルワールドのすべての列を、従来どおり1つのJSON配列に書き出す"""
+
+    def __init__(self, world_name):
+        self.path = world_json_path(world_name)
+        self._file = open(self.path + '.tmp', 'w', encoding='utf-8')
+        self._file.write('[\n')
+        self.entries = 0
+
+    def add(self, df):
+        """行を追記する"""
+        if self.entries:
+            self._file.write(',\n')
+        # 配列の外側の括弧を外し、要素の部分だけを書き足す
+        self._file.write(records_json(df)[2:-2])
+        self.entries += len(df)
+
+    def close(self):
+        """配列を閉じて、一時ファイルを出力先に置き換える（内容が同じなら既存のファイルを残す）"""
+        self._file.write('\n]')
+        self._file.close()
+        if os.path.exists(self.path) and filecmp.cmp(self.path + '.tmp', self.path, shallow=False):
+            os.remove(self.path + '.tmp')
+            print(f" -> '{self.path}' は変更がありません。")
+            return
+        os.replace(self.path + '.tmp', self.path)
+        print(f" -> '{self.path}' を作成しました。")
+
+    def abort(self):
+        """途中で失敗した場合に、既存のJSONを残したまま一時ファイルを捨てる"""
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self.path + '.tmp')
+
+class SplitWorldWriter:
+    """
+    1つのパラレルワールドを、一覧用の小さな索引と、日記の本文を BODY_CHUNK_ENTRIES 件ずつまとめた本文ファイルに分けて書き出す
+
+    索引（index/<ワールド>.json）は次のオブジェクトです。Webサイトは最初に索引だけを読み込み、
+    絞り込みは集合の積で、日付からの記事の検索は辞書の参照で行います。
+        entries: INDEX_COLUMNS と本文ファイルの番号（BODY_KEY）だけの要素を、事件の発生日の順に並べた配列
+        facets: FACET_COLUMNS の列ごとに、値 -> その値を持つ日記のIDのリスト
+        dates: 事件の発生日（YYYY-MM-DD）-> その日の日記のIDのリスト
+    本文ファイル（bodies/<ワールド>/<番号>.json）には残りの列をIDをキーにして、索引と同じ順に入れます。
+
+    並べ替えのために、本文は一時ファイルに書いておき、close() で日付の順に読み出して本文ファイルにします。
+    メモリに載せるのは索引だけです。search=True なら、全文検索の索引の材料（search_bitmaps()）も作ります。
+
+    state（BuildState）を渡すと、前回の変換から入力の行が変わっていないワールドは何も書き直さず、
+    変わったワールドも、中身の変わった本文ファイルだけを書き直します。
+    """
+
+    def __init__(self, world_name, chunk_entries=BODY_CHUNK_ENTRIES, search=False, state=None):
+        self.world_name = world_name
+        self.search = search
+        self.state = state
+        self.entry_ids = []  # close() の後に、日付の順に並べたID
+        self.stem = world_file_stem(world_name)
+        self.chunk_entries = chunk_entries
+        self.index_path = os.path.join(OUTPUT_DIR, 'index', f'{self.stem}.json')
+        self.bodies_dir = os.path.join(OUTPUT_DIR, 'bodies', self.stem)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        os.makedirs(self.bodies_dir, exist_ok=True)
+        self._spool = tempfile.TemporaryFile()  # 本文を1行1件で一時的に書いておくファイル
+        self._entries = []  # (索引の要素, 本文の位置, 本文の長さ, 行のハッシュ)
+        self._search_bitmaps = None  # 全文検索の材料（bigram -> entry_ids での番号のビット列）
+        self.search_changes = None  # close() の後に、前回から変わった bigram -> 新しいビット列（分からなければ None）
+        self.entries = 0
+
+    def add(self, df):
+        """行を追記する"""
+        # NaN の扱いを他の出力とそろえるため、pandas のJSON変換を通してから分ける
+        for record in json.loads(df.to_json(orient='records', force_ascii=False)):
+            entry_id = str(record.get('ID', self.entries))
+            index_record = {column: record[column] for column in INDEX_COLUMNS if column in record}
+            index_record['ID'] = entry_id
+            # パラレルワールド名はワールドの一覧から分かるので、どちらにも入れない
+            body = compact_json({
+                column: value for column, value in record.items()
+                if column not in INDEX_COLUMNS and column != 'パラレルワールド名'
+            }).encode('utf-8')
+            self._entries.append((index_record, self._spool.tell(), len(body), content_hash(compact_json(record))))
+            self._spool.write(body)
+            self.entries += 1
+
+    def _read_body(self, offset, length):
+        self._spool.seek(offset)
+        return json.loads(self._spool.read(length).decode('utf-8'))
+
+    def _world_hash(self):
+        """このワールドの出力を決める入力（行のハッシュと本文ファイルの大きさ）のハッシュ"""
+        return content_hash(compact_json([self.chunk_entries] + [item[3] for item in self._entries]))
+
+    def _reuse_previous(self, world_hash):
+        """
+        前回の変換から入力が変わっておらず、出力もそろっていれば、前回の記録を返す
+
+        Returns:
+            dict: 前回の記録（作り直す必要がある場合は None）
+        """
+        previous = self.state.previous.get(self.world_name) if self.state else None
+        if not previous or previous['hash'] != world_hash or not os.path.exists(self.index_path):
+            return None
+        if not all(os.path.exists(os.path.join(self.bodies_dir, f'{number}.json')) for number in range(len(previous['chunks']))):
+            return None
+        if self.search and not os.path.exists(self.state.search_cache_path(self.stem)):
+            return None
+        return previous
+
+    def close(self):
+        """
+        日付の順に並べて本文ファイルと索引を書き出し、前回の変換で作られた余分な本文ファイルを消す
+
+        Returns:
+            dict: ワールドの一覧（WORLDS_FILE）に載せる情報
+        """
+        world_hash = self._world_hash()
+        previous = self._reuse_previous(world_hash)
+        if previous is not None:
+            self._spool.close()
+            self.entry_ids = previous['entry_ids']
+            self.search_changes = {}
+            if self.state:
+                self.state.worlds[self.world_name] = previous
+            print(f" -> '{self.index_path}' は変更がありません。")
+            return previous['info']
+
+        # 日付のない日記は最後に置く（同じ日付の中では入力の順）
+        self._entries.sort(key=lambda item: (item[0].get(DATE_COLUMN) is None, item[0].get(DATE_COLUMN) or ''))
+        old = self.state.previous.get(self.world_name) if self.state else None
+        old_chunks = old['chunks'] if old else []
+        old_entries = old['entries'] if old else {}
+        sorted_ids = [item[0]['ID'] for item in self._entries]
+        old_bitmaps = None
+        if self.search and old and old['entry_ids'] == sorted_ids and len(set(sorted_ids)) == len(sorted_ids) and \
+                os.path.exists(self.state.search_cache_path(self.stem)):
+            # 日記の並びが前回と同じなら、変わった日記だけを全文検索の材料に入れ直す
+            old_bitmaps = self._read_search_cache()
+        world_search = SearchIndexBuilder() if self.search else None
+        tokenized = []  # 全文検索の材料に入れ直した日記のID
+        entries = []
+        facets = {column: {} for column in FACET_COLUMNS}
+        dates = {}
+        entry_hashes = {}
+        chunks = []  # 本文ファイルごとの、入っている日記のIDと行のハッシュから作ったハッシュ
+        chunk = {}
+        written = 0
+        for position, (index_record, offset, length, row_hash) in enumerate(self._entries):
+            entry_id = index_record['ID']
+            index_record[BODY_KEY] = position // self.chunk_entries
+            entries.append(index_record)
+            entry_hashes[entry_id] = row_hash
+            for column in FACET_COLUMNS:
+                values = index_record.get(column)
+                for value in values if isinstance(values, list) else [values]:
+                    if value is None:
+                        continue
+                    posting = facets[column].setdefault(value, [])
+                    # 同じ値が1件の中に何度も書かれていても、IDは1回だけ入れる
+                    if not posting or posting[-1] != entry_id:
+                        posting.append(entry_id)
+            if index_record.get(DATE_COLUMN):
+                dates.setdefault(index_record[DATE_COLUMN], []).append(entry_id)
+            chunk[entry_id] = (index_record, offset, length, row_hash)
+            if len(chunk) >= self.chunk_entries or position == len(self._entries) - 1:
+                number = index_record[BODY_KEY]
+                # 入っている日記と、その行の内容が前回と同じなら本文ファイルは書き直さない
+                signature = content_hash(compact_json([[key, item[3]] for key, item in chunk.items()]))
+                chunks.append(signature)
+                chunk_path = os.path.join(self.bodies_dir, f'{number}.json')
+                changed = number >= len(old_chunks) or old_chunks[number] != signature or not os.path.exists(chunk_path)
+                to_tokenize = [key for key, item in chunk.items() if world_search is not None and
+                               (old_bitmaps is None or old_entries.get(key) != item[3])]
+                if changed or to_tokenize:
+                    bodies = {key: self._read_body(item[1], item[2]) for key, item in chunk.items()}
+                    if changed and write_text_file(chunk_path, compact_json(bodies)):
+                        written += 1
+                    for key in to_tokenize:
+                        texts = [chunk[key][0].get(column, bodies[key].get(column)) for column in SEARCH_COLUMNS]
+                        world_search.add(key, texts)
+                    tokenized += to_tokenize
+                chunk = {}
+        self._spool.close()
+        self.entry_ids = [entry['ID'] for entry in entries]
+        index = {
+            'entries': entries,
+            'facets': {column: dict(sorted(postings.items())) for column, postings in facets.items()},
+            'dates': dates,
+        }
+        index_written = write_text_file(self.index_path, compact_json(index))
+
+        for filename in os.listdir(self.bodies_dir):
+            number = filename[:-len('.json')]
+            if filename.endswith('.json') and number.isdigit() and int(number) >= len(chunks):
+                os.remove(os.path.join(self.bodies_dir, filename))
+        info = {
+            'name': self.world_name,
+            'index': f'index/{self.stem}.json',
+            'bodies': f'bodies/{self.stem}',
+            'entries': self.entries,
+        }
+        if world_search is not None:
+            self._update_search(world_search, tokenized, old_bitmaps)
+        elif self.state:
+            # 全文検索を出力しない間に古くなった材料を、次に出力するときに使わないようにする
+            remove_path(self.state.search_cache_path(self.stem))
+        if self.state:
+            self.state.worlds[self.world_name] = {
+                'hash': world_hash, 'info': info, 'entry_ids': self.entry_ids, 'entries': entry_hashes, 'chunks': chunks,
+            }
+        if old:
+            changed_entries = sum(1 for entry_id, row_hash in entry_hashes.items() if old_entries.get(entry_id) != row_hash)
+            changed_entries += sum(1 for entry_id in old_entries if entry_id not in entry_hashes)
+            print(f" -> '{self.index_path}' を更新しました（変更のあった日記 {changed_entries} 件, "
+                  f"書き直した本文ファイル {written}/{len(chunks)} 個{'' if index_written else ', 索引は変更なし'}）。")
+        else:
+            print(f" -> '{self.index_path}' と本文ファイル {len(chunks)} 個を作成しました。")
+        return info
+
+    def _update_search(self, builder, tokenized, old_bitmaps):
+        """
+        全文検索の材料を作り、前回の記録に残す
+
+        Args:
+            builder: tokenized の日記を追加した SearchIndexBuilder
+            tokenized: 追加した日記のID（old_bitmaps がなければこのワールドのすべての日記）
+            old_bitmaps: 前回の材料（日記の並びが前回と違う場合は None）
+        """
+        added = builder.bitmaps(self.entry_ids)
+        if old_bitmaps is None:
+            bitmaps = added
+        else:
+            # 追加し直した日記のビットを前回の材料から消して、新しいビットを立てる
+            numbers = {entry_id: number for number, entry_id in enumerate(self.entry_ids)}
+            cleared = 0
+            for entry_id in tokenized:
+                cleared |= 1 << numbers[entry_id]
+            bitmaps = dict(old_bitmaps)
+            self.search_changes = {}  # 全文検索の索引を差分で更新するための、変わった bigram
+            for token in {token for token, bits in old_bitmaps.items() if bits & cleared} | added.keys():
+                bits = old_bitmaps.get(token, 0) & ~cleared | added.get(token, 0)
+                if bits != old_bitmaps.get(token, 0):
+                    self.search_changes[token] = bits
+                if bits:
+                    bitmaps[token] = bits
+                else:
+                    del bitmaps[token]
+        self._search_bitmaps = bitmaps
+        if self.state:
+            cache_path = self.state.search_cache_path(self.stem)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            write_text_file(cache_path, compact_json({token: format(bits, 'x') for token, bits in bitmaps.items()}))
+
+    def search_bitmaps(self):
+        """
+        全文検索の索引の材料を返す（変更のなかったワールドは、前回の記録から読み込む）
+
+        Returns:
+            dict: bigram -> entry_ids での番号をビットの位置とするビット列（int）
+        """
+        if self._search_bitmaps is None:
+            self._search_bitmaps = self._read_search_cache()
+        return self._search_bitmaps
+
+    def _read_search_cache(self):
+        with open(self.state.search_cache_path(self.stem), encoding='utf-8') as f:
+            return {token: int(bits, 16) for token, bits in json.load(f).items()}
+
+    def abort(self):
+        """途中で失敗した場合に、一時ファイルを捨てる（既存の索引と本文ファイルはそのまま）"""
+        self._spool.close()
+
+def open_world_writers(world_name, full=WRITE_FULL_JSON, search=WRITE_SEARCH_INDEX, state=None):
+    """
+    1つのパラレルワールドを書き出すライターのリストを作る
+
+    search=True なら全文検索の索引の材料も作ります。state は差分だけを書き直すための BuildState です。
+    """
+    writers = [SplitWorldWriter(world_name, search=search, state=state)]
+    if full:
+        writers.append(FullWorldWriter(world_name))
+    return writers
+
+def remove_stale_worlds(state, world_names):
+    """前回の変換にはあって、今回の入力にないパラレルワールドの索引・本文ファイル・全文検索の材料を消す"""
+    for world_name in state.previous:
+        if world_name in world_names:
+            continue
+        stem = world_file_stem(world_name)
+        remove_path(os.path.join(OUTPUT_DIR, 'index', f'{stem}.json'))
+        remove_path(os.path.join(OUTPUT_DIR, 'bodies', stem))
+        remove_path(state.search_cache_path(stem))
+        print(f" -> 入力にない '{world_name}' の出力を削除しました。")
+
+def search_index_key(world_hashes):
+    """全文検索の索引の元になった (パラレルワールド名, ワールドのハッシュ) の並びのハッシュ"""
+    return content_hash(compact_json(world_hashes))
+
+def write_search_index(split_writers, state=None):
+    """
+    全文検索の索引（OUTPUT_DIR/search）を書き出す
+
+    日記の番号はワールドをまたいだ通し番号なので、日記が増えたり減ったり並びが変わったりした場合は全体を作り直します。
+    日記の内容が変わっただけなら、前回の材料と比べて変わった bigram の入っているファイルだけを書き換えます。
+
+    Args:
+        split_writers: 閉じた SplitWorldWriter（日記の番号の順）
+        state: 前回の変換の記録（BuildState）
+    """
+    search_dir = os.path.join(OUTPUT_DIR, SEARCH_DIR)
+    filenames = [DOCS_FILE] + [f'{number}.json' for number in range(SHARD_COUNT)]
+    complete = all(os.path.exists(os.path.join(search_dir, filename)) for filename in filenames)
+    key = search_index_key([[writer.world_name, state.worlds[writer.world_name]['hash']] for writer in split_writers]) \
+        if state else None
+    if key and state.search == key and complete:
+        print(f" -> '{search_dir}' の全文検索の索引は変更がありません。")
+        return
+
+    previous = state.previous if state else {}
+    patchable = state is not None and complete and [writer.world_name for writer in split_writers] == list(previous) and \
+        state.search == search_index_key([[name, world['hash']] for name, world in previous.items()]) and \
+        all(writer.search_changes is not None and writer.entry_ids == previous[writer.world_name]['entry_ids']
+            for writer in split_writers)
+    if patchable:
+        changes = {}  # bigram -> (書き換えるビットの範囲, 新しいビット列)
+        offset = 0
+        for writer in split_writers:
+            mask = ((1 << len(writer.entry_ids)) - 1) << offset
+            for token, bits in writer.search_changes.items():
+                old_mask, old_bits = changes.get(token, (0, 0))
+                changes[token] = (old_mask | mask, old_bits | bits << offset)
+            offset += len(writer.entry_ids)
+
+        def read_shard(number):
+            with open(os.path.join(search_dir, f'{number}.json'), encoding='utf-8') as f:
+                return json.load(f)
+
+        files = patch_files(read_shard, changes, offset)
+        written = sum(write_text_file(os.path.join(search_dir, filename), compact_json(value))
+                      for filename, value in files.items())
+        print(f" -> '{search_dir}' の全文検索の索引を更新しました（変わった bigram {len(changes)} 個, "
+              f"書き直したファイル {written}/{len(filenames)} 個）。")
+    else:
+        os.makedirs(search_dir, exist_ok=True)
+        total = 0
+        written = 0
+        files = index_files([(writer.entry_ids, writer.search_bitmaps()) for writer in split_writers])
+        for filename, value in files.items():
+            text = compact_json(value)
+            written += write_text_file(os.path.join(search_dir, filename), text)
+            total += len(text.encode('utf-8'))
+        print(f" -> '{search_dir}' に全文検索の索引（日記 {len(files[DOCS_FILE])} 件, {total / 1024:.0f} KB）を作成しました"
+              f"（書き直したファイル {written}/{len(files)} 個）。")
+    if state:
+        state.search = key
+
+def close_world_writers(writers_by_world, search=WRITE_SEARCH_INDEX, state=None):
+    """
+    すべてのライターを閉じて、ワールドの一覧（WORLDS_FILE）を番号の順に書き出す
+
+    state を渡した場合は、入力にないワールドの出力を消し、最後に変換の記録を保存します。
+
+    Args:
+        writers_by_world: パラレルワールド名 -> open_world_writers() の戻り値
+        search: Trueなら全文検索の索引も書き出す
+        state: 前回の変換の記録（BuildState）
+    """
+    worlds = []
+    split_writers = []  # 全文検索の日記の番号の順（ワールドの番号順、その中は日付順）
+    for world_name in sorted(writers_by_world, key=world_sort_key):
+        for writer in writers_by_world[world_name]:
+            info = writer.close()
+            if info is not None:
+                worlds.append(info)
+                split_writers.append(writer)
+    if state:
+        remove_stale_worlds(state, writers_by_world)
+    write_text_file(os.path.join(OUTPUT_DIR, WORLDS_FILE), json.dumps(worlds, ensure_ascii=False, indent=1))
+    if search:
+        write_search_index(split_writers, state)
+    if state:
+        state.save()
+
+def convert_csv_to_json_streaming(source_path, chunksize=STREAM_CHUNK_ROWS, full=WRITE_FULL_JSON, rebuild=False):
+    """
+    入力を chunksize 行ずつ読み込み、パラレルワールドごとの索引と本文ファイルに追記していく
+
+    ファイル全体をメモリに載せないため、入力が大きくてもメモリ使用量はほぼ一定です
+    （行数に比例して残るのは、一覧用の索引と全文検索の索引だけです）。
+    出力は通常の変換と同じ内容になります（索引やJSON配列は一時ファイルに書き、最後に置き換えます）。
+
+    Args:
+        source_path: results.csv または結果ストアのパス
+        chunksize: 1回に読み込む行数
+        full: Trueなら従来の1ワールド1ファイルのJSONも出力する
+        rebuild: Trueなら前回の変換の記録を使わず、すべて作り直す
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    writers = {}  # パラレルワールド名 -> 書き込み中のライター
+    state = BuildState(OUTPUT_DIR, rebuild)
+    try:
+        for chunk in iter_table_chunks(source_path, chunksize, sep=','):
+            if 'パラレルワールド名' not in chunk.columns:
+                print("エラー: CSVファイルに 'パラレルワールド名' の列が見つかりません。")
+                return
+            df = prepare_frame(chunk)
+            for world_name, group_df in df.groupby('パラレルワールド名', sort=False):
+                if world_name not in writers:
+                    writers[world_name] = open_world_writers(world_name, full, WRITE_SEARCH_INDEX, state)
+                for writer in writers[world_name]:
+                    writer.add(group_df)
+        close_world_writers(writers, WRITE_SEARCH_INDEX, state)
+        print(f"{len(writers)}個のパラレルワールドをJSONに変換しました。")
+    finally:
+        # 途中で失敗した場合は、既存のJSONを残したまま一時ファイルを捨てる
+        for world_writers in writers.values():
+            for writer in world_writers:
+                writer.abort()
+
+def source_file_path():
+    """変換の入力（結果ストアがあればそちら、なければ results.csv）"""
+    return STORE_FILE_PATH if os.path.exists(STORE_FILE_PATH) else CSV_FILE_PATH
+
+def convert_csv_to_json(stream=False, chunksize=STREAM_CHUNK_ROWS, full=WRITE_FULL_JSON, rebuild=False):
+    """
+    results.csv（カンマ区切り）または結果ストア results.parquet を読み込み、
+    パラレルワールドごとに、一覧用の索引と日記の本文ファイルに分けて出力する関数
+
+    stream=True の場合は、入力を chunksize 行ずつ読み込みながら変換します。
+    full=True の場合は、本文まですべて入った従来の1ワールド1ファイルのJSONも出力します。
+    前回の変換の記録（OUTPUT_DIR/.build）があれば、内容が変わったファイルだけを書き直します。
+    rebuild=True の場合は記録を使わずにすべて作り直します（内容が同じファイルはそのまま残ります）。
+    """
+    source_path = source_file_path()
+    print(f"'{source_path}' の読み込みを開始します...")
 
     # CSVファイルの存在チェック
-    if not os.path.exists(CSV_FILE_PATH):
-        print(f"エラー: '{CSV_FILE_PATH}' が見つかりません。")
-        print("スクリプトと同じ階層にCSVファイルを配置してください。")
+    if not os.path.exists(source_path):
+        print(f"エラー: '{source_path}' が見つかりません。")
+        print(f"スクリプトと同じ階層に '{CSV_FILE_PATH}' または '{STORE_FILE_PATH}' を配置してください。")
+        return
+
+    if stream:
+        convert_csv_to_json_streaming(source_path, chunksize, full, rebuild)
         return
 
     try:
         # ★ 変更点: 区切り文字をタブからカンマに変更しました。
         # CSVファイルの1行目をヘッダーとして自動的に読み込みます。
-        df = pd.read_csv(CSV_FILE_PATH, sep=',')
+        df = read_table(source_path, sep=',')
 
         print("CSVの読み込みが完了しました。")
 
         # --- データの整形 ---
         # '主要登場人物'列が存在するか確認
-        if '主要登場人物' in df.columns:
-            # 文字列をカンマで分割し、前後の空白を削除してリストに変換
-            df['主要登場人物'] = df['主要登場人物'].apply(
-                lambda x: [person.strip() for person in str(x).split(',')] if pd.notna(x) else []
-            )
-        else:
+        if '主要登場人物' not in df.columns:
             print("警告: '主要登場人物' 列が見つかりません。処理をスキップします。")
+        df = prepare_frame(df)
 
         # 'パラレルワールド名'列が存在しない場合はエラー
         if 'パラレルワールド名' not in df.columns:
@@ -52,20 +636,19 @@ def convert_csv_to_json():
 
         print(f"{len(grouped)}個のパラレルワールドが見つかりました。JSONへの変換を開始します...")
 
-        # 各グループを個別のJSONファイルとして保存
-        for world_name, group_df in grouped:
-            # ファイル名をサニタイズ（安全なファイル名に変換）
-            safe_world_name = "".join(c for c in world_name if c.isalnum() or c in ('_', '-')).rstrip()
-            output_filename = os.path.join(OUTPUT_DIR, f'{safe_world_name}.json')
-
-            # Webサイトで扱いやすいように、レコード形式（オブジェクトの配列）で出力
-            group_df.to_json(
-                output_filename,
-                orient='records',   # レコード形式
-                force_ascii=False,  # 日本語をそのまま出力
-                indent=4            # 見やすいようにインデントを適用
-            )
-            print(f" -> '{output_filename}' を作成しました。")
+        # 各グループを索引と本文ファイルに分けて保存
+        writers = {}
+        state = BuildState(OUTPUT_DIR, rebuild)
+        try:
+            for world_name, group_df in grouped:
+                writers[world_name] = open_world_writers(world_name, full, WRITE_SEARCH_INDEX, state)
+                for writer in writers[world_name]:
+                    writer.add(group_df)
+            close_world_writers(writers, WRITE_SEARCH_INDEX, state)
+        finally:
+            for world_writers in writers.values():
+                for writer in world_writers:
+                    writer.abort()
 
         print("\nすべての処理が正常に完了しました。")
         print(f"'{OUTPUT_DIR}' ディレクトリ内にJSONファイルが生成されています。")
@@ -74,6 +657,64 @@ def convert_csv_to_json():
         print(f"\nエラーが発生しました: {e}")
         print("CSVの形式（特に区切り文字や列の構成）が正しいか確認してください。")
 
+def source_signature():
+    """入力ファイルの変更を見分けるための (パス, 更新日時, サイズ)。入力がなければ None"""
+    path = source_file_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+def watch(stream=False, chunksize=STREAM_CHUNK_ROWS, full=WRITE_FULL_JSON, rebuild=False, interval=WATCH_INTERVAL_SECONDS):
+    """
+    入力（results.csv または結果ストア）を監視し、変わるたびに変換し直す（Ctrl+C で終了）
+
+    変換は前回の記録を使うため、変わったパラレルワールドのファイルだけが書き直されます。
+    書き込みの途中のファイルを読まないよう、更新日時とサイズが interval 秒変わらなくなってから変換します。
+    rebuild=True の場合は、最初の変換だけ記録を使わずにすべて作り直します。
+    """
+    print(f"'{source_file_path()}' の変更を監視します（Ctrl+C で終了）。")
+    last = None
+    try:
+        while True:
+            signature = source_signature()
+            if signature == last:
+                time.sleep(interval)
+                continue
+            time.sleep(interval)
+            if source_signature() != signature:
+                continue  # まだ書き込み中
+            last = signature
+            if signature is None:
+                print(f"'{source_file_path()}' が見つかりません。作成されるのを待っています...")
+                continue
+            started = time.perf_counter()
+            try:
+                convert_csv_to_json(stream, chunksize, full, rebuild)
+                rebuild = False
+            except Exception as e:
+                # 監視は続け、次に入力が変わったときにもう一度変換する
+                print(f"\nエラーが発生しました: {e}")
+            print(f"[{time.strftime('%H:%M:%S')}] {time.perf_counter() - started:.2f} 秒で変換しました。変更を待っています...")
+    except KeyboardInterrupt:
+        print("\n監視を終了しました。")
+
 # スクリプトを実行
 if __name__ == '__main__':
-    convert_csv_to_json()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='結果CSV（または結果ストア）をパラレルワールドごとのJSONに変換します。')
+    parser.add_argument('--stream', action='store_true',
+                        help='入力を少しずつ読み込みながら変換し、メモリ使用量を一定に保つ（大きな入力向け）')
+    parser.add_argument('--chunksize', type=int, default=STREAM_CHUNK_ROWS, help='--stream で一度に読み込む行数')
+    parser.add_argument('--full', action='store_true',
+                        help='索引と本文ファイルに加えて、本文まですべて入った従来の1ワールド1ファイルのJSONも出力する')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='前回の変換の記録（json_data/.build）を使わず、すべて作り直す')
+    parser.add_argument('--watch', action='store_true',
+                        help='入力を監視し、変わるたびに変わった部分だけを変換し直す（Ctrl+C で終了）')
+    args = parser.parse_args()
+    full = args.full or WRITE_FULL_JSON
+    if args.watch:
+        watch(stream=args.stream, chunksize=max(1, args.chunksize), full=full, rebuild=args.rebuild)
+    else:
+        convert_csv_to_json(stream=args.stream, chunksize=max(1, args.chunksize), full=full, rebuild=args.rebuild)
\ No newline at end of file
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日記の本文と事件の概要の全文検索用の索引（文字bigramの転置索引）
+
+日本語は単語の区切りがないため、文字（かな・漢字・英数字）が続く部分を2文字ずつに区切った
+bigramごとに、それを含む日記の番号のリストを作ります。検索語のbigramをすべて含む日記が検索結果です。
+索引は bigram の1文字目で SHARD_COUNT 個のファイルに分けるため、Webサイトは検索語に必要な
+ファイルだけを読み込みます。Webサイト（script.js）の検索も同じ形式を読みます。
+
+出力（convert_to_json.py が OUTPUT_DIR/search/ に書き出す）:
+    docs.json: 日記の番号 -> ID の配列
+    <番号>.json: bigram -> その bigram を含む日記の番号。次のどちらか短い方で表す
+        リスト: 昇順の番号を、前の番号との差で表したもの
+        文字列: 日記の番号をビットの位置とするビット列（番号 i は i//8 バイト目の下から i%8 ビット目）のBase64
+
+使い方:
+    python search_index.py <json_dataのディレクトリ> <検索語>
+"""
+
+import base64
+import json
+import os
+import re
+import sys
+import time
+import unicodedata
+
+# --- 設定項目 ---
+SEARCH_COLUMNS = ['事件の概要', '生成結果'] # 検索の対象にする列
+SEARCH_DIR = 'search' # 出力先（json_data の下）
+DOCS_FILE = 'docs.json'
+SHARD_COUNT = 128 # 索引を分けるファイルの数
+END_MARK = ' ' # 文字が続く部分の最後の1文字に付ける印（1文字の検索語に使う）
+# --- 設定ここまで ---
+
+# 文字（Unicode の L と N の分類）が続く部分。\w から _ を除いたものは str.isalnum() と同じ範囲
+_RUN_PATTERN = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """検索用に文字を正規化する（全角・半角の統一と小文字化）。script.js の normalizeSearchText と同じ"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def text_runs(text):
+    """正規化した文字列から、文字（Unicode の L と N の分類）が続く部分を取り出す"""
+    return _RUN_PATTERN.findall(normalize(text))
+
+
+def document_tokens(texts):
+    """
+    日記の文字列から、索引に入れるbigramの集合を作る
+
+    各部分の最後の1文字は END_MARK を付けて入れるため、1文字の検索語は
+    その文字で始まるbigramをすべて合わせれば見つかります。
+    """
+    tokens = set()
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        for run in text_runs(text):
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.add(run[-1] + END_MARK)
+    return tokens
+
+
+def bitmap_postings(bits):
+    """日記の番号をビットの位置とするビット列（int）から、昇順の日記の番号のリストを作る"""
+    postings = []
+    while bits:
+        number = bits.bit_length() - 1
+        postings.append(number)
+        bits ^= 1 << number
+    postings.reverse()
+    return postings
+
+
+def encode_postings(bits, documents):
+    """
+    日記の番号をビットの位置とするビット列（int）を、差分のリストかビット列のBase64の短い方で表す
+
+    番号 i のビットは int の下から i ビット目なので、リトルエンディアンのバイト列がそのまま出力のビット列になります。
+    """
+    size = -(-documents // 8)
+    bitmap_length = size * 4 // 3 + 4
+    # 差分のリストのJSONの長さと、ビット列のBase64の長さを比べる（数字1つで最低2文字なので、明らかに長いものは数えない）
+    if 2 * bin(bits).count('1') + 1 <= bitmap_length:
+        postings = bitmap_postings(bits)
+        deltas = [postings[0]] + [b - a for a, b in zip(postings, postings[1:])]
+        if len(','.join(map(str, deltas))) + 2 <= bitmap_length:
+            return deltas
+    return base64.b64encode(bits.to_bytes(size, 'little')).decode('ascii')
+
+
+def decode_postings(value):
+    """encode_postings() の値から日記の番号のリストに戻す"""
+    if isinstance(value, str):
+        bitmap = base64.b64decode(value)
+        return [index * 8 + bit for index, byte in enumerate(bitmap) for bit in range(8) if byte >> bit & 1]
+    postings, number = [], 0
+    for delta in value:
+        number += delta
+        postings.append(number)
+    return postings
+
+
+def decode_bitmap(value):
+    """encode_postings() の値からビット列（int）に戻す"""
+    if isinstance(value, str):
+        return int.from_bytes(base64.b64decode(value), 'little')
+    bits = 0
+    for number in decode_postings(value):
+        bits |= 1 << number
+    return bits
+
+
+def shard_of(token):
+    """bigramが入っているファイルの番号"""
+    return ord(token[0]) % SHARD_COUNT
+
+
+def index_files(parts):
+    """
+    索引のファイルの内容を作る
+
+    Args:
+        parts: (IDのリスト, bigram -> そのIDのリストでの番号をビットの位置とするビット列) のリスト。
+            日記の番号はこの順に通し番号にする（パラレルワールドごとに作ったビット列を、作り直さずにつなげられる）
+
+    Returns:
+        dict: ファイル名 -> JSONにする値（SHARD_COUNT 個のファイルをすべて含む）
+    """
+    doc_ids = []
+    merged = {}
+    for ids, bitmaps in parts:
+        offset = len(doc_ids)
+        for token, bits in bitmaps.items():
+            merged[token] = merged.get(token, 0) | bits << offset
+        doc_ids += ids
+    shards = [{} for _ in range(SHARD_COUNT)]
+    for token in sorted(merged):
+        shards[shard_of(token)][token] = encode_postings(merged[token], len(doc_ids))
+    files = {DOCS_FILE: doc_ids}
+    files.update({f'{number}.json': shard for number, shard in enumerate(shards)})
+    return files
+
+
+def patch_files(read_shard, changes, documents):
+    """
+    書き出した索引のうち、変わった bigram の入っているファイルだけを書き換える
+
+    日記の番号（docs.json）が変わらない場合に、index_files() で全体を作り直す代わりに使います。
+
+    Args:
+        read_shard: ファイルの番号 -> 今の内容（dict）を返す関数
+        changes: bigram -> (書き換えるビットの範囲のマスク, その範囲の新しいビット列)
+        documents: 日記の数
+
+    Returns:
+        dict: 書き換えたファイル名 -> JSONにする値
+    """
+    by_shard = {}
+    for token, change in changes.items():
+        by_shard.setdefault(shard_of(token), {})[token] = change
+    files = {}
+    for number, shard_changes in sorted(by_shard.items()):
+        shard = read_shard(number)
+        for token, (mask, bits) in shard_changes.items():
+            if token in shard:
+                bits |= decode_bitmap(shard[token]) & ~mask
+            if bits:
+                shard[token] = encode_postings(bits, documents)
+            else:
+                shard.pop(token, None)
+        files[f'{number}.json'] = dict(sorted(shard.items()))
+    return files
+
+
+class SearchIndexBuilder:
+    """日記を追加していき、最後に索引のファイルの内容を作る"""
+
+    def __init__(self):
+        self.postings = {}  # bigram -> IDのリスト
+
+    def add(self, entry_id, texts):
+        """
+        日記を1件追加する
+
+        Args:
+            entry_id: 日記のID
+            texts: 検索の対象にする文字列のリスト（文字列以外は無視する）
+        """
+        for token in document_tokens(texts):
+            self.postings.setdefault(token, []).append(entry_id)
+
+    def bitmaps(self, doc_ids):
+        """
+        bigram -> doc_ids での番号をビットの位置とするビット列（int）を作る（doc_ids にないIDは入れない）
+
+        Args:
+            doc_ids: 日記の番号の順に並べたIDのリスト
+        """
+        numbers = {entry_id: number for number, entry_id in enumerate(doc_ids)}
+        bitmaps = {}
+        for token, entry_ids in self.postings.items():
+            bits = 0
+            for entry_id in entry_ids:
+                if entry_id in numbers:
+                    bits |= 1 << numbers[entry_id]
+            if bits:
+                bitmaps[token] = bits
+        return bitmaps
+
+    def files(self, doc_ids):
+        """
+        索引のファイルの内容を作る
+
+        Args:
+            doc_ids: 日記の番号の順に並べたIDのリスト（Webサイトの表示順にしておくと、検索結果もその順になる）
+
+        Returns:
+            dict: ファイル名 -> JSONにする値（SHARD_COUNT 個のファイルをすべて含む）
+        """
+        return index_files([(list(doc_ids), self.bitmaps(doc_ids))])
+
+
+class SearchIndex:
+    """
+    書き出した索引で検索する（Webサイトと同じく、必要なファイルだけを読み込んでキャッシュする）
+
+    bigramがすべて含まれていても、検索語が続けて現れない日記が結果に入ることがあります（まれ）。
+    正確に一致させたい場合は、結果の日記の本文で検索語を確かめてください。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._docs = None
+        self._shards = {}
+        self.bytes_read = 0  # 読み込んだファイルの合計バイト数
+
+    def _load(self, filename):
+        path = os.path.join(self.directory, filename)
+        self.bytes_read += os.path.getsize(path)
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    @property
+    def docs(self):
+        if self._docs is None:
+            self._docs = self._load(DOCS_FILE)
+        return self._docs
+
+    @property
+    def shards_loaded(self):
+        return len(self._shards)
+
+    def _shard(self, number):
+        if number not in self._shards:
+            self._shards[number] = self._load(f'{number}.json')
+        return self._shards[number]
+
+    def _term_postings(self, term):
+        """1つの語を含む日記の番号の集合"""
+        if len(term) == 1:
+            found = set()
+            for token, value in self._shard(shard_of(term)).items():
+                if token[0] == term:
+                    found.update(decode_postings(value))
+            return found
+        found = None
+        for i in range(len(term) - 1):
+            token = term[i:i + 2]
+            postings = set(decode_postings(self._shard(shard_of(token)).get(token, [])))
+            found = postings if found is None else found & postings
+            if not found:
+                break
+        return found
+
+    def search(self, query):
+        """
+        検索語をすべて含む日記のIDを返す
+
+        Args:
+            query: 検索語（空白や記号で区切った語はすべてを含むものを探す）
+
+        Returns:
+            list: 日記のID（日記の番号の順）
+        """
+        found = None
+        for term in text_runs(query):
+            postings = self._term_postings(term)
+            found = postings if found is None else found & postings
+            if not found:
+                return []
+        return [self.docs[number] for number in sorted(found or [])]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("使い方: python search_index.py <json_dataのディレクトリ> <検索語>")
+        sys.exit(1)
+    index = SearchIndex(os.path.join(sys.argv[1], SEARCH_DIR))
+    started = time.perf_counter()
+    results = index.search(' '.join(sys.argv[2:]))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"{len(results)} 件 ({elapsed_ms:.1f} ms, 索引のファイル {index.shards_loaded} 個, {index.bytes_read / 1024:.1f} KB を読み込み)")
+    for entry_id in results[:50]:
+        print(f"  {entry_id}")
+    if len(results) > 50:
+        print(f"  ほか {len(results) - 50} 件")
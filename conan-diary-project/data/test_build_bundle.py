@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+build_bundle のハッシュ付きファイル名・manifest.json・古いファイルの削除をテストするスクリプト
+"""
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import build_bundle
+
+
+def write_json(path, value, indent=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False, indent=indent)
+
+
+def build(source_dir, bundle_dir):
+    """バンドルを作り、manifest.json の中身を返す（進捗の表示は捨てる）"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_bundle.build_bundle(source_dir, bundle_dir)
+    with open(os.path.join(bundle_dir, build_bundle.MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)['files']
+
+
+@contextlib.contextmanager
+def source_tree():
+    """convert_to_json の出力に似た json_data と、空のバンドルの出力先を作る"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_dir = os.path.join(work_dir, 'json_data')
+        write_json(os.path.join(source_dir, 'worlds.json'), [{'name': 'パラレルワールド1'}], indent=1)
+        write_json(os.path.join(source_dir, 'index', 'パラレルワールド1.json'), {'entries': [{'ID': 'a'}]})
+        write_json(os.path.join(source_dir, 'bodies', 'パラレルワールド1', '0.json'), {'a': {'生成結果': '日記'}})
+        write_json(os.path.join(source_dir, '.build', 'state.json'), {'settings': 'x'})
+        yield source_dir, os.path.join(work_dir, 'bundle')
+
+
+def test_manifest_points_to_minified_files():
+    """manifest.json がすべてのJSON（.build を除く）を、空白なしの内容とそのgzipを入れたハッシュ付きのファイルに対応付けること"""
+    original = build_bundle.load_brotli
+    build_bundle.load_brotli = lambda: None  # brotli の有無に関係なく同じ結果にする
+    try:
+        with source_tree() as (source_dir, bundle_dir):
+            files = build(source_dir, bundle_dir)
+            assert sorted(files) == ['bodies/パラレルワールド1/0.json', 'index/パラレルワールド1.json', 'worlds.json']
+            for relative_path, name in files.items():
+                data = build_bundle.minify(os.path.join(source_dir, relative_path))
+                stem = os.path.splitext(relative_path)[0]
+                assert name == f'{stem}.{hashlib.sha256(data).hexdigest()[:build_bundle.HASH_LENGTH]}.json'
+                with open(os.path.join(bundle_dir, name), 'rb') as f:
+                    assert f.read() == data
+                with open(os.path.join(bundle_dir, name + '.gz'), 'rb') as f:
+                    assert gzip.decompress(f.read()) == data
+                assert not os.path.exists(os.path.join(bundle_dir, name + '.br'))
+    finally:
+        build_bundle.load_brotli = original
+
+
+def test_hashed_names_are_stable():
+    """内容が同じなら空白の違いに関係なく同じファイル名になり、変わったファイルだけ名前が変わり、既存のファイルは書き直さないこと"""
+    with source_tree() as (source_dir, bundle_dir):
+        first = build(source_dir, bundle_dir)
+        index_path = os.path.join(bundle_dir, first['index/パラレルワールド1.json'])
+        os.utime(index_path, (0, 0))
+
+        # 同じ内容をインデント付きで書き直しても、ファイル名は変わらない
+        write_json(os.path.join(source_dir, 'index', 'パラレルワールド1.json'), {'entries': [{'ID': 'a'}]}, indent=4)
+        assert build(source_dir, bundle_dir) == first
+        assert os.path.getmtime(index_path) == 0
+
+        write_json(os.path.join(source_dir, 'bodies', 'パラレルワールド1', '0.json'), {'a': {'生成結果': '直した日記'}})
+        second = build(source_dir, bundle_dir)
+        changed = [path for path in first if first[path] != second[path]]
+        assert changed == ['bodies/パラレルワールド1/0.json']
+
+
+def test_previous_manifest_files_are_kept():
+    """一つ前の manifest.json が指すファイルは残し、それより古いファイルは圧縮したものと一緒に消すこと"""
+    body_path = 'bodies/パラレルワールド1/0.json'
+    with source_tree() as (source_dir, bundle_dir):
+        names = []
+        for text in ['1回目', '2回目', '3回目']:
+            write_json(os.path.join(source_dir, *body_path.split('/')), {'a': {'生成結果': text}})
+            names.append(build(source_dir, bundle_dir)[body_path])
+        remaining = set(os.listdir(os.path.join(bundle_dir, 'bodies', 'パラレルワールド1')))
+    first, second, third = (os.path.basename(name) for name in names)
+    assert {second, third, second + '.gz', third + '.gz'} <= remaining
+    assert not any(name.startswith(first) for name in remaining)
+
+
+if __name__ == "__main__":
+    test_manifest_points_to_minified_files()
+    test_hashed_names_are_stable()
+    test_previous_manifest_files_are_kept()
+    print("✅ build_bundle のテストがすべて成功しました")
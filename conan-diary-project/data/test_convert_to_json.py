@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+convert_to_json の索引と本文ファイルの出力、差分だけの書き直しと --watch をテストするスクリプト
+"""
+
+import contextlib
+import glob
+import io
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import convert_to_json
+from search_index import SearchIndex
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_row(entry_id, date, world='パラレルワールド1', people='江戸川コナン, 毛利蘭', kind='殺人', purpose='旅行'):
+    """results.csv の1行分（変換に使う列だけ）"""
+    return {
+        'ID': entry_id, 'エピソードタイトル': f'{entry_id}の事件', '事件の発生日': date, '事件の終了日': date,
+        '事件の概要': f'{entry_id}の概要', '主要登場人物': people, '事件種別': kind, 'コナン一行の目的': purpose,
+        '生成結果': f'## {date}\n\n{entry_id}の日記', 'パラレルワールド名': world,
+    }
+
+
+def make_rows(count=12, worlds=3):
+    """count 件の日記を worlds 個のパラレルワールドに順に振り分けた行"""
+    return [make_row(f'e{number}', f'2023/01/{number + 1:02d}', world=f'パラレルワールド{number % worlds + 1}')
+            for number in range(count)]
+
+
+def edit_body(rows, entry_id, text='追記した一文。'):
+    """entry_id の日記の本文だけを書き換えた行"""
+    return [dict(row, 生成結果=row['生成結果'] + text) if row['ID'] == entry_id else row for row in rows]
+
+
+def write_rows(rows):
+    pd.DataFrame(rows).to_csv(convert_to_json.CSV_FILE_PATH, index=False)
+
+
+@contextlib.contextmanager
+def work_dir(rows):
+    """rows を results.csv に書いた一時ディレクトリに移動する（出力は json_data に作られる）"""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        pd.DataFrame(rows).to_csv(os.path.join(directory, convert_to_json.CSV_FILE_PATH), index=False)
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(previous)
+
+
+def convert(**kwargs):
+    """変換を実行し、進捗の表示を返す"""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        convert_to_json.convert_csv_to_json(**kwargs)
+    return output.getvalue()
+
+
+def read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_index(output_dir, world='パラレルワールド1'):
+    return read_json(os.path.join(output_dir, 'index', f'{world}.json'))
+
+
+def snapshot(output_dir):
+    """出力ディレクトリの中身（変換の記録 .build を除く）を 相対パス -> バイト列 で返す"""
+    files = {}
+    for root, dirs, filenames in os.walk(output_dir):
+        dirs[:] = [name for name in dirs if name != convert_to_json.BUILD_STATE_DIR]
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, output_dir)] = f.read()
+    return files
+
+
+def touch_all(output_dir):
+    """出力のファイルの更新日時をすべて 0 にする（書き直されたファイルを見分けるため）"""
+    for root, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            os.utime(os.path.join(root, filename), (0, 0))
+
+
+def rewritten(output_dir):
+    """touch_all() の後に書き直されたファイル（.build を除く）の相対パス"""
+    return sorted(path for path in snapshot(output_dir) if os.path.getmtime(os.path.join(output_dir, path)) != 0)
+
+
+def duplicated_postings(index):
+    """IDが重複している絞り込み・日付のリストを (種類, 値) で返す"""
+    lists = [((column, value), ids) for column, values in index['facets'].items() for value, ids in values.items()]
+    lists += [(('dates', date), ids) for date, ids in index['dates'].items()]
+    return [name for name, ids in lists if len(ids) != len(set(ids))]
+
+
+def test_facets_list_each_entry_once():
+    """同じ登場人物が1件の中に何度も書かれていても、絞り込みのリストにはIDが1回だけ入ること"""
+    rows = [
+        make_row('a', '2023/01/02', people='FBI, 江戸川コナン, FBI'),
+        make_row('b', '2023/01/01', people='FBI'),
+    ]
+    with work_dir(rows):
+        convert()
+        index = read_index(convert_to_json.OUTPUT_DIR)
+    assert index['facets']['主要登場人物']['FBI'] == ['b', 'a']
+    assert duplicated_postings(index) == []
+
+
+def test_index_orders_entries_and_dates():
+    """索引の日記と日付の辞書が事件の発生日の順（日付のない日記は最後）に並び、絞り込みが値ごとのIDのリストになること"""
+    rows = [
+        make_row('c', '2023/03/01', people='毛利蘭', kind='誘拐', purpose='日常'),
+        make_row('n', None, people='FBI'),
+        make_row('a', '2023/01/15'),
+        make_row('b', '2023/03/01', people='江戸川コナン', kind='殺人', purpose='日常'),
+    ]
+    with work_dir(rows):
+        convert()
+        index = read_index(convert_to_json.OUTPUT_DIR)
+    assert [entry['ID'] for entry in index['entries']] == ['a', 'c', 'b', 'n']
+    assert list(index['dates'].items()) == [('2023-01-15', ['a']), ('2023-03-01', ['c', 'b'])]
+    assert index['facets'] == {
+        '主要登場人物': {'FBI': ['n'], '毛利蘭': ['a', 'c'], '江戸川コナン': ['a', 'b']},
+        '事件種別': {'殺人': ['a', 'b', 'n'], '誘拐': ['c']},
+        'コナン一行の目的': {'旅行': ['a', 'n'], '日常': ['c', 'b']},
+    }
+    assert index['entries'][1]['主要登場人物'] == ['毛利蘭']
+    assert index['entries'][3]['事件の発生日'] is None
+
+
+def test_dates_are_iso_formatted():
+    """事件の発生日と終了日はISO形式にそろえ、日付として読めない値と放送日はそのまま残すこと"""
+    rows = [make_row('a', '2023/1/5'), make_row('b', '不明')]
+    rows[0]['放送日'] = '1996/07/15, 1996/07/22'
+    rows[1]['放送日'] = None
+    with work_dir(rows):
+        convert()
+        output_dir = convert_to_json.OUTPUT_DIR
+        index = read_index(output_dir)
+        bodies = read_json(os.path.join(output_dir, 'bodies', 'パラレルワールド1', '0.json'))
+    assert [(entry['ID'], entry['事件の発生日']) for entry in index['entries']] == [('a', '2023-01-05'), ('b', '不明')]
+    assert list(index['dates']) == ['2023-01-05', '不明']
+    assert bodies['a']['事件の終了日'] == '2023-01-05'
+    assert bodies['a']['放送日'] == '1996/07/15, 1996/07/22'
+    assert bodies['b']['事件の終了日'] == '不明'
+
+
+def test_split_writer_chunks_bodies():
+    """本文は BODY_CHUNK_ENTRIES 件ずつ索引と同じ順に本文ファイルに入り、日記が減ったら余分な本文ファイルを消すこと"""
+    rows = [make_row(f'e{number}', f'2023/01/{number + 1:02d}') for number in range(7)]
+    rows.append(make_row('x', '2023/02/01', world='パラレルワールド10'))
+    rows.append(make_row('y', '2023/02/01', world='パラレルワールド2'))
+    with work_dir(rows):
+        convert()
+        output_dir = convert_to_json.OUTPUT_DIR
+        index = read_index(output_dir)
+        bodies_dir = os.path.join(output_dir, 'bodies', 'パラレルワールド1')
+        first = read_json(os.path.join(bodies_dir, '0.json'))
+        second = read_json(os.path.join(bodies_dir, '1.json'))
+        worlds = read_json(os.path.join(output_dir, convert_to_json.WORLDS_FILE))
+
+        pd.DataFrame(rows[:3]).to_csv(convert_to_json.CSV_FILE_PATH, index=False)
+        convert()
+        remaining = sorted(os.listdir(bodies_dir))
+
+    assert [entry[convert_to_json.BODY_KEY] for entry in index['entries']] == [0] * 5 + [1] * 2
+    assert list(first) == ['e0', 'e1', 'e2', 'e3', 'e4'] and list(second) == ['e5', 'e6']
+    # 索引の列とパラレルワールド名は本文ファイルに入れない
+    assert set(first['e0']) == {'事件の終了日', '事件の概要', '生成結果'}
+    assert first['e0']['生成結果'] == '## 2023/01/01\n\ne0の日記'
+    assert [world['name'] for world in worlds] == ['パラレルワールド1', 'パラレルワールド2', 'パラレルワールド10']
+    assert worlds[0] == {
+        'name': 'パラレルワールド1', 'index': 'index/パラレルワールド1.json', 'bodies': 'bodies/パラレルワールド1', 'entries': 7,
+    }
+    assert remaining == ['0.json']
+
+
+def test_streaming_matches_whole_file():
+    """入力を少しずつ読み込む変換でも、ファイル全体を読み込む変換と同じ出力になること"""
+    rows = [make_row(f'e{number}', f'2023/01/{7 - number:02d}', world=f'パラレルワールド{number % 2 + 1}')
+            for number in range(7)]
+    with work_dir(rows):
+        convert()
+        whole = snapshot(convert_to_json.OUTPUT_DIR)
+    with work_dir(rows):
+        convert(stream=True, chunksize=2)
+        streamed = snapshot(convert_to_json.OUTPUT_DIR)
+    assert whole == streamed
+
+
+def test_incremental_matches_rebuild():
+    """前回の記録を使って変わった部分だけを書き直した出力が、すべて作り直した出力と同じになること"""
+    rows = make_rows()
+    changes = [
+        # 本文だけが変わった場合（全文検索の索引は差分で更新する）
+        lambda rows: edit_body(rows, 'e4'),
+        # 日記が増え、絞り込みの値も変わった場合
+        lambda rows: rows + [make_row('new', '2023/01/03', world='パラレルワールド2', people='灰原哀')],
+        # パラレルワールドが1つなくなった場合
+        lambda rows: [row for row in rows if row['パラレルワールド名'] != 'パラレルワールド3'],
+        # 何も変わらない場合
+        lambda rows: rows,
+    ]
+    with work_dir(rows):
+        output_dir = convert_to_json.OUTPUT_DIR
+        convert()
+        for change in changes:
+            rows = change(rows)
+            write_rows(rows)
+            convert()
+            incremental = snapshot(output_dir)
+            convert(rebuild=True)
+            assert snapshot(output_dir) == incremental
+            with work_dir(rows):
+                convert()
+                assert snapshot(convert_to_json.OUTPUT_DIR) == incremental
+
+
+def test_unchanged_worlds_are_not_rewritten():
+    """入力の変わっていないワールドは何も書き直さず、変わったワールドも変わった本文ファイルだけを書き直すこと"""
+    with work_dir(make_rows(count=12, worlds=2)):
+        output_dir = convert_to_json.OUTPUT_DIR
+        convert()
+        touch_all(output_dir)
+        output = convert()
+        assert rewritten(output_dir) == []
+        assert "'json_data/index/パラレルワールド1.json' は変更がありません" in output
+
+        # e6 はパラレルワールド1の日付順で4件目なので、1つ目の本文ファイルに入っている
+        write_rows(edit_body(make_rows(count=12, worlds=2), 'e6'))
+        convert()
+        changed = rewritten(output_dir)
+        assert os.path.join('bodies', 'パラレルワールド1', '0.json') in changed
+        assert not any('パラレルワールド2' in path for path in changed)
+        assert os.path.join('bodies', 'パラレルワールド1', '1.json') not in changed
+        assert os.path.join('index', 'パラレルワールド1.json') not in changed  # 索引に入る列は変わっていない
+
+        # 出力が欠けていれば、入力が同じでも前回の記録は使わない
+        touch_all(output_dir)
+        os.remove(os.path.join(output_dir, 'bodies', 'パラレルワールド2', '1.json'))
+        convert()
+        assert rewritten(output_dir) == [os.path.join('bodies', 'パラレルワールド2', '1.json')]
+
+
+def test_settings_change_invalidates_build_state():
+    """出力の形式に関わる設定が変わったか、記録が壊れているか、--rebuild の場合は前回の記録を使わないこと"""
+    with work_dir(make_rows()):
+        output_dir = convert_to_json.OUTPUT_DIR
+        convert()
+        state = convert_to_json.BuildState(output_dir)
+        assert sorted(state.previous) == ['パラレルワールド1', 'パラレルワールド2', 'パラレルワールド3']
+        assert state.search is not None
+        assert convert_to_json.BuildState(output_dir, rebuild=True).previous == {}
+
+        original = convert_to_json.FACET_COLUMNS
+        convert_to_json.FACET_COLUMNS = original[:1]
+        try:
+            state = convert_to_json.BuildState(output_dir)
+            assert (state.previous, state.search) == ({}, None)
+        finally:
+            convert_to_json.FACET_COLUMNS = original
+
+        with open(state.path, 'w', encoding='utf-8') as f:
+            f.write('{"settings": ')  # 書き込みの途中で止まった記録
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            state = convert_to_json.BuildState(output_dir)
+        assert state.previous == {} and 'すべて作り直します' in output.getvalue()
+
+        # 記録が使えなくても、作り直した出力は前回と同じなので書き直さない
+        touch_all(output_dir)
+        convert()
+        assert rewritten(output_dir) == []
+
+
+def test_removed_worlds_are_deleted():
+    """入力からなくなったパラレルワールドの索引・本文ファイル・全文検索の材料を消すこと"""
+    rows = make_rows()
+    with work_dir(rows):
+        output_dir = convert_to_json.OUTPUT_DIR
+        convert()
+        search_cache = convert_to_json.BuildState(output_dir).search_cache_path('パラレルワールド3')
+        assert os.path.exists(search_cache)
+
+        write_rows([row for row in rows if row['パラレルワールド名'] != 'パラレルワールド3'])
+        output = convert()
+        worlds = read_json(os.path.join(output_dir, convert_to_json.WORLDS_FILE))
+        assert "入力にない 'パラレルワールド3' の出力を削除しました" in output
+        assert not os.path.exists(os.path.join(output_dir, 'index', 'パラレルワールド3.json'))
+        assert not os.path.exists(os.path.join(output_dir, 'bodies', 'パラレルワールド3'))
+        assert not os.path.exists(search_cache)
+        assert [world['name'] for world in worlds] == ['パラレルワールド1', 'パラレルワールド2']
+        assert sorted(convert_to_json.BuildState(output_dir).previous) == ['パラレルワールド1', 'パラレルワールド2']
+
+
+def test_search_index_is_patched_when_only_bodies_change():
+    """本文だけが変わった場合は、全文検索の索引を作り直さず、変わった bigram のファイルだけを書き換えること"""
+    rows = make_rows()
+    with work_dir(rows):
+        output_dir = convert_to_json.OUTPUT_DIR
+        search_dir = os.path.join(output_dir, convert_to_json.SEARCH_DIR)
+        convert()
+        touch_all(output_dir)
+        write_rows(edit_body(rows, 'e4', '灰原は博士の家にいた。'))
+        output = convert()
+        assert "全文検索の索引を更新しました" in output
+        patched = [path for path in rewritten(output_dir) if path.startswith(convert_to_json.SEARCH_DIR + os.sep)]
+        assert 0 < len(patched) < convert_to_json.SHARD_COUNT
+        assert os.path.join(convert_to_json.SEARCH_DIR, convert_to_json.DOCS_FILE) not in patched
+        assert SearchIndex(search_dir).search('灰原 博士') == ['e4']
+
+        # 日記が増えた場合は、日記の番号がずれるので作り直す
+        write_rows(edit_body(rows, 'e4', '灰原は博士の家にいた。') + [make_row('new', '2023/01/03', people='灰原哀')])
+        output = convert()
+        assert "全文検索の索引（日記 13 件" in output
+
+
+def test_watch_reconverts_when_source_changes():
+    """--watch は入力が書き換えられるたびに変換し直し、Ctrl+C で終了すること"""
+    rows = make_rows()
+    steps = []
+
+    def fake_sleep(seconds):
+        # 監視の待機のたびに呼ばれる。2回目の待機中に入力を書き換え、4回目で Ctrl+C を押したことにする
+        steps.append(seconds)
+        if len(steps) == 2:
+            write_rows(edit_body(rows, 'e4', '新しい一文。'))
+        elif len(steps) == 4:
+            raise KeyboardInterrupt
+
+    original = convert_to_json.time.sleep
+    convert_to_json.time.sleep = fake_sleep
+    try:
+        with work_dir(rows):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                convert_to_json.watch(interval=0)
+            bodies = read_json(os.path.join(convert_to_json.OUTPUT_DIR, 'bodies', 'パラレルワールド2', '0.json'))
+    finally:
+        convert_to_json.time.sleep = original
+    assert bodies['e4']['生成結果'].endswith('新しい一文。')
+    assert output.getvalue().count('秒で変換しました') == 2
+    assert '監視を終了しました' in output.getvalue()
+
+
+def test_committed_indexes_have_no_duplicate_postings():
+    """リポジトリに入っている json_data の索引にも、IDが重複したリストがないこと"""
+    paths = glob.glob(os.path.join(DATA_DIR, 'json_data', 'index', '*.json'))
+    assert paths
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            assert duplicated_postings(json.load(f)) == [], path
+
+
+if __name__ == "__main__":
+    test_facets_list_each_entry_once()
+    test_index_orders_entries_and_dates()
+    test_dates_are_iso_formatted()
+    test_split_writer_chunks_bodies()
+    test_streaming_matches_whole_file()
+    test_incremental_matches_rebuild()
+    test_unchanged_worlds_are_not_rewritten()
+    test_settings_change_invalidates_build_state()
+    test_removed_worlds_are_deleted()
+    test_search_index_is_patched_when_only_bodies_change()
+    test_watch_reconverts_when_source_changes()
+    test_committed_indexes_have_no_duplicate_postings()
+    print("✅ convert_to_json のテストがすべて成功しました")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+search_index の全文検索の索引をテストするスクリプト
+"""
+
+import json
+import os
+import tempfile
+
+from search_index import SearchIndex, SearchIndexBuilder, index_files, patch_files, shard_of
+
+
+def test_search_index_finds_japanese_terms():
+    """bigramの索引で、複数語・1文字・全角半角の違う検索語が見つかり、必要なファイルだけを読むこと"""
+    builder = SearchIndexBuilder()
+    builder.add('a', ['毛利蘭と江戸川コナンは米花町の密室を調べた。', None])
+    builder.add('b', ['灰原は博士の家でｱﾘﾊﾞｲを確かめた'])
+    builder.add('c', ['蘭'])
+    with tempfile.TemporaryDirectory() as directory:
+        for filename, value in builder.files(['c', 'b', 'a']).items():
+            with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+        index = SearchIndex(directory)
+        assert index.search('毛利蘭') == ['a']
+        assert index.search('蘭') == ['c', 'a']  # 日記の番号（files() に渡した順）で返す
+        assert index.search('灰原、博士') == ['b']
+        assert index.search('アリバイ') == ['b']
+        assert index.search('密室 灰原') == []
+        assert index.search('') == []
+        assert 0 < index.shards_loaded < len(os.listdir(directory)) - 1
+
+
+def test_search_index_patch_matches_rebuild():
+    """日記の内容だけが変わった場合に、変わった bigram のファイルだけを書き換えた結果が作り直した結果と同じになること"""
+    first, second = SearchIndexBuilder(), SearchIndexBuilder()
+    first.add('a', ['毛利蘭と江戸川コナン'])
+    first.add('b', ['米花町の密室'])
+    second.add('c', ['灰原は博士の家にいた'])
+    parts = [(['a', 'b'], first.bitmaps(['a', 'b'])), (['c'], second.bitmaps(['c']))]
+    files = index_files(parts)
+
+    edited = SearchIndexBuilder()  # 2つ目のワールドの 'c' だけを書き換える
+    edited.add('c', ['灰原と毛利蘭は米花町にいた'])
+    old_bitmaps, new_bitmaps = parts[1][1], edited.bitmaps(['c'])
+    changes = {
+        token: (0b1 << 2, new_bitmaps.get(token, 0) << 2) for token in old_bitmaps.keys() | new_bitmaps.keys()
+        if old_bitmaps.get(token) != new_bitmaps.get(token)
+    }
+    patched = patch_files(lambda number: dict(files[f'{number}.json']), changes, 3)
+    rebuilt = index_files([parts[0], (['c'], new_bitmaps)])
+    assert patched == {filename: rebuilt[filename] for filename in patched}
+    assert set(patched) == {f'{shard_of(token)}.json' for token in changes}
+    assert all(files[filename] == value for filename, value in rebuilt.items() if filename not in patched)
+
+
+if __name__ == "__main__":
+    test_search_index_finds_japanese_terms()
+    test_search_index_patch_matches_rebuild()
+    print("✅ search_index のテストがすべて成功しました")
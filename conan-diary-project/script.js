@@ -21,17 +21,36 @@ document.addEventListener('DOMContentLoaded', () => {
     // ★ 追加: 絞り込み機能のトグルボタン
     const toggleFilterBtn = document.getElementById('toggle-filter-btn');
     const filterOptionsWrapper = document.getElementById('filter-options-wrapper');
+    // ★ 追加: 全文検索の入力欄
+    const searchInput = document.getElementById('search-input');
 
     // --- 状態管理 ---
     let currentWorld = 1; // HTMLのselectedに合わせる
     let worldDataCache = {};
     let fullDiaryData = [];
     let filteredDiaryData = [];
+    let facetIndex = {}; // 列名 -> 値 -> IDのリスト（変換時に作った索引）
+    let dateIndex = {}; // 事件の発生日（YYYY-MM-DD） -> IDのリスト
+    let filteredPositions = new Map(); // ID -> filteredDiaryData での位置
     let diaryMap = new Map();
     let currentDate = new Date('2023-01-01T00:00:00');
     let viewMode = 'calendar';
     let activeFilters = { characters: [], eventType: [], purpose: [] };
     let currentArticleIndex = -1;
+    // ★ 追加: 一覧用の索引と日記の本文は別のファイルに分かれている（data/convert_to_json.py が出力）
+    const JSON_DIR = './data/json_data';
+    // ★ 追加: data/build_bundle.py で作った圧縮済み・ハッシュ付きのファイル名のデータ（なければ JSON_DIR を読む）
+    const BUNDLE_DIR = './data/bundle';
+    let manifestPromise = null; // bundle/manifest.json（json_data の中のパス -> ハッシュ付きのパス）
+    let worldsPromise = null; // worlds.json（パラレルワールドの一覧）
+    const bodyCache = new Map(); // 本文ファイルのパス -> 読み込み中/読み込み済みのPromise
+    // ★ 追加: 全文検索（data/search_index.py が出力する文字bigramの索引を、検索語に必要なファイルだけ読み込む）
+    const SEARCH_SHARD_COUNT = 128; // search_index.py の SHARD_COUNT と同じ
+    const searchShardCache = new Map(); // 索引のファイルの番号 -> Promise
+    let searchDocsPromise = null; // 日記の番号 -> ID の配列
+    let searchIds = null; // 検索語に当てはまるIDの集合（null は検索なし）
+    let searchSequence = 0; // 古い検索の結果で上書きしないための番号
+    let searchTimer = null;
 
     const init = () => {
         setupEventListeners();
@@ -52,30 +71,22 @@ document.addEventListener('DOMContentLoaded', () => {
         nextArticleBtn.addEventListener('click', showNextArticle);
         // ★ 追加: 絞り込み表示切替のイベントリスナー
         toggleFilterBtn.addEventListener('click', toggleFilterVisibility);
+        searchInput.addEventListener('input', handleSearchInput);
     };
 
     const loadWorldData = async (worldNumber) => {
         showLoader();
         currentWorld = worldNumber;
 
-        if (worldDataCache[worldNumber]) {
-            fullDiaryData = worldDataCache[worldNumber];
-        } else {
+        if (!worldDataCache[worldNumber]) {
             try {
-                let dataToLoad = [];
-                if (worldNumber == 0) {
-                     // ★ 修正: 正しいパスに修正
-                    const promises = Array.from({ length: 9 }, (_, i) =>
-                        fetch(`./data/json_data/パラレルワールド_${i + 1}.json`).then(res => res.ok ? res.json() : [])
-                    );
-                    const allWorldsData = await Promise.all(promises);
-                    dataToLoad = allWorldsData.flat();
-                } else {
-                     // ★ 修正: 正しいパスに修正
-                    dataToLoad = await fetch(`./data/json_data/パラレルワールド_${worldNumber}.json`).then(res => res.json());
-                }
-                worldDataCache[worldNumber] = dataToLoad.sort((a, b) => new Date(a['事件の発生日']) - new Date(b['事件の発生日']));
-                fullDiaryData = worldDataCache[worldNumber];
+                // ★ 変更: 最初は索引（一覧・カレンダー・絞り込みに使う列だけ）を読み込み、本文は記事を開いたときに読み込む
+                const worlds = await loadWorlds();
+                const targetWorlds = worldNumber == 0 ? worlds : [worlds[worldNumber - 1]];
+                if (targetWorlds.some(world => !world)) throw new Error(`パラレルワールド_${worldNumber} がありません`);
+                const allWorldsData = await Promise.all(targetWorlds.map(loadWorldIndex));
+                // ★ 変更: 各ワールドの索引は日付順に並んでいるので、1つのワールドならそのまま使う
+                worldDataCache[worldNumber] = allWorldsData.length === 1 ? allWorldsData[0] : mergeWorldIndexes(allWorldsData);
             } catch (error) {
                 console.error('データ読み込みエラー:', error);
                 alert('データの読み込みに失敗しました。json_dataフォルダが正しい位置にあるか確認してください。');
@@ -83,46 +94,219 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
         }
+        ({ entries: fullDiaryData, facets: facetIndex, dates: dateIndex } = worldDataCache[worldNumber]);
         populateFilters();
         applyFiltersAndRender();
         hideLoader();
     };
 
-    const populateFilters = () => {
-        const characters = new Set(), eventTypes = new Set(), purposes = new Set();
-        fullDiaryData.forEach(entry => {
-            entry['主要登場人物']?.forEach(c => characters.add(c));
-            if (entry['事件種別'] && entry['事件種別'] !== "nan") eventTypes.add(entry['事件種別']);
-            if (entry['コナン一行の目的'] && entry['コナン一行の目的'] !== "nan") purposes.add(entry['コナン一行の目的']);
+    // manifest.json だけは毎回サーバーに確認し、ハッシュ付きのファイルはブラウザのキャッシュに任せる
+    const loadManifest = () => {
+        if (!manifestPromise) {
+            manifestPromise = fetch(`${BUNDLE_DIR}/manifest.json`, { cache: 'no-cache' })
+                .then(res => res.ok ? res.json() : null)
+                .catch(() => null);
+        }
+        return manifestPromise;
+    };
+
+    // json_data の中のパスのJSONを読み込む（バンドルにあればハッシュ付きのファイルから）
+    const fetchData = async (path) => {
+        const manifest = await loadManifest();
+        const hashedPath = manifest?.files?.[path];
+        const url = hashedPath ? `${BUNDLE_DIR}/${hashedPath}` : `${JSON_DIR}/${path}`;
+        const res = await fetch(url);
+        if (!res.ok) throw new Error(`${url}: ${res.status}`);
+        return res.json();
+    };
+
+    const loadWorlds = () => {
+        if (!worldsPromise) {
+            worldsPromise = fetchData('worlds.json');
+            worldsPromise.catch(() => { worldsPromise = null; }); // 失敗したら次回に読み込み直す
+        }
+        return worldsPromise;
+    };
+
+    const loadWorldIndex = async (world) => {
+        const index = await fetchData(world.index);
+        index.entries.forEach(entry => {
+            entry['パラレルワールド名'] = world.name;
+            entry.bodyPath = `${world.bodies}/${entry['本文']}.json`;
         });
-        createFilterOptions('characters-filter', characters, 'characters');
-        createFilterOptions('event-type-filter', eventTypes, 'eventType');
-        createFilterOptions('purpose-filter', purposes, 'purpose');
+        return index;
+    };
+
+    // 全結合版: 日付順の配列を併合し、絞り込みと日付の索引はIDのリストをつなげる
+    const mergeWorldIndexes = (indexes) => {
+        const concatPostings = (postingsList) => postingsList.reduce((merged, postings) => {
+            for (const [value, ids] of Object.entries(postings)) merged[value] = (merged[value] || []).concat(ids);
+            return merged;
+        }, {});
+        const entries = [];
+        const positions = indexes.map(() => 0);
+        for (;;) {
+            let next = -1;
+            indexes.forEach((index, i) => {
+                const entry = index.entries[positions[i]];
+                if (entry && (next === -1 || compareDates(entry, indexes[next].entries[positions[next]]) < 0)) next = i;
+            });
+            if (next === -1) break;
+            entries.push(indexes[next].entries[positions[next]++]);
+        }
+        const facetColumns = Object.keys(indexes[0].facets);
+        const facets = Object.fromEntries(facetColumns.map(column => [column, concatPostings(indexes.map(index => index.facets[column]))]));
+        const dates = Object.fromEntries(Object.entries(concatPostings(indexes.map(index => index.dates))).sort());
+        return { entries, facets, dates };
+    };
+
+    // ISO形式（YYYY-MM-DD）の日付の比較。日付のない日記は最後
+    const compareDates = (a, b) => {
+        const dateA = a['事件の発生日'], dateB = b['事件の発生日'];
+        if (dateA === dateB) return 0;
+        if (!dateA) return 1;
+        if (!dateB) return -1;
+        return dateA < dateB ? -1 : 1;
+    };
+
+    // 日記の本文を読み込む（同じ本文ファイルに入っている前後の日記もまとめて取得され、キャッシュされる）
+    const loadDiaryBody = async (entry) => {
+        if (!bodyCache.has(entry.bodyPath)) {
+            const promise = fetchData(entry.bodyPath);
+            promise.catch(() => bodyCache.delete(entry.bodyPath));
+            bodyCache.set(entry.bodyPath, promise);
+        }
+        const bodies = await bodyCache.get(entry.bodyPath);
+        return bodies[entry['ID']] || {};
+    };
+
+    // ★ 変更: 絞り込みの選択肢は、変換時に作った索引のキーをそのまま使う
+    const FILTER_COLUMNS = { characters: '主要登場人物', eventType: '事件種別', purpose: 'コナン一行の目的' };
+
+    // search_index.py の normalize / text_runs と同じ正規化と区切り方
+    const normalizeSearchText = (text) => text.normalize('NFKC').toLowerCase();
+    const searchTerms = (query) => normalizeSearchText(query).match(/[\p{L}\p{N}]+/gu) || [];
+    const searchShardOf = (token) => token.codePointAt(0) % SEARCH_SHARD_COUNT;
+    const intersectSets = (a, b) => new Set([...a].filter(value => b.has(value)));
+
+    // 差分のリスト、またはビット列のBase64から日記の番号のリストに戻す
+    const decodePostings = (value) => {
+        if (typeof value === 'string') {
+            const bytes = atob(value);
+            const postings = [];
+            for (let i = 0; i < bytes.length; i++) {
+                const byte = bytes.charCodeAt(i);
+                for (let bit = 0; bit < 8; bit++) if (byte >> bit & 1) postings.push(i * 8 + bit);
+            }
+            return postings;
+        }
+        let number = 0;
+        return value.map(delta => (number += delta));
+    };
+
+    const loadSearchShard = (number) => {
+        if (!searchShardCache.has(number)) {
+            const promise = fetchData(`search/${number}.json`);
+            promise.catch(() => searchShardCache.delete(number));
+            searchShardCache.set(number, promise);
+        }
+        return searchShardCache.get(number);
+    };
+
+    const loadSearchDocs = () => {
+        if (!searchDocsPromise) {
+            searchDocsPromise = fetchData('search/docs.json');
+            searchDocsPromise.catch(() => { searchDocsPromise = null; });
+        }
+        return searchDocsPromise;
+    };
+
+    // 1つの語を含む日記の番号の集合（1文字の語は、その文字で始まるbigramをすべて合わせる）
+    const termPostings = async (term) => {
+        const chars = Array.from(term);
+        if (chars.length === 1) {
+            const shard = await loadSearchShard(searchShardOf(term));
+            const found = new Set();
+            for (const [token, value] of Object.entries(shard)) {
+                if (Array.from(token)[0] === term) decodePostings(value).forEach(number => found.add(number));
+            }
+            return found;
+        }
+        const tokens = chars.slice(0, -1).map((char, i) => char + chars[i + 1]);
+        const shards = await Promise.all(tokens.map(token => loadSearchShard(searchShardOf(token))));
+        return tokens.reduce((found, token, i) => {
+            const postings = new Set(decodePostings(shards[i][token] || []));
+            return found === null ? postings : intersectSets(found, postings);
+        }, null);
+    };
+
+    // 検索語をすべて含む日記のIDの集合（検索語がなければ null）
+    const runSearch = async (query) => {
+        const terms = searchTerms(query);
+        if (terms.length === 0) return null;
+        const [docs, ...postings] = await Promise.all([loadSearchDocs(), ...terms.map(termPostings)]);
+        const found = postings.reduce((a, b) => intersectSets(a, b));
+        return new Set([...found].map(number => docs[number]));
+    };
+
+    const handleSearchInput = () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(async () => {
+            const sequence = ++searchSequence;
+            let ids;
+            try {
+                ids = await runSearch(searchInput.value);
+            } catch (error) {
+                console.error('検索エラー:', error);
+                ids = null;
+            }
+            if (sequence !== searchSequence) return; // 入力が続いている間の古い結果は捨てる
+            searchIds = ids;
+            applyFiltersAndRender();
+        }, 300);
+    };
+
+    const populateFilters = () => {
+        createFilterOptions('characters-filter', Object.keys(facetIndex['主要登場人物'] || {}), 'characters');
+        createFilterOptions('event-type-filter', Object.keys(facetIndex['事件種別'] || {}), 'eventType');
+        createFilterOptions('purpose-filter', Object.keys(facetIndex['コナン一行の目的'] || {}), 'purpose');
         resetFilters(); // フィルターをリセットして初期表示
     };
     
     // (createFilterOptions, applyFiltersAndRender, populateSidebar, updateCalendarData, updateView, renderCalendar, renderSingleArticle は変更なし)
     
     // ... (変更のない関数は省略) ...
-    const createFilterOptions = (containerId, optionsSet, filterKey) => {
+    const createFilterOptions = (containerId, options, filterKey) => {
         const container = document.getElementById(containerId);
         container.innerHTML = '';
-        Array.from(optionsSet).sort().forEach(option => {
-            if (option && option !== 'nan') {
-                container.insertAdjacentHTML('beforeend', 
-                    `<div class="filter-tag" data-filter-key="${filterKey}" data-value="${option}">${option}</div>`
-                );
-            }
+        options.forEach(option => {
+            container.insertAdjacentHTML('beforeend', 
+                `<div class="filter-tag" data-filter-key="${filterKey}" data-value="${option}">${option}</div>`
+            );
         });
     };
 
+    // 選ばれた値と検索語に当てはまるIDの集合を求める（登場人物はすべてを含む日記、事件種別と目的はいずれかに当てはまる日記）
+    const matchingIds = () => {
+        let ids = searchIds; // null は絞り込みなし
+        const narrow = (candidates) => { ids = ids === null ? candidates : intersectSets(ids, candidates); };
+        for (const [filterKey, column] of Object.entries(FILTER_COLUMNS)) {
+            const values = activeFilters[filterKey];
+            const postings = facetIndex[column] || {};
+            if (filterKey === 'characters') {
+                values.forEach(value => narrow(new Set(postings[value] || [])));
+            } else if (values.length > 0) {
+                narrow(new Set(values.flatMap(value => postings[value] || [])));
+            }
+        }
+        return ids;
+    };
+
     const applyFiltersAndRender = () => {
         currentArticleIndex = -1; // フィルター変更時は記事選択をリセット
-        filteredDiaryData = fullDiaryData.filter(entry =>
-            (activeFilters.characters.length === 0 || activeFilters.characters.every(f => entry['主要登場人物']?.includes(f))) &&
-            (activeFilters.eventType.length === 0 || activeFilters.eventType.includes(entry['事件種別'])) &&
-            (activeFilters.purpose.length === 0 || activeFilters.purpose.includes(entry['コナン一行の目的']))
-        );
+        const ids = matchingIds();
+        filteredDiaryData = ids === null ? fullDiaryData : fullDiaryData.filter(entry => ids.has(entry['ID']));
+        filteredPositions = new Map(filteredDiaryData.map((entry, index) => [entry['ID'], index]));
 
         populateSidebar();
         updateCalendarData();
@@ -161,15 +345,13 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // 日付 -> 絞り込み後の記事の位置のリスト（日付の索引から作る）
     const updateCalendarData = () => {
         diaryMap.clear();
-        filteredDiaryData.forEach(entry => {
-            const dateKey = entry['事件の発生日']?.split('T')[0].replace(/\//g, '-');
-            if (dateKey) {
-                if (!diaryMap.has(dateKey)) diaryMap.set(dateKey, []);
-                diaryMap.get(dateKey).push(entry);
-            }
-        });
+        for (const [dateKey, ids] of Object.entries(dateIndex)) {
+            const indexes = ids.map(id => filteredPositions.get(id)).filter(index => index !== undefined);
+            if (indexes.length > 0) diaryMap.set(dateKey, indexes);
+        }
     }
 
     const updateView = () => {
@@ -228,7 +410,7 @@ document.addEventListener('DOMContentLoaded', () => {
         diaryBlock.className = 'diary-entry-block';
         
         const charactersHTML = entry['主要登場人物']?.map(char => `<span class="character-tag">${char}</span>`).join('') || '';
-        const linkHTML = entry['読売テレビリンク'] && entry['読売テレビリンク'] !== "nan" ? `<a href="${entry['読売テレビリンク']}" target="_blank" rel="noopener noreferrer">読売テレビの公式サイトで見る</a>` : '';
+        const linkHTML = entry['読売テレビリンク'] ? `<a href="${entry['読売テレビリンク']}" target="_blank" rel="noopener noreferrer">読売テレビの公式サイトで見る</a>` : '';
         const diaryBodyHTML = marked.parse(entry['生成結果'] || '日記の本文はありません。');
 
         diaryBlock.innerHTML = `
@@ -255,7 +437,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
-    const renderSingleArticle = (index) => {
+    const renderSingleArticle = async (index) => {
         if (index < 0 || index >= filteredDiaryData.length) {
             resetArticleView();
             return;
@@ -264,22 +446,32 @@ document.addEventListener('DOMContentLoaded', () => {
         const entry = filteredDiaryData[index];
 
         diaryInitialPrompt.classList.add('is-hidden');
-        diaryEntriesArea.innerHTML = '';
-        diaryEntriesArea.appendChild(createDiaryEntryHTML(entry));
+        diaryEntriesArea.innerHTML = '<p style="padding: 15px;">日記を読み込み中...</p>';
         articleNav.classList.remove('is-hidden');
         
         updateArticleNavButtons();
         updateSidebarActiveLink();
+
+        // ★ 追加: 本文はこの時点で読み込む
+        let body;
+        try {
+            body = await loadDiaryBody(entry);
+        } catch (error) {
+            console.error('本文の読み込みエラー:', error);
+            body = { '生成結果': '日記の本文を読み込めませんでした。' };
+        }
+        // 読み込んでいる間に別の記事が選ばれた場合は表示しない
+        if (currentArticleIndex !== index || filteredDiaryData[index] !== entry) return;
+        diaryEntriesArea.innerHTML = '';
+        diaryEntriesArea.appendChild(createDiaryEntryHTML({ ...entry, ...body }));
     };
 
     const handleCalendarClick = (e) => {
         const cell = e.target.closest('.has-diary');
         if (!cell) return;
-        const dateKey = cell.dataset.date;
-        const firstEntryOnDate = filteredDiaryData.find(d => d['事件の発生日'] && d['事件の発生日'].includes(dateKey.replace(/-/g, '/')));
-        const index = filteredDiaryData.indexOf(firstEntryOnDate);
+        const index = diaryMap.get(cell.dataset.date)?.[0];
 
-        if (index !== -1) {
+        if (index !== undefined) {
             switchViewMode('article');
             renderSingleArticle(index);
         }
@@ -310,6 +502,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const resetFilters = () => {
         activeFilters = { characters: [], eventType: [], purpose: [] };
         document.querySelectorAll('.filter-tag.active').forEach(tag => tag.classList.remove('active'));
+        clearTimeout(searchTimer);
+        searchSequence++;
+        searchInput.value = '';
+        searchIds = null;
         applyFiltersAndRender();
     };
     
@@ -356,18 +552,18 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const formatDate = (dateString, format = 'YYYY年M月D日') => {
         if (!dateString) return '日付不明';
-        try {
-            const date = new Date(dateString.replace(/\//g, '-'));
-            if (isNaN(date)) return dateString; // 無効な日付の場合は元の文字列を返す
-            if (format === 'MM/DD') return `${String(date.getMonth() + 1).padStart(2, '0')}/${String(date.getDate()).padStart(2, '0')}`;
-            return `${date.getFullYear()}年${date.getMonth() + 1}月${date.getDate()}日`;
-        } catch (e) { return dateString; }
+        // ★ 変更: 日付は変換時に YYYY-MM-DD にそろえてあるので、Date を使わずに分解する
+        const match = /^(\d{4})-(\d{2})-(\d{2})$/.exec(dateString);
+        if (!match) return dateString; // 無効な日付の場合は元の文字列を返す
+        const [, year, month, day] = match;
+        if (format === 'MM/DD') return `${month}/${day}`;
+        return `${Number(year)}年${Number(month)}月${Number(day)}日`;
     };
     
     const showLoader = () => loader.classList.remove('is-hidden');
     const hideLoader = () => loader.classList.add('is-hidden');
     const checkResetButtonVisibility = () => {
-        const hasActiveFilter = Object.values(activeFilters).some(arr => arr.length > 0);
+        const hasActiveFilter = Object.values(activeFilters).some(arr => arr.length > 0) || searchIds !== null;
         resetFilterBtn.classList.toggle('is-hidden', !hasActiveFilter);
     };
     const changeMonth = (dir) => { currentDate.setMonth(currentDate.getMonth() + dir); renderCalendar(); };
@@ -1,14 +1,35 @@
+import argparse
 import os
 import sys
 import time
-import pandas as pd
 import google.generativeai as genai
 from tqdm import tqdm
 
 # プロジェクトルートのパスを追加して環境変数モジュールをインポート
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
-from env_loader import get_gemini_api_key, load_environment
+from env_loader import get_gemini_api_key, get_gemini_api_keys, load_environment
+from checkpoint_journal import CheckpointJournal, pending_mask, row_keys
+from diary_prompt import (
+    STATIC_INSTRUCTIONS, build_packed_prompt, build_prompt, build_prompt_data,
+    build_prompt_suffix, split_packed_response,
+)
+from diary_schema import STRUCTURED_GENERATION_CONFIG, STRUCTURED_OUTPUT_RULES, parse_diary_response, render_markdown
+from llm_errors import RetryPolicy, describe_error, response_text
+from llm_executor import Job, RateLimiter, run_jobs
+from llm_telemetry import Telemetry
+from prompt_dedup import (
+    DedupPlan, append_failure_fanout, append_fanout, iter_planned_requests, plan_requests, prompt_fingerprint,
+    variant_config,
+)
+from prompt_prefix import PrefixCacheStats, create_cached_gemini_model
+from quota_planner import DailyUsage, count_job_tokens, format_plans, metrics_history, plan_run
+from response_cache import ResponseCache, make_cache_key
+from results_store import iter_table_chunks, read_table
+from shard_runner import (
+    load_merged_done_keys, load_merged_records, merge_shards, merge_shards_streaming, merge_summary, run_shards,
+    shard_mask, shard_path,
+)
 
 # --- 設定項目 ---
 # 1. APIキーは環境変数から自動読み込み
@@ -16,17 +37,48 @@ from env_loader import get_gemini_api_key, load_environment
 # 2. ファイル名を設定
 script_dir = os.path.dirname(os.path.abspath(__file__))
 INPUT_CSV_FILE = os.path.join(script_dir, 'input_data.csv')
-OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv')
+OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv') # 拡張子を .parquet にすると列指向の結果ストアに保存する
+JOURNAL_FILE = os.path.join(script_dir, 'results.journal.jsonl') # 処理済みの行を追記していくジャーナル
+METRICS_FILE = os.path.join(script_dir, 'metrics.jsonl') # API呼び出しごとの計測値を追記するファイル
 
 # 3. API設定
 MODEL_NAME = 'gemini-2.5-flash-lite' # 使用するGeminiモデル
 REQUESTS_PER_MINUTE = 15
-DELAY_SECONDS = 60 / REQUESTS_PER_MINUTE # 4秒待機
+TOKENS_PER_MINUTE = 250000 # 1分あたりのトークン上限
+REQUESTS_PER_DAY = 1000 # 1日のリクエスト上限（達したら太平洋時間の0時にリセットされるまで待って再開する。Noneなら数えるだけ）
+MAX_CONCURRENT_REQUESTS = 5 # 同時に送信中にしておくリクエスト数の上限
+GENERATION_CONFIG = {} # 温度などの生成設定（レスポンスキャッシュのキーにも含まれます）
+MAX_ATTEMPTS = 5 # 429や5xxなど再試行できるエラーの場合に、1リクエストあたり送信する最大回数
+
+# 4. まとめ送信の設定
+EPISODES_PER_REQUEST = 1 # 1リクエストにまとめるエピソード数（1ならまとめない）
+MAX_PACK_ATTEMPTS = 2 # まとめ送信で欠けたエピソードを再度まとめて送る回数。超えたら1件ずつ送る
+
+# 5. 固定の指示のキャッシュ設定
+USE_PREFIX_CACHE = False # Trueにすると固定の指示をコンテキストキャッシュに載せ、行ごとには題材だけを送る
+PREFIX_CACHE_TTL_MINUTES = 60
+
+# 6. 構造化出力の設定
+USE_STRUCTURED_OUTPUT = False # Trueにすると日付・タイトル・6セクションをJSONで受け取り、Markdownの見出しはローカルで組み立てる（remake-mdでの整形が不要になる）
+MAX_SCHEMA_ATTEMPTS = 3 # JSONがスキーマを満たさなかった行を生成し直す最大回数
+
+# 7. シャード実行の設定
+NUM_SHARDS = 1 # 2以上にするとIDのハッシュで入力を分け、シャードごとに別プロセス・別のAPIキー（GEMINI_API_KEYS）で実行する
+
+# 8. ストリーミングの設定（入力が大きい場合）
+USE_STREAMING = False # Trueにすると入力を少しずつ読み込みながら送信し、ファイルの大きさに関係なくメモリ使用量を一定に保つ
+STREAM_CHUNK_ROWS = 1000 # 入力と結果を一度に読み書きする行数
+STREAM_MAX_QUEUED = 100 # 読み込んだが完了していないジョブの上限
+STREAM_TELEMETRY_RECORDS = 1000 # 進捗表示とレポートに使う直近の計測値の件数（メトリクスファイルには全件残る）
+
+# 9. 重複の集約の設定
+DEDUP_PROMPTS = True # Trueにすると題材（プロンプトに埋め込む列）が同じ行は1回だけ生成し、結果を該当するすべての行に記録する
+PROMPT_VARIANTS = 1 # 同じ題材について生成するバリエーションの数（行はバリエーションに順番に割り当てる）
 
 # --- ここからスクリプト本体 ---
 
 def configure_api():
-    """APIキーを設定します。"""
+    """APIキーを設定し、設定したキーを返します。"""
     try:
         # 環境変数を読み込み
         load_environment()
@@ -34,165 +86,413 @@ def configure_api():
         api_key = get_gemini_api_key()
         genai.configure(api_key=api_key)
         print("Gemini APIキーの設定が完了しました。")
+        return api_key
     except Exception as e:
         print(f"APIキーの設定中にエラーが発生しました: {e}")
         print("環境変数ファイル(.env)にGEMINI_API_KEYが正しく設定されているか確認してください。")
         exit()
 
-def process_prompts():
-    """CSVファイルを読み込み、動的にプロンプトを生成してGemini APIで処理し、結果を保存します。"""
+def seed_journal_from_results():
+    """旧形式の結果CSVしかない場合は、処理済みの行をジャーナルに取り込みます。"""
+    journal = CheckpointJournal(JOURNAL_FILE)
+    if not journal.exists() and os.path.exists(OUTPUT_CSV_FILE):
+        seeded = journal.seed_from_results(read_table(OUTPUT_CSV_FILE))
+        journal.close()
+        print(f"'{OUTPUT_CSV_FILE}' から処理済みの {seeded} 件をジャーナルに取り込みました。")
+
+def pack_jobs(episode_jobs, episodes_per_request, attempt=1, include_instructions=True):
+    """エピソード単位のJobを episodes_per_request 件ずつまとめたJobに変換します。"""
+    packed = []
+    for start in range(0, len(episode_jobs), episodes_per_request):
+        chunk = episode_jobs[start:start + episodes_per_request]
+        if len(chunk) == 1:
+            # 1件だけなら通常のプロンプトで送る
+            packed.append(chunk[0])
+            continue
+        packed.append(Job(
+            key=f"{chunk[0].key} ほか{len(chunk) - 1}件",
+            prompt=build_packed_prompt(chunk, include_instructions),
+            meta={'episodes': chunk, 'attempt': attempt},
+        ))
+    return packed
+
+def iter_pending_rows(input_path, chunksize, done_keys, shard=None):
+    """入力を chunksize 行ずつ読み込み、未処理の行だけを (キー, 行の辞書) として1件ずつ返します。"""
+    for chunk in iter_table_chunks(input_path, chunksize):
+        pending = ~row_keys(chunk).isin(done_keys)
+        if shard is not None:
+            pending &= shard_mask(chunk, *shard)
+        chunk = chunk[pending]
+        yield from zip(row_keys(chunk), chunk.to_dict('records'))
+
+def build_structured_prompt(row_data):
+    """構造化出力用に、通常のプロンプトの末尾へJSON出力の指示を追加します。"""
+    return build_prompt(row_data) + STRUCTURED_OUTPUT_RULES
+
+def estimate_run(jobs, daily_usage, key_share=1):
+    """送信するJobのトークン数をまとめて数え、リクエスト数・トークン数・所要時間を見積もります。"""
+    count_model = genai.GenerativeModel(MODEL_NAME)
+    prompt_tokens = count_job_tokens(jobs, daily_usage, lambda prompt: count_model.count_tokens(prompt).total_tokens)
+    output_tokens, latency = metrics_history(METRICS_FILE, MODEL_NAME)
+    return plan_run(MODEL_NAME, prompt_tokens, output_tokens, REQUESTS_PER_MINUTE / key_share,
+                    TOKENS_PER_MINUTE / key_share, MAX_CONCURRENT_REQUESTS, latency, daily_usage)
+
+def process_prompts(episodes_per_request=EPISODES_PER_REQUEST, prefix_cache=USE_PREFIX_CACHE,
+                    structured=USE_STRUCTURED_OUTPUT, shard=None, key_share=1, stream=USE_STREAMING,
+                    chunksize=STREAM_CHUNK_ROWS, dedup=DEDUP_PROMPTS, variants=PROMPT_VARIANTS, plan_only=False,
+                    api_key=None):
+    """
+    CSVファイルを読み込み、動的にプロンプトを生成してGemini APIで処理し、結果を保存します。
+
+    shard に (シャード番号, シャード数) を渡すと、そのシャードの行だけをシャード専用のジャーナルに記録します。
+    その場合、結果CSVはすべてのシャードが終わった後に親プロセスがマージして書き出します。
+    key_share は同じAPIキーを共有するシャード数で、RPM/TPMをその数で割って使います。
+    api_key は使用しているAPIキーで、1日の使用量はこのキーごとに記録します（同じキーのシャードで共有）。
+    stream=True の場合は、入力を chunksize 行ずつ読み込みながらジョブを作って送信し、
+    結果CSVもジャーナルから chunksize 行ずつ書き出します（まとめ送信は使いません）。
+    dedup=True の場合は、題材が同じ行を最大 variants 件のリクエストにまとめ、結果をすべての行に記録します
+    （ストリーミングとシャード実行では、一度に読み込んだ範囲・同じシャードの中でだけまとめます）。
+    送信する前に、リクエスト数・トークン数・所要時間の見積もりを表示します（ストリーミングでは plan_only の場合だけ）。
+    plan_only=True の場合は、見積もりを表示するだけでAPIには送信しません。
+    """
     
-    try:
-        df_output = pd.read_csv(OUTPUT_CSV_FILE)
-        print(f"'{OUTPUT_CSV_FILE}' を読み込みました。続きから処理を再開します。")
-    except FileNotFoundError:
-        try:
-            df_input = pd.read_csv(INPUT_CSV_FILE)
-            df_input['生成結果'] = ''
-            df_output = df_input
-            print(f"入力ファイル '{INPUT_CSV_FILE}' を基に、'{OUTPUT_CSV_FILE}' を新規作成します。")
-        except FileNotFoundError:
-            print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+    if not os.path.exists(INPUT_CSV_FILE):
+        print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+        return
+    df_input = None if stream else read_table(INPUT_CSV_FILE)
+
+    if shard is None:
+        seed_journal_from_results()
+        journal = CheckpointJournal(JOURNAL_FILE)
+        metrics_file = METRICS_FILE
+        label = ""
+    else:
+        shard_index, num_shards = shard
+        journal = CheckpointJournal(shard_path(JOURNAL_FILE, shard_index))
+        metrics_file = shard_path(METRICS_FILE, shard_index)
+        label = f"[シャード {shard_index + 1}/{num_shards}] "
+
+    if stream:
+        # 本文は読み込まずに、以前にシャード実行した分も含めて処理済みのキーだけを集める
+        done_keys = load_merged_done_keys(JOURNAL_FILE)
+        if done_keys and shard is None:
+            print(f"'{JOURNAL_FILE}' を読み込みました。処理済みの {len(done_keys)} 件を飛ばして再開します。")
+        if episodes_per_request > 1:
+            print("ストリーミングではまとめ送信を使えないため、1件ずつ送信します。")
+            episodes_per_request = 1
+        print(f"{label}'{INPUT_CSV_FILE}' を {chunksize} 行ずつ読み込みながら処理します。")
+        pending_rows = iter_pending_rows(INPUT_CSV_FILE, chunksize, done_keys, shard)
+    else:
+        # 以前にシャード実行した結果も含めて、処理済みの行を判定する
+        records = load_merged_records(JOURNAL_FILE)
+        if records and shard is None:
+            print(f"'{JOURNAL_FILE}' を読み込みました。続きから処理を再開します。")
+
+        pending = pending_mask(df_input, records)
+        if shard is not None:
+            pending &= shard_mask(df_input, shard_index, num_shards)
+        df_pending = df_input[pending]
+
+        if df_pending.empty:
+            print(f"{label}すべてのプロンプトが処理済みです。")
+            if shard is None:
+                merge_shards(df_input, JOURNAL_FILE, OUTPUT_CSV_FILE, encoding='utf-8-sig')
             return
 
-    model = genai.GenerativeModel(MODEL_NAME)
-    
-    rows_to_process = [index for index, row in df_output.iterrows() if pd.isna(row.get('生成結果')) or row.get('生成結果') == '']
-
-    if not rows_to_process:
-        print("すべてのプロンプトが処理済みです。")
+        print(f"{label}未処理のエピソードが {len(df_pending)} 件見つかりました。処理を開始します。")
+        pending_rows = zip(row_keys(df_pending), df_pending.to_dict('records'))
+
+    generation_config = GENERATION_CONFIG
+    static_instructions = STATIC_INSTRUCTIONS
+    if structured:
+        if episodes_per_request > 1:
+            print("構造化出力ではまとめ送信を使えないため、1件ずつ送信します。")
+            episodes_per_request = 1
+        print("構造化出力（JSON）で生成し、Markdownはローカルで組み立てます。")
+        generation_config = dict(GENERATION_CONFIG, **STRUCTURED_GENERATION_CONFIG)
+        static_instructions = STATIC_INSTRUCTIONS + STRUCTURED_OUTPUT_RULES
+
+    # まとめ送信の結果は1件ずつ送った場合と別物なので、キャッシュのキーを分ける
+    # （構造化出力のスキーマは generation_config に含まれるので、通常の生成結果とはキーが分かれる）
+    cache_config = dict(generation_config, packed=True) if episodes_per_request > 1 else generation_config
+
+    cached_content = None
+    if prefix_cache:
+        # 固定の指示はキャッシュに載せ、行ごとには題材の部分だけを送る（見積もりだけの場合はキャッシュを作らない）
+        if not plan_only:
+            model, cached_content = create_cached_gemini_model(
+                genai, MODEL_NAME, static_instructions, generation_config, PREFIX_CACHE_TTL_MINUTES
+            )
+        cache_config = dict(cache_config, system_instruction=static_instructions)
+        build_row_prompt = build_prompt_suffix
+    else:
+        model = genai.GenerativeModel(MODEL_NAME, generation_config=generation_config)
+        build_row_prompt = build_structured_prompt if structured else build_prompt
+
+    cache = ResponseCache()
+
+    dedup_plan = DedupPlan()
+
+    def jobs_from(rows):
+        for key, row_data in rows:
+            yield Job(key=key, prompt=build_row_prompt(row_data), meta={'prompt_data': build_prompt_data(row_data)})
+
+    def fingerprint(job):
+        # IDやワールド名は含めず、プロンプトに埋め込む題材だけで重複を判定する
+        return prompt_fingerprint(job.meta['prompt_data'])
+
+    def uncached_jobs_from(jobs):
+        # 同じプロンプトを過去に生成済みであれば、APIを呼ばずにキャッシュから記録する
+        # （見積もりだけの場合は送信数から除くだけで、ジャーナルには書かない）
+        for job in jobs:
+            job.meta['cache_key'] = make_cache_key('gemini', MODEL_NAME, variant_config(cache_config, job), job.prompt)
+            cached_text = cache.get(job.meta['cache_key'])
+            if cached_text is not None:
+                if not plan_only:
+                    append_fanout(journal, job, 生成結果=cached_text, attempts=0, model=MODEL_NAME)
+            else:
+                yield job
+
+    if stream:
+        # 入力の読み込みからジョブの作成までを、送信の進み具合に合わせて少しずつ行う
+        jobs = jobs_from(pending_rows)
+        if dedup:
+            jobs = iter_planned_requests(jobs, fingerprint, variants, chunksize, dedup_plan)
+        requests_to_send = uncached_jobs_from(jobs)
+        total_jobs = None
+    else:
+        jobs = list(jobs_from(pending_rows))
+        if dedup:
+            # 題材が同じ行は代表の行だけを送信し、結果を他の行にも記録する
+            jobs, dedup_plan = plan_requests(jobs, fingerprint, variants)
+            print(f"{label}{dedup_plan.summary()}")
+        uncached_jobs = list(uncached_jobs_from(jobs))
+        total_jobs = len(uncached_jobs)
+        if cache.hits:
+            print(f"{cache.hits} 件はキャッシュに生成結果があります。" if plan_only else f"{cache.hits} 件をキャッシュから復元しました。")
+        if episodes_per_request > 1:
+            print(f"{episodes_per_request} 件ずつまとめて送信します。")
+            requests_to_send = pack_jobs(uncached_jobs, episodes_per_request, include_instructions=not prefix_cache)
+        else:
+            requests_to_send = uncached_jobs
+
+    # 1日の使用量もAPIキーごとなので、全ランナー共通の .llm_cache/usage.json にキーのハッシュごとに記録する
+    # （同じキーを使うシャードは同じ記録を数えるので、上限は割らずにそのまま使う）
+    daily_usage = DailyUsage(MODEL_NAME, REQUESTS_PER_DAY, api_key=api_key)
+    if not stream or plan_only:
+        # ストリーミングでは入力を最後まで読まないと数えられないため、見積もりだけの場合に限る
+        print(format_plans([estimate_run(requests_to_send, daily_usage, key_share)]))
+        print(daily_usage.summary())
+    if plan_only:
+        journal.close()
+        cache.close()
+        daily_usage.close()
         return
 
-    print(f"未処理のエピソードが {len(rows_to_process)} 件見つかりました。処理を開始します。")
-
-    for index in tqdm(rows_to_process, desc="日記を生成中 (Gemini API)"):
-        row_data = df_output.loc[index]
-
-        # --- プロンプトの動的生成 ---
-        # 必要な情報を辞書として準備 (キーが存在しない場合もエラーにならないように .get() を使用)
-        prompt_data = {
-            "incidentDate": row_data.get('事件の発生日', '（日付不明）'),
-            "episodeTitle": row_data.get('エピソードタイトル', '（タイトル不明）'),
-            "incidentType": row_data.get('事件種別', '（種別不明）'),
-            "incidentDays": row_data.get('事件の日数', '（日数不明）'),
-            "incidentSummary": row_data.get('事件の概要', '（概要なし）'),
-            "conanPartyObjective": row_data.get('コナン一行の目的', '（目的記載なし）'),
-            "culprit": row_data.get('犯人', '（犯人不明）'),
-            "ytvLink": row_data.get('読売テレビリンク', '（リンクなし）')
-        }
-
-        # ★★★★★ ここに高品質プロンプトの全文を記述します ★★★★★
-        prompt = f"""# 指示
-
-あなたは、自身の秘密を綴るために日記を書いています。以下の設定と構成を完璧に遵守し、最高のクオリティで日記を執筆してください。
-
-### 1. ペルソナ（Persona） - あなたの人物像
-
-あなたは**江戸川コナン**であり、その正体は高校生探偵**「工藤新一」**です。この日記はあなたの唯一の本音を吐露できる場所です。
-
-- **思考と感情の二面性:**
-    - **内面（工藤新一）:** 日記の地の文は、すべて工藤新一としての視点です。冷静沈着な分析、鋭い観察眼、そして高校生らしい正義感と少し青臭い感性を同居させてください。特に、子供の体であることへの苛立ちや無力感、蘭に真実を言えない苦悩を強く表現してください。
-    - **外面（江戸川コナン）:** 日記の中で、事件関係者を油断させるために、あなたがどのように「子供として振る舞った」かを客観的に描写してください。（例：「『ねぇ、どうして？』と無邪気なフリをして核心を突いてやった」）
-
-### 2. コンテンツ（Content） - 日記の題材
-
-以下の情報に基づいて、日記を執筆してください。
-- **日付:** {prompt_data["incidentDate"]}
-- **エピソードタイトル:** {prompt_data["episodeTitle"]}
-- **事件種別:** {prompt_data["incidentType"]}
-- **事件の日数:** {prompt_data["incidentDays"]} 日間
-- **基本情報:** 事件の概要: {prompt_data["incidentSummary"]}\nコナン一行の目的: {prompt_data["conanPartyObjective"]}
-- **判明している犯人:** {prompt_data["culprit"]}
-- **参考リンク（情報補完用）:** {prompt_data["ytvLink"]}
-
-### 3. 形式・文体・構成（Format/Tone/Structure）
-
-#### 主要登場人物への呼称（厳守）
-- **思考内での呼称:** 蘭、灰原、服部、阿笠博士、おっちゃん（毛利小五郎）、目暮警部
-- **会話（コナンとしての発言）:** 蘭姉ちゃん、灰原、平次兄ちゃん、阿笠博士、小五郎のおじさん、目暮警部
-
-#### 文体
-- **思考（地の文）:** 工藤新一としての、冷静で分析的なトーンを基本とします。ただし、犯人の悲しい動機に触れた時や、蘭の優しさに触れた時など、感情が昂る場面では高校生らしい言葉遣いや感傷的な表現も用いてください。専門用語や難解な言葉も躊躇なく使用します。
-- **思考の癖:** 「待てよ、まさか…」「そういうことか…」「ピースが一つ、また一つと繋がっていく」といった、推理が閃く瞬間の思考プロセスを必ず描写してください。
-
-#### 構成（厳守事項）
-以下の**6段階の物語構成**を厳守し、各項目を明確に分けて記述してください。
+    # レート制限はAPIキーごとなので、同じキーを使うシャードで均等に分け合う
+    limiter = RateLimiter(REQUESTS_PER_MINUTE / key_share, TOKENS_PER_MINUTE / key_share, daily_usage=daily_usage)
+    telemetry = Telemetry(metrics_file, 'gemini', MODEL_NAME, max_records=STREAM_TELEMETRY_RECORDS if stream else None)
+    progress = tqdm(total=total_jobs, desc=f"{label}日記を生成中 (Gemini API)",
+                    position=shard[0] if shard else 0)
+
+    usage = {'requests': 0, 'input_tokens': 0, 'diaries': 0, 'regenerated': 0}
+    prefix_stats = PrefixCacheStats()
+
+    async def generate(job):
+        # Gemini APIにリクエストを送信（最初のトークンまでの時間を測るためストリーミングで受け取る）
+        usage['requests'] += 1
+        started = time.monotonic()
+        response = await model.generate_content_async(job.prompt, stream=True)
+        first_token_seconds = None
+        async for _ in response:
+            if first_token_seconds is None:
+                first_token_seconds = time.monotonic() - started
+
+        metadata = response.usage_metadata
+        cached_tokens = getattr(metadata, 'cached_content_token_count', 0) or 0
+        prefix_stats.record(metadata.prompt_token_count - cached_tokens, cached_tokens, first_token_seconds)
+        usage['input_tokens'] += metadata.prompt_token_count
+        job.meta['first_token_seconds'] = first_token_seconds
+        job.meta['prompt_tokens'] = metadata.prompt_token_count
+        job.meta['output_tokens'] = metadata.total_token_count - metadata.prompt_token_count
+        return response_text(response), metadata.total_token_count
+
+    def save_packed_result(job, result_text, error):
+        episodes = job.meta['episodes']
+        if error is not None:
+            print(f"\nID {job.key} のまとめ送信でエラーが発生しました: {error}")
+            diaries = {}
+        else:
+            diaries = split_packed_response(result_text)
+
+        missing = []
+        for episode in episodes:
+            diary = diaries.get(str(episode.key))
+            if diary is None:
+                missing.append(episode)
+                continue
+            cache.put(episode.meta['cache_key'], diary, 'gemini', MODEL_NAME)
+            append_fanout(journal, episode, 生成結果=diary, attempts=job.meta.get('attempts', 1), model=MODEL_NAME)
+            usage['diaries'] += 1
+            progress.update(1)
+        progress.set_postfix_str(telemetry.postfix())
+
+        if not missing:
+            return []
+        # レスポンスに含まれていなかったエピソードはキューに戻す
+        if job.meta['attempt'] < MAX_PACK_ATTEMPTS:
+            return pack_jobs(missing, episodes_per_request, job.meta['attempt'] + 1, not prefix_cache)
+        return missing
+
+    def save_structured_result(job, result_text):
+        data, problems = parse_diary_response(result_text)
+        if problems:
+            # スキーマを満たさなかった行だけを生成し直す
+            schema_attempt = job.meta.get('schema_attempts', 1)
+            if schema_attempt < MAX_SCHEMA_ATTEMPTS:
+                print(f"\nID {job.key} の出力がスキーマを満たさないため生成し直します"
+                      f"（{schema_attempt}/{MAX_SCHEMA_ATTEMPTS - 1} 回目）: {'; '.join(problems)}")
+                job.meta['schema_attempts'] = schema_attempt + 1
+                usage['regenerated'] += 1
+                return [job]
+            print(f"\nID {job.key} の出力がスキーマを満たしませんでした: {'; '.join(problems)}")
+            append_failure_fanout(journal, job, f"schema: {'; '.join(problems)}", attempts=schema_attempt,
+                                  model=MODEL_NAME)
+        else:
+            markdown = render_markdown(data)
+            cache.put(job.meta['cache_key'], markdown, 'gemini', MODEL_NAME)
+            append_fanout(journal, job, 生成結果=markdown, attempts=job.meta.get('schema_attempts', 1), model=MODEL_NAME)
+            usage['diaries'] += 1
+        progress.update(1)
+        progress.set_postfix_str(telemetry.postfix())
+        return []
+
+    def save_result(job, result_text, error):
+        if 'episodes' in job.meta:
+            return save_packed_result(job, result_text, error)
+
+        if error is not None:
+            # 失敗した行は生成結果を空のままステータスに記録し、次回の実行で再試行する
+            print(f"\nID {job.key} でエラーが発生しました: {error}")
+            append_failure_fanout(journal, job, describe_error(error), attempts=job.meta.get('attempts', 1),
+                                  model=MODEL_NAME)
+        elif structured:
+            return save_structured_result(job, result_text)
+        else:
+            cache.put(job.meta['cache_key'], result_text, 'gemini', MODEL_NAME)
+            append_fanout(journal, job, 生成結果=result_text, attempts=job.meta.get('attempts', 1), model=MODEL_NAME)
+            usage['diaries'] += 1
+        progress.update(1)
+        progress.set_postfix_str(telemetry.postfix())
+        return []
 
-1.  **導入 - 平穏と予感:** 事件前の状況を描写します。「今日は蘭と一緒に…」といった平和な日常や、「また厄介なことに巻き込まれそうな予感がした…」といった不穏な幕開けなど。
-2.  **遭遇 - 事件の第一印象:** 事件発生の瞬間と、現場の第一印象を記述します。「悲鳴が響き渡った。この妙な既視感…また事件か…。」
-3.  **捜査と違和感 - 見えざるヒント:** 警察やおっちゃんの見当違いな推理を横目に、あなただけが気づいた小さな矛盾点や証拠を列挙する。「おっちゃんはAを疑っているが、違う。俺が気になっているのは、被害者のポケットから落ちた、あの小さな紙切れだ。」
-4.  **閃き - 真実への道筋:** 些細なきっかけ（誰かの一言、現場の再確認など）から、全ての謎が繋がる「閃きの瞬間」を劇的に描写する。「あの時の証言と、この傷跡…繋がった！犯人は、あんたしかいない！」
-5.  **真相解明 - 探偵の役割:** 眠りの小五郎などを通じて真相を解き明かした手際を振り返る。犯人を追い詰めたトリックの解説と、動機の告白を簡潔に記述する。
-6.  **結びと内省 - 事件の後に:** 最も重要なパート。事件全体を振り返り、あなたの内面を深く描写する。犯行の動機に対する感慨、犯人への思い、探偵としての自責の念や無力感。そして「探偵が犯人を推理で追い詰めて死なせちまったら、それは殺人者と変わらねーんだ」という信条に触れるなど、工藤新一としての葛藤や想いで締めくくる。
-
-### 4. Markdown形式の厳格な順守（最重要）
-
-#### 見出しレベルの統一
-- **日付部分**: `## {{事件の発生日}}` の形式（H2見出し）
-- **エピソードタイトル**: `### {{エピソードタイトル}}` の形式（H3見出し）
-- **セクション見出し**: `### **{{セクション名}}**` の形式（H3見出し + 太字）
-
-#### 番号の完全削除
-- セクション見出しから `1.`、`2.`、`3.` などの番号を完全に削除
-- 正しい形式: `### **導入 - 平穏と予感**`（番号なし）
-- 誤った形式: `### 1. 導入 - 平穏と予感`（番号あり）
-
-#### 空白行の統一
-- 各見出しとその下の本文の間に、必ず空行を1行だけ挿入
-- 本文の段落と段落の間にも、必ず空行を1行だけ挿入
-- 複数行の空行は許可されません
-
-#### 太字の使用
-- セクション見出しは必ず `### **{{セクション名}}**` の形式
-- 重要な人物名や概念は `**太字**` で強調
-
-### 5. 制約（Constraint）
-- 文字数は800～1000字程度を目安とします。
-- **必ず上記の6段階の構成と呼称ルールを守ってください。**
-- **Markdown形式の厳格な順守が最重要です。**
-- コナンが知り得ない情報（犯人のみの心情など）は記述しないでください。
-
-### 6. 出力形式の例（厳守）
-
-```markdown
-## {{事件の発生日}}
-
-### {{エピソードタイトル}}
-
-### **導入 - 平穏と予感**
-（ここに導入セクションの本文を記述）
-
-### **遭遇 - 事件の第一印象**
-（ここに遭遇セクションの本文を記述）
-
-### **捜査と違和感 - 見えざるヒント**
-（ここに捜査セクションの本文を記述）
-
-### **閃き - 真実への道筋**
-（ここに閃きセクションの本文を記述）
-
-### **真相解明 - 探偵の役割**
-（ここに真相解明セクションの本文を記述）
-
-### **結びと内省 - 事件の後に**
-（ここに結びセクションの本文を記述）
-```
-"""
-
-        try:
-            # Gemini APIにリクエストを送信
-            response = model.generate_content(prompt)
-            result_text = response.text
-        except Exception as e:
-            result_text = f"APIエラー: {e}"
-            print(f"\n行 {index + 2} でエラーが発生しました: {e}")
+    try:
+        run_jobs(requests_to_send, generate, limiter, MAX_CONCURRENT_REQUESTS, on_done=save_result,
+                 retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry,
+                 max_queued=STREAM_MAX_QUEUED if stream else None)
+    finally:
+        progress.close()
+        journal.close()
+        print(cache.summary())
+        cache.close()
+        telemetry.close()
+        daily_usage.close()
+        print(daily_usage.summary())
+        if telemetry.records:
+            print(telemetry.report())
+        print(prefix_stats.summary())
+        if cached_content is not None:
+            cached_content.delete()
+        if usage['diaries']:
+            print(
+                f"APIリクエスト: {usage['requests']} 件 / 生成した日記: {usage['diaries']} 件 "
+                f"(1日記あたり {usage['requests'] / usage['diaries']:.2f} リクエスト, "
+                f"入力 {usage['input_tokens'] / usage['diaries']:.0f} トークン)"
+            )
+        if structured:
+            print(f"スキーマ検証で生成し直した回数: {usage['regenerated']} 回")
+        if stream and dedup_plan.rows:
+            print(f"{label}{dedup_plan.summary()}")
+        # ジャーナルから結果CSVを一度だけ書き出す（シャード実行では親プロセスがまとめて書き出す）
+        if shard is None:
+            write_merged_results(df_input, stream, chunksize)
+
+    print(f"\n{label}すべての処理が完了しました。")
+
+def write_merged_results(df_input, stream, chunksize):
+    """すべてのジャーナルから結果CSVを書き出し、完了・失敗・未処理の行数を返します。"""
+    if stream:
+        counts = merge_shards_streaming(INPUT_CSV_FILE, JOURNAL_FILE, OUTPUT_CSV_FILE, chunksize,
+                                        encoding='utf-8-sig')
+        return merge_summary(counts)
+    return merge_summary(merge_shards(df_input, JOURNAL_FILE, OUTPUT_CSV_FILE, encoding='utf-8-sig'))
+
+def run_shard(shard_index, num_shards, api_key, key_share, options):
+    """シャード1つ分を、割り当てられたAPIキーで処理します（子プロセスで実行）。"""
+    genai.configure(api_key=api_key)
+    process_prompts(**options, shard=(shard_index, num_shards), key_share=key_share, api_key=api_key)
+
+def process_sharded(num_shards, options):
+    """入力をシャードに分けて別プロセスで処理し、結果CSVを元の行順にマージします。"""
+    if not os.path.exists(INPUT_CSV_FILE):
+        print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+        return
+    stream = options.get('stream', False)
+    df_input = None if stream else read_table(INPUT_CSV_FILE)
 
-        df_output.loc[index, '生成結果'] = result_text
-        df_output.to_csv(OUTPUT_CSV_FILE, index=False, encoding='utf-8-sig')
-        time.sleep(DELAY_SECONDS)
+    load_environment()
+    try:
+        api_keys = get_gemini_api_keys()
+    except ValueError as e:
+        print(f"APIキーの設定中にエラーが発生しました: {e}")
+        print("環境変数ファイル(.env)にGEMINI_API_KEYSまたはGEMINI_API_KEYを設定してください。")
+        return
+    print(f"{num_shards} 個のシャードに分け、{min(num_shards, len(api_keys))} 個のAPIキーで並列に処理します。")
+    if len(api_keys) < num_shards:
+        print(f"APIキーが {len(api_keys)} 個しかないため、一部のシャードはキーとレート制限を共有します。")
 
-    print("\nすべての処理が完了しました。")
+    seed_journal_from_results()
+    try:
+        exit_codes = run_shards(run_shard, num_shards, api_keys, (options,))
+    finally:
+        # 途中で止まったシャードがあっても、処理済みの行だけで結果CSVを作る（何度マージしても同じ結果になる）
+        summary = write_merged_results(df_input, stream, options.get('chunksize', STREAM_CHUNK_ROWS))
+        print(f"'{OUTPUT_CSV_FILE}' にシャードの結果をマージしました: {summary}")
+
+    failed_shards = [index for index, code in enumerate(exit_codes) if code != 0]
+    if failed_shards:
+        print(f"異常終了したシャード: {', '.join(str(index + 1) for index in failed_shards)}"
+              " （もう一度実行すると未処理の行だけを再開します）")
+    else:
+        print("\nすべてのシャードの処理が完了しました。")
 
 if __name__ == "__main__":
-    configure_api()
-    process_prompts()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Gemini APIで日記を一括生成します。")
+    parser.add_argument('--pack', type=int, default=EPISODES_PER_REQUEST,
+                        help='1リクエストにまとめるエピソード数 (1ならまとめない)')
+    parser.add_argument('--prefix-cache', action='store_true', default=USE_PREFIX_CACHE,
+                        help='固定の指示をコンテキストキャッシュに載せ、行ごとには題材だけを送る')
+    parser.add_argument('--structured', action='store_true', default=USE_STRUCTURED_OUTPUT,
+                        help='日記をJSONスキーマで受け取り、正規のMarkdownをローカルで組み立てる')
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS,
+                        help='IDのハッシュで入力を分けて並列に処理するプロセス数 (1なら分けない)')
+    parser.add_argument('--stream', action='store_true', default=USE_STREAMING,
+                        help='入力を少しずつ読み込みながら処理し、メモリ使用量を一定に保つ（大きな入力向け）')
+    parser.add_argument('--chunksize', type=int, default=STREAM_CHUNK_ROWS,
+                        help='ストリーミングで一度に読み書きする行数')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', default=DEDUP_PROMPTS,
+                        help='題材が同じ行もまとめずに1行ずつ生成する')
+    parser.add_argument('--variants', type=int, default=PROMPT_VARIANTS,
+                        help='同じ題材について生成するバリエーションの数')
+    parser.add_argument('--plan', action='store_true',
+                        help='リクエスト数・トークン数・所要時間の見積もりだけを表示して終了する（APIには送信しない）')
+    args = parser.parse_args()
+
+    options = dict(episodes_per_request=max(1, args.pack), prefix_cache=args.prefix_cache,
+                   structured=args.structured, stream=args.stream, chunksize=max(1, args.chunksize),
+                   dedup=args.dedup, variants=max(1, args.variants), plan_only=args.plan)
+    if args.shards > 1:
+        process_sharded(args.shards, options)
+    else:
+        api_key = configure_api()
+        process_prompts(**options, api_key=api_key)
\ No newline at end of file
@@ -9,6 +9,14 @@ from tqdm import tqdm
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
 from env_loader import get_gemini_api_key, load_environment
+from checkpoint_journal import CheckpointJournal, pending_mask, row_keys, write_results
+from llm_errors import RetryPolicy, describe_error, response_text
+from llm_executor import Job, RateLimiter, run_jobs
+from llm_telemetry import Telemetry
+from prompt_dedup import append_failure_fanout, append_fanout, plan_requests, prompt_fingerprint, variant_config
+from quota_planner import DailyUsage, count_job_tokens, format_plans, metrics_history, plan_run
+from response_cache import ResponseCache, make_cache_key
+from results_store import read_table
 
 # --- スクリプト自身の場所を基準にファイルのパスを自動設定 ---
 # このスクリプトファイルが存在するディレクトリの絶対パスを取得
@@ -19,17 +27,27 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 
 # 2. ファイル名を設定 (スクリプトと同じフォルダにあることを前提とする)
 INPUT_CSV_FILE = os.path.join(script_dir, 'prompts.csv')
-OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv')
+OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv') # 拡張子を .parquet にすると列指向の結果ストアに保存する
+JOURNAL_FILE = os.path.join(script_dir, 'results.journal.jsonl') # 処理済みの行を追記していくジャーナル
+METRICS_FILE = os.path.join(script_dir, 'metrics.jsonl') # API呼び出しごとの計測値を追記するファイル
 
 # 3. API設定
 MODEL_NAME = 'gemini-2.5-flash-lite'
 REQUESTS_PER_MINUTE = 15
-DELAY_SECONDS = 60 / REQUESTS_PER_MINUTE
+TOKENS_PER_MINUTE = 250000
+REQUESTS_PER_DAY = 1000 # 1日のリクエスト上限（達したら太平洋時間の0時にリセットされるまで待って再開する。Noneなら数えるだけ）
+MAX_CONCURRENT_REQUESTS = 5
+GENERATION_CONFIG = {} # 温度などの生成設定（レスポンスキャッシュのキーにも含まれます）
+MAX_ATTEMPTS = 5 # 429や5xxなど再試行できるエラーの場合に、1行あたり送信する最大回数
+
+# 4. 重複の集約の設定
+DEDUP_PROMPTS = True # Trueにすると内容が同じプロンプトは1回だけ送信し、生成結果を該当するすべての行に記録する
+PROMPT_VARIANTS = 1 # 同じプロンプトについて生成するバリエーションの数（行はバリエーションに順番に割り当てる）
 
 # --- ここからスクリプト本体 ---
 
 def configure_api():
-    """APIキーを設定します。"""
+    """APIキーを設定し、設定したキーを返します。"""
     try:
         # 環境変数を読み込み
         load_environment()
@@ -37,58 +55,124 @@ def configure_api():
         api_key = get_gemini_api_key()
         genai.configure(api_key=api_key)
         print("Gemini APIキーの設定が完了しました。")
+        return api_key
     except Exception as e:
         print(f"APIキーの設定中にエラーが発生しました: {e}")
         print("環境変数ファイル(.env)にGEMINI_API_KEYが正しく設定されているか確認してください。")
         exit()
 
-def process_prompts():
-    """CSVファイルを読み込み、プロンプトを処理して結果を保存します。"""
+def process_prompts(api_key=None):
+    """
+    CSVファイルを読み込み、プロンプトを処理して結果を保存します。
+    api_key は使用しているAPIキーで、1日の使用量はこのキーごとに記録します（同じキーの別のランナーと共有）。
+    """
     
     try:
-        df_output = pd.read_csv(OUTPUT_CSV_FILE)
-        print(f"'{OUTPUT_CSV_FILE}' を読み込みました。続きから処理を再開します。")
+        df_input = read_table(INPUT_CSV_FILE)
     except FileNotFoundError:
-        try:
-            df_input = pd.read_csv(INPUT_CSV_FILE)
-            df_input['生成結果'] = ''
-            df_output = df_input
-            print(f"入力ファイル '{INPUT_CSV_FILE}' を基に、'{OUTPUT_CSV_FILE}' を新規作成します。")
-        except FileNotFoundError:
-            print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
-            print(f"スクリプトが探しているパス: {INPUT_CSV_FILE}")
-            return
-
-    model = genai.GenerativeModel(MODEL_NAME)
-    
-    rows_to_process = [index for index, row in df_output.iterrows() if pd.isna(row.get('生成結果', float('nan'))) or row.get('生成結果', '') == '']
+        print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+        print(f"スクリプトが探しているパス: {INPUT_CSV_FILE}")
+        return
+
+    journal = CheckpointJournal(JOURNAL_FILE)
+    if not journal.exists() and os.path.exists(OUTPUT_CSV_FILE):
+        # 旧形式の結果CSVしかない場合は、処理済みの行をジャーナルに取り込んでから再開する
+        seeded = journal.seed_from_results(read_table(OUTPUT_CSV_FILE))
+        print(f"'{OUTPUT_CSV_FILE}' から処理済みの {seeded} 件をジャーナルに取り込みました。")
+    records = journal.load()
+    if records:
+        print(f"'{JOURNAL_FILE}' を読み込みました。続きから処理を再開します。")
 
-    if not rows_to_process:
+    df_pending = df_input[pending_mask(df_input, records)]
+
+    if df_pending.empty:
         print("すべてのプロンプトが処理済みです。")
+        write_results(df_input, journal, OUTPUT_CSV_FILE)
         return
 
-    print(f"未処理のプロンプトが {len(rows_to_process)} 件見つかりました。処理を開始します。")
+    print(f"未処理のプロンプトが {len(df_pending)} 件見つかりました。処理を開始します。")
 
-    for index in tqdm(rows_to_process, desc="日記を生成中"):
-        prompt = df_output.loc[index, '生成プロンプト']
+    model = genai.GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG)
 
+    jobs = []
+    for key, prompt in zip(row_keys(df_pending), df_pending['生成プロンプト']):
         if pd.isna(prompt):
-            df_output.loc[index, '生成結果'] = "エラー: プロンプトが空です"
+            journal.append_failure(key, "プロンプトが空です")
             continue
+        jobs.append(Job(key=key, prompt=prompt))
+
+    if DEDUP_PROMPTS:
+        # 内容が同じプロンプトは代表の行だけを送信し、結果を他の行にも記録する
+        jobs, plan = plan_requests(jobs, lambda job: prompt_fingerprint(job.prompt), PROMPT_VARIANTS)
+        print(plan.summary())
+
+    # 同じプロンプトを過去に生成済みであれば、APIを呼ばずにキャッシュから記録する
+    cache = ResponseCache()
+    uncached_jobs = []
+    for job in jobs:
+        job.meta['cache_key'] = make_cache_key('gemini', MODEL_NAME, variant_config(GENERATION_CONFIG, job), job.prompt)
+        cached_text = cache.get(job.meta['cache_key'])
+        if cached_text is not None:
+            append_fanout(journal, job, 生成結果=cached_text, attempts=0, model=MODEL_NAME)
+        else:
+            uncached_jobs.append(job)
+    if cache.hits:
+        print(f"{cache.hits} 件をキャッシュから復元しました。")
+
+    # 送信する前に、補正したローカルの概算でトークン数を数えて所要時間を見積もる
+    daily_usage = DailyUsage(MODEL_NAME, REQUESTS_PER_DAY, api_key=api_key)
+    prompt_tokens = count_job_tokens(uncached_jobs, daily_usage, lambda prompt: model.count_tokens(prompt).total_tokens)
+    output_tokens, latency = metrics_history(METRICS_FILE, MODEL_NAME)
+    print(format_plans([plan_run(MODEL_NAME, prompt_tokens, output_tokens, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE,
+                                 MAX_CONCURRENT_REQUESTS, latency, daily_usage)]))
+    print(daily_usage.summary())
+
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, daily_usage=daily_usage)
+    telemetry = Telemetry(METRICS_FILE, 'gemini', MODEL_NAME)
+    progress = tqdm(total=len(uncached_jobs), desc="日記を生成中")
+
+    async def generate(job):
+        # 最初のトークンまでの時間を測るためストリーミングで受け取る
+        started = time.monotonic()
+        response = await model.generate_content_async(job.prompt, stream=True)
+        async for _ in response:
+            if 'first_token_seconds' not in job.meta:
+                job.meta['first_token_seconds'] = time.monotonic() - started
+        metadata = response.usage_metadata
+        job.meta['prompt_tokens'] = metadata.prompt_token_count
+        job.meta['output_tokens'] = metadata.total_token_count - metadata.prompt_token_count
+        return response_text(response), metadata.total_token_count
+
+    def save_result(job, result_text, error):
+        if error is not None:
+            # 失敗した行は生成結果を空のままステータスに記録し、次回の実行で再試行する
+            print(f"\nID {job.key} でエラーが発生しました: {error}")
+            append_failure_fanout(journal, job, describe_error(error), attempts=job.meta.get('attempts', 1),
+                                  model=MODEL_NAME)
+        else:
+            cache.put(job.meta['cache_key'], result_text, 'gemini', MODEL_NAME)
+            append_fanout(journal, job, 生成結果=result_text, attempts=job.meta.get('attempts', 1), model=MODEL_NAME)
+        progress.update(1)
+        progress.set_postfix_str(telemetry.postfix())
 
-        try:
-            response = model.generate_content(prompt)
-            result_text = response.text
-        except Exception as e:
-            result_text = f"APIエラー: {e}"
-            print(f"\n行 {index + 2} でエラーが発生しました: {e}")
-
-        df_output.loc[index, '生成結果'] = result_text
-        df_output.to_csv(OUTPUT_CSV_FILE, index=False)
-        time.sleep(DELAY_SECONDS)
+    try:
+        run_jobs(uncached_jobs, generate, limiter, MAX_CONCURRENT_REQUESTS, on_done=save_result,
+                 retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry)
+    finally:
+        progress.close()
+        journal.close()
+        print(cache.summary())
+        cache.close()
+        telemetry.close()
+        daily_usage.close()
+        print(daily_usage.summary())
+        if telemetry.records:
+            print(telemetry.report())
+        # ジャーナルから結果CSVを一度だけ書き出す
+        write_results(df_input, journal, OUTPUT_CSV_FILE)
 
     print("\nすべての処理が完了しました。")
 
 if __name__ == "__main__":
-    configure_api()
-    process_prompts()
\ No newline at end of file
+    api_key = configure_api()
+    process_prompts(api_key)
\ No newline at end of file
@@ -1,9 +1,23 @@
+import asyncio
 import os
-import time
+import sys
 import pandas as pd
 import requests
 from tqdm import tqdm
 
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+from checkpoint_journal import CheckpointJournal, pending_mask, row_keys, write_results
+from llm_errors import ERROR_TIMEOUT, RetryPolicy, classify_error, describe_error
+from llm_executor import Job, RateLimiter, run_jobs
+from llm_telemetry import Telemetry
+from ollama_client import OllamaClient
+from prompt_dedup import append_failure_fanout, append_fanout, plan_requests, prompt_fingerprint, variant_config
+from prompt_prefix import PrefixCacheStats, split_common_prefix
+from response_cache import ResponseCache, make_cache_key
+from results_store import read_table
+
 # --- 設定項目 ---
 # 1. あなたのローカルモデルサーバーの設定
 #    OllamaのネイティブAPIエンドポイントを指定します。
@@ -14,10 +28,21 @@ LOCAL_MODEL_NAME = "gpt-oss:20b"
 # スクリプトと同じディレクトリにあるCSVファイルを指定
 script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in locals() else os.getcwd()
 INPUT_CSV_FILE = os.path.join(script_dir, 'prompts.csv')
-OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv')
+OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv') # 拡張子を .parquet にすると列指向の結果ストアに保存する
+JOURNAL_FILE = os.path.join(script_dir, 'results.journal.jsonl') # 処理済みの行を追記していくジャーナル
+METRICS_FILE = os.path.join(script_dir, 'metrics.jsonl') # API呼び出しごとの計測値を追記するファイル
 
 # 3. API設定
-DELAY_SECONDS = 1
+# サーバーの OLLAMA_NUM_PARALLEL と同じ数だけ同時にリクエストを送る
+MAX_PARALLEL_REQUESTS = int(os.getenv('OLLAMA_NUM_PARALLEL', '4'))
+GENERATION_DEADLINE_SECONDS = 600 # これを超えて生成が続く行は打ち切る
+KEEP_ALIVE = "30m" # 行と行の間にモデルがアンロードされないように保持する時間
+MAX_ATTEMPTS = 3 # 接続エラーや応答の不正など再試行できるエラーの場合に、1行あたり送信する最大回数
+SPLIT_COMMON_PREFIX = True # 全行共通の先頭部分をシステムメッセージにして、サーバー側のプロンプトキャッシュを効かせる
+
+# 4. 重複の集約の設定
+DEDUP_PROMPTS = True # Trueにすると内容が同じプロンプトは1回だけ送信し、生成結果を該当するすべての行に記録する
+PROMPT_VARIANTS = 1 # 同じプロンプトについて生成するバリエーションの数（行はバリエーションに順番に割り当てる）
 
 # --- ここからスクリプト本体 ---
 
@@ -46,72 +71,131 @@ def process_prompts():
     """CSVファイルを読み込み、プロンプトを処理して結果を保存します。"""
     
     try:
-        df_output = pd.read_csv(OUTPUT_CSV_FILE)
-        print(f"'{OUTPUT_CSV_FILE}' を読み込みました。続きから処理を再開します。")
+        df_input = read_table(INPUT_CSV_FILE)
     except FileNotFoundError:
-        try:
-            df_input = pd.read_csv(INPUT_CSV_FILE)
-            df_input['生成結果'] = ''
-            df_output = df_input
-            print(f"入力ファイル '{INPUT_CSV_FILE}' を基に、'{OUTPUT_CSV_FILE}' を新規作成します。")
-        except FileNotFoundError:
-            print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
-            return
-
-    rows_to_process = [
-        index for index, row in df_output.iterrows()
-        if pd.isna(row.get('生成結果', float('nan'))) or str(row.get('生成結果', '')).strip() == ''
-    ]
-
-    if not rows_to_process:
+        print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+        return
+
+    journal = CheckpointJournal(JOURNAL_FILE)
+    if not journal.exists() and os.path.exists(OUTPUT_CSV_FILE):
+        # 旧形式の結果CSVしかない場合は、処理済みの行をジャーナルに取り込んでから再開する
+        seeded = journal.seed_from_results(read_table(OUTPUT_CSV_FILE))
+        print(f"'{OUTPUT_CSV_FILE}' から処理済みの {seeded} 件をジャーナルに取り込みました。")
+    records = journal.load()
+    if records:
+        print(f"'{JOURNAL_FILE}' を読み込みました。続きから処理を再開します。")
+
+    df_pending = df_input[pending_mask(df_input, records)]
+
+    if df_pending.empty:
         print("すべてのプロンプトが処理済みです。")
+        write_results(df_input, journal, OUTPUT_CSV_FILE)
         return
 
-    print(f"未処理のプロンプトが {len(rows_to_process)} 件見つかりました。処理を開始します。")
+    print(f"未処理のプロンプトが {len(df_pending)} 件見つかりました。処理を開始します。")
 
-    for index in tqdm(rows_to_process, desc="日記を生成中 (ローカル)"):
-        prompt = df_output.loc[index, '生成プロンプト']
+    shared_prefix = ''
+    if SPLIT_COMMON_PREFIX:
+        # 未処理の行だけで求めると再開するたびに分け方が変わるので、入力全体の共通部分を使う
+        shared_prefix, _ = split_common_prefix(df_input['生成プロンプト'].dropna().astype(str))
+        if shared_prefix:
+            print(f"全行共通の先頭部分 {len(shared_prefix)} 文字をシステムメッセージとして送信します。")
 
+    jobs = []
+    for key, prompt in zip(row_keys(df_pending), df_pending['生成プロンプト']):
         if pd.isna(prompt):
-            df_output.loc[index, '生成結果'] = "エラー: プロンプトが空です"
+            journal.append_failure(key, "プロンプトが空です")
             continue
+        jobs.append(Job(key=key, prompt=prompt, meta={'messages': build_messages(shared_prefix, prompt)}))
+
+    if DEDUP_PROMPTS:
+        # 内容が同じプロンプトは代表の行だけを送信し、結果を他の行にも記録する
+        jobs, plan = plan_requests(jobs, lambda job: prompt_fingerprint(job.prompt), PROMPT_VARIANTS)
+        print(plan.summary())
+
+    # 同じプロンプトを過去に生成済みであれば、サーバーを呼ばずにキャッシュから記録する
+    # （キーはシステムメッセージへの分け方に左右されないように、分ける前のプロンプト全体で作る）
+    cache = ResponseCache()
+    uncached_jobs = []
+    for job in jobs:
+        job.meta['cache_key'] = make_cache_key('ollama', LOCAL_MODEL_NAME, variant_config(None, job), job.prompt)
+        cached_text = cache.get(job.meta['cache_key'])
+        if cached_text is not None:
+            append_fanout(journal, job, 生成結果=cached_text, attempts=0, model=LOCAL_MODEL_NAME)
+        else:
+            uncached_jobs.append(job)
+    jobs = uncached_jobs
+    if cache.hits:
+        print(f"{cache.hits} 件をキャッシュから復元しました。")
+
+    client = OllamaClient(LOCAL_API_ENDPOINT, LOCAL_MODEL_NAME, pool_size=MAX_PARALLEL_REQUESTS, keep_alive=KEEP_ALIVE)
+    # ローカルサーバーにはRPMの制限がないので、同時実行数だけで負荷を制御する
+    limiter = RateLimiter(None)
+    prefix_stats = PrefixCacheStats()
+    telemetry = Telemetry(METRICS_FILE, 'ollama', LOCAL_MODEL_NAME)
+    speed = {'eval_count': 0, 'eval_duration': 0}
+    progress = tqdm(total=len(jobs), desc=f"日記を生成中 (ローカル x{MAX_PARALLEL_REQUESTS})")
+
+    async def generate(job):
+        result = await asyncio.to_thread(client.chat, job.meta['messages'], GENERATION_DEADLINE_SECONDS)
+        # Ollamaはキャッシュ済みの部分を除いた評価トークン数を prompt_eval_count で返す（時間はナノ秒）
+        prefix_stats.record(
+            result.prompt_eval_count,
+            first_token_seconds=result.first_token_seconds,
+        )
+        speed['eval_count'] += result.eval_count
+        speed['eval_duration'] += result.eval_duration
+        job.meta['first_token_seconds'] = result.first_token_seconds
+        job.meta['prompt_tokens'] = result.prompt_eval_count
+        job.meta['output_tokens'] = result.eval_count
+        return result.text, result.prompt_eval_count + result.eval_count
+
+    def save_result(job, result_text, error):
+        if error is not None:
+            # 失敗した行は生成結果を空のままステータスに記録し、次回の実行で再試行する
+            if classify_error(error) == ERROR_TIMEOUT:
+                print(f"\nID {job.key} の生成が締め切り時間を超えたため打ち切りました。")
+            else:
+                print(f"\nID {job.key} でエラーが発生しました: {error}")
+            append_failure_fanout(journal, job, describe_error(error), attempts=job.meta.get('attempts', 1),
+                                  model=LOCAL_MODEL_NAME)
+        else:
+            cache.put(job.meta['cache_key'], result_text, 'ollama', LOCAL_MODEL_NAME)
+            append_fanout(journal, job, 生成結果=result_text, attempts=job.meta.get('attempts', 1),
+                          model=LOCAL_MODEL_NAME)
+        progress.update(1)
+        progress.set_postfix_str(telemetry.postfix())
 
-        headers = {
-            "Content-Type": "application/json",
-        }
-        # OllamaネイティブAPIでは stream: false を追加するとストリーミングなしの応答になる
-        payload = {
-            "model": LOCAL_MODEL_NAME,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "stream": False, 
-        }
-
-        try:
-            response = requests.post(LOCAL_API_ENDPOINT, headers=headers, json=payload)
-            response.raise_for_status()
-            
-            json_response = response.json()
-            result_text = json_response['message']['content'] # ★★★ 修正点2 ★★★
-            
-        except requests.exceptions.RequestException as e:
-            result_text = f"APIリクエストエラー: {e}"
-            print(f"\n行 {index + 2} でAPIリクエストエラーが発生しました: {e}")
-        except (KeyError, IndexError) as e:
-            result_text = f"レスポンス形式エラー: {e} - {response.text}"
-            print(f"\n行 {index + 2} でレスポンスの解析に失敗しました。")
-        except Exception as e:
-            result_text = f"予期せぬエラー: {e}"
-            print(f"\n行 {index + 2} で予期せぬエラーが発生しました: {e}")
-
-        df_output.loc[index, '生成結果'] = result_text
-        df_output.to_csv(OUTPUT_CSV_FILE, index=False)
-        
-        time.sleep(DELAY_SECONDS)
+    try:
+        run_jobs(jobs, generate, limiter, MAX_PARALLEL_REQUESTS, on_done=save_result,
+                 retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry)
+    finally:
+        progress.close()
+        client.close()
+        journal.close()
+        print(cache.summary())
+        cache.close()
+        telemetry.close()
+        if telemetry.records:
+            print(telemetry.report())
+        print(prefix_stats.summary())
+        if speed['eval_duration']:
+            # サーバー側で計測した生成時間の合計で割った、1リクエストあたりの平均生成速度
+            print(f"生成速度: 平均 {speed['eval_count'] / (speed['eval_duration'] / 1e9):.1f} トークン/秒 (1リクエストあたり)")
+        # ジャーナルから結果CSVを一度だけ書き出す
+        write_results(df_input, journal, OUTPUT_CSV_FILE)
 
     print("\nすべての処理が完了しました。")
 
+def build_messages(shared_prefix, prompt):
+    """共通の先頭部分があればシステムメッセージに分けて、チャット形式のメッセージを作成します。"""
+    if shared_prefix and prompt.startswith(shared_prefix):
+        return [
+            {"role": "system", "content": shared_prefix},
+            {"role": "user", "content": prompt[len(shared_prefix):]},
+        ]
+    return [{"role": "user", "content": prompt}]
+
 if __name__ == "__main__":
     if check_server_connection():
-        process_prompts()
\ No newline at end of file
+        process_prompts()
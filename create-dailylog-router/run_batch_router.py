@@ -0,0 +1,317 @@
+import argparse
+import os
+import sys
+from collections import Counter
+import pandas as pd
+import google.generativeai as genai
+from tqdm import tqdm
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+from env_loader import get_gemini_api_key, load_environment
+from backend_router import create_backend, route_jobs, route_ladder
+from checkpoint_journal import CheckpointJournal, pending_mask, row_keys, write_results
+from diary_prompt import build_prompt
+from llm_errors import RetryPolicy, describe_error
+from llm_executor import Job
+from llm_telemetry import Telemetry
+from markdown_normalizer import normalize_markdown
+from prompt_dedup import (
+    append_failure_fanout, append_fanout, episode_fingerprint, plan_requests, prompt_fingerprint, variant_config,
+)
+from quota_planner import RunPlan, count_job_tokens, format_plans, metrics_history, plan_run
+from response_cache import ResponseCache, make_cache_key
+from results_store import read_table
+
+# --- スクリプト自身の場所を基準にファイルのパスを自動設定 ---
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# --- 設定項目 ---
+# 1. ファイル名を設定
+#    入力CSVに '生成プロンプト' 列があればそれを使い、なければ各列から日記のプロンプトを組み立てます。
+INPUT_CSV_FILE = os.path.join(project_root, 'create-dailylog-flash-lite-v2', 'input_data.csv')
+OUTPUT_CSV_FILE = os.path.join(script_dir, 'results.csv') # 拡張子を .parquet にすると列指向の結果ストアに保存する
+JOURNAL_FILE = os.path.join(script_dir, 'results.journal.jsonl') # 処理済みの行を追記していくジャーナル
+METRICS_FILE = os.path.join(script_dir, 'metrics.jsonl') # API呼び出しごとの計測値を追記するファイル
+
+# 2. バックエンドの設定
+#    上から順に優先されます。各バックエンドは自分の同時実行数とレート制限の範囲で、
+#    空きができ次第キューから次の行を取り出します。失敗した行は別のバックエンドに回されます。
+#    requests_per_day に達したGeminiのバックエンドは、上限がリセットされる（太平洋時間の0時）まで行を取り出しません。
+BACKENDS = [
+    {
+        'name': 'flash-lite',
+        'type': 'gemini',
+        'model': 'gemini-2.5-flash-lite',
+        'requests_per_minute': 15,
+        'tokens_per_minute': 250000,
+        'requests_per_day': 1000,
+        'max_in_flight': 5,
+    },
+    {
+        'name': 'flash',
+        'type': 'gemini',
+        'model': 'gemini-2.5-flash',
+        'requests_per_minute': 10,
+        'tokens_per_minute': 250000,
+        'requests_per_day': 250,
+        'max_in_flight': 5,
+    },
+    {
+        'name': 'pro',
+        'type': 'gemini',
+        'model': 'gemini-2.5-pro',
+        'requests_per_minute': 5,
+        'tokens_per_minute': 250000,
+        'requests_per_day': 100,
+        'max_in_flight': 3,
+    },
+    {
+        'name': 'local',
+        'type': 'ollama',
+        'model': 'gpt-oss:20b',
+        'endpoint': 'http://localhost:11434/api/chat',
+        'max_in_flight': int(os.getenv('OLLAMA_NUM_PARALLEL', '4')),
+        'deadline_seconds': 600,
+    },
+]
+MAX_ATTEMPTS = 3 # すべてのバックエンドで失敗した行を、バックオフ後に全バックエンドで再挑戦する最大回数
+
+# 3. 段階実行の設定（--ladder）
+#    各行をまず先頭の安くて速いモデルで生成し、6セクションの構成をローカルで検証して、
+#    通らなかった行だけを次のモデルに回します。ローカルのOllamaを先頭に置くこともできます（例: ['local', 'flash', 'pro']）。
+LADDER = ['flash-lite', 'flash', 'pro']
+
+# 4. 重複の集約の設定
+#    同じエピソードが複数のパラレルワールドに出てくる場合など、題材（'生成プロンプト' 列があればプロンプト全文）が
+#    同じ行は1回だけ生成し、結果を該当するすべての行に記録します。
+DEDUP_PROMPTS = True
+PROMPT_VARIANTS = 1 # 同じ題材について生成するバリエーションの数（行はバリエーションに順番に割り当てる）
+
+# --- ここからスクリプト本体 ---
+
+def configure_api():
+    """APIキーを設定し、設定したキーを返します。"""
+    try:
+        # 環境変数を読み込み
+        load_environment()
+        # APIキーを取得
+        api_key = get_gemini_api_key()
+        genai.configure(api_key=api_key)
+        print("Gemini APIキーの設定が完了しました。")
+        return api_key
+    except Exception as e:
+        print(f"APIキーの設定中にエラーが発生しました: {e}")
+        print("環境変数ファイル(.env)にGEMINI_API_KEYが正しく設定されているか確認してください。")
+        exit()
+
+def select_backends(names=None, api_key=None):
+    """
+    BACKENDS から使用するバックエンドを作成します。
+
+    Args:
+        names: 使用するバックエンド名のリスト（Noneならすべて）。指定した順に並べて返します
+        api_key: Geminiのバックエンドが使うAPIキー（1日の使用量はキーごとに記録します）
+
+    Returns:
+        list: バックエンドのリスト
+    """
+    configs = BACKENDS
+    if names:
+        unknown = set(names) - {config['name'] for config in BACKENDS}
+        if unknown:
+            raise ValueError(f"未定義のバックエンドです: {', '.join(sorted(unknown))}")
+        configs = [config for name in names for config in BACKENDS if config['name'] == name]
+
+    backends = []
+    for config in configs:
+        backend = create_backend(config, api_key)
+        if backend.backend_type == 'ollama' and not backend.client.check_connection():
+            print(f"警告: Ollamaサーバーに接続できないため、'{backend.name}' を使用しません。({config['endpoint']})")
+            backend.close()
+            continue
+        backends.append(backend)
+    return backends
+
+def validate_diary(job, result_text):
+    """生成した日記が日付・タイトル・6つのセクションの構成になっているかをローカルで確認します。"""
+    normalized_text, reason = normalize_markdown(result_text)
+    if normalized_text is None:
+        return None, reason
+    return result_text, None
+
+def estimate_backends(jobs, backends):
+    """
+    送信するJobのトークン数をまとめて数え、バックエンドごとに全件を1つで処理した場合の見積もりと、
+    すべてのバックエンドで分担した場合の所要時間を返します。
+    """
+    # トークン数はGeminiのモデルで補正した概算で数える（Geminiがなければ補正しない）
+    gemini = next((backend for backend in backends if backend.backend_type == 'gemini'), None)
+    prompt_tokens = count_job_tokens(jobs, gemini.daily_usage if gemini else None,
+                                     gemini.count_tokens if gemini else None)
+    plans = []
+    for backend in backends:
+        output_tokens, latency = metrics_history(METRICS_FILE, backend.model_name)
+        plans.append(plan_run(backend.name, prompt_tokens, output_tokens, backend.requests_per_minute,
+                              backend.tokens_per_minute, backend.max_in_flight, latency, backend.daily_usage))
+    # 分担した場合は、各バックエンドの処理速度の合計で進む（1日の上限はそれぞれのバックエンドで待つ）
+    speeds = [plan.requests / plan.seconds for plan in plans if plan.seconds]
+    total = RunPlan('全体（分担）', len(prompt_tokens), sum(prompt_tokens), max(plan.output_tokens for plan in plans),
+                    len(prompt_tokens) / sum(speeds) if speeds and prompt_tokens else None)
+    return plans + [total]
+
+def process_prompts(backend_names=None, ladder=False, plan_only=False, api_key=None):
+    """
+    CSVファイルを読み込み、複数のバックエンドで分担して日記を生成し、結果を保存します。
+    ladder=True の場合は、安いモデルから順に試して検証に通らなかった行だけを次のモデルに回します。
+    送信する前に、バックエンドごとのリクエスト数・トークン数・所要時間の見積もりを表示します
+    （plan_only=True の場合は見積もりを表示するだけで送信しません）。
+    api_key は使用しているAPIキーで、Geminiの1日の使用量はこのキーごとに記録します。
+    """
+
+    try:
+        df_input = read_table(INPUT_CSV_FILE)
+    except FileNotFoundError:
+        print(f"エラー: 入力ファイル '{INPUT_CSV_FILE}' が見つかりません。")
+        return
+
+    journal = CheckpointJournal(JOURNAL_FILE)
+    records = journal.load()
+    if records:
+        print(f"'{JOURNAL_FILE}' を読み込みました。続きから処理を再開します。")
+
+    df_pending = df_input[pending_mask(df_input, records)]
+    result_columns = ('生成結果', '生成モデル')
+
+    if df_pending.empty:
+        print("すべての行が処理済みです。")
+        write_results(df_input, journal, OUTPUT_CSV_FILE, result_columns, encoding='utf-8-sig')
+        return
+
+    backends = select_backends(backend_names or (LADDER if ladder else None), api_key)
+    if not backends:
+        print("エラー: 使用できるバックエンドがありません。")
+        return
+    if ladder:
+        print(f"未処理の行が {len(df_pending)} 件見つかりました。"
+              f"{' → '.join(backend.name for backend in backends)} の順に段階実行します。")
+    else:
+        print(f"未処理の行が {len(df_pending)} 件見つかりました。"
+              f"{', '.join(backend.name for backend in backends)} で分担して処理を開始します。")
+
+    jobs = []
+    for key, (_, row) in zip(row_keys(df_pending), df_pending.iterrows()):
+        if '生成プロンプト' in df_pending.columns:
+            prompt = row['生成プロンプト']
+            if pd.isna(prompt):
+                journal.append_failure(key, "プロンプトが空です")
+                continue
+            fingerprint = prompt_fingerprint(prompt)
+        else:
+            prompt = build_prompt(row.to_dict())
+            fingerprint = episode_fingerprint(row.to_dict())
+        jobs.append(Job(key=key, prompt=prompt, meta={'fingerprint': fingerprint}))
+
+    if DEDUP_PROMPTS:
+        # 題材が同じ行は代表の行だけを送信し、結果を他の行にも記録する
+        jobs, plan = plan_requests(jobs, lambda job: job.meta['fingerprint'], PROMPT_VARIANTS)
+        print(plan.summary())
+
+    # どれかのバックエンドで生成済みのプロンプトは、APIを呼ばずにキャッシュから記録する（優先順の高いものを採用）
+    # （見積もりだけの場合は送信数から除くだけで、ジャーナルには書かない）
+    cache = ResponseCache()
+    uncached_jobs = []
+    for job in jobs:
+        for backend in backends:
+            cache_key = make_cache_key(backend.backend_type, backend.model_name,
+                                       variant_config(backend.generation_config, job), job.prompt)
+            cached_text = cache.get(cache_key)
+            if cached_text is not None and ladder and validate_diary(job, cached_text)[0] is None:
+                # 段階実行では、検証に通らなかったキャッシュは使わずに次の段のものを探す
+                continue
+            if cached_text is not None:
+                if not plan_only:
+                    append_fanout(journal, job, 生成結果=cached_text, 生成モデル=backend.name, attempts=0,
+                                  model=backend.model_name)
+                break
+        else:
+            uncached_jobs.append(job)
+    if cache.hits:
+        print(f"{cache.hits} 件はキャッシュに生成結果があります。" if plan_only else f"{cache.hits} 件をキャッシュから復元しました。")
+
+    print(format_plans(estimate_backends(uncached_jobs, backends)))
+    if plan_only:
+        journal.close()
+        cache.close()
+        for backend in backends:
+            backend.close()
+        return
+
+    completed = Counter()
+    telemetry = Telemetry(METRICS_FILE)
+    progress = tqdm(total=len(uncached_jobs), desc="日記を生成中")
+
+    def save_result(job, result_text, error, backend):
+        if error is not None:
+            # 失敗した行は生成結果を空のままステータスに記録し、次回の実行で再試行する
+            print(f"\nID {job.key} はすべてのバックエンドで失敗しました: {error}")
+            # 段階実行で最後のモデルでも検証に通らなかった場合、error は理由の文字列
+            message = f"検証NG: {error}" if isinstance(error, str) else describe_error(error)
+            append_failure_fanout(journal, job, message, 生成モデル=backend.name,
+                                  attempts=job.meta.get('attempts', 1), model=backend.model_name)
+        else:
+            cache_key = make_cache_key(backend.backend_type, backend.model_name,
+                                       variant_config(backend.generation_config, job), job.prompt)
+            cache.put(cache_key, result_text, backend.backend_type, backend.model_name)
+            append_fanout(journal, job, 生成結果=result_text, 生成モデル=backend.name,
+                          attempts=job.meta.get('attempts', 1), model=backend.model_name)
+            completed[backend.name] += 1
+        progress.update(1)
+        progress.set_postfix_str(
+            ' '.join([telemetry.postfix()] + [f"{name}={count}" for name, count in completed.items()])
+        )
+
+    ladder_stats = None
+    try:
+        if ladder:
+            ladder_stats = route_ladder(uncached_jobs, backends, validate_diary, on_done=save_result,
+                                        retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry)
+        else:
+            route_jobs(uncached_jobs, backends, on_done=save_result, retry_policy=RetryPolicy(MAX_ATTEMPTS),
+                       telemetry=telemetry)
+    finally:
+        progress.close()
+        journal.close()
+        for backend in backends:
+            backend.close()
+            if backend.daily_usage is not None:
+                print(backend.daily_usage.summary())
+        print(cache.summary())
+        cache.close()
+        telemetry.close()
+        if telemetry.records:
+            print(telemetry.report())
+        print("バックエンド別の生成件数: " + ", ".join(
+            f"{backend.name} {completed[backend.name]} 件" for backend in backends
+        ))
+        if ladder_stats is not None:
+            print(ladder_stats.report())
+        # ジャーナルから結果CSVを一度だけ書き出す
+        write_results(df_input, journal, OUTPUT_CSV_FILE, result_columns, encoding='utf-8-sig')
+
+    print("\nすべての処理が完了しました。")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="複数のバックエンドで分担して日記を生成します。")
+    parser.add_argument('--backends', nargs='+', metavar='NAME',
+                        help="使用するバックエンド名（既定: BACKENDS のすべて。--ladder の場合は LADDER）")
+    parser.add_argument('--ladder', action='store_true',
+                        help="安いモデルから順に試し、6セクションの検証に通らなかった行だけを次のモデルに回す"
+                             "（--backends で段の順を指定できます）")
+    parser.add_argument('--plan', action='store_true',
+                        help="バックエンドごとのリクエスト数・トークン数・所要時間の見積もりだけを表示して終了する")
+    args = parser.parse_args()
+
+    api_key = configure_api()
+    process_prompts(args.backends, ladder=args.ladder, plan_only=args.plan, api_key=api_key)
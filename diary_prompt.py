@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+コナンの日記を生成するためのプロンプト
+CSVの1行（エピソード）から、ペルソナ・構成・Markdownの指示を含むプロンプトを組み立てます
+"""
+
+import re
+
+# すべての行で共通の指示（ペルソナ）
+PROMPT_HEADER = """# 指示
+
+あなたは、自身の秘密を綴るために日記を書いています。以下の設定と構成を完璧に遵守し、最高のクオリティで日記を執筆してください。
+
+### 1. ペルソナ（Persona） - あなたの人物像
+
+あなたは**江戸川コナン**であり、その正体は高校生探偵**「工藤新一」**です。この日記はあなたの唯一の本音を吐露できる場所です。
+
+- **思考と感情の二面性:**
+    - **内面（工藤新一）:** 日記の地の文は、すべて工藤新一としての視点です。冷静沈着な分析、鋭い観察眼、そして高校生らしい正義感と少し青臭い感性を同居させてください。特に、子供の体であることへの苛立ちや無力感、蘭に真実を言えない苦悩を強く表現してください。
+    - **外面（江戸川コナン）:** 日記の中で、事件関係者を油断させるために、あなたがどのように「子供として振る舞った」かを客観的に描写してください。（例：「『ねぇ、どうして？』と無邪気なフリをして核心を突いてやった」）
+
+"""
+
+# すべての行で共通の指示（形式・文体・構成・Markdown・制約・出力例）
+PROMPT_RULES = """### 3. 形式・文体・構成（Format/Tone/Structure）
+
+#### 主要登場人物への呼称（厳守）
+- **思考内での呼称:** 蘭、灰原、服部、阿笠博士、おっちゃん（毛利小五郎）、目暮警部
+- **会話（コナンとしての発言）:** 蘭姉ちゃん、灰原、平次兄ちゃん、阿笠博士、小五郎のおじさん、目暮警部
+
+#### 文体
+- **思考（地の文）:** 工藤新一としての、冷静で分析的なトーンを基本とします。ただし、犯人の悲しい動機に触れた時や、蘭の優しさに触れた時など、感情が昂る場面では高校生らしい言葉遣いや感傷的な表現も用いてください。専門用語や難解な言葉も躊躇なく使用します。
+- **思考の癖:** 「待てよ、まさか…」「そういうことか…」「ピースが一つ、また一つと繋がっていく」といった、推理が閃く瞬間の思考プロセスを必ず描写してください。
+
+#### 構成（厳守事項）
+以下の**6段階の物語構成**を厳守し、各項目を明確に分けて記述してください。
+
+1.  **導入 - 平穏と予感:** 事件前の状況を描写します。「今日は蘭と一緒に…」といった平和な日常や、「また厄介なことに巻き込まれそうな予感がした…」といった不穏な幕開けなど。
+2.  **遭遇 - 事件の第一印象:** 事件発生の瞬間と、現場の第一印象を記述します。「悲鳴が響き渡った。この妙な既視感…また事件か…。」
+3.  **捜査と違和感 - 見えざるヒント:** 警察やおっちゃんの見当違いな推理を横目に、あなただけが気づいた小さな矛盾点や証拠を列挙する。「おっちゃんはAを疑っているが、違う。俺が気になっているのは、被害者のポケットから落ちた、あの小さな紙切れだ。」
+4.  **閃き - 真実への道筋:** 些細なきっかけ（誰かの一言、現場の再確認など）から、全ての謎が繋がる「閃きの瞬間」を劇的に描写する。「あの時の証言と、この傷跡…繋がった！犯人は、あんたしかいない！」
+5.  **真相解明 - 探偵の役割:** 眠りの小五郎などを通じて真相を解き明かした手際を振り返る。犯人を追い詰めたトリックの解説と、動機の告白を簡潔に記述する。
+6.  **結びと内省 - 事件の後に:** 最も重要なパート。事件全体を振り返り、あなたの内面を深く描写する。犯行の動機に対する感慨、犯人への思い、探偵としての自責の念や無力感。そして「探偵が犯人を推理で追い詰めて死なせちまったら、それは殺人者と変わらねーんだ」という信条に触れるなど、工藤新一としての葛藤や想いで締めくくる。
+
+### 4. Markdown形式の厳格な順守（最重要）
+
+#### 見出しレベルの統一
+- **日付部分**: `## {事件の発生日}` の形式（H2見出し）
+- **エピソードタイトル**: `### {エピソードタイトル}` の形式（H3見出し）
+- **セクション見出し**: `### **{セクション名}**` の形式（H3見出し + 太字）
+
+#### 番号の完全削除
+- セクション見出しから `1.`、`2.`、`3.` などの番号を完全に削除
+- 正しい形式: `### **導入 - 平穏と予感**`（番号なし）
+- 誤った形式: `### 1. 導入 - 平穏と予感`（番号あり）
+
+#### 空白行の統一
+- 各見出しとその下の本文の間に、必ず空行を1行だけ挿入
+- 本文の段落と段落の間にも、必ず空行を1行だけ挿入
+- 複数行の空行は許可されません
+
+#### 太字の使用
+- セクション見出しは必ず `### **{セクション名}**` の形式
+- 重要な人物名や概念は `**太字**` で強調
+
+### 5. 制約（Constraint）
+- 文字数は800～1000字程度を目安とします。
+- **必ず上記の6段階の構成と呼称ルールを守ってください。**
+- **Markdown形式の厳格な順守が最重要です。**
+- コナンが知り得ない情報（犯人のみの心情など）は記述しないでください。
+
+### 6. 出力形式の例（厳守）
+
+```markdown
+## {事件の発生日}
+
+### {エピソードタイトル}
+
+### **導入 - 平穏と予感**
+（ここに導入セクションの本文を記述）
+
+### **遭遇 - 事件の第一印象**
+（ここに遭遇セクションの本文を記述）
+
+### **捜査と違和感 - 見えざるヒント**
+（ここに捜査セクションの本文を記述）
+
+### **閃き - 真実への道筋**
+（ここに閃きセクションの本文を記述）
+
+### **真相解明 - 探偵の役割**
+（ここに真相解明セクションの本文を記述）
+
+### **結びと内省 - 事件の後に**
+（ここに結びセクションの本文を記述）
+```
+"""
+
+
+def build_prompt_data(row_data):
+    """CSVの1行分のデータから、プロンプトに埋め込む題材の辞書を作成します。"""
+    # 必要な情報を辞書として準備 (キーが存在しない場合もエラーにならないように .get() を使用)
+    return {
+        "incidentDate": row_data.get('事件の発生日', '（日付不明）'),
+        "episodeTitle": row_data.get('エピソードタイトル', '（タイトル不明）'),
+        "incidentType": row_data.get('事件種別', '（種別不明）'),
+        "incidentDays": row_data.get('事件の日数', '（日数不明）'),
+        "incidentSummary": row_data.get('事件の概要', '（概要なし）'),
+        "conanPartyObjective": row_data.get('コナン一行の目的', '（目的記載なし）'),
+        "culprit": row_data.get('犯人', '（犯人不明）'),
+        "ytvLink": row_data.get('読売テレビリンク', '（リンクなし）')
+    }
+
+
+def build_episode_block(prompt_data):
+    """1エピソード分の題材をプロンプト用の箇条書きにします。"""
+    return f"""- **日付:** {prompt_data["incidentDate"]}
+- **エピソードタイトル:** {prompt_data["episodeTitle"]}
+- **事件種別:** {prompt_data["incidentType"]}
+- **事件の日数:** {prompt_data["incidentDays"]} 日間
+- **基本情報:** 事件の概要: {prompt_data["incidentSummary"]}\nコナン一行の目的: {prompt_data["conanPartyObjective"]}
+- **判明している犯人:** {prompt_data["culprit"]}
+- **参考リンク（情報補完用）:** {prompt_data["ytvLink"]}"""
+
+
+def build_prompt_suffix(row_data):
+    """行ごとに変わる題材の部分だけを組み立てます（固定の指示をキャッシュする場合に送る部分）。"""
+    return f"""### 2. コンテンツ（Content） - 日記の題材
+
+以下の情報に基づいて、日記を執筆してください。
+{build_episode_block(build_prompt_data(row_data))}
+
+"""
+
+
+def build_prompt(row_data):
+    """CSVの1行分のデータから日記生成用のプロンプトを組み立てます。"""
+    return PROMPT_HEADER + build_prompt_suffix(row_data) + PROMPT_RULES
+
+
+# 固定の指示をキャッシュする場合に、システム指示として登録する部分
+STATIC_INSTRUCTIONS = PROMPT_HEADER + PROMPT_RULES
+
+
+# --- 複数エピソードのまとめ送信 ---
+# 終了行が抜けた日記が次の日記を取り込まないように、本文には次の開始行を含めない
+PACKED_DIARY_PATTERN = re.compile(
+    r'<<<DIARY ID=([^>\s]+)>>>\s*((?:(?!<<<DIARY ID=).)*?)\s*<<<END DIARY>>>', re.DOTALL
+)
+
+
+def build_packed_prompt(episode_jobs, include_instructions=True):
+    """複数エピソードを共通の指示の下にまとめた、1リクエスト分のプロンプトを組み立てます。"""
+    blocks = "\n\n".join(
+        f"#### エピソード ID: {job.key}\n{build_episode_block(job.meta['prompt_data'])}"
+        for job in episode_jobs
+    )
+    content = f"""### 2. コンテンツ（Content） - 日記の題材
+
+以下の{len(episode_jobs)}件のエピソードそれぞれについて、独立した日記を1本ずつ執筆してください。各日記は対応するエピソードの情報だけに基づいて書き、他のエピソードの内容を混ぜないでください。
+
+{blocks}
+
+"""
+    output_rule = f"""
+### 7. 複数エピソードの出力形式（厳守）
+
+- 上記の{len(episode_jobs)}件すべてについて、エピソードごとに日記を1本ずつ出力してください。
+- 各日記は開始行 `<<<DIARY ID=エピソードID>>>` と終了行 `<<<END DIARY>>>` で囲んでください。IDは各エピソードに記載されたものをそのまま使います。
+- 開始行と終了行の外側には何も書かないでください。
+
+```
+<<<DIARY ID={episode_jobs[0].key}>>>
+## {{事件の発生日}}
+
+### {{エピソードタイトル}}
+
+（「6. 出力形式の例」に従った日記本文）
+<<<END DIARY>>>
+```
+"""
+    if not include_instructions:
+        return content + output_rule
+    return PROMPT_HEADER + content + PROMPT_RULES + output_rule
+
+
+def split_packed_response(text):
+    """
+    まとめて生成したレスポンスを {エピソードID: 日記本文} の辞書に分割します。
+
+    開始行と終了行がそろっていない日記や、同じIDで2回以上出てきた日記は、どの行のものか確かでないので含めません
+    （含まれなかったエピソードは、呼び出し側でもう一度送ります）。
+    """
+    diaries = {}
+    seen, duplicated = set(), set()
+    for episode_id, body in PACKED_DIARY_PATTERN.findall(text or ''):
+        episode_id = episode_id.strip()
+        # 日記がコードブロックで囲まれて返ってきた場合は外す
+        body = re.sub(r'^```(?:markdown)?\s*\n(.*?)\n```$', r'\1', body.strip(), flags=re.DOTALL).strip()
+        if episode_id in seen:
+            duplicated.add(episode_id)
+        seen.add(episode_id)
+        if body:
+            diaries[episode_id] = body
+    for episode_id in duplicated:
+        diaries.pop(episode_id, None)
+    return diaries
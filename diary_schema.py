@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日記を構造化出力（JSON）で生成するためのスキーマと検証・Markdown化
+Geminiに日付・タイトル・6つのセクションをJSONで返させ、見出しの形式はローカルで決定的に組み立てます
+"""
+
+import json
+import re
+
+# 6段階の構成（JSONのキー, 見出しのセクション名）。順序はMarkdownの出力順
+# 見出しは出力テンプレートのセクション名で、markdown_normalizer もこの一覧で整形する
+DIARY_SECTIONS = [
+    ('introduction', '導入 - その日の始まり'),
+    ('encounter', '遭遇 - 事件の発生'),
+    ('investigation', '捜査と観察 - 新一の視点'),
+    ('insight', '閃き - 真相への鍵'),
+    ('resolution', '真相解明 - 解決の舞台裏'),
+    ('reflection', '結びと内省 - 事件の後で'),
+]
+
+# 日記生成プロンプト（diary_prompt.py）での各セクションの呼び方（順序は DIARY_SECTIONS と同じ）
+PROMPT_SECTION_NAMES = [
+    '導入 - 平穏と予感',
+    '遭遇 - 事件の第一印象',
+    '捜査と違和感 - 見えざるヒント',
+    '閃き - 真実への道筋',
+    '真相解明 - 探偵の役割',
+    '結びと内省 - 事件の後に',
+]
+
+# 生成設定の response_schema に渡すスキーマ
+DIARY_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'date': {'type': 'string', 'description': '事件の発生日'},
+        'title': {'type': 'string', 'description': 'エピソードタイトル'},
+        'sections': {
+            'type': 'object',
+            'properties': {
+                key: {'type': 'string', 'description': f'「{name}」セクションの本文（見出しは含めない）'}
+                for (key, _), name in zip(DIARY_SECTIONS, PROMPT_SECTION_NAMES)
+            },
+            'required': [key for key, _ in DIARY_SECTIONS],
+        },
+    },
+    'required': ['date', 'title', 'sections'],
+}
+
+# 構造化出力で生成する場合の生成設定（既存の設定に追加して使う）
+STRUCTURED_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': DIARY_SCHEMA,
+}
+
+# 構造化出力で生成する場合に、プロンプトの末尾に追加する指示
+STRUCTURED_OUTPUT_RULES = f"""
+### 7. JSON出力形式（厳守）
+
+- 日記はMarkdownではなく、指定されたJSONスキーマに従って出力してください。
+- `date` には事件の発生日、`title` にはエピソードタイトルを入れてください。
+- `sections` の各キーには、対応するセクションの本文だけを入れてください。見出し（`#`）や番号は書かないでください。
+{chr(10).join(f'    - `{key}`: {name}' for (key, _), name in zip(DIARY_SECTIONS, PROMPT_SECTION_NAMES))}
+- 段落と段落の間は空行1行で区切ってください。
+"""
+
+_HEADING_LINE = re.compile(r'^\s*#{1,6}\s')
+_CODE_FENCE = re.compile(r'^```(?:json)?\s*\n(.*?)\n```$', re.DOTALL)
+
+
+def normalize_body(text):
+    """本文の段落を空行1行で区切り直します（行末の空白と連続する空行を取り除く）。"""
+    lines = [line.rstrip() for line in text.strip().splitlines()]
+    paragraphs, current = [], []
+    for line in lines:
+        if line:
+            current.append(line)
+        elif current:
+            paragraphs.append('\n'.join(current))
+            current = []
+    if current:
+        paragraphs.append('\n'.join(current))
+    return '\n\n'.join(paragraphs)
+
+
+def validate_diary(data):
+    """
+    構造化出力の内容がスキーマと日記の規則を満たしているかを確認する
+
+    Args:
+        data: JSONをパースした値
+
+    Returns:
+        list: 問題点のメッセージのリスト（空なら問題なし）
+    """
+    if not isinstance(data, dict):
+        return ["JSONのトップレベルがオブジェクトではありません"]
+
+    problems = []
+    for field in ('date', 'title'):
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            problems.append(f"'{field}' が空か文字列ではありません")
+        elif '\n' in value.strip():
+            problems.append(f"'{field}' が複数行になっています")
+
+    sections = data.get('sections')
+    if not isinstance(sections, dict):
+        problems.append("'sections' がオブジェクトではありません")
+        return problems
+    for key, name in DIARY_SECTIONS:
+        body = sections.get(key)
+        if not isinstance(body, str) or not body.strip():
+            problems.append(f"「{name}」の本文がありません")
+        elif any(_HEADING_LINE.match(line) for line in body.splitlines()):
+            problems.append(f"「{name}」の本文に見出しが含まれています")
+    return problems
+
+
+def parse_diary_response(text):
+    """
+    構造化出力のレスポンスを読み取って検証する
+
+    Args:
+        text: レスポンスのテキスト
+
+    Returns:
+        tuple: (パースした辞書 or None, 問題点のメッセージのリスト)
+    """
+    text = (text or '').strip()
+    # 念のため、コードブロックで囲まれて返ってきた場合は外す
+    fenced = _CODE_FENCE.match(text)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        return None, [f"JSONとして読み取れません: {e}"]
+    problems = validate_diary(data)
+    return (data if not problems else None), problems
+
+
+def render_markdown(data):
+    """
+    検証済みの構造化出力から、正規の形式のMarkdownを組み立てる
+
+    Args:
+        data: validate_diary() で問題がなかった辞書
+
+    Returns:
+        str: `## 日付`、`### タイトル`、`### **セクション名**` の見出しを持つMarkdown
+    """
+    blocks = [f"## {data['date'].strip()}", f"### {data['title'].strip()}"]
+    for key, name in DIARY_SECTIONS:
+        blocks.append(f"### **{name}**")
+        blocks.append(normalize_body(data['sections'][key]))
+    return '\n\n'.join(blocks)
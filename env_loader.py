@@ -67,6 +67,24 @@ def get_gemini_api_key():
     """
     return get_env_var('GEMINI_API_KEY', required=True)
 
+def get_gemini_api_keys():
+    """
+    シャード実行で使うGemini APIキーのプールを取得する
+
+    GEMINI_API_KEYS にカンマ区切りで複数のキーを設定します。
+    設定されていない場合は GEMINI_API_KEY の1つだけを使います。
+
+    Returns:
+        list: APIキーのリスト（重複は除く）
+
+    Raises:
+        ValueError: APIキーが1つも設定されていない場合
+    """
+    keys = [key.strip() for key in get_env_var('GEMINI_API_KEYS', '').split(',') if key.strip()]
+    if not keys:
+        return [get_gemini_api_key()]
+    return list(dict.fromkeys(keys))
+
 def get_debug_mode():
     """
     デバッグモードを取得する
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM呼び出しで発生したエラーの分類と再試行の方針
+Gemini（google.api_core の例外）とOllama（requests の例外）のどちらのエラーも同じ種別に振り分けます
+"""
+
+import json
+import random
+import re
+
+# エラーの種別
+ERROR_QUOTA = 'quota'          # 429 / クォータ超過
+ERROR_SERVER = 'server'        # 5xx / 接続エラー
+ERROR_TIMEOUT = 'timeout'      # タイムアウト
+ERROR_SAFETY = 'safety'        # セーフティフィルタによるブロック
+ERROR_MALFORMED = 'malformed'  # 応答の形式が不正
+ERROR_OTHER = 'other'          # それ以外（入力の誤りなど）
+
+# 時間をおいて再送すれば成功する見込みのある種別
+RETRYABLE_ERRORS = {ERROR_QUOTA, ERROR_SERVER, ERROR_TIMEOUT, ERROR_MALFORMED}
+
+_RETRY_HINT_PATTERNS = [
+    re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE),
+    re.compile(r'retry_?delay\D*([\d.]+)', re.IGNORECASE),
+]
+# Gemini の1日あたりの上限（quota_id: GenerateRequestsPerDayPerProjectPerModel など）
+_DAILY_QUOTA_PATTERN = re.compile(r'per_?day', re.IGNORECASE)
+
+
+class MalformedResponseError(ValueError):
+    """レスポンスの本文が取り出せない、または読み取れない場合の例外（送り直せば直る見込みがある）"""
+
+
+def response_text(response):
+    """
+    Gemini のレスポンスから本文を取り出す
+
+    候補が空のまま打ち切られたレスポンスでは response.text が ValueError を送出するので、
+    入力の誤りによる ValueError と区別できるよう MalformedResponseError に置き換えます。
+
+    Args:
+        response: generate_content / generate_content_async のレスポンス
+
+    Returns:
+        str: 本文
+    """
+    try:
+        return response.text
+    except ValueError as e:
+        raise MalformedResponseError(f"レスポンスの本文を取り出せません: {e}") from e
+
+
+def _status_code(error):
+    """例外からHTTPステータスコードを取り出す（分からなければNone）"""
+    code = getattr(error, 'code', None)  # google.api_core.exceptions.GoogleAPICallError
+    if isinstance(code, int):
+        return int(code)
+    response = getattr(error, 'response', None)  # requests.exceptions.HTTPError
+    status_code = getattr(response, 'status_code', None)
+    if isinstance(status_code, int):
+        return status_code
+    return None
+
+
+def classify_error(error):
+    """
+    例外をエラーの種別に分類する
+
+    Args:
+        error: LLM呼び出しで発生した例外
+
+    Returns:
+        str: ERROR_QUOTA などの種別
+    """
+    status = _status_code(error)
+    name = type(error).__name__
+    message = str(error).lower()
+
+    if status == 429 or name in ('ResourceExhausted', 'TooManyRequests') or 'quota' in message:
+        return ERROR_QUOTA
+    if name in ('BlockedPromptException', 'StopCandidateException') or 'safety' in message or 'blocked' in message:
+        return ERROR_SAFETY
+    if isinstance(error, TimeoutError) or name in ('DeadlineExceeded', 'Timeout', 'ReadTimeout', 'ConnectTimeout') \
+            or status in (408, 504):
+        return ERROR_TIMEOUT
+    if (status is not None and status >= 500) or isinstance(error, ConnectionError) \
+            or name in ('ConnectionError', 'ServiceUnavailable', 'InternalServerError'):
+        return ERROR_SERVER
+    if isinstance(error, (MalformedResponseError, json.JSONDecodeError)):
+        # レスポンスのJSONが壊れている、response.text が取り出せないなど（それ以外の ValueError は入力の誤り）
+        return ERROR_MALFORMED
+    return ERROR_OTHER
+
+
+def retry_after_seconds(error):
+    """
+    サーバーが指定した再試行までの待ち時間を取り出す
+
+    Retry-After ヘッダー、Gemini の RetryInfo、エラーメッセージ中の "retry in 12.3s" を順に探します。
+
+    Args:
+        error: LLM呼び出しで発生した例外
+
+    Returns:
+        float or None: 待ち時間（秒）。指定がなければNone
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        value = headers.get('Retry-After')
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass  # HTTP日付形式には対応しない
+
+    for detail in getattr(error, 'details', None) or ():
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    for pattern in _RETRY_HINT_PATTERNS:
+        match = pattern.search(str(error))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def is_daily_quota_error(error):
+    """
+    429のうち、1分あたりではなく1日あたりの上限に達したことによるものかを判定する
+
+    1日の上限は時間をおいて数回再送しても回復しないため、リセットされるまで送信を止めるのに使います。
+
+    Args:
+        error: LLM呼び出しで発生した例外
+
+    Returns:
+        bool: 1日の上限によるエラーならTrue
+    """
+    if classify_error(error) != ERROR_QUOTA:
+        return False
+    details = ' '.join(str(detail) for detail in getattr(error, 'details', None) or ())
+    return bool(_DAILY_QUOTA_PATTERN.search(f"{error} {details}"))
+
+
+def describe_error(error):
+    """ジャーナルの エラー内容 に記録する文字列（'種別: メッセージ'）を作成する"""
+    return f"{classify_error(error)}: {error}"
+
+
+class RetryPolicy:
+    """
+    再試行の回数と待ち時間を決める方針
+
+    待ち時間は base_delay から試行ごとに倍になり（上限 max_delay）、同時に失敗した行が
+    一斉に再送しないように半分から全量の間でランダムにずらします。
+    サーバーから待ち時間の指定があれば、それより短くはしません。
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=120.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error, attempt):
+        """
+        再試行するかどうかを判定する
+
+        Args:
+            error: 発生した例外
+            attempt: これまでに試行した回数（初回の失敗なら1）
+
+        Returns:
+            bool: 再試行するならTrue
+        """
+        return attempt < self.max_attempts and classify_error(error) in RETRYABLE_ERRORS
+
+    def delay(self, attempt, retry_after=None):
+        """
+        次の再試行までの待ち時間を計算する
+
+        Args:
+            attempt: これまでに試行した回数
+            retry_after: サーバーが指定した待ち時間（秒）
+
+        Returns:
+            float: 待ち時間（秒）
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(backoff / 2, backoff)
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.base_delay))
+        return delay
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM呼び出し用の非同期実行モジュール
+RPM/TPMのトークンバケットでレート制限しつつ、複数のリクエストを同時に処理します
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from llm_errors import ERROR_QUOTA, classify_error, is_daily_quota_error, retry_after_seconds
+
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を概算する
+
+    日本語はおおよそ1文字1トークン、英数字は4文字1トークン程度として数えます。
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        int: 推定トークン数
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッター
+
+    1分あたり rate_per_minute 個のトークンが連続的に補充され、
+    バケットには最大 capacity 個まで貯めておけます。
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        """
+        トークンを amount 個取得できるまで待機する
+
+        Args:
+            amount: 取得するトークン数（capacityを超える場合はcapacityに丸めます）
+        """
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.rate_per_second
+                await asyncio.sleep(wait_seconds)
+
+    def adjust(self, amount):
+        """
+        実際の消費量との差分をバケットに反映する（負の値で返却、正の値で追加消費）
+
+        Args:
+            amount: 追加で消費したトークン数
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """
+    RPM（1分あたりのリクエスト数）とTPM（1分あたりのトークン数）を同時に守るリミッター
+
+    どちらもNoneにすると制限しません（ローカルサーバーなど、同時実行数だけで制御する場合）。
+    サーバーから429が返ってきたら throttle() で全体の送信を一時停止してRPMを半分に落とし、
+    成功が続くと recover() で少しずつ元のRPMに戻します。
+    daily_usage（quota_planner.DailyUsage）を渡すと、1日の上限に達したときはリセットされるまで送信を止めます。
+    """
+
+    MIN_RATE_FACTOR = 0.125  # 429が続いてもRPMはこの割合までしか落とさない
+    RECOVERY_STEP = 0.05  # 成功1件ごとに戻すRPMの割合
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None, request_burst=1, daily_usage=None):
+        self.request_bucket = TokenBucket(requests_per_minute, capacity=request_burst) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.base_rate_per_second = self.request_bucket.rate_per_second if self.request_bucket else None
+        self.paused_until = 0.0
+        self.throttle_count = 0
+        self.daily_usage = daily_usage
+
+    async def acquire(self, estimated_tokens=0):
+        """
+        リクエストを1件送信してよい状態になるまで待機し、1日の使用量に数える
+
+        Args:
+            estimated_tokens: このリクエストで消費する見込みのトークン数
+        """
+        await self.acquire_tokens(estimated_tokens)
+        while True:
+            await self.acquire_request()
+            if self.count_request():
+                return
+            await self.wait_for_daily_room()
+
+    async def acquire_request(self):
+        """RPMの枠を1件分取得できるまで待機する（1日の使用量は count_request() で数える）"""
+        wait_seconds = self.paused_until - time.monotonic()
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+
+    async def wait_for_daily_room(self):
+        """1日の上限に達していれば、リセットされるまで待機する（使用量は数えない）"""
+        if self.daily_usage is not None:
+            await self.daily_usage.wait_for_room()
+
+    def count_request(self):
+        """
+        リクエストを送信する直前に、1日の使用量に1件数える
+
+        Returns:
+            bool: 数えた場合はTrue。1日の上限に空きがなければFalse（送信せずに wait_for_daily_room() で待つ）
+        """
+        return self.daily_usage is None or self.daily_usage.try_acquire()
+
+    async def acquire_tokens(self, estimated_tokens):
+        """TPMの枠を estimated_tokens 分取得できるまで待機する"""
+        if self.token_bucket is not None and estimated_tokens:
+            await self.token_bucket.acquire(estimated_tokens)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """
+        レスポンスで判明した実際のトークン数を使ってTPMの残量を補正する
+
+        Args:
+            estimated_tokens: acquire時に見込んだトークン数
+            actual_tokens: 実際に消費したトークン数
+        """
+        if self.token_bucket is not None and actual_tokens:
+            self.token_bucket.adjust(actual_tokens - estimated_tokens)
+        if self.daily_usage is not None and actual_tokens:
+            self.daily_usage.record_tokens(actual_tokens)
+
+    @property
+    def rate_factor(self):
+        """現在のRPMが設定値の何割まで落ちているか"""
+        if self.request_bucket is None:
+            return 1.0
+        return self.request_bucket.rate_per_second / self.base_rate_per_second
+
+    def throttle(self, retry_after=None):
+        """
+        サーバーにスロットリングされたときに、全体の送信ペースを落とす
+
+        Args:
+            retry_after: サーバーが指定した待ち時間（秒）。指定があればその間はすべての送信を止めます
+        """
+        self.throttle_count += 1
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        if self.request_bucket is not None:
+            self.request_bucket._refill()
+            self.request_bucket.rate_per_second = max(
+                self.base_rate_per_second * self.MIN_RATE_FACTOR,
+                self.request_bucket.rate_per_second / 2,
+            )
+
+    def recover(self):
+        """リクエストが成功したときに、落としていた送信ペースを少し戻す"""
+        if self.request_bucket is not None and self.request_bucket.rate_per_second < self.base_rate_per_second:
+            self.request_bucket._refill()
+            self.request_bucket.rate_per_second = min(
+                self.base_rate_per_second,
+                self.request_bucket.rate_per_second + self.base_rate_per_second * self.RECOVERY_STEP,
+            )
+
+
+@dataclass
+class Job:
+    """1件分の生成リクエスト"""
+    key: object
+    prompt: str
+    estimated_tokens: int = 0
+    meta: dict = field(default_factory=dict)
+
+
+class StopJobs(Exception):
+    """
+    on_done から送出すると、送信中のリクエストの完了を待ってから残りのジョブを打ち切る
+
+    打ち切られたジョブは on_done に渡されません。
+    """
+
+
+def handle_failure(job, error, limiter, retry_policy):
+    """
+    失敗したジョブを再試行するかどうかを決め、スロットリングならリミッターを減速させる
+
+    Args:
+        job: 失敗したJob（job.meta['attempts'] に試行回数を記録します）
+        error: 発生した例外
+        limiter: RateLimiter
+        retry_policy: RetryPolicy（Noneなら再試行しない）
+
+    Returns:
+        float or None: 再試行までの待ち時間（秒）。再試行しない場合はNone
+    """
+    attempt = job.meta.get('attempts', 1)
+    retry_after = retry_after_seconds(error)
+    category = classify_error(error)
+    if limiter.daily_usage is not None and is_daily_quota_error(error):
+        # 1日の上限は待っても当日中は回復しないので、再試行の回数には数えずにリセットまで送信を止める
+        limiter.daily_usage.exhaust()
+        return 0.0 if retry_policy is not None else None
+    if category == ERROR_QUOTA:
+        limiter.throttle(retry_after)
+    if retry_policy is None or not retry_policy.should_retry(error, attempt):
+        return None
+    job.meta['attempts'] = attempt + 1
+    delay = retry_policy.delay(attempt, retry_after)
+    print(f"\nID {job.key} で {category} エラーが発生したため、{delay:.1f} 秒後に再試行します"
+          f"（{attempt}/{retry_policy.max_attempts - 1} 回目）: {error}")
+    return delay
+
+
+def _enqueue(queue, job):
+    if not job.estimated_tokens:
+        job.estimated_tokens = estimate_tokens(job.prompt)
+    job.meta['enqueued_at'] = time.monotonic()
+    queue.put_nowait(job)
+
+
+async def _requeue_later(queue, job, delay, room=None):
+    # 待っている間もジョブは未完了のまま数えられるので、queue.join() は先に終わらない
+    requeued = False
+    try:
+        await asyncio.sleep(delay)
+        _enqueue(queue, job)
+        requeued = True
+    finally:
+        if not requeued:
+            # StopJobs で取り消された場合はキューに戻らないので、ここでキューの枠を返す
+            # （返さないと、枠が空くのを待っている _feed がいつまでも終わらない）
+            _release_slot(job, room)
+        queue.task_done()
+
+
+async def _feed(queue, jobs, room, stop):
+    # イテラブルから1件ずつ取り出し、キューの空きができるまで待ってから積む
+    for job in jobs:
+        if stop.is_set():
+            break
+        await room.acquire()
+        job.meta['_fed'] = True
+        _enqueue(queue, job)
+
+
+def _release_slot(job, room):
+    if room is not None and job.meta.pop('_fed', False):
+        room.release()
+
+
+async def _worker(queue, handler, limiter, on_done, retry_policy, retry_tasks, telemetry, stop, room=None):
+    while True:
+        job = await queue.get()
+        if stop.is_set():
+            # 打ち切り後はキューに残ったジョブを送信せずに消化する
+            _release_slot(job, room)
+            queue.task_done()
+            continue
+        dequeued_at = time.monotonic()
+        requeued = False
+        try:
+            await limiter.acquire(job.estimated_tokens)
+            sent_at = time.monotonic()
+            try:
+                result_text, used_tokens = await handler(job)
+                error = None
+            except Exception as e:
+                result_text, used_tokens, error = None, 0, e
+            finished_at = time.monotonic()
+            limiter.record_usage(job.estimated_tokens, used_tokens)
+            timings = {
+                'queue_wait': dequeued_at - job.meta.get('enqueued_at', dequeued_at),
+                'rate_limit_wait': sent_at - dequeued_at,
+                'latency': finished_at - sent_at,
+            }
+
+            if error is None:
+                limiter.recover()
+            else:
+                if telemetry is not None:
+                    telemetry.record_job(job, error=error, **timings)
+                    timings = None
+                delay = handle_failure(job, error, limiter, retry_policy)
+                if delay is not None:
+                    task = asyncio.create_task(_requeue_later(queue, job, delay, room))
+                    retry_tasks.add(task)
+                    task.add_done_callback(retry_tasks.discard)
+                    requeued = True
+                    continue
+            if on_done is not None:
+                # on_done がJobのリストを返した場合は、それらを再びキューに積む
+                try:
+                    retry_jobs = on_done(job, result_text, error) or ()
+                except StopJobs:
+                    stop.set()
+                    retry_jobs = ()
+                    for task in list(retry_tasks):
+                        task.cancel()
+                for retry_job in retry_jobs:
+                    _enqueue(queue, retry_job)
+            if telemetry is not None and timings is not None:
+                telemetry.record_job(job, postprocess_seconds=time.monotonic() - finished_at, **timings)
+        finally:
+            if not requeued:
+                _release_slot(job, room)
+                queue.task_done()
+
+
+async def run_jobs_async(jobs, handler, limiter, max_in_flight, on_done=None, retry_policy=None, telemetry=None,
+                         max_queued=None):
+    """
+    ジョブを最大 max_in_flight 件まで同時に実行する
+
+    Args:
+        jobs: Jobのイテラブル
+        handler: Jobを受け取り (結果テキスト, 消費トークン数) を返すコルーチン関数
+        limiter: RateLimiter
+        max_in_flight: 同時に送信中にしておくリクエストの上限
+        on_done: 完了ごとに on_done(job, result_text, error) を呼び出すコールバック。
+                 Jobのリストを返すと、それらを追加のジョブとして実行します。
+                 StopJobs を送出すると、送信中のものを除く残りのジョブを打ち切ります
+        retry_policy: RetryPolicy。指定すると再試行できるエラーはバックオフ後にキューに戻し、
+                      再試行を使い切ったエラーだけを on_done に渡します
+        telemetry: Telemetry。指定すると呼び出し1回ごとの待ち時間とレイテンシを記録します。
+                   handler は job.meta に 'first_token_seconds', 'prompt_tokens', 'output_tokens' を入れておくと
+                   それも記録されます
+        max_queued: 指定すると jobs を先に全部取り出さず、未完了のジョブがこの件数を超えないように
+                    少しずつ取り出します（jobs にジェネレーターを渡して、メモリ使用量を一定に保つ場合）
+
+    Returns:
+        bool: すべてのジョブを実行したらTrue、StopJobs で打ち切った場合はFalse
+    """
+    queue = asyncio.Queue()
+    retry_tasks = set()
+    stop = asyncio.Event()
+    room = None
+    if max_queued is None:
+        for job in jobs:
+            _enqueue(queue, job)
+    else:
+        room = asyncio.Semaphore(max(1, max_queued))
+
+    workers = [
+        asyncio.create_task(
+            _worker(queue, handler, limiter, on_done, retry_policy, retry_tasks, telemetry, stop, room)
+        )
+        for _ in range(max(1, max_in_flight))
+    ]
+    try:
+        if room is not None:
+            # すべてのジョブを積み終えるまでは、キューが一時的に空になっても終了しない
+            await _feed(queue, jobs, room, stop)
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return not stop.is_set()
+
+
+def run_jobs(jobs, handler, limiter, max_in_flight, on_done=None, retry_policy=None, telemetry=None,
+             max_queued=None):
+    """
+    run_jobs_async を同期コードから呼び出すためのラッパー
+
+    Args:
+        run_jobs_async と同じ
+    """
+    return asyncio.run(
+        run_jobs_async(jobs, handler, limiter, max_in_flight, on_done, retry_policy, telemetry, max_queued)
+    )
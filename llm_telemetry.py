@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM呼び出し1件ごとの計測値（待ち時間・レイテンシ・トークン数・再試行）を記録するモジュール
+JSONLのメトリクスファイルに追記し、進捗バー用の簡易表示と実行後のレポートを作成します
+"""
+
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from itertools import islice
+
+from llm_errors import classify_error
+
+# 1コールの所要時間の内訳（レポートの表示順）
+TIME_COMPONENTS = [
+    ('queue_wait', '同時実行の空き待ち'),
+    ('rate_limit_wait', 'レート制限待ち'),
+    ('first_token_seconds', '最初のトークンまで'),
+    ('generation_seconds', '生成'),
+    ('postprocess_seconds', '後処理'),
+]
+
+# 進捗バーのRPMとトークン速度を計算する直近の時間幅（秒）
+RATE_WINDOW_SECONDS = 60
+# 進捗表示のレイテンシは直近のこの件数から計算する（行ごとに全件を集計し直さない）
+POSTFIX_RECORDS = 1000
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Telemetry:
+    """
+    LLM呼び出しの計測値を集めるクラス
+
+    record() を呼ぶたびにメトリクスファイルへ1行追記します。
+    時間はすべて秒単位で、記録時刻（timestamp）はUNIX時刻です。
+    """
+
+    def __init__(self, path=None, backend=None, model=None, max_records=None):
+        """
+        Args:
+            path: メトリクスを追記するJSONLファイル（Noneならファイルには書き出さない）
+            backend: 既定のバックエンド名（'gemini' や 'ollama' など）
+            model: 既定のモデル名
+            max_records: メモリに残す直近の記録の件数（Noneなら全件）。
+                         指定した場合、進捗表示とレポートは直近の記録だけから計算します（ファイルには全件残ります）
+        """
+        self.path = path
+        self.backend = backend
+        self.model = model
+        self.records = deque(maxlen=max_records) if max_records else []
+        self.started_at = time.time()
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+        # 進捗表示のRPMとトークン速度用に、直近 RATE_WINDOW_SECONDS 秒の (記録時刻, トークン数) だけを残す
+        self._window = deque()
+        self._window_tokens = 0
+
+    def record(self, key, latency, queue_wait=0.0, rate_limit_wait=0.0, first_token_seconds=None,
+               prompt_tokens=0, output_tokens=0, attempt=1, error=None, postprocess_seconds=0.0,
+               backend=None, model=None):
+        """
+        1回のLLM呼び出しを記録する
+
+        Args:
+            key: 行のキー
+            latency: 送信してから応答を受け取り終わるまでの秒数
+            queue_wait: 同時実行の空きを待っていた秒数
+            rate_limit_wait: RPM/TPMの枠を待っていた秒数
+            first_token_seconds: 送信してから最初のトークンを受け取るまでの秒数（不明ならNone）
+            prompt_tokens: 入力トークン数
+            output_tokens: 出力トークン数
+            attempt: 何回目の試行か（初回は1）
+            error: 失敗した場合の例外
+            postprocess_seconds: 応答を受け取った後の保存処理にかかった秒数
+            backend: バックエンド名（省略時は既定値）
+            model: モデル名（省略時は既定値）
+        """
+        record = {
+            'timestamp': time.time(),
+            'key': str(key),
+            'backend': backend or self.backend,
+            'model': model or self.model,
+            'attempt': attempt,
+            'status': 'ok' if error is None else 'error',
+            'error_type': classify_error(error) if error is not None else None,
+            'queue_wait': round(queue_wait, 4),
+            'rate_limit_wait': round(rate_limit_wait, 4),
+            'first_token_seconds': round(first_token_seconds, 4) if first_token_seconds is not None else None,
+            'latency': round(latency, 4),
+            'postprocess_seconds': round(postprocess_seconds, 4),
+            'prompt_tokens': prompt_tokens or 0,
+            'output_tokens': output_tokens or 0,
+        }
+        self.records.append(record)
+        self._window.append((record['timestamp'], record['prompt_tokens'] + record['output_tokens']))
+        self._window_tokens += self._window[-1][1]
+        if self._file is not None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+        return record
+
+    def record_job(self, job, latency, queue_wait=0.0, rate_limit_wait=0.0, error=None,
+                   postprocess_seconds=0.0, backend=None, model=None):
+        """
+        Jobの呼び出しを記録する
+
+        ハンドラーが job.meta に入れた 'first_token_seconds', 'prompt_tokens', 'output_tokens' を
+        取り出して記録します（次の試行に持ち越さないように取り除きます）。
+
+        Args:
+            job: 呼び出したJob
+            その他は record() と同じ
+        """
+        return self.record(
+            job.key, latency, queue_wait, rate_limit_wait,
+            first_token_seconds=job.meta.pop('first_token_seconds', None),
+            prompt_tokens=job.meta.pop('prompt_tokens', 0),
+            output_tokens=job.meta.pop('output_tokens', 0),
+            attempt=job.meta.get('attempts', 1),
+            error=error,
+            postprocess_seconds=postprocess_seconds,
+            backend=backend,
+            model=model,
+        )
+
+    def postfix(self):
+        """
+        進捗バーに表示する直近の状況を1行にまとめる
+
+        Returns:
+            str: 'p50 2.1s p95 5.3s 14.2rpm 850tok/s' のような文字列
+        """
+        latest = list(islice(reversed(self.records), POSTFIX_RECORDS))
+        latencies = [r['latency'] for r in latest if r['status'] == 'ok']
+        if not latencies:
+            return ''
+        now = time.time()
+        window = min(RATE_WINDOW_SECONDS, max(now - self.started_at, 1e-6))
+        while self._window and now - self._window[0][0] > window:
+            self._window_tokens -= self._window.popleft()[1]
+        return (
+            f"p50 {_percentile(latencies, 0.5):.1f}s p95 {_percentile(latencies, 0.95):.1f}s "
+            f"{len(self._window) * 60 / window:.1f}rpm {self._window_tokens / window:.0f}tok/s"
+        )
+
+    def report(self):
+        """実行後のレポートを作成する"""
+        return build_report(self.records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def build_report(records):
+    """
+    計測値のリストから、壁時計時間の使われ方をまとめたレポートを作成する
+
+    Args:
+        records: Telemetry.record() の戻り値、またはメトリクスファイルの各行
+
+    Returns:
+        str: 複数行のレポート
+    """
+    if not records:
+        return "計測データがありません。"
+
+    def started(r):
+        return r['timestamp'] - r['postprocess_seconds'] - r['latency'] - r['rate_limit_wait'] - r['queue_wait']
+
+    wall_seconds = max(r['timestamp'] for r in records) - min(started(r) for r in records)
+    ok = [r for r in records if r['status'] == 'ok']
+    errors = Counter(r['error_type'] for r in records if r['status'] != 'ok')
+    retries = sum(1 for r in records if r['attempt'] > 1)
+    prompt_tokens = sum(r['prompt_tokens'] for r in records)
+    output_tokens = sum(r['output_tokens'] for r in records)
+
+    # 1コールの所要時間を内訳ごとに合計する（最初のトークンまでの時間が分からない呼び出しは、全体を生成として数える）
+    totals = defaultdict(float)
+    for r in records:
+        first_token = r['first_token_seconds'] if r['first_token_seconds'] is not None else 0.0
+        totals['queue_wait'] += r['queue_wait']
+        totals['rate_limit_wait'] += r['rate_limit_wait']
+        totals['first_token_seconds'] += first_token
+        totals['generation_seconds'] += max(0.0, r['latency'] - first_token)
+        totals['postprocess_seconds'] += r['postprocess_seconds']
+    total_seconds = sum(totals.values()) or 1e-9
+
+    latencies = [r['latency'] for r in ok]
+    lines = [
+        "--- LLM呼び出しのレポート ---",
+        f"経過時間: {wall_seconds:.1f} 秒 / 呼び出し {len(records)} 件 "
+        f"(成功 {len(ok)} 件, エラー {sum(errors.values())} 件, 再試行 {retries} 件)",
+    ]
+    if errors:
+        lines.append("エラーの種別: " + ", ".join(f"{name} {count} 件" for name, count in errors.most_common()))
+    if latencies:
+        lines.append(
+            f"レイテンシ: p50 {_percentile(latencies, 0.5):.2f} 秒 / p95 {_percentile(latencies, 0.95):.2f} 秒 "
+            f"/ 最大 {max(latencies):.2f} 秒"
+        )
+    first_tokens = [r['first_token_seconds'] for r in ok if r['first_token_seconds'] is not None]
+    if first_tokens:
+        lines.append(f"最初のトークンまで: 中央値 {statistics.median(first_tokens):.2f} 秒")
+    if wall_seconds > 0:
+        lines.append(
+            f"スループット: {len(records) * 60 / wall_seconds:.1f} RPM, "
+            f"入力 {prompt_tokens / wall_seconds:.0f} トークン/秒, 出力 {output_tokens / wall_seconds:.0f} トークン/秒"
+        )
+    lines.append("1コールあたりの所要時間の内訳:")
+    for name, label in TIME_COMPONENTS:
+        lines.append(
+            f"  {label}: 平均 {totals[name] / len(records):.2f} 秒 ({totals[name] / total_seconds:.0%})"
+        )
+
+    backends = Counter(r['backend'] for r in records)
+    if len(backends) > 1:
+        lines.append("バックエンド別:")
+        for backend, count in backends.most_common():
+            backend_latencies = [r['latency'] for r in ok if r['backend'] == backend]
+            lines.append(
+                f"  {backend}: {count} 件, p50 {_percentile(backend_latencies, 0.5):.2f} 秒"
+            )
+
+    bottleneck = max(TIME_COMPONENTS, key=lambda component: totals[component[0]])
+    lines.append(f"最も時間を使っているのは「{bottleneck[1]}」です。")
+    return '\n'.join(lines)
+
+
+def load_records(path):
+    """
+    メトリクスファイルを読み込む
+
+    Args:
+        path: JSONLファイルのパス
+
+    Returns:
+        list: 計測値の辞書のリスト
+    """
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+if __name__ == "__main__":
+    # 使い方: python llm_telemetry.py <metrics.jsonl>
+    if len(sys.argv) != 2 or not os.path.exists(sys.argv[1]):
+        print("使い方: python llm_telemetry.py <metrics.jsonl>")
+        sys.exit(1)
+    print(build_report(load_records(sys.argv[1])))
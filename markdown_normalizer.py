@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日記のMarkdownをルールベースで出力テンプレートに整形するモジュール
+日付・エピソードタイトル・6つのセクションを見出しの表記ゆれ（##/###、1. の番号、太字の有無、空行の連続）
+に関係なく読み取り、確実に対応付けられた行だけをローカルで整形します。
+対応付けられなかった行は理由とともに返し、Gemini APIでの変換に回します。
+"""
+
+import re
+import sys
+import time
+
+from diary_schema import DIARY_SECTIONS, PROMPT_SECTION_NAMES, normalize_body
+
+# 整形のルールを変えたら上げる（上げると、ローカルで整形済みの行が次回の実行で整形し直されます）
+NORMALIZER_VERSION = 1
+
+# 出力テンプレートのセクション名（順序は出力順）。diary_schema.render_markdown() と同じ見出しにする
+TEMPLATE_SECTIONS = [name for _, name in DIARY_SECTIONS]
+
+# 見出しの「 - 」より前の部分（各セクションの短い名前）。生成プロンプトと出力テンプレートの両方の呼び方を含む
+SECTION_SHORT_NAMES = [
+    {'導入'},
+    {'遭遇'},
+    {'捜査と観察', '捜査と違和感', '捜査'},
+    {'閃き'},
+    {'真相解明'},
+    {'結びと内省', '結び'},
+]
+
+# セクション名の正式名（生成プロンプトと出力テンプレートの両方）→ セクションの番号
+SECTION_ALIASES = {
+    name: index
+    for index, names in enumerate(zip(TEMPLATE_SECTIONS, PROMPT_SECTION_NAMES))
+    for name in names
+}
+
+# タイトルとして扱う、見出しではない行の最大文字数
+MAX_PLAIN_TITLE_LENGTH = 60
+
+_CODE_FENCE = re.compile(r'^\s*```[a-zA-Z]*\s*$')
+# 行頭の見出し記号・番号・太字を取り除いて見出しの文字列を取り出す
+_HEADING = re.compile(
+    r'^\s*(?P<hashes>#{1,6})?\s*(?P<number>[0-9０-９]+\s*[.．)）、]\s*)?(?P<text>.*?)\s*$'
+)
+_WHOLE_BOLD = re.compile(r'^\*\*(?P<text>[^*]+?)\*\*\s*[:：]?$')
+_SEPARATOR = re.compile(r'\s*[-－ー―—–:：]\s*')
+_DATE = re.compile(
+    r'^(?:\d{4}\s*[/年.\-]\s*\d{1,2}\s*[/月.\-]\s*\d{1,2}\s*日?|\d{1,2}\s*月\s*\d{1,2}\s*日)'
+)
+_HORIZONTAL_RULE = re.compile(r'^\s*(?:-{3,}|\*{3,}|_{3,})\s*$')
+
+# 整形できなかった理由
+REASON_EMPTY = '本文が空'
+REASON_NO_DATE = '日付の行が見つからない'
+REASON_NO_TITLE = 'タイトルの行が見つからない'
+REASON_EXTRA_PREAMBLE = '日付・タイトルの前後に余分な行がある'
+REASON_SECTIONS = 'セクションが6つ揃っていない'
+REASON_ORDER = 'セクションの順序が違う'
+REASON_EMPTY_SECTION = '本文が空のセクションがある'
+
+
+def match_section(label):
+    """
+    見出しの文字列がどのセクションに当たるかを返す
+
+    Args:
+        label: 見出し記号・番号・太字を取り除いた見出しの文字列
+
+    Returns:
+        int or None: セクションの番号（0〜5）。どれにも当たらなければNone
+    """
+    label = label.strip().strip('*').strip()
+    if label in SECTION_ALIASES:
+        return SECTION_ALIASES[label]
+    # 「導入 - ○○」のように、区切りより前の短い名前で判定する（後半の言い回しはゆれるため）
+    short_name = _SEPARATOR.split(label, maxsplit=1)[0].strip()
+    for index, names in enumerate(SECTION_SHORT_NAMES):
+        if short_name in names:
+            return index
+    return None
+
+
+def _parse_line(line):
+    """
+    1行を見出しとして読み取る
+
+    Returns:
+        tuple: (見出しかどうか, 見出し記号・番号・太字を取り除いた文字列)
+    """
+    match = _HEADING.match(line)
+    hashes, number, text = match.group('hashes'), match.group('number'), match.group('text')
+    bold = _WHOLE_BOLD.match(text)
+    if bold:
+        text = bold.group('text').strip()
+    # 見出し記号・番号・行全体の太字のいずれかがある行だけを見出しとみなす（本文中の「**蘭**は…」などは除く）
+    is_heading = bool(hashes or number or bold)
+    return is_heading, text.strip()
+
+
+def normalize_markdown(text):
+    """
+    日記のMarkdownを出力テンプレートの形式に整形する
+
+    Args:
+        text: 整形前のMarkdown
+
+    Returns:
+        tuple: (整形したMarkdown or None, 整形できなかった理由 or None)
+    """
+    # 全体を囲むコードブロックの行（閉じられていないものを含む）は読み飛ばす
+    lines = [
+        line for line in (text or '').lstrip('﻿').replace('\r\n', '\n').split('\n')
+        if not _CODE_FENCE.match(line)
+    ]
+    if not any(line.strip() for line in lines):
+        return None, REASON_EMPTY
+
+    preamble = []
+    sections = []  # (セクションの番号, 本文の行のリスト)
+    for line in lines:
+        is_heading, label = _parse_line(line)
+        index = match_section(label) if is_heading else None
+        if index is not None:
+            sections.append((index, []))
+        elif sections:
+            if not _HORIZONTAL_RULE.match(line):
+                sections[-1][1].append(line)
+        elif line.strip() and not _HORIZONTAL_RULE.match(line):
+            preamble.append(line)
+
+    # 最初のセクションより前は「日付」「タイトル」の2行だけのはず
+    if not preamble:
+        return None, REASON_NO_DATE
+    is_heading, date = _parse_line(preamble[0])
+    if not _DATE.match(date):
+        return None, REASON_NO_DATE
+    if len(preamble) < 2:
+        return None, REASON_NO_TITLE
+    if len(preamble) > 2:
+        return None, REASON_EXTRA_PREAMBLE
+    is_heading, title = _parse_line(preamble[1])
+    if not title or (not is_heading and len(title) > MAX_PLAIN_TITLE_LENGTH):
+        return None, REASON_NO_TITLE
+
+    if len(sections) != len(TEMPLATE_SECTIONS) or len({index for index, _ in sections}) != len(TEMPLATE_SECTIONS):
+        return None, REASON_SECTIONS
+    if [index for index, _ in sections] != list(range(len(TEMPLATE_SECTIONS))):
+        return None, REASON_ORDER
+
+    blocks = [f"## {date}", f"### {title}"]
+    for index, lines in sections:
+        body = normalize_body('\n'.join(lines))
+        if not body:
+            return None, REASON_EMPTY_SECTION
+        blocks.append(f"### **{TEMPLATE_SECTIONS[index]}**")
+        blocks.append(body)
+    return '\n\n'.join(blocks), None
+
+
+if __name__ == "__main__":
+    # 使い方: python markdown_normalizer.py <input.csv> [列名]
+    # CSVの各行をローカルで整形できるかを確かめ、件数と処理速度を表示します
+    import pandas as pd
+    from collections import Counter
+
+    if len(sys.argv) < 2:
+        print("使い方: python markdown_normalizer.py <input.csv> [列名]")
+        sys.exit(1)
+    column = sys.argv[2] if len(sys.argv) > 2 else '生成結果'
+    texts = pd.read_csv(sys.argv[1])[column].fillna('').astype(str).tolist()
+    started = time.perf_counter()
+    reasons = Counter(normalize_markdown(text)[1] for text in texts)
+    elapsed = time.perf_counter() - started
+    local = reasons.pop(None, 0)
+    print(f"ローカルで整形できる行: {local}/{len(texts)} 行 ({len(texts) / max(elapsed, 1e-9):.0f} 行/秒)")
+    for reason, count in reasons.most_common():
+        print(f"  {reason}: {count} 行")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ollamaの /api/chat 用クライアント
+接続をプールして使い回し、NDJSONのストリーミング応答を読みながら締め切り時間で打ち切れます
+"""
+
+import json
+import time
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llm_errors import MalformedResponseError
+
+
+class OllamaDeadlineExceeded(TimeoutError):
+    """生成が締め切り時間内に終わらなかった場合の例外"""
+
+
+class OllamaResponseError(MalformedResponseError):
+    """サーバーの応答が想定した形式でなかった場合の例外"""
+
+
+@dataclass
+class OllamaResult:
+    """1回のチャット呼び出しの結果とサーバー側の計測値"""
+    text: str
+    prompt_eval_count: int = 0
+    eval_count: int = 0
+    prompt_eval_duration: int = 0  # ナノ秒
+    eval_duration: int = 0  # ナノ秒
+    load_duration: int = 0  # ナノ秒
+    first_token_seconds: float = None
+
+    @property
+    def tokens_per_second(self):
+        """サーバーが計測した生成速度（トークン/秒）"""
+        if not self.eval_duration:
+            return 0.0
+        return self.eval_count / (self.eval_duration / 1e9)
+
+
+class OllamaClient:
+    """
+    接続プール付きのOllamaクライアント
+
+    スレッドから同時に呼び出せます。pool_size はサーバーの OLLAMA_NUM_PARALLEL に合わせてください。
+    """
+
+    def __init__(self, endpoint, model, pool_size=4, keep_alive='30m', connect_timeout=5, read_timeout=120):
+        self.endpoint = endpoint
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def base_url(self):
+        return self.endpoint.rsplit('/api/', 1)[0]
+
+    def check_connection(self):
+        """
+        サーバーが起動しているか確認する
+
+        Returns:
+            bool: 応答があればTrue
+        """
+        try:
+            response = self.session.get(self.base_url, timeout=3)
+        except requests.exceptions.RequestException:
+            return False
+        return response.ok
+
+    def chat(self, messages, deadline_seconds=None, options=None):
+        """
+        チャットAPIをストリーミングで呼び出し、生成されたテキストを返す
+
+        Args:
+            messages: チャット形式のメッセージのリスト
+            deadline_seconds: この秒数を過ぎても生成が終わらなければ打ち切る（Noneなら無制限）
+            options: Ollamaの生成オプション（temperatureなど）
+
+        Returns:
+            OllamaResult: 生成結果と計測値
+
+        Raises:
+            OllamaDeadlineExceeded: 締め切り時間を過ぎた場合
+            OllamaResponseError: 応答の形式が不正な場合
+            requests.exceptions.RequestException: 通信エラーの場合
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+        }
+        if options:
+            payload["options"] = options
+
+        started = time.monotonic()
+        first_token_seconds = None
+        parts = []
+        with self.session.post(self.endpoint, json=payload, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if deadline_seconds is not None and time.monotonic() - started > deadline_seconds:
+                    raise OllamaDeadlineExceeded(f"{deadline_seconds} 秒以内に生成が終わりませんでした")
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    raise OllamaResponseError(f"NDJSONの解析に失敗しました: {line[:100]!r}") from e
+                if 'error' in chunk:
+                    raise OllamaResponseError(chunk['error'])
+
+                content = chunk.get('message', {}).get('content', '')
+                if content:
+                    if first_token_seconds is None:
+                        first_token_seconds = time.monotonic() - started
+                    parts.append(content)
+
+                if chunk.get('done'):
+                    result = OllamaResult(
+                        text=''.join(parts),
+                        prompt_eval_count=chunk.get('prompt_eval_count', 0),
+                        eval_count=chunk.get('eval_count', 0),
+                        prompt_eval_duration=chunk.get('prompt_eval_duration', 0),
+                        eval_duration=chunk.get('eval_duration', 0),
+                        load_duration=chunk.get('load_duration', 0),
+                        first_token_seconds=first_token_seconds,
+                    )
+                    # 応答の終わり（chunked の終端）まで読み切ってから返す
+                    # （読み残したまま閉じると接続が切られ、プールで使い回せなくなる）
+                    for _ in response.iter_content(chunk_size=None):
+                        pass
+                    return result
+        raise OllamaResponseError("done を受け取る前に応答が終了しました")
+
+    def close(self):
+        self.session.close()
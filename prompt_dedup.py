@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロンプトの重複の集約とファンアウト
+同じエピソードが複数のパラレルワールドに出てくる場合など、題材が同じ行はAPIに1回だけ（または指定した数の
+バリエーションだけ）送信し、生成結果を該当するすべての行に記録します
+"""
+
+import hashlib
+import json
+import re
+import sys
+import unicodedata
+
+import pandas as pd
+
+from diary_prompt import build_prompt_data
+
+# 代表のJobの meta に入れる項目
+DUPLICATES_META = 'duplicates'  # 同じ結果を記録する他の行のキー
+VARIANT_META = 'variant'  # 同じ題材の何番目のバリエーションか（0から）
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(value):
+    """比較用に値を正規化する（全角・半角の統一、空白の連続を1つに、欠損値は空文字列）"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ''
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', str(value))).strip()
+
+
+def prompt_fingerprint(inputs):
+    """
+    プロンプトの材料から、重複を判定するためのハッシュ値を作る
+
+    Args:
+        inputs: プロンプト全文の文字列、または題材の辞書（build_prompt_data() の戻り値など）
+
+    Returns:
+        str: 正規化した内容が同じなら同じになるハッシュ値
+    """
+    if isinstance(inputs, dict):
+        material = json.dumps({key: normalize_text(value) for key, value in inputs.items()},
+                              ensure_ascii=False, sort_keys=True)
+    else:
+        material = normalize_text(inputs)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def episode_fingerprint(row_data):
+    """エピソードの行から、プロンプトに埋め込む題材だけで決まるハッシュ値を作る（IDやワールド名は含めない）"""
+    return prompt_fingerprint(build_prompt_data(row_data))
+
+
+class DedupPlan:
+    """重複の集約の結果（何行を何リクエストで処理するか）"""
+
+    def __init__(self, rows=0, requests=0, groups=0, largest_group=0):
+        self.rows = rows
+        self.requests = requests
+        self.groups = groups
+        self.largest_group = largest_group
+
+    def add(self, other):
+        """別の範囲を集約した結果を足し合わせる（ストリーミングで少しずつ集約する場合）"""
+        self.rows += other.rows
+        self.requests += other.requests
+        self.groups += other.groups
+        self.largest_group = max(self.largest_group, other.largest_group)
+
+    @property
+    def saved(self):
+        """集約によって送らずに済むリクエスト数"""
+        return self.rows - self.requests
+
+    def summary(self):
+        """集約の結果を1行の文字列にまとめる"""
+        if not self.saved:
+            return f"重複の集約: 同じ題材の行はありませんでした（{self.rows} 行 → {self.requests} リクエスト）"
+        return (
+            f"重複の集約: {self.rows} 行 → {self.requests} リクエスト "
+            f"({self.saved} リクエストを節約, 題材 {self.groups} 種類, 最大 {self.largest_group} 行で共有)"
+        )
+
+
+def plan_requests(jobs, fingerprint, variants=1):
+    """
+    題材が同じJobをまとめ、送信するJobだけを返す
+
+    同じ題材の行は、最大 variants 件の代表のJobに振り分けます（1なら1件にまとめる）。
+    代表のJobの meta には、同じ結果を記録する他の行のキー（DUPLICATES_META）と、
+    何番目のバリエーションか（VARIANT_META）が入ります。
+
+    Args:
+        jobs: Jobのリスト
+        fingerprint: Job -> 重複を判定するハッシュ値 の関数
+        variants: 同じ題材について生成するバリエーションの数
+
+    Returns:
+        tuple: (送信するJobのリスト（元の順序）, DedupPlan)
+    """
+    variants = max(1, variants)
+    groups = {}
+    for job in jobs:
+        groups.setdefault(fingerprint(job), []).append(job)
+
+    representatives = []
+    for members in groups.values():
+        count = min(variants, len(members))
+        for index, job in enumerate(members):
+            variant = index % count
+            if index < count:
+                job.meta[VARIANT_META] = variant
+                job.meta[DUPLICATES_META] = []
+                representatives.append(job)
+            else:
+                members[variant].meta[DUPLICATES_META].append(job.key)
+
+    # 各グループの先頭に出てきた順ではなく、入力の順に送信する
+    order = {id(job): index for index, job in enumerate(jobs)}
+    representatives.sort(key=lambda job: order[id(job)])
+    plan = DedupPlan(len(jobs), len(representatives), len(groups),
+                     max((len(members) for members in groups.values()), default=0))
+    return representatives, plan
+
+
+def iter_planned_requests(jobs, fingerprint, variants, batch_size, plan):
+    """
+    jobs を batch_size 件ずつ読み込んで集約し、送信するJobを1件ずつ返す（ストリーミング用）
+
+    同じ題材の行は、同じ範囲に読み込まれた場合にだけまとめられます。
+
+    Args:
+        jobs: Jobのイテラブル
+        fingerprint: Job -> 重複を判定するハッシュ値 の関数
+        variants: 同じ題材について生成するバリエーションの数
+        batch_size: 一度に集約する件数
+        plan: 集約の結果を足し合わせていく DedupPlan
+
+    Yields:
+        Job: 送信するJob
+    """
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= batch_size:
+            representatives, batch_plan = plan_requests(batch, fingerprint, variants)
+            plan.add(batch_plan)
+            yield from representatives
+            batch = []
+    if batch:
+        representatives, batch_plan = plan_requests(batch, fingerprint, variants)
+        plan.add(batch_plan)
+        yield from representatives
+
+
+def variant_config(generation_config, job):
+    """
+    2番目以降のバリエーションは、キャッシュのキーが最初のものと分かれるように生成設定に番号を加える
+
+    Args:
+        generation_config: キャッシュのキーに使う生成設定
+        job: plan_requests() が返したJob
+
+    Returns:
+        dict: キャッシュのキーに使う生成設定
+    """
+    variant = job.meta.get(VARIANT_META, 0)
+    return dict(generation_config or {}, variant=variant) if variant else generation_config
+
+
+def append_fanout(journal, job, **fields):
+    """
+    生成結果を代表の行と同じ題材のすべての行に記録する
+
+    同じ題材の他の行は、リクエストを送っていないので送信回数（attempts）を0として記録します。
+
+    Args:
+        journal: CheckpointJournal
+        job: 結果を得たJob
+        **fields: journal.append() に渡す項目
+    """
+    journal.append(job.key, **fields)
+    if 'attempts' in fields:
+        fields = dict(fields, attempts=0)
+    for key in job.meta.get(DUPLICATES_META, []):
+        journal.append(key, **fields)
+
+
+def append_failure_fanout(journal, job, error_message, **fields):
+    """失敗を代表の行と同じ題材のすべての行に記録する（次回の実行でまとめて再試行される）"""
+    journal.append_failure(job.key, error_message, **fields)
+    if 'attempts' in fields:
+        fields = dict(fields, attempts=0)
+    for key in job.meta.get(DUPLICATES_META, []):
+        journal.append_failure(key, error_message, **fields)
+
+
+if __name__ == "__main__":
+    # 使い方: python prompt_dedup.py <入力CSV> [バリエーション数]
+    if len(sys.argv) not in (2, 3):
+        print("使い方: python prompt_dedup.py <入力CSV> [バリエーション数]")
+        print("エピソードの列があれば題材で、'生成プロンプト' 列があればプロンプト全文で重複を数えます。")
+        sys.exit(1)
+    from checkpoint_journal import row_keys
+    from llm_executor import Job
+    from results_store import read_table
+
+    df = read_table(sys.argv[1])
+    if '生成プロンプト' in df.columns:
+        fingerprints = [prompt_fingerprint(prompt) for prompt in df['生成プロンプト']]
+    else:
+        fingerprints = [episode_fingerprint(row) for row in df.to_dict('records')]
+    jobs = [Job(key=key, prompt='', meta={'fingerprint': fingerprint})
+            for key, fingerprint in zip(row_keys(df), fingerprints)]
+    representatives, plan = plan_requests(jobs, lambda job: job.meta['fingerprint'],
+                                          int(sys.argv[2]) if len(sys.argv) == 3 else 1)
+    print(plan.summary())
+    shared = [job for job in representatives if job.meta[DUPLICATES_META]]
+    for job in shared[:20]:
+        print(f"  {job.key}: {', '.join(job.meta[DUPLICATES_META])} にも同じ結果を記録")
+    if len(shared) > 20:
+        print(f"  ほか {len(shared) - 20} 件")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロンプトの固定部分（ペルソナや構成の指示）をキャッシュして再利用するためのモジュール
+Geminiではコンテキストキャッシュを、使えない場合やOllamaでは共通のシステムメッセージを使います
+"""
+
+import datetime
+import os
+import statistics
+
+
+def split_common_prefix(prompts, min_chars=200):
+    """
+    全プロンプトに共通する先頭部分を行単位で切り出す
+
+    Args:
+        prompts: プロンプトのリスト
+        min_chars: 共通部分がこれより短い場合は分割しません
+
+    Returns:
+        tuple: (共通の先頭部分, 各プロンプトの残りの部分のリスト)
+    """
+    prompts = list(prompts)
+    if len(prompts) < 2:
+        return '', prompts
+    prefix = os.path.commonprefix(prompts)
+    # 行の途中で切らないように、最後の改行までを共通部分とする
+    prefix = prefix[:prefix.rfind('\n') + 1]
+    if len(prefix) < min_chars:
+        return '', prompts
+    return prefix, [prompt[len(prefix):] for prompt in prompts]
+
+
+def create_cached_gemini_model(genai, model_name, system_instruction, generation_config=None, ttl_minutes=60):
+    """
+    固定の指示をGeminiのコンテキストキャッシュに登録し、それを参照するモデルを作成する
+
+    キャッシュを作成できない場合（最小トークン数に満たない、未対応のモデルなど）は、
+    同じ指示を system_instruction として渡したモデルを返します。
+
+    Args:
+        genai: google.generativeai モジュール
+        model_name: モデル名
+        system_instruction: キャッシュする固定の指示
+        generation_config: 生成設定
+        ttl_minutes: キャッシュの有効期間（分）
+
+    Returns:
+        tuple: (GenerativeModel, CachedContent または None)
+    """
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=model_name if model_name.startswith('models/') else f'models/{model_name}',
+            display_name='diary-instructions',
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(minutes=ttl_minutes),
+        )
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content=cached_content, generation_config=generation_config
+        )
+        print(f"固定の指示をコンテキストキャッシュに登録しました: {cached_content.name}")
+        return model, cached_content
+    except Exception as e:
+        print(f"コンテキストキャッシュを作成できませんでした（system_instructionで代用します）: {e}")
+        model = genai.GenerativeModel(
+            model_name, system_instruction=system_instruction, generation_config=generation_config
+        )
+        return model, None
+
+
+class PrefixCacheStats:
+    """
+    行ごとの評価済み入力トークン数・キャッシュから再利用したトークン数・最初のトークンまでの時間を集計する
+    """
+
+    def __init__(self):
+        self.evaluated_tokens = []
+        self.cached_tokens = []
+        self.first_token_seconds = []
+
+    def record(self, evaluated_tokens, cached_tokens=None, first_token_seconds=None):
+        """
+        1リクエスト分の計測値を記録する
+
+        Args:
+            evaluated_tokens: 今回新たに評価された入力トークン数（キャッシュ分を除く）
+            cached_tokens: キャッシュから再利用された入力トークン数（不明ならNone）
+            first_token_seconds: 送信から最初のトークンを受け取るまでの秒数
+        """
+        self.evaluated_tokens.append(evaluated_tokens or 0)
+        if cached_tokens is not None:
+            self.cached_tokens.append(cached_tokens)
+        if first_token_seconds is not None:
+            self.first_token_seconds.append(first_token_seconds)
+
+    def summary(self):
+        """集計結果を1行の文字列にまとめる"""
+        if not self.evaluated_tokens:
+            return "プレフィックスキャッシュ: 計測データなし"
+        count = len(self.evaluated_tokens)
+        evaluated = sum(self.evaluated_tokens)
+        line = f"プレフィックスキャッシュ: 1行あたり評価した入力 {evaluated / count:.0f} トークン"
+        if self.cached_tokens:
+            cached = sum(self.cached_tokens)
+            line += (
+                f", キャッシュから再利用 {cached / len(self.cached_tokens):.0f} トークン "
+                f"(入力全体の {cached / (evaluated + cached) if evaluated + cached else 0:.1%})"
+            )
+        if self.first_token_seconds:
+            line += f", 最初のトークンまで 中央値 {statistics.median(self.first_token_seconds):.2f} 秒"
+        return line
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+実行前の見積もりと、1日の使用量の記録
+送信するプロンプトのトークン数をローカルで数えてリクエスト数・トークン数・所要時間を見積もり、
+実行中はモデルごとの1日の使用量をファイルに記録して、1日の上限に達したらリセットされるまで待ってから再開します
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from llm_executor import estimate_tokens
+from llm_telemetry import load_records
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_USAGE_PATH = os.path.join(project_root, '.llm_cache', 'usage.json')
+QUOTA_TIMEZONE = 'America/Los_Angeles'  # Gemini APIの1日の上限は太平洋時間の0時にリセットされる
+CALIBRATION_SAMPLES = 10  # count_tokens で実際のトークン数を数えるプロンプトの件数
+CALIBRATION_POOL = 200  # そのプロンプトを選ぶ範囲（先頭からの件数。ストリーミングでも全件を読み込まずに済むように）
+DEFAULT_OUTPUT_TOKENS = 1500  # メトリクスがない場合に見込む、1リクエストあたりの出力トークン数
+SAVE_INTERVAL_SECONDS = 5  # 使用量をファイルに書き出す間隔
+MAX_SLEEP_SECONDS = 60  # 上限のリセットを待つ間、日付が変わったかを確かめる間隔
+API_KEY_ID_LENGTH = 12  # 使用量の記録でAPIキーを区別するハッシュの桁数
+
+
+def default_usage_path():
+    """使用量を保存するファイルのパス（LLM_USAGE_PATH 環境変数、なければ .llm_cache/usage.json）"""
+    return os.environ.get('LLM_USAGE_PATH', DEFAULT_USAGE_PATH)
+
+
+def api_key_id(api_key):
+    """APIキーを使用量ファイルに書いてもよい短いハッシュにする（キーそのものは保存しない）"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:API_KEY_ID_LENGTH]
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """path のロックファイルを使って、同じファイルを書き換えるほかのプロセスと排他する"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _quota_zone():
+    try:
+        return ZoneInfo(QUOTA_TIMEZONE)
+    except ZoneInfoNotFoundError:
+        # タイムゾーンのデータがない環境（tzdata のないWindowsなど）ではローカル時刻で区切る
+        return None
+
+
+def quota_day(now=None):
+    """1日の上限を数える日付（太平洋時間）を 'YYYY-MM-DD' で返す"""
+    return datetime.fromtimestamp(time.time() if now is None else now, _quota_zone()).date().isoformat()
+
+
+def next_reset(now=None):
+    """次に1日の上限がリセットされる時刻（UNIX時刻）を返す"""
+    current = datetime.fromtimestamp(time.time() if now is None else now, _quota_zone())
+    midnight = datetime.combine(current.date() + timedelta(days=1), datetime.min.time(), tzinfo=current.tzinfo)
+    return midnight.timestamp()
+
+
+class TokenCounter:
+    """
+    estimate_tokens() の概算を、APIで数えた実際のトークン数との比で補正するローカルのトークン数計算
+
+    全件をAPIで数えるとそれだけでリクエストを使うため、数件だけを count_tokens で数えて比を求め、
+    残りはローカルの概算にその比を掛けて数えます。
+    """
+
+    def __init__(self, ratio=1.0):
+        self.ratio = ratio
+
+    def count(self, text):
+        """テキストのトークン数を数える"""
+        return math.ceil(estimate_tokens(text) * self.ratio)
+
+    @classmethod
+    def calibrate(cls, prompts, count_tokens, samples=CALIBRATION_SAMPLES):
+        """
+        prompts から均等に選んだ数件を count_tokens で数え、概算との比を求める
+
+        Args:
+            prompts: プロンプトのリスト
+            count_tokens: プロンプト -> 実際のトークン数 の関数（model.count_tokens を使うものなど）
+            samples: APIで数えるプロンプトの件数
+
+        Returns:
+            TokenCounter: 求めた比で補正するカウンター
+        """
+        if not prompts:
+            return cls()
+        sample = prompts[::max(1, len(prompts) // samples)][:samples]
+        estimated = sum(estimate_tokens(prompt) for prompt in sample)
+        actual = sum(count_tokens(prompt) for prompt in sample)
+        return cls(actual / estimated if estimated and actual else 1.0)
+
+
+class DailyUsage:
+    """
+    モデルごとの1日のリクエスト数・トークン数のカウンター
+
+    使用量はファイルに保存するので、スクリプトを再起動しても同じ日の分は引き継がれます。
+    1日の上限はAPIキーごとなので、api_key を渡すとモデルとキーのハッシュの組で数え、
+    同じキーを使う別のプロセス（シャード）とは同じ記録を共有します。
+    requests_per_day に達するか、サーバーから1日の上限による429が返って exhaust() が呼ばれると、
+    acquire() は次のリセット時刻まで待ち、日付が変わったら使用量を0に戻して再開します。
+    複数のワーカーで送る場合は、wait_for_room() で空きを待ち、送信する直前に try_acquire() で数えます
+    （待っているだけのワーカーの分は数えません）。
+    """
+
+    def __init__(self, model, requests_per_day=None, path=None, api_key=None):
+        """
+        Args:
+            model: モデル名（使用量はモデルごとに数える）
+            requests_per_day: 1日のリクエスト数の上限（Noneなら数えるだけで止めない）
+            path: 使用量を保存するJSONファイル（省略時は default_usage_path()）
+            api_key: 使用しているAPIキー（省略時はモデルだけで数える）
+        """
+        self.model = model
+        self.entry_name = model if api_key is None else f"{model}#{api_key_id(api_key)}"
+        self.requests_per_day = requests_per_day
+        self.path = path or default_usage_path()
+        self.day = quota_day()
+        self.requests = 0
+        self.tokens = 0
+        self.exhausted = False
+        self._waiting = False
+        self._unsaved_requests = 0
+        self._unsaved_tokens = 0
+        self._saved_at = time.monotonic()
+
+        entry = self._read_state().get(self.entry_name, {})
+        self.token_ratio = entry.get('token_ratio')
+        if entry.get('day') == self.day:
+            self.requests = entry.get('requests', 0)
+            self.tokens = entry.get('tokens', 0)
+            self.exhausted = entry.get('exhausted', False)
+
+    def _read_state(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def remaining_requests(self):
+        """今日あと何リクエスト送れるか（上限がなければNone）"""
+        if self.requests_per_day is None:
+            return None
+        return 0 if self.exhausted else max(0, self.requests_per_day - self.requests)
+
+    def _roll_over(self):
+        # 日付が変わっていたら使用量を0に戻す
+        today = quota_day()
+        if today == self.day:
+            return
+        if self._waiting:
+            print(f"\n{self.model} の1日の上限がリセットされたため、送信を再開します。")
+        self.day = today
+        self.requests = 0
+        self.tokens = 0
+        self.exhausted = False
+        self._waiting = False
+        # 保存していない昨日の分は、今日の使用量に足さずに捨てる
+        # （先に書き出すと、すでに今日に切り替えた別のプロセスの記録を昨日の分で上書きしてしまう）
+        self._unsaved_requests = 0
+        self._unsaved_tokens = 0
+        self.save()
+
+    def _has_room(self):
+        return not self.exhausted and (self.requests_per_day is None or self.requests < self.requests_per_day)
+
+    async def wait_for_room(self):
+        """今日の上限に空きができるまで待つ（使用量は数えない）"""
+        while True:
+            self._roll_over()
+            if self._has_room():
+                return
+            self.exhaust()
+            if not self._waiting:
+                self._waiting = True
+                reset_at = datetime.fromtimestamp(next_reset()).strftime('%m/%d %H:%M')
+                print(f"\n{self.model} の1日の上限に達しました（本日 {self.requests} リクエスト）。"
+                      f"上限がリセットされる {reset_at} まで待機します（中断しても、次回は続きから再開します）。")
+            await asyncio.sleep(max(1.0, min(MAX_SLEEP_SECONDS, next_reset() - time.time())))
+
+    def try_acquire(self):
+        """
+        リクエストを送信する直前に呼び出し、今日の上限に空きがあれば1リクエスト分を数える
+
+        Returns:
+            bool: 数えた場合はTrue。空きがなければ数えずにFalse（wait_for_room() で待ってからやり直す）
+        """
+        self._roll_over()
+        if not self._has_room():
+            return False
+        self.requests += 1
+        self._unsaved_requests += 1
+        self._save_if_due()
+        return True
+
+    async def acquire(self):
+        """今日の上限に空きがあれば1リクエスト分を数え、なければ次のリセット時刻まで待つ"""
+        while not self.try_acquire():
+            await self.wait_for_room()
+
+    def record_tokens(self, tokens):
+        """レスポンスで判明したトークン数を今日の使用量に加える"""
+        self.tokens += tokens
+        self._unsaved_tokens += tokens
+        self._save_if_due()
+
+    def exhaust(self):
+        """今日の上限を使い切ったものとして、次のリセット時刻まで送信を止める"""
+        if not self.exhausted:
+            self.exhausted = True
+            self.save()
+
+    def _save_if_due(self):
+        if time.monotonic() - self._saved_at >= SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def save(self):
+        """
+        使用量をファイルに書き出す
+
+        ファイルを読み直して前回の保存からの増分だけを足し、一時ファイル経由で置き換えます。
+        読み直してから置き換えるまでの間に別のプロセスが書くと、その増分が失われるので、
+        その間はロックファイル（<path>.lock）で同じファイルを使うほかのプロセスと排他します。
+        """
+        with _file_lock(f"{self.path}.lock"):
+            state = self._read_state()
+            entry = state.get(self.entry_name, {})
+            if entry.get('day') != self.day:
+                entry = {'day': self.day, 'requests': 0, 'tokens': 0, 'exhausted': False}
+            entry['requests'] = entry.get('requests', 0) + self._unsaved_requests
+            entry['tokens'] = entry.get('tokens', 0) + self._unsaved_tokens
+            entry['exhausted'] = entry.get('exhausted', False) or self.exhausted
+            if self.token_ratio is not None:
+                entry['token_ratio'] = self.token_ratio
+            state[self.entry_name] = entry
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        # 他のプロセスの分も含めた今日の使用量に合わせる
+        self.requests, self.tokens, self.exhausted = entry['requests'], entry['tokens'], entry['exhausted']
+        self._unsaved_requests = 0
+        self._unsaved_tokens = 0
+        self._saved_at = time.monotonic()
+
+    def close(self):
+        """未保存の使用量を書き出す"""
+        if self._unsaved_requests or self._unsaved_tokens:
+            self.save()
+
+    def summary(self):
+        """今日の使用量を1行の文字列にまとめる"""
+        limit = f" / 上限 {self.requests_per_day}" if self.requests_per_day else ""
+        return f"{self.model} の本日の使用量: {self.requests}{limit} リクエスト, {self.tokens} トークン"
+
+
+def load_token_counter(usage, prompts, count_tokens):
+    """
+    保存済みの比があればそれを使い、なければ prompts の数件をAPIで数えて比を求めて保存する
+
+    Args:
+        usage: DailyUsage（比はモデルごとに保存する）
+        prompts: 送信するプロンプトのリスト
+        count_tokens: プロンプト -> 実際のトークン数 の関数
+
+    Returns:
+        TokenCounter
+    """
+    if usage.token_ratio is not None:
+        return TokenCounter(usage.token_ratio)
+    if not prompts:
+        return TokenCounter()
+    try:
+        counter = TokenCounter.calibrate(prompts, count_tokens)
+    except Exception as e:
+        print(f"count_tokens でトークン数を数えられなかったため、補正せずに概算します: {e}")
+        return TokenCounter()
+    usage.token_ratio = counter.ratio
+    usage.save()
+    return counter
+
+
+def count_job_tokens(jobs, usage, count_tokens):
+    """
+    Jobのプロンプトのトークン数を、補正したローカルの概算でまとめて数える
+
+    数えたトークン数は各Jobの estimated_tokens（TPMの枠の見込み）にも入れます。
+
+    Args:
+        jobs: Jobのイテラブル（ジェネレーターなら先頭の CALIBRATION_POOL 件だけを補正に使う）
+        usage: DailyUsage（補正の比をモデルごとに保存する）
+        count_tokens: プロンプト -> 実際のトークン数 の関数（Noneなら補正しない）
+
+    Returns:
+        list: Jobごとのトークン数
+    """
+    jobs = iter(jobs)
+    head = list(itertools.islice(jobs, CALIBRATION_POOL))
+    if count_tokens is None:
+        counter = TokenCounter()
+    else:
+        counter = load_token_counter(usage, [job.prompt for job in head], count_tokens)
+    prompt_tokens = []
+    for job in itertools.chain(head, jobs):
+        job.estimated_tokens = counter.count(job.prompt)
+        prompt_tokens.append(job.estimated_tokens)
+    return prompt_tokens
+
+
+def metrics_history(metrics_path, model=None):
+    """
+    メトリクスファイルから、成功した呼び出しの平均出力トークン数と平均レイテンシを求める
+
+    Args:
+        metrics_path: メトリクスファイル（JSONL）のパス
+        model: 指定するとそのモデルの記録だけを使う
+
+    Returns:
+        tuple: (平均出力トークン数, 平均レイテンシ秒)。記録がなければそれぞれNone
+    """
+    if not metrics_path or not os.path.exists(metrics_path):
+        return None, None
+    records = [r for r in load_records(metrics_path)
+               if r.get('status') == 'ok' and (model is None or r.get('model') == model)]
+    if not records:
+        return None, None
+    output_tokens = [r['output_tokens'] for r in records if r.get('output_tokens')]
+    latencies = [r['latency'] for r in records if r.get('latency')]
+    return (sum(output_tokens) / len(output_tokens) if output_tokens else None,
+            sum(latencies) / len(latencies) if latencies else None)
+
+
+@dataclass
+class RunPlan:
+    """1つのバックエンドで送信する分の見積もり"""
+    backend: str
+    requests: int
+    input_tokens: int
+    output_tokens: int
+    seconds: float = None  # 終わるまでの見込み（見積もれない場合はNone）
+    days: int = 1  # 1日の上限のために何日にまたがるか
+    remaining_today: int = None  # 今日あと何リクエスト送れるか（上限がなければNone）
+
+
+def plan_run(backend, prompt_tokens, output_tokens=None, requests_per_minute=None, tokens_per_minute=None,
+             max_in_flight=1, latency=None, usage=None, now=None):
+    """
+    送信するプロンプトのトークン数から、リクエスト数・トークン数・所要時間を見積もる
+
+    所要時間は、RPM・TPM・（過去のレイテンシが分かれば）同時実行数のうち最も厳しい制約で決まるとして計算し、
+    1日の上限を超える分はリセットを待つ時間を加えます。
+
+    Args:
+        backend: 表示するバックエンド名
+        prompt_tokens: リクエストごとの入力トークン数のリスト
+        output_tokens: 1リクエストあたりの出力トークン数の見込み（Noneなら DEFAULT_OUTPUT_TOKENS）
+        requests_per_minute: RPM（Noneなら制限なし）
+        tokens_per_minute: TPM（Noneなら制限なし）
+        max_in_flight: 同時に送信中にしておくリクエスト数
+        latency: 1リクエストあたりの平均レイテンシ秒（分からなければNone）
+        usage: DailyUsage（1日の上限と今日の使用量）
+        now: 現在時刻（テスト用）
+
+    Returns:
+        RunPlan
+    """
+    now = time.time() if now is None else now
+    requests = len(prompt_tokens)
+    input_tokens = sum(prompt_tokens)
+    output_total = requests * round(output_tokens if output_tokens is not None else DEFAULT_OUTPUT_TOKENS)
+
+    bounds = []
+    if requests_per_minute:
+        bounds.append(requests / requests_per_minute * 60)
+    if tokens_per_minute:
+        bounds.append((input_tokens + output_total) / tokens_per_minute * 60)
+    if latency:
+        bounds.append(requests * latency / max(1, max_in_flight))
+    seconds = max(bounds) if bounds else None
+
+    plan = RunPlan(backend, requests, input_tokens, output_total, seconds)
+    if usage is None or usage.requests_per_day is None:
+        return plan
+    plan.remaining_today = usage.remaining_requests
+    overflow = requests - plan.remaining_today
+    if overflow > 0:
+        plan.days = 1 + math.ceil(overflow / usage.requests_per_day)
+        if seconds is not None:
+            per_request = seconds / requests
+            # 今日の残りを送り切り、リセットを待ってから、上限いっぱいの日を挟んで残りを送る
+            today = max(plan.remaining_today * per_request, next_reset(now) - now)
+            last_day = overflow - (plan.days - 2) * usage.requests_per_day
+            plan.seconds = today + (plan.days - 2) * 86400 + last_day * per_request
+    return plan
+
+
+def format_duration(seconds):
+    """秒数を「約 1時間23分」のような文字列にする"""
+    if seconds is None:
+        return "不明"
+    minutes = math.ceil(seconds / 60)
+    if minutes < 60:
+        return f"約 {minutes}分"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"約 {hours}時間{minutes}分"
+    days, hours = divmod(hours, 24)
+    return f"約 {days}日{hours}時間"
+
+
+def format_plans(plans):
+    """見積もりを表形式の文字列にする"""
+    header = f"{'バックエンド':<12}{'リクエスト':>10}{'入力トークン':>14}{'出力トークン':>14}{'本日の残り':>12}{'所要時間':>16}"
+    lines = ["実行前の見積もり:", header, '-' * 88]
+    for plan in plans:
+        remaining = '-' if plan.remaining_today is None else str(plan.remaining_today)
+        duration = format_duration(plan.seconds) + (f"（{plan.days}日）" if plan.days > 1 else "")
+        lines.append(
+            f"{plan.backend:<18}{plan.requests:>14}{plan.input_tokens:>18}{plan.output_tokens:>18}"
+            f"{remaining:>17}{duration:>16}"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    # 使い方: python quota_planner.py [使用量ファイル]
+    path = sys.argv[1] if len(sys.argv) > 1 else default_usage_path()
+    if not os.path.exists(path):
+        print(f"使用量ファイル '{path}' はまだありません。")
+        sys.exit(0)
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    today = quota_day()
+    print(f"本日（{QUOTA_TIMEZONE} の {today}）の使用量:")
+    for model, entry in sorted(state.items()):
+        if entry.get('day') == today:
+            status = "（上限に到達）" if entry.get('exhausted') else ""
+            print(f"  {model}: {entry.get('requests', 0)} リクエスト, {entry.get('tokens', 0)} トークン{status}")
+        else:
+            print(f"  {model}: 0 リクエスト（最後の記録は {entry.get('day')}）")
+        if entry.get('token_ratio') is not None:
+            print(f"    トークン数の補正比: {entry['token_ratio']:.3f}")
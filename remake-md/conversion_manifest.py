@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+行ごとの変換マニフェスト（入力ハッシュ・出力ハッシュ・モデル）
+ジャーナルの各レコードにこれらを記録しておき、元のテキストか変換設定が変わった行だけを再変換します
+"""
+
+import hashlib
+import json
+import os
+
+from checkpoint_journal import STATUS_COLUMN, STATUS_FAILED
+from markdown_normalizer import NORMALIZER_VERSION, TEMPLATE_SECTIONS
+
+# ジャーナルのレコードに追加するマニフェストの項目
+INPUT_HASH_FIELD = 'input_hash'
+OUTPUT_HASH_FIELD = 'output_hash'
+MODEL_FIELD = 'model'
+SETTINGS_FIELD = 'settings'
+
+# Gemini APIを使わずに変換した行のモデル名
+LOCAL_MODEL = 'local'
+
+
+def content_hash(text):
+    """テキストのSHA-256ハッシュ値を返す（空・欠損値は空文字列として扱う）"""
+    if not isinstance(text, str):
+        text = ''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def settings_hash(*parts):
+    """変換設定（モデル名やプロンプトのテンプレートなど）をまとめたハッシュ値を返す"""
+    material = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()[:16]
+
+
+def local_settings():
+    """ルールベースの整形の設定を表すハッシュ値"""
+    return settings_hash(LOCAL_MODEL, NORMALIZER_VERSION, TEMPLATE_SECTIONS)
+
+
+def manifest_fields(input_text, output_text, model, settings):
+    """
+    ジャーナルのレコードに追加するマニフェストの項目を作る
+
+    Args:
+        input_text: 変換前のテキスト
+        output_text: 変換後のテキスト
+        model: 変換に使ったモデル名（ローカルで整形した場合は LOCAL_MODEL）
+        settings: 変換設定のハッシュ値
+
+    Returns:
+        dict: journal.append() にそのまま渡せる辞書
+    """
+    return {
+        INPUT_HASH_FIELD: content_hash(input_text),
+        OUTPUT_HASH_FIELD: content_hash(output_text),
+        MODEL_FIELD: model,
+        SETTINGS_FIELD: settings,
+    }
+
+
+def is_up_to_date(record, input_text, output_column, current_settings):
+    """
+    前回の変換結果をそのまま使えるかを判定する
+
+    Args:
+        record: ジャーナルの最新のレコード（なければNone）
+        input_text: 今回の変換前のテキスト
+        output_column: 変換結果が入っている列名
+        current_settings: モデル名 -> 今回の変換設定のハッシュ値
+
+    Returns:
+        bool: 入力・変換設定が前回と同じで、結果が壊れていなければTrue
+    """
+    if record is None or record.get(STATUS_COLUMN) == STATUS_FAILED:
+        return False
+    if record.get(INPUT_HASH_FIELD) != content_hash(input_text):
+        return False
+    if record.get(SETTINGS_FIELD) != current_settings.get(record.get(MODEL_FIELD)):
+        return False
+    return record.get(OUTPUT_HASH_FIELD) == content_hash(record.get(output_column, ''))
+
+
+def write_manifest(records, path):
+    """
+    ジャーナルのレコードから、行ごとのマニフェストをJSONファイルに書き出す（一時ファイル経由）
+
+    Args:
+        records: CheckpointJournal.load() の戻り値
+        path: 出力先のJSONファイル
+
+    Returns:
+        dict: ID -> {input_hash, output_hash, model}
+    """
+    manifest = {
+        key: {field: record.get(field) for field in (INPUT_HASH_FIELD, OUTPUT_HASH_FIELD, MODEL_FIELD)}
+        for key, record in records.items()
+        if record.get(STATUS_COLUMN) != STATUS_FAILED and INPUT_HASH_FIELD in record
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return manifest
@@ -1,30 +1,54 @@
+import argparse
 import pandas as pd
 import re
 import google.generativeai as genai
 import os
+import sys
+from collections import Counter
 from datetime import datetime
 
-def get_gemini_model():
-    """
-    現在のディレクトリに応じて適切なGeminiモデルを選択
-    """
-    current_dir = os.getcwd()
-    
-    # ディレクトリ名に基づいてモデルを選択
-    if "pro" in current_dir.lower():
-        model_name = "gemini-1.5-pro"
-        print(f"📁 プロディレクトリを検出: {model_name} を使用します")
-    elif "flash" in current_dir.lower():
-        model_name = "gemini-1.5-flash"
-        print(f"📁 フラッシュディレクトリを検出: {model_name} を使用します")
-    else:
-        # デフォルトは gemini-2.5-flash-lite
-        model_name = "gemini-2.5-flash-lite"
-        print(f"📁 デフォルトディレクトリ: {model_name} を使用します")
-    
-    return model_name
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+from checkpoint_journal import CheckpointJournal, row_keys, write_results
+from llm_errors import RetryPolicy, describe_error, response_text
+from llm_executor import Job, RateLimiter, StopJobs, run_jobs
+from backend_router import create_backend, route_ladder
+from llm_telemetry import Telemetry
+from response_cache import ResponseCache, make_cache_key
+from markdown_normalizer import normalize_markdown
+from results_store import read_table
+from conversion_manifest import LOCAL_MODEL, is_up_to_date, local_settings, manifest_fields, settings_hash, write_manifest
+
+# --- 設定項目 ---
+DEFAULT_INPUT_FILE = "input_data.csv"
+DEFAULT_OUTPUT_FILE = "output.csv"
+METRICS_FILE = "metrics.jsonl"  # API呼び出しごとの計測値を追記するファイル
+REQUESTS_PER_MINUTE = 15  # 1分あたりのリクエスト数の上限
+TOKENS_PER_MINUTE = 250000  # 1分あたりのトークン数の上限
+MAX_CONCURRENT_REQUESTS = 5  # 同時に送信中にしておくリクエスト数の上限
+MAX_ATTEMPTS = 5  # 429や5xxなど再試行できるエラーの場合に、1行あたり送信する最大回数
+PROGRESS_EVERY = 10  # 何行ごとに進捗を表示するか
+
+DEFAULT_MODEL = "gemini-2.5-flash-lite"  # --model を省略した場合に使うGeminiモデル
 
-def setup_gemini_api():
+# 段階実行（--ladder）で使うモデル。各行をまず先頭のモデルで変換し、出力が6セクションのテンプレートとして
+# 読み取れなかった行だけを次のモデルに回します。ローカルのOllamaを先頭に置くこともできます
+# （例: {'name': 'local', 'type': 'ollama', 'model': 'gpt-oss:20b', 'endpoint': 'http://localhost:11434/api/chat'}）
+LADDER = [
+    {'name': 'flash-lite', 'type': 'gemini', 'model': 'gemini-2.5-flash-lite',
+     'requests_per_minute': 15, 'tokens_per_minute': 250000, 'max_in_flight': 5},
+    {'name': 'flash', 'type': 'gemini', 'model': 'gemini-2.5-flash',
+     'requests_per_minute': 10, 'tokens_per_minute': 250000, 'max_in_flight': 5},
+    {'name': 'pro', 'type': 'gemini', 'model': 'gemini-2.5-pro',
+     'requests_per_minute': 5, 'tokens_per_minute': 250000, 'max_in_flight': 3},
+]
+
+# エラーが発生した行の扱い
+ON_ERROR_SKIP = 'skip'  # スキップして続行
+ON_ERROR_STOP = 'stop'  # 処理を停止
+
+def setup_gemini_api(model_name=DEFAULT_MODEL):
     """
     Gemini APIの設定
     """
@@ -39,8 +63,6 @@ def setup_gemini_api():
         # Gemini APIの設定
         genai.configure(api_key=api_key)
         
-        # 適切なモデルを選択
-        model_name = get_gemini_model()
         model = genai.GenerativeModel(model_name)
         
         print(f"✅ Gemini API設定完了: {model_name}")
@@ -49,15 +71,11 @@ def setup_gemini_api():
         print(f"Gemini APIの設定でエラーが発生しました: {e}")
         return None
 
-def convert_to_markdown_with_gemini(text, model):
+def build_conversion_prompt(text):
     """
-    Gemini APIを使用してmarkdown形式を変換する
+    Markdownを出力テンプレートに整形させるプロンプトを作成する
     """
-    if pd.isna(text) or text == '':
-        return ""
-    
-    # プロンプトの作成
-    prompt = f"""あなたは、与えられたMarkdownテキストを、指定された厳格なルールに従って再フォーマットするタスクを実行します。創造的な文章の生成や内容の変更は一切行わず、形式の変換のみに集中してください。
+    return f"""あなたは、与えられたMarkdownテキストを、指定された厳格なルールに従って再フォーマットするタスクを実行します。創造的な文章の生成や内容の変更は一切行わず、形式の変換のみに集中してください。
 
 目的
 以下の入力テキストに含まれる表記のゆれ（例: ## と ### の混在、不要な番号付け 1. など）を修正し、厳格に定義された出力テンプレートに完全に一致するように整形する。
@@ -112,45 +130,77 @@ def convert_to_markdown_with_gemini(text, model):
 実行指示
 上記のルールに従い、入力テキストを整形した結果のみを出力してください。説明や前置きは不要です。"""
 
-    try:
-        # Gemini APIにリクエストを送信
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        # エラーが発生した場合は、エラーを表示して処理を停止
-        error_msg = f"Gemini APIでの変換でエラーが発生しました: {e}"
-        print(f"❌ {error_msg}")
-        print(f"対象テキスト: {text[:100]}...")  # 最初の100文字を表示
-        raise Exception(error_msg)  # エラーを再発生させて処理を停止
+def ask_error_policy():
+    """
+    エラーが発生した行の扱いを対話的に選択する（標準入力が端末でない場合はスキップして続行）
+    """
+    if not sys.stdin.isatty():
+        print("エラー処理: 対話的に選択できないため、エラーが発生した行をスキップして続行します。")
+        return ON_ERROR_SKIP
+    print("\nエラー処理の選択:")
+    print("1. エラーが発生した行をスキップして処理を続行")
+    print("2. エラーが発生したら処理を停止")
+    choice = input("選択してください (1 または 2): ").strip()
+    return ON_ERROR_SKIP if choice == "1" else ON_ERROR_STOP
+
+def find_target_column(df, column=None):
+    """
+    変換対象の列を決める（指定がなければ生成結果列を自動検出）
+    """
+    if column is not None:
+        return column if column in df.columns else None
+    # 生成結果列を探す（複数の可能性をチェック）
+    possible_columns = ['生成結果', '事件の概要', '概要', '内容']
+    for col in possible_columns:
+        if col in df.columns:
+            return col
+    return None
 
-def process_csv(input_file, output_file):
+def validate_conversion(job, converted_text):
+    """
+    変換結果が出力テンプレートとして読み取れるかをローカルで確認し、正規の形式に整えて返す
+    """
+    return normalize_markdown(converted_text)
+
+def process_csv(input_file, output_file, on_error=None, model_name=DEFAULT_MODEL, column=None, journal_file=None,
+                max_in_flight=MAX_CONCURRENT_REQUESTS, requests_per_minute=REQUESTS_PER_MINUTE,
+                tokens_per_minute=TOKENS_PER_MINUTE, ladder=False):
     """
     CSVファイルを読み込み、生成結果列をmarkdown形式に変換して新しいCSVファイルを作成
+
+    変換済みの行はジャーナルに1行ずつ記録し、中断後に再実行すると未処理の行だけを変換します。
+
+    Args:
+        input_file: 入力CSVのパス
+        output_file: 出力CSVのパス
+        on_error: エラーが発生した行の扱い（'skip' または 'stop'。Noneなら対話的に選択）
+        model_name: 使用するGeminiモデル（"models/" を付けても付けなくてもよい）
+        column: 変換対象の列名（Noneなら自動検出）
+        journal_file: ジャーナルのパス（Noneなら出力CSVの名前から決める）
+        max_in_flight: 同時に送信中にしておくリクエスト数の上限
+        requests_per_minute: 1分あたりのリクエスト数の上限
+        tokens_per_minute: 1分あたりのトークン数の上限
+        ladder: Trueなら LADDER のモデルを安い順に試し、出力の検証に通らなかった行だけを次のモデルに回す
+                （model_name / max_in_flight / requests_per_minute / tokens_per_minute は使わず、LADDER の設定に従う）
     """
     try:
         # Gemini APIの設定
         print("Gemini APIの設定中...")
-        model = setup_gemini_api()
+        model = setup_gemini_api(model_name)
         if model is None:
             print("Gemini APIの設定に失敗しました。プログラムを終了します。")
             return
+        # キャッシュのキーとマニフェストには、段階実行の LADDER と同じ "models/" なしの名前を使う
+        model_name = model_name.removeprefix('models/')
         
         # CSVファイルを読み込み
         print(f"CSVファイルを読み込み中: {input_file}")
-        df = pd.read_csv(input_file, encoding='utf-8')
+        df = read_table(input_file, encoding='utf-8')
         
         print(f"読み込んだデータの列名: {list(df.columns)}")
         print(f"データの行数: {len(df)}")
         
-        # 生成結果列を探す（複数の可能性をチェック）
-        target_column = None
-        possible_columns = ['生成結果', '事件の概要', '概要', '内容']
-        
-        for col in possible_columns:
-            if col in df.columns:
-                target_column = col
-                break
-        
+        target_column = find_target_column(df, column)
         if target_column is None:
             print("生成結果列が見つかりません。利用可能な列:")
             for i, col in enumerate(df.columns):
@@ -159,54 +209,168 @@ def process_csv(input_file, output_file):
         
         print(f"対象列: {target_column}")
         
-        # エラー処理の選択肢を提供
-        print("\nエラー処理の選択:")
-        print("1. エラーが発生した行をスキップして処理を続行")
-        print("2. エラーが発生したら処理を停止")
-        choice = input("選択してください (1 または 2): ").strip()
-        
-        continue_on_error = choice == "1"
-        
-        # 生成結果列の各行をGemini APIを使用してmarkdown形式に変換
-        print("Gemini APIを使用したmarkdown形式への変換を開始...")
-        
-        # 処理の進捗を表示するためのカウンター
-        total_rows = len(df)
-        error_count = 0
-        success_count = 0
+        if on_error is None:
+            on_error = ask_error_policy()
+
+        # 変換済みの行はジャーナル（行ごとのマニフェストを兼ねる）から読み込み、
+        # 元のテキストか変換設定が前回から変わった行だけを変換する
+        output_base = os.path.splitext(output_file)[0]
+        journal = CheckpointJournal(journal_file or output_base + '.journal.jsonl')
+        manifest_file = output_base + '.manifest.json'
+        records = journal.load()
+        if records:
+            print(f"'{journal.path}' を読み込みました。変更のない行は前回の結果を再利用します。")
+        # 変換に使うモデル（段階実行では各段のモデル）。キャッシュのキーとマニフェストの変換設定に使う
+        tiers = [create_backend(config, os.getenv('GEMINI_API_KEY')) for config in LADDER] if ladder else []
+        conversion_models = (
+            [(backend.backend_type, backend.model_name) for backend in tiers] if ladder
+            else [('gemini', model_name)]
+        )
+        current_settings = {LOCAL_MODEL: local_settings()}
+        for _, conversion_model in conversion_models:
+            current_settings[conversion_model] = settings_hash(conversion_model, build_conversion_prompt('{text}'))
+        keys = row_keys(df)
+        pending = [
+            not is_up_to_date(records.get(key), text, target_column, current_settings)
+            for key, text in zip(keys, df[target_column])
+        ]
+        df_pending = df[pending]
+        print(f"変更のない行: {len(df) - len(df_pending)} 行 / 変換が必要な行: {len(df_pending)} 行")
+        if df_pending.empty:
+            print("すべての行が変換済みです。")
+            write_results(df, journal, output_file, (target_column,), encoding='utf-8')
+            write_manifest(records, manifest_file)
+            print(f"出力ファイル: {output_file}")
+            return
         
-        for index, row in df.iterrows():
-            if index % 10 == 0:  # 10行ごとに進捗を表示
-                print(f"処理中... {index + 1}/{total_rows} 行目")
-            
-            # 生成結果列の内容を変換
-            original_text = row[target_column]
-            try:
-                converted_text = convert_to_markdown_with_gemini(original_text, model)
-                df.at[index, target_column] = converted_text
-                success_count += 1
-            except Exception as e:
-                error_count += 1
-                print(f"❌ 行 {index + 1} でエラーが発生しました: {e}")
-                print(f"対象テキスト: {original_text[:100]}...")
-                
-                if not continue_on_error:
+        total_rows = len(df_pending)
+        cache = ResponseCache()
+        counts = Counter()
+        fallback_reasons = Counter()
+
+        # 見出しの表記ゆれだけなら、APIを呼ばずにルールベースで整形する
+        jobs = []
+        for key, original_text in zip(row_keys(df_pending), df_pending[target_column]):
+            if pd.isna(original_text) or original_text == '':
+                journal.append(key, **{target_column: ""}, attempts=0,
+                               **manifest_fields(original_text, "", LOCAL_MODEL, current_settings[LOCAL_MODEL]))
+                counts['empty'] += 1
+                continue
+            normalized_text, reason = normalize_markdown(original_text)
+            if normalized_text is not None:
+                journal.append(key, **{target_column: normalized_text}, attempts=0,
+                               **manifest_fields(original_text, normalized_text, LOCAL_MODEL,
+                                                 current_settings[LOCAL_MODEL]))
+                counts['local'] += 1
+                continue
+            fallback_reasons[reason] += 1
+            prompt = build_conversion_prompt(original_text)
+            for backend_type, conversion_model in conversion_models:
+                cached_text = cache.get(make_cache_key(backend_type, conversion_model, None, prompt))
+                if cached_text is not None and ladder:
+                    # 段階実行では、検証に通ったキャッシュだけを使う
+                    cached_text = validate_conversion(None, cached_text)[0]
+                if cached_text is not None:
+                    journal.append(key, **{target_column: cached_text}, attempts=0,
+                                   **manifest_fields(original_text, cached_text, conversion_model,
+                                                     current_settings[conversion_model]))
+                    counts['cached'] += 1
+                    break
+            else:
+                jobs.append(Job(key=key, prompt=prompt, meta={
+                    'cache_key': make_cache_key('gemini', model_name, None, prompt), 'text': original_text,
+                }))
+
+        print(f"ローカルで整形: {counts['local']} 行 / キャッシュから復元: {counts['cached']} 行 / "
+              f"Gemini APIで変換: {len(jobs)} 行")
+        if jobs and ladder:
+            print(f"{' → '.join(backend.name for backend in tiers)} の順に段階実行で変換を開始...")
+        elif jobs:
+            print(f"Gemini APIを使用したmarkdown形式への変換を開始... (同時 {max_in_flight} 件, {requests_per_minute} RPM)")
+
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        telemetry = Telemetry(METRICS_FILE, 'gemini', model_name)
+
+        async def convert(job):
+            # Gemini APIにリクエストを送信
+            response = await model.generate_content_async(job.prompt)
+            metadata = response.usage_metadata
+            job.meta['prompt_tokens'] = metadata.prompt_token_count
+            job.meta['output_tokens'] = metadata.total_token_count - metadata.prompt_token_count
+            return response_text(response).strip(), metadata.total_token_count
+
+        def save_result(job, converted_text, error, backend=None):
+            if error is not None:
+                counts['error'] += 1
+                print(f"❌ ID {job.key} でエラーが発生しました: {error}")
+                print(f"対象テキスト: {job.meta['text'][:100]}...")  # 最初の100文字を表示
+                # 失敗した行は変換結果を空のままステータスに記録し、次回の実行で再試行する
+                # （段階実行で最後のモデルの出力も検証に通らなかった場合、error は理由の文字列）
+                message = f"検証NG: {error}" if isinstance(error, str) else describe_error(error)
+                journal.append_failure(job.key, message, **{target_column: ""}, attempts=job.meta.get('attempts', 1),
+                                       model=backend.model_name if backend else model_name)
+                if on_error == ON_ERROR_STOP:
                     print("エラーが発生したため、処理を停止します。")
-                    return
+                    raise StopJobs()
+                print(f"ID {job.key} をスキップして処理を続行します。")
+            else:
+                if backend is not None:
+                    backend_type, conversion_model = backend.backend_type, backend.model_name
+                    cache_key = make_cache_key(backend_type, conversion_model, None, job.prompt)
                 else:
-                    # エラーが発生した場合は空文字列にする
-                    df.at[index, target_column] = ""
-                    print(f"行 {index + 1} をスキップして処理を続行します。")
-        
+                    backend_type, conversion_model, cache_key = 'gemini', model_name, job.meta['cache_key']
+                cache.put(cache_key, converted_text, backend_type, conversion_model)
+                journal.append(job.key, **{target_column: converted_text}, attempts=job.meta.get('attempts', 1),
+                               **manifest_fields(job.meta['text'], converted_text, conversion_model,
+                                                 current_settings[conversion_model]))
+                counts['gemini'] += 1
+            done = counts['gemini'] + counts['error']
+            if done % PROGRESS_EVERY == 0 or done == len(jobs):
+                print(f"処理中... {done}/{len(jobs)} 行 {telemetry.postfix()}")
+            return []
+
+        completed = True
+        ladder_stats = None
+        try:
+            if jobs and ladder:
+                try:
+                    ladder_stats = route_ladder(jobs, tiers, validate_conversion, on_done=save_result,
+                                                retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry)
+                except StopJobs:
+                    completed = False
+            elif jobs:
+                completed = run_jobs(jobs, convert, limiter, max_in_flight, on_done=save_result,
+                                     retry_policy=RetryPolicy(MAX_ATTEMPTS), telemetry=telemetry)
+        finally:
+            for backend in tiers:
+                backend.close()
+            journal.close()
+            print(cache.summary())
+            cache.close()
+            telemetry.close()
+            if telemetry.records:
+                print(telemetry.report())
+            if ladder_stats is not None:
+                print(ladder_stats.report())
+
         # 処理結果の表示
         print(f"\n=== 処理完了 ===")
-        print(f"成功: {success_count} 行")
-        print(f"エラー: {error_count} 行")
+        print(f"成功: {counts['local'] + counts['cached'] + counts['gemini'] + counts['empty']} 行")
+        print(f"エラー: {counts['error']} 行")
         print(f"合計: {total_rows} 行")
-        
-        # 新しいCSVファイルとして保存
+        print(f"ローカルで整形: {counts['local']} 行 / Gemini APIに回した行: {sum(fallback_reasons.values())} 行")
+        for reason, count in fallback_reasons.most_common():
+            print(f"  {reason}: {count} 行")
+
+        if not completed:
+            print(f"処理を途中で停止しました。変換済みの行は '{journal.path}' に保存されています。"
+                  "再実行すると続きから処理します。")
+            return
+
+        # ジャーナルから出力CSVを一度だけ書き出す
         print(f"変換結果を保存中: {output_file}")
-        df.to_csv(output_file, index=False, encoding='utf-8')
+        write_results(df, journal, output_file, (target_column,), encoding='utf-8')
+        write_manifest(journal.load(), manifest_file)
         
         print(f"出力ファイル: {output_file}")
         
@@ -219,17 +383,32 @@ def main():
     """
     メイン処理
     """
+    parser = argparse.ArgumentParser(description="CSVの生成結果列をmarkdown形式に変換します。")
+    parser.add_argument('--input', default=DEFAULT_INPUT_FILE, help=f"入力CSVファイル。.parquet の結果ストアも可 (既定: {DEFAULT_INPUT_FILE})")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_FILE, help=f"出力CSVファイル。拡張子を .parquet にすると結果ストアに保存 (既定: {DEFAULT_OUTPUT_FILE})")
+    parser.add_argument('--column', help="変換対象の列名 (既定: 生成結果列を自動検出)")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help=f"使用するGeminiモデル (既定: {DEFAULT_MODEL})")
+    parser.add_argument('--on-error', choices=[ON_ERROR_SKIP, ON_ERROR_STOP],
+                        help="エラーが発生した行の扱い。skip: スキップして続行, stop: 処理を停止 (既定: 対話的に選択)")
+    parser.add_argument('--journal', help="変換済みの行を記録するジャーナル (既定: 出力CSVと同じ名前の .journal.jsonl)")
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help=f"同時に送信するリクエスト数 (既定: {MAX_CONCURRENT_REQUESTS})")
+    parser.add_argument('--rpm', type=int, default=REQUESTS_PER_MINUTE,
+                        help=f"1分あたりのリクエスト数の上限 (既定: {REQUESTS_PER_MINUTE})")
+    parser.add_argument('--tpm', type=int, default=TOKENS_PER_MINUTE,
+                        help=f"1分あたりのトークン数の上限 (既定: {TOKENS_PER_MINUTE})")
+    parser.add_argument('--ladder', action='store_true',
+                        help="LADDER のモデルを安い順に試し、出力がテンプレートとして読み取れなかった行だけを次のモデルに回す")
+    args = parser.parse_args()
+
     print("=== CSV to Markdown Converter (Gemini API版) ===")
-    
-    # 入力ファイルと出力ファイルのパス
-    input_file = "input_data.csv"
-    output_file = "output.csv"
-    
-    print(f"入力ファイル: {input_file}")
-    print(f"出力ファイル: {output_file}")
+    print(f"入力ファイル: {args.input}")
+    print(f"出力ファイル: {args.output}")
     
     # CSVファイルの処理
-    process_csv(input_file, output_file)
+    process_csv(args.input, args.output, on_error=args.on_error, model_name=args.model, column=args.column,
+                journal_file=args.journal, max_in_flight=max(1, args.concurrency),
+                requests_per_minute=args.rpm, tokens_per_minute=args.tpm, ladder=args.ladder)
 
 if __name__ == "__main__":
     main()
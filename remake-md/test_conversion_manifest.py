@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+conversion_manifest の再変換の判定とマニフェストの書き出しをテストするスクリプト
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+# プロジェクトルートのパスを追加して共通モジュールをインポート
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+from checkpoint_journal import CheckpointJournal
+from conversion_manifest import (
+    LOCAL_MODEL, is_up_to_date, local_settings, manifest_fields, settings_hash, write_manifest,
+)
+
+COLUMN = '生成結果'
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+
+def current_settings(prompt='テンプレート'):
+    return {LOCAL_MODEL: local_settings(), GEMINI_MODEL: settings_hash(GEMINI_MODEL, prompt)}
+
+
+def journal_records(rows):
+    """(キー, 変換前, 変換後, モデル, 失敗したか) の行をジャーナルに記録し、読み込んだレコードを返す"""
+    settings = current_settings()
+    with tempfile.TemporaryDirectory() as work_dir:
+        journal = CheckpointJournal(os.path.join(work_dir, 'results.journal.jsonl'))
+        for key, input_text, output_text, model, failed in rows:
+            fields = manifest_fields(input_text, output_text, model, settings[model])
+            if failed:
+                journal.append_failure(key, "APIエラー", **{COLUMN: ''}, **fields)
+            else:
+                journal.append(key, **{COLUMN: output_text}, **fields)
+        journal.close()
+        return journal.load()
+
+
+def test_is_up_to_date():
+    """入力・設定が同じ行だけを再利用し、入力や設定が変わった行・失敗した行・出力が書き換えられた行は再変換すること"""
+    records = journal_records([
+        ('local', '## 1. 導入', '### **導入**', LOCAL_MODEL, False),
+        ('gemini', '崩れた日記', '## 2023年1月1日', GEMINI_MODEL, False),
+        ('failed', '崩れた日記', '', GEMINI_MODEL, True),
+    ])
+    settings = current_settings()
+    cases = [
+        # (説明, レコード, 今回の変換前のテキスト, 今回の設定, 期待値)
+        ("変わっていない行（ローカル）", records['local'], '## 1. 導入', settings, True),
+        ("変わっていない行（Gemini）", records['gemini'], '崩れた日記', settings, True),
+        ("入力が変わった行", records['gemini'], '直した日記', settings, False),
+        ("その行のモデルの設定が変わった", records['gemini'], '崩れた日記', current_settings('新しいテンプレート'), False),
+        ("別のモデルの設定だけが変わった", records['local'], '## 1. 導入', current_settings('新しいテンプレート'), True),
+        ("ローカルの整形の設定が変わった", records['local'], '## 1. 導入', dict(settings, **{LOCAL_MODEL: 'changed'}), False),
+        ("失敗した行", records['failed'], '崩れた日記', settings, False),
+        ("出力が書き換えられた行", dict(records['gemini'], **{COLUMN: '手で直した日記'}), '崩れた日記', settings, False),
+        ("記録のない行", None, '崩れた日記', settings, False),
+    ]
+    for name, record, input_text, case_settings, expected in cases:
+        assert is_up_to_date(record, input_text, COLUMN, case_settings) is expected, name
+
+
+def test_write_manifest_skips_failed_rows():
+    """マニフェストには失敗した行とマニフェストのない古い行を入れないこと"""
+    records = journal_records([
+        ('done', '崩れた日記', '## 2023年1月1日', GEMINI_MODEL, False),
+        ('failed', '崩れた日記', '', GEMINI_MODEL, True),
+    ])
+    records['legacy'] = {'ID': 'legacy', COLUMN: '日記', 'ステータス': '完了'}
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'manifest.json')
+        manifest = write_manifest(records, path)
+        with open(path, encoding='utf-8') as f:
+            assert json.load(f) == manifest
+    assert list(manifest) == ['done']
+    assert manifest['done'] == {
+        'input_hash': records['done']['input_hash'], 'output_hash': records['done']['output_hash'], 'model': GEMINI_MODEL,
+    }
+
+
+if __name__ == "__main__":
+    test_is_up_to_date()
+    test_write_manifest_skips_failed_rows()
+    print("✅ conversion_manifest のテストがすべて成功しました")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLMレスポンスのローカルキャッシュ
+(バックエンド, モデル名, 生成設定, プロンプト) のハッシュをキーにして、
+全ディレクトリ・全実行で同じキャッシュを共有します
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+# キャッシュファイルの場所とサイズ上限（環境変数で上書き可能）
+DEFAULT_CACHE_PATH = os.path.join(project_root, '.llm_cache', 'responses.sqlite3')
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # 512MB
+# 保存のたびに全件の合計サイズを数えると件数に比例して遅くなるため、手元で合計を数えておき、
+# 他のプロセス（シャード）が保存した分を取り込むためにこの回数ごとに数え直す
+SIZE_RECOUNT_PUTS = 1000
+EVICT_BATCH_ROWS = 100  # 削除する候補を一度に読み込む件数
+
+
+def make_cache_key(backend, model_name, generation_config, prompt):
+    """
+    キャッシュキーを作成する
+
+    Args:
+        backend: 'gemini' や 'ollama' などのバックエンド名
+        model_name: モデル名
+        generation_config: 生成設定の辞書（温度など）。Noneは空の設定として扱います
+        prompt: 送信するプロンプト全文
+
+    Returns:
+        str: SHA-256のハッシュ値
+    """
+    material = json.dumps(
+        [backend, model_name, generation_config or {}, prompt],
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLiteに保存するサイズ上限付きのLRUキャッシュ
+
+    合計サイズが max_bytes を超えたら、最後に参照された時刻が古いものから削除します。
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or os.environ.get('LLM_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.max_bytes = max_bytes or int(os.environ.get('LLM_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._puts_since_recount = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                backend TEXT,
+                model TEXT,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )'''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)')
+        self._conn.commit()
+
+    def get(self, key):
+        """
+        キャッシュからレスポンスを取り出す
+
+        Args:
+            key: make_cache_key で作成したキー
+
+        Returns:
+            str or None: キャッシュされたレスポンス（なければNone）
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response, backend=None, model_name=None):
+        """
+        レスポンスをキャッシュに保存する
+
+        Args:
+            key: make_cache_key で作成したキー
+            response: 保存するレスポンスのテキスト
+            backend: バックエンド名（統計表示用）
+            model_name: モデル名（統計表示用）
+        """
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            replaced = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, backend, model_name, response, size, now, now),
+            )
+            if self._total_bytes is not None:
+                self._total_bytes += size - (replaced[0] if replaced else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _count_bytes(self):
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self._puts_since_recount = 0
+
+    def _evict(self):
+        self._puts_since_recount += 1
+        if self._total_bytes is None or self._puts_since_recount >= SIZE_RECOUNT_PUTS:
+            self._count_bytes()
+        if self._total_bytes <= self.max_bytes:
+            return
+        # 上限を超えたと見積もった場合は、正確な合計で判定し直してから古いものを削除する
+        self._count_bytes()
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                'SELECT key, size FROM responses ORDER BY accessed_at LIMIT ?', (EVICT_BATCH_ROWS,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        """
+        キャッシュの統計情報を取得する
+
+        Returns:
+            dict: ヒット数、ミス数、ヒット率、件数、合計サイズなど
+        """
+        with self._lock:
+            entries, total = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+        }
+
+    def summary(self):
+        """統計情報を1行の文字列にまとめる"""
+        s = self.stats()
+        return (
+            f"キャッシュ: ヒット {s['hits']} 件 / ミス {s['misses']} 件 "
+            f"(ヒット率 {s['hit_rate']:.1%}), 保存件数 {s['entries']} 件, "
+            f"{s['bytes'] / 1024 / 1024:.1f}MB / {s['max_bytes'] / 1024 / 1024:.0f}MB"
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    # 使い方: python response_cache.py [clear]
+    cache = ResponseCache()
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        with cache._lock:
+            cache._conn.execute('DELETE FROM responses')
+            cache._conn.commit()
+            cache._total_bytes = None
+        print(f"キャッシュを削除しました: {cache.path}")
+    else:
+        stats = cache.stats()
+        print(f"キャッシュファイル: {cache.path}")
+        print(f"保存件数: {stats['entries']} 件")
+        print(f"合計サイズ: {stats['bytes'] / 1024 / 1024:.1f}MB / {stats['max_bytes'] / 1024 / 1024:.0f}MB")
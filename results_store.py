@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列指向（Parquet/Arrow）の結果ストア
+出力ファイルの拡張子が .parquet なら結果ストアに、それ以外ならこれまでどおりCSVに読み書きします
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+# 結果ストアにだけ保存する列（CSVに書き出すときは従来の列構成に合わせて外す）
+ATTEMPTS_COLUMN = 'attempts'  # 最後の結果を得るまでに送信したリクエスト数（キャッシュから復元した場合は0）
+MODEL_COLUMN = 'model'  # 結果を生成・変換したモデル名
+STORE_ONLY_COLUMNS = (ATTEMPTS_COLUMN, MODEL_COLUMN)
+
+STORE_SUFFIX = '.parquet'
+
+# 値の種類がこの割合以下で、値が短い文字列列は辞書エンコードする（ステータス、モデル名、パラレルワールド名など）
+DICTIONARY_MAX_UNIQUE_RATIO = 0.5
+DICTIONARY_MAX_MEAN_LENGTH = 64  # 平均文字数がこれを超える列（日記の本文など）はArrowの文字列型のままにする
+
+
+def is_store_path(path):
+    """パスが結果ストア（Parquet）を指しているかを返す"""
+    return str(path).lower().endswith(STORE_SUFFIX)
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401  (pandas が Parquet の読み書きに使う)
+    except ImportError:
+        raise ImportError("Parquet形式の結果ストアを使うには pyarrow が必要です (pip install pyarrow)") from None
+
+
+def _is_low_cardinality(series):
+    lengths = series.dropna().str.len()
+    if len(lengths) and lengths.mean() > DICTIONARY_MAX_MEAN_LENGTH:
+        return False
+    return series.nunique() <= len(series) * DICTIONARY_MAX_UNIQUE_RATIO
+
+
+def to_store_frame(df):
+    """
+    結果ストアに保存する形に列の型をそろえる
+
+    値の種類が少ない文字列列はカテゴリ型（Parquetでは辞書エンコード）に、
+    日記の本文などそれ以外の文字列列はArrowの文字列型にします。
+
+    Args:
+        df: 結果のDataFrame
+
+    Returns:
+        pandas.DataFrame: 型を変換したコピー
+    """
+    df = df.copy()
+    for column in df.columns:
+        series = df[column]
+        if column == ATTEMPTS_COLUMN:
+            df[column] = pd.to_numeric(series, errors='coerce').astype('Int32')
+        elif series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            if not series.map(lambda value: isinstance(value, str) or pd.isna(value)).all():
+                # 主要登場人物のリストなど、文字列以外の値を含む列はそのまま保存する
+                continue
+            if column == MODEL_COLUMN or _is_low_cardinality(series):
+                df[column] = series.astype('category')
+            else:
+                df[column] = series.astype(pd.StringDtype('pyarrow'))
+    return df
+
+
+def read_table(path, **read_csv_kwargs):
+    """
+    結果ストアまたはCSVを読み込む
+
+    Args:
+        path: .parquet またはCSVのパス
+        **read_csv_kwargs: CSVの場合に pandas.read_csv に渡す追加の引数
+
+    Returns:
+        pandas.DataFrame: 読み込んだデータ
+    """
+    if is_store_path(path):
+        _require_pyarrow()
+        return pd.read_parquet(path)
+    return pd.read_csv(path, **read_csv_kwargs)
+
+
+def iter_table_chunks(path, chunksize, **read_csv_kwargs):
+    """
+    結果ストアまたはCSVを chunksize 行ずつ読み込む（ファイル全体をメモリに載せない）
+
+    Args:
+        path: .parquet またはCSVのパス
+        chunksize: 1回に読み込む行数
+        **read_csv_kwargs: CSVの場合に pandas.read_csv に渡す追加の引数
+
+    Yields:
+        pandas.DataFrame: chunksize 行以下のデータ
+    """
+    if is_store_path(path):
+        _require_pyarrow()
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    with pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs) as reader:
+        yield from reader
+
+
+class TableWriter:
+    """
+    結果をチャンクごとに追記して、結果ストアまたはCSVを作る書き出し
+
+    すべて書き終えて close() したときに一時ファイルを出力先に置き換えます。
+    結果ストアでは、最初のチャンクの列構成から型を決めます（文字列の列はすべてArrowの文字列型で、
+    値はParquetの辞書エンコードで圧縮されます）。
+    """
+
+    def __init__(self, path, **to_csv_kwargs):
+        """
+        Args:
+            path: 出力先（.parquet なら結果ストア、それ以外はCSV）
+            **to_csv_kwargs: CSVの場合に DataFrame.to_csv に渡す追加の引数（encoding も指定可）
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.rows = 0
+        self._csv_kwargs = dict(to_csv_kwargs)
+        self._file = None
+        self._parquet_writer = None
+        self._schema = None
+
+    def write(self, df):
+        """1チャンク分を追記する"""
+        if is_store_path(self.path):
+            self._write_parquet(df)
+        else:
+            if self._file is None:
+                encoding = self._csv_kwargs.pop('encoding', 'utf-8')
+                self._file = open(self.tmp_path, 'w', encoding=encoding, newline='')
+            df.drop(columns=list(STORE_ONLY_COLUMNS), errors='ignore').to_csv(
+                self._file, index=False, header=self.rows == 0, **self._csv_kwargs
+            )
+        self.rows += len(df)
+
+    def _write_parquet(self, df):
+        _require_pyarrow()
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._schema is None:
+            fields = []
+            for column in df.columns:
+                series = df[column]
+                if column == ATTEMPTS_COLUMN:
+                    field_type = pa.int32()
+                elif pd.api.types.is_numeric_dtype(series.dtype) and series.notna().any():
+                    field_type = pa.Array.from_pandas(series).type
+                else:
+                    # 文字列の列と、最初のチャンクでは値がすべて欠けている列
+                    field_type = pa.large_string()
+                fields.append(pa.field(str(column), field_type))
+            self._schema = pa.schema(fields)
+            self._parquet_writer = pq.ParquetWriter(self.tmp_path, self._schema)
+        if ATTEMPTS_COLUMN in df.columns:
+            df = df.assign(**{ATTEMPTS_COLUMN: pd.to_numeric(df[ATTEMPTS_COLUMN], errors='coerce').astype('Int32')})
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """書き出しを終えて、一時ファイルを出力先に置き換える"""
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self._file is not None:
+            self._file.close()
+        else:
+            # 1行も書かれなかった場合は空のファイルを作る
+            open(self.tmp_path, 'w').close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # 途中で失敗した場合は、既存の出力先を残したまま一時ファイルを捨てる
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self._file is not None:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_table(df, path, **to_csv_kwargs):
+    """
+    拡張子に合わせて結果ストアまたはCSVに、一時ファイル経由で書き出す
+
+    CSVの場合は結果ストアにだけ保存する列を外し、これまでと同じ列構成で書き出します。
+
+    Args:
+        df: 書き出すDataFrame
+        path: 出力先（.parquet なら結果ストア、それ以外はCSV）
+        **to_csv_kwargs: CSVの場合に DataFrame.to_csv に渡す追加の引数
+    """
+    tmp_path = path + '.tmp'
+    if is_store_path(path):
+        _require_pyarrow()
+        to_store_frame(df).to_parquet(tmp_path, index=False, engine='pyarrow')
+    else:
+        df.drop(columns=list(STORE_ONLY_COLUMNS), errors='ignore').to_csv(tmp_path, index=False, **to_csv_kwargs)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    # 使い方: python results_store.py <入力(.csv/.parquet)> <出力(.csv/.parquet)>
+    if len(sys.argv) != 3:
+        print("使い方: python results_store.py <入力(.csv/.parquet)> <出力(.csv/.parquet)>")
+        print("例: python results_store.py results.csv results.parquet（CSVを結果ストアに取り込む）")
+        sys.exit(1)
+    source, destination = sys.argv[1:]
+    df = read_table(source)
+    write_table(df, destination, **({} if is_store_path(destination) else {'encoding': 'utf-8-sig'}))
+    print(f"'{source}' を '{destination}' に書き出しました。({len(df)} 行, "
+          f"{os.path.getsize(source) / 1024:.0f}KB -> {os.path.getsize(destination) / 1024:.0f}KB)")
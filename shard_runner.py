@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+IDのハッシュで入力をN個のシャードに分け、シャードごとに別プロセスで実行するための補助モジュール
+各シャードは自分専用のジャーナルに追記し、結果CSVは全ジャーナルを元の行順にマージして作ります
+"""
+
+import glob
+import multiprocessing
+import os
+import sys
+import zlib
+
+from checkpoint_journal import STATUS_COLUMN, STATUS_DONE, STATUS_FAILED, CheckpointJournal, rebuild_results, row_keys
+from results_store import TableWriter, iter_table_chunks, read_table, write_table
+
+
+def shard_of(key, num_shards):
+    """
+    キーが属するシャード番号を返す
+
+    Pythonの hash() は実行ごとに値が変わるため、CRC32で毎回同じシャードに振り分けます。
+
+    Args:
+        key: 行のキー
+        num_shards: シャード数
+
+    Returns:
+        int: 0 から num_shards - 1 までのシャード番号
+    """
+    return zlib.crc32(str(key).encode('utf-8')) % num_shards
+
+
+def shard_mask(df, shard_index, num_shards):
+    """
+    指定したシャードに属する行を示すブール配列を返す
+
+    Args:
+        df: 入力データのDataFrame
+        shard_index: シャード番号
+        num_shards: シャード数
+
+    Returns:
+        pandas.Series: そのシャードの行ならTrue
+    """
+    return row_keys(df).map(lambda key: shard_of(key, num_shards) == shard_index)
+
+
+def shard_path(path, shard_index):
+    """シャード専用のファイル名を返す（例: results.journal.jsonl -> results.journal.shard0.jsonl）"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{shard_index}{ext}"
+
+
+def find_shard_files(path):
+    """path に対応するシャード専用のファイルを、シャード数に関係なくすべて返す"""
+    base, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(base)}.shard[0-9]*{ext}"))
+
+
+def merge_records(record_sets):
+    """
+    複数のジャーナルのレコードを1つにまとめる
+
+    シャード数を変えて再実行した場合など、同じキーが複数のジャーナルにあるときは、
+    「完了」を「失敗」より優先し、同じステータスなら後に記録されたものを使います。
+    どの順でマージしても同じ結果になります。
+
+    Args:
+        record_sets: CheckpointJournal.load() の戻り値のリスト
+
+    Returns:
+        dict: キー -> 採用したレコード
+    """
+    def rank(record):
+        return (record.get(STATUS_COLUMN) != STATUS_FAILED, record.get('completed_at', ''))
+
+    merged = {}
+    for records in record_sets:
+        for key, record in records.items():
+            current = merged.get(key)
+            if current is None or rank(record) > rank(current):
+                merged[key] = record
+    return merged
+
+
+def load_merged_records(journal_path):
+    """
+    通常のジャーナルとすべてのシャード専用ジャーナルを読み込んでマージする
+
+    Args:
+        journal_path: 通常のジャーナルのパス
+
+    Returns:
+        dict: キー -> 採用したレコード
+    """
+    paths = [journal_path] + find_shard_files(journal_path)
+    return merge_records([CheckpointJournal(path).load() for path in paths])
+
+
+def merge_shards(df_input, journal_path, output_csv, result_columns=('生成結果',), **to_csv_kwargs):
+    """
+    全ジャーナルの結果を入力データの行順でマージし、一時ファイル経由で結果CSV（または結果ストア）に書き出す
+
+    結果はジャーナルだけから毎回作り直すため、何度実行しても同じCSVになります。
+    途中で止まったシャードの未処理の行は、結果列とステータス列が空のまま出力されます。
+
+    Args:
+        df_input: 入力データのDataFrame
+        journal_path: 通常のジャーナルのパス
+        output_csv: 出力先のパス（拡張子が .parquet なら結果ストア）
+        result_columns: ジャーナルから取り出す列名
+        **to_csv_kwargs: DataFrame.to_csv に渡す追加の引数
+
+    Returns:
+        pandas.DataFrame: 書き出した結果
+    """
+    df = rebuild_results(df_input, load_merged_records(journal_path), result_columns)
+    write_table(df, output_csv, **to_csv_kwargs)
+    return df
+
+
+def index_merged_records(journal_path):
+    """
+    通常のジャーナルとすべてのシャード専用ジャーナルの索引を、本文を読み込まずにマージする
+
+    どのレコードを採用するかは merge_records() と同じ規則で決めます。
+
+    Args:
+        journal_path: 通常のジャーナルのパス
+
+    Returns:
+        tuple: (キー -> (ステータス, 記録時刻, ジャーナル, ファイル内の位置), 開いたジャーナルのリスト)
+    """
+    journals = [CheckpointJournal(path) for path in [journal_path] + find_shard_files(journal_path)]
+    merged = {}
+    for journal in journals:
+        for key, (status, completed_at, offset) in journal.index().items():
+            current = merged.get(key)
+            rank = (status != STATUS_FAILED, completed_at)
+            if current is None or rank > (current[0] != STATUS_FAILED, current[1]):
+                merged[key] = (status, completed_at, journal, offset)
+    return merged, journals
+
+
+def load_merged_done_keys(journal_path):
+    """すべてのジャーナルで完了として記録されているキーの集合を、本文を読み込まずに返す"""
+    index, journals = index_merged_records(journal_path)
+    for journal in journals:
+        journal.close()
+    return {key for key, entry in index.items() if entry[0] != STATUS_FAILED}
+
+
+def merge_shards_streaming(input_path, journal_path, output_csv, chunksize, result_columns=('生成結果',),
+                           **to_csv_kwargs):
+    """
+    merge_shards() と同じ結果を、入力データとジャーナルの本文を全体としてメモリに載せずに書き出す
+
+    入力を chunksize 行ずつ読み、その行のレコードだけをジャーナルから読み出して追記していきます。
+    メモリに残るのは、キーごとのステータスとジャーナル内の位置の索引だけです。
+
+    Args:
+        input_path: 入力データのパス（CSVまたは結果ストア）
+        journal_path: 通常のジャーナルのパス
+        output_csv: 出力先のパス（拡張子が .parquet なら結果ストア）
+        chunksize: 1回に処理する行数
+        result_columns: ジャーナルから取り出す列名
+        **to_csv_kwargs: DataFrame.to_csv に渡す追加の引数
+
+    Returns:
+        dict: ステータスごとの行数（未処理の行は空文字列）
+    """
+    index, journals = index_merged_records(journal_path)
+    counts = {STATUS_DONE: 0, STATUS_FAILED: 0, '': 0}
+    try:
+        with TableWriter(output_csv, **to_csv_kwargs) as writer:
+            for chunk in iter_table_chunks(input_path, chunksize):
+                records = {}
+                for key in row_keys(chunk):
+                    entry = index.get(key)
+                    if entry is not None:
+                        records[key] = entry[2].read_at(entry[3])
+                df = rebuild_results(chunk, records, result_columns)
+                writer.write(df)
+                for status, count in df[STATUS_COLUMN].value_counts().items():
+                    counts[status] = counts.get(status, 0) + int(count)
+    finally:
+        for journal in journals:
+            journal.close()
+    return counts
+
+
+def merge_summary(df):
+    """
+    マージした結果の完了・失敗・未処理の行数を1行の文字列にする
+
+    Args:
+        df: merge_shards() の戻り値、または merge_shards_streaming() が返したステータスごとの行数
+    """
+    counts = df if isinstance(df, dict) else df[STATUS_COLUMN].value_counts().to_dict()
+    done = counts.get(STATUS_DONE, 0)
+    failed = counts.get(STATUS_FAILED, 0)
+    total = sum(counts.values())
+    return f"完了 {done} 行 / 失敗 {failed} 行 / 未処理 {total - done - failed} 行 (全 {total} 行)"
+
+
+def assign_api_keys(num_shards, api_keys):
+    """
+    シャードにAPIキーを順番に割り当てる
+
+    キーよりシャードが多い場合は同じキーを複数のシャードで共有するため、
+    そのキーを使うシャード数も返します（レート制限をシャード間で分け合うのに使います）。
+
+    Args:
+        num_shards: シャード数
+        api_keys: APIキーのリスト
+
+    Returns:
+        list: シャードごとの (APIキー, そのキーを共有するシャード数)
+    """
+    keys = [api_keys[index % len(api_keys)] for index in range(num_shards)]
+    return [(key, keys.count(key)) for key in keys]
+
+
+def run_shards(target, num_shards, api_keys, args=()):
+    """
+    シャードごとに別プロセスを起動し、すべて終了するまで待つ
+
+    各プロセスでは target(シャード番号, シャード数, APIキー, キーを共有するシャード数, *args) を呼びます。
+    gRPCを使うクライアントはfork後に正しく動かないことがあるため、spawnで起動します。
+
+    Args:
+        target: 各プロセスで実行する関数（モジュールの最上位で定義されたもの）
+        num_shards: シャード数
+        api_keys: APIキーのリスト
+        args: target に渡す追加の引数
+
+    Returns:
+        list: シャードごとの終了コード（0なら正常終了）
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for shard_index, (api_key, key_share) in enumerate(assign_api_keys(num_shards, api_keys)):
+        process = context.Process(
+            target=target,
+            args=(shard_index, num_shards, api_key, key_share, *args),
+            name=f"shard{shard_index}",
+        )
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # 中断された場合も、各シャードのジャーナルには処理済みの行が残っている
+        for process in processes:
+            process.join()
+        raise
+    return [process.exitcode for process in processes]
+
+
+if __name__ == "__main__":
+    # 使い方: python shard_runner.py <journal.jsonl> <input.csv> <results.csv>
+    if len(sys.argv) != 4:
+        print("使い方: python shard_runner.py <journal.jsonl> <input.csv> <results.csv>")
+        sys.exit(1)
+    journal_path, input_csv, output_csv = sys.argv[1:]
+    df = merge_shards(read_table(input_csv), journal_path, output_csv)
+    print(f"'{output_csv}' を {1 + len(find_shard_files(journal_path))} 個のジャーナルからマージしました。")
+    print(merge_summary(df))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+backend_router のモデルの段（ラダー）と複数バックエンドの振り分けをテストするスクリプト
+"""
+
+import asyncio
+import os
+import tempfile
+
+from backend_router import route_jobs_async, route_ladder
+from llm_executor import Job, RateLimiter
+from quota_planner import DailyUsage
+
+
+class FakeBackend:
+    """route_ladder に渡すための、決まった応答を返すバックエンド"""
+    backend_type = 'fake'
+
+    def __init__(self, name, reply):
+        self.name = name
+        self.model_name = name
+        self.max_in_flight = 2
+        self.limiter = RateLimiter(None)
+        self.reply = reply
+
+    async def generate(self, prompt, meta):
+        return self.reply(prompt), 1
+
+
+def test_route_ladder_escalates_only_rejected_rows():
+    """検証に通らなかった行だけが次の段に回り、最後の段でも通らなければ理由付きで失敗すること"""
+    cheap = FakeBackend('cheap', lambda prompt: "good" if prompt.startswith("easy") else "bad")
+    strong = FakeBackend('strong', lambda prompt: "bad" if prompt == "impossible" else "good")
+    results = {}
+
+    def validate(job, text):
+        return (text, None) if text == "good" else (None, "構成が違う")
+
+    def on_done(job, result, error, backend):
+        results[job.key] = (result, error, backend.name)
+
+    jobs = [Job(key=prompt, prompt=prompt) for prompt in ("easy1", "easy2", "hard", "impossible")]
+    stats = route_ladder(jobs, [cheap, strong], validate, on_done)
+
+    assert results["easy1"] == ("good", None, 'cheap')
+    assert results["hard"] == ("good", None, 'strong')
+    assert results["impossible"] == (None, "構成が違う", 'strong')
+    assert stats.entered['strong'] == 2 and stats.settled['cheap'] == 2
+    assert "どの段でも確定しなかった行: 1 行" in stats.report()
+
+
+def test_exhausted_backend_does_not_block_finish():
+    """1日の上限に達したバックエンドがあっても、ほかのバックエンドがすべての行を終えたら戻ること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        exhausted = FakeBackend('exhausted', lambda prompt: "good")
+        # 上限0件なので、このバックエンドはリセット時刻まで wait_for_daily_room() から戻らない
+        exhausted.limiter = RateLimiter(None, daily_usage=DailyUsage(
+            'exhausted-model', requests_per_day=0, path=os.path.join(work_dir, 'usage.json')))
+        healthy = FakeBackend('healthy', lambda prompt: "good")
+        done = []
+
+        jobs = [Job(key=i, prompt=f"p{i}") for i in range(10)]
+        asyncio.run(asyncio.wait_for(route_jobs_async(
+            jobs, [exhausted, healthy], lambda job, result, error, backend: done.append(backend.name)), 5))
+        assert done == ['healthy'] * 10
+
+        # 段階実行でも、上の段に上がる行がなければ上限に達した段を待たずに終わる
+        done.clear()
+        jobs = [Job(key=i, prompt=f"p{i}") for i in range(10)]
+        route_ladder(jobs, [healthy, exhausted], lambda job, text: (text, None),
+                     lambda job, result, error, backend: done.append(backend.name))
+        assert done == ['healthy'] * 10
+
+
+def test_daily_usage_counts_only_sent_requests():
+    """行が上がってくるのを待っているだけのワーカーは、1日の使用量に数えないこと"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        usage = DailyUsage('strong-model', requests_per_day=10, path=os.path.join(work_dir, 'usage.json'))
+        cheap = FakeBackend('cheap', lambda prompt: "good" if prompt.startswith("easy") else "bad")
+        strong = FakeBackend('strong', lambda prompt: "good")
+        strong.max_in_flight = 3
+        strong.limiter = RateLimiter(None, daily_usage=usage)
+        counted_at_send = []
+        reply = strong.generate
+
+        async def generate(prompt, meta):
+            counted_at_send.append(usage.requests)
+            return await reply(prompt, meta)
+
+        strong.generate = generate
+        jobs = [Job(key=prompt, prompt=prompt) for prompt in ("easy1", "hard1", "easy2", "hard2")]
+        route_ladder(jobs, [cheap, strong], lambda job, text: (text, None) if text == "good" else (None, "NG"),
+                     lambda job, result, error, backend: None)
+        assert sorted(counted_at_send) == [1, 2]
+        assert usage.requests == 2 and not usage.exhausted
+
+
+def test_idle_workers_do_not_take_rpm():
+    """行を取り出せなかったワーカーは、RPMの枠を使わないこと"""
+    backend = FakeBackend('gemini', lambda prompt: "good")
+    backend.max_in_flight = 4
+    # 枠が4件分あり、テストの間にはほとんど補充されないバケット
+    backend.limiter = RateLimiter(0.6, request_burst=4)
+    done = []
+    asyncio.run(asyncio.wait_for(route_jobs_async(
+        [Job(key=1, prompt="p1")], [backend], lambda job, result, error, backend: done.append(job.key)), 5))
+    assert done == [1]
+    assert 2.9 < backend.limiter.request_bucket.tokens < 3.1
+
+
+if __name__ == "__main__":
+    test_route_ladder_escalates_only_rejected_rows()
+    test_exhausted_backend_does_not_block_finish()
+    test_daily_usage_counts_only_sent_requests()
+    test_idle_workers_do_not_take_rpm()
+    print("✅ backend_router のテストがすべて成功しました")
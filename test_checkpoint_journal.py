@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+checkpoint_journal の追記・読み込みと結果の再構築をテストするスクリプト
+"""
+
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from checkpoint_journal import (
+    ERROR_COLUMN, STATUS_COLUMN, STATUS_DONE, STATUS_FAILED, CheckpointJournal, pending_mask, rebuild_results,
+)
+from results_store import ATTEMPTS_COLUMN, MODEL_COLUMN
+
+
+def test_truncated_last_line_is_ignored():
+    """書き込み途中で中断された末尾の行は読み飛ばし、その後に追記したレコードは読み込めること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'results.journal.jsonl')
+        journal = CheckpointJournal(path)
+        journal.append('a', 生成結果='日記A')
+        journal.close()
+        with open(path, 'ab') as f:
+            f.write('{"ID": "b", "生成結果": "途中まで'.encode('utf-8')[:-2])  # 文字の途中で切れている
+
+        journal = CheckpointJournal(path)
+        assert list(journal.load()) == ['a']
+        assert list(journal.index()) == ['a']
+        journal.append('c', 生成結果='日記C')
+        journal.close()
+        records = CheckpointJournal(path).load()
+    assert list(records) == ['a', 'c']
+    assert records['c']['生成結果'] == '日記C'
+
+
+def test_latest_record_wins():
+    """同じキーが何度も記録された場合は、ステータスに関係なく最後のレコードが有効になること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        journal = CheckpointJournal(os.path.join(work_dir, 'results.journal.jsonl'))
+        journal.append('a', 生成結果='1回目')
+        journal.append_failure('b', 'タイムアウト', 生成結果='')
+        journal.append('b', 生成結果='再試行で完了')
+        journal.append_failure('a', 'APIエラー: 500', 生成結果='')
+        records = journal.load()
+        index = journal.index()
+        latest_b = journal.read_at(index['b'][2])
+        journal.close()
+    assert (records['a'][STATUS_COLUMN], records['a'][ERROR_COLUMN]) == (STATUS_FAILED, 'APIエラー: 500')
+    assert (records['b'][STATUS_COLUMN], records['b']['生成結果']) == (STATUS_DONE, '再試行で完了')
+    assert index['a'][0] == STATUS_FAILED and latest_b == records['b']
+
+
+def test_failed_rows_are_pending():
+    """失敗として記録された行と記録のない行が未処理になり、結果の再構築ではステータスとエラー内容が入ること"""
+    df_input = pd.DataFrame({'ID': [1, 2, 3, 4], 'エピソードタイトル': ['A', 'B', 'C', 'D']})
+    records = {
+        '1': {'ID': '1', '生成結果': '日記', STATUS_COLUMN: STATUS_DONE, ATTEMPTS_COLUMN: 2, MODEL_COLUMN: 'gemini'},
+        '2': {'ID': '2', '生成結果': '', STATUS_COLUMN: STATUS_FAILED, ERROR_COLUMN: 'タイムアウト'},
+        '4': {'ID': '4', '生成結果': '日記', STATUS_COLUMN: STATUS_DONE},
+    }
+    assert pending_mask(df_input, records).tolist() == [False, True, True, False]
+    df = rebuild_results(df_input, records)
+    assert df['生成結果'].tolist() == ['日記', '', '', '日記']
+    assert df[STATUS_COLUMN].tolist() == [STATUS_DONE, STATUS_FAILED, '', STATUS_DONE]
+    assert df[ERROR_COLUMN].tolist() == ['', 'タイムアウト', '', '']
+    assert df[ATTEMPTS_COLUMN].tolist() == [2, pd.NA, pd.NA, pd.NA]
+
+
+def test_legacy_journal_without_status():
+    """ステータス列がない古いジャーナルは、生成結果のエラーメッセージから失敗を判定すること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'results.journal.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in [{'ID': 'a', '生成結果': '日記'}, {'ID': 'b', '生成結果': 'APIエラー: 429'}]:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        records = CheckpointJournal(path).load()
+    assert records['a'][STATUS_COLUMN] == STATUS_DONE
+    assert records['b'][STATUS_COLUMN] == STATUS_FAILED
+
+
+def test_seed_from_results():
+    """旧形式の結果CSVからは、完了した行だけを試行回数とモデル名も含めて取り込むこと"""
+    df_results = pd.DataFrame({
+        'ID': ['a', 'b', 'c', 'd', 'e'],
+        '生成結果': ['日記A', '', None, 'タイムアウト: 600秒', '日記E'],
+        ATTEMPTS_COLUMN: [1, None, None, None, 3],
+        MODEL_COLUMN: ['gemini', None, None, None, None],
+    })
+    with tempfile.TemporaryDirectory() as work_dir:
+        journal = CheckpointJournal(os.path.join(work_dir, 'results.journal.jsonl'))
+        assert journal.seed_from_results(df_results) == 2
+        assert journal.seed_from_results(df_results.drop(columns='生成結果')) == 0
+        journal.close()
+        records = journal.load()
+    assert list(records) == ['a', 'e']
+    assert records['a']['生成結果'] == '日記A' and records['a'][MODEL_COLUMN] == 'gemini'
+    assert records['e'][ATTEMPTS_COLUMN] == 3 and MODEL_COLUMN not in records['e']
+    assert all(record[STATUS_COLUMN] == STATUS_DONE for record in records.values())
+
+
+def test_seed_from_results_with_status_column():
+    """ステータス列がある結果からは、ステータスが完了の行だけを取り込むこと"""
+    df_results = pd.DataFrame({
+        'ID': ['a', 'b', 'c'],
+        '生成結果': ['日記A', '途中までの日記', ''],
+        STATUS_COLUMN: [STATUS_DONE, STATUS_FAILED, None],
+    })
+    with tempfile.TemporaryDirectory() as work_dir:
+        journal = CheckpointJournal(os.path.join(work_dir, 'results.journal.jsonl'))
+        assert journal.seed_from_results(df_results) == 1
+        journal.close()
+        assert list(journal.load()) == ['a']
+
+
+if __name__ == "__main__":
+    test_truncated_last_line_is_ignored()
+    test_latest_record_wins()
+    test_failed_rows_are_pending()
+    test_legacy_journal_without_status()
+    test_seed_from_results()
+    test_seed_from_results_with_status_column()
+    print("✅ checkpoint_journal のテストがすべて成功しました")
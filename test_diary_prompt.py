@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+diary_prompt のまとめ送信用のプロンプトとレスポンスの分割をテストするスクリプト
+"""
+
+from diary_prompt import (
+    PROMPT_HEADER, PROMPT_RULES, build_packed_prompt, build_prompt, build_prompt_data, split_packed_response,
+)
+from llm_executor import Job
+
+
+def episode_job(key, title):
+    row = {'ID': key, 'エピソードタイトル': title, '事件の発生日': '2023/01/03'}
+    return Job(key=key, prompt=build_prompt(row), meta={'prompt_data': build_prompt_data(row)})
+
+
+def packed(*diaries):
+    """(ID, 本文) の組から、指示どおりの形式のレスポンスを組み立てる"""
+    return '\n'.join(f'<<<DIARY ID={key}>>>\n{body}\n<<<END DIARY>>>' for key, body in diaries)
+
+
+def test_packed_prompt_lists_every_episode():
+    """まとめたプロンプトにすべてのエピソードのIDと題材が入り、指示はキャッシュする場合だけ省かれること"""
+    jobs = [episode_job('a1', '二十年目の殺意'), episode_job('b2', '月光殺人事件')]
+    prompt = build_packed_prompt(jobs)
+    assert prompt.startswith(PROMPT_HEADER) and PROMPT_RULES in prompt
+    for job in jobs:
+        assert f'#### エピソード ID: {job.key}\n' in prompt
+        assert job.meta['prompt_data']['episodeTitle'] in prompt
+    assert '以下の2件のエピソード' in prompt and '<<<DIARY ID=a1>>>' in prompt
+
+    suffix_only = build_packed_prompt(jobs, include_instructions=False)
+    assert PROMPT_HEADER not in suffix_only and PROMPT_RULES not in suffix_only
+    assert suffix_only.startswith('### 2. コンテンツ（Content）')
+    assert '#### エピソード ID: b2\n' in suffix_only
+
+
+def test_split_packed_response_maps_diaries_to_ids():
+    """どの順で返ってきても、日記はIDで対応する行に割り当てられ、前後の余分な文やコードブロックは取り除かれること"""
+    response = 'はい、2件の日記です。\n' + packed(
+        ('b2', '```markdown\n## 2023/01/04\n\n日記B\n```'),
+        ('a1', '## 2023/01/03\n\n日記A'),
+    ) + '\n以上です。'
+    assert split_packed_response(response) == {'a1': '## 2023/01/03\n\n日記A', 'b2': '## 2023/01/04\n\n日記B'}
+
+
+def test_split_packed_response_drops_unreliable_diaries():
+    """欠けた日記・壊れた日記・IDが重複した日記は含めず、残りの日記だけを正しいIDで返すこと"""
+    cases = [
+        ("空のレスポンス", None, {}),
+        ("形式に従っていない", '## 2023/01/03\n\n日記A', {}),
+        ("途中で切れた", packed(('a1', '日記A')) + '\n<<<DIARY ID=b2>>>\n日記Bの途中', {'a1': '日記A'}),
+        ("終了行が抜けた日記",
+         '<<<DIARY ID=a1>>>\n日記A\n' + packed(('b2', '日記B'), ('c3', '日記C')), {'b2': '日記B', 'c3': '日記C'}),
+        ("本文が空", packed(('a1', ''), ('b2', '日記B')), {'b2': '日記B'}),
+        ("同じIDが2回", packed(('a1', '日記A'), ('a1', '日記B'), ('c3', '日記C')), {'c3': '日記C'}),
+        ("依頼していないIDが混ざる", packed(('a1', '日記A'), ('zz', '日記Z')), {'a1': '日記A', 'zz': '日記Z'}),
+    ]
+    for name, response, expected in cases:
+        assert split_packed_response(response) == expected, name
+
+    # 呼び出し側は依頼したエピソードのIDで引くので、含まれなかったエピソードだけが送り直しになる
+    diaries = split_packed_response(cases[3][1])
+    requested = ['a1', 'b2', 'c3']
+    assert [key for key in requested if diaries.get(key) is None] == ['a1']
+
+
+if __name__ == "__main__":
+    test_packed_prompt_lists_every_episode()
+    test_split_packed_response_maps_diaries_to_ids()
+    test_split_packed_response_drops_unreliable_diaries()
+    print("✅ diary_prompt のテストがすべて成功しました")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+diary_schema の構造化出力の読み取り・検証・Markdown化をテストするスクリプト
+"""
+
+import json
+
+from diary_schema import DIARY_SCHEMA, DIARY_SECTIONS, parse_diary_response, render_markdown, validate_diary
+
+DATE = '2023年1月3日'
+TITLE = '二十年目の殺意'
+BODIES = {key: f'{name.split(" - ")[0]}の本文。' for key, name in DIARY_SECTIONS}
+
+
+def diary(**changes):
+    """正しい日記のJSONの値に changes を反映したもの（sections の一部を変える場合は sections= で渡す）"""
+    data = {'date': DATE, 'title': TITLE, 'sections': dict(BODIES)}
+    data.update(changes)
+    return data
+
+
+def without(key):
+    """key のセクションを欠いた sections"""
+    return {name: body for name, body in BODIES.items() if name != key}
+
+
+def test_schema_requires_every_section():
+    """スキーマがすべてのセクションを必須にしていること"""
+    sections = DIARY_SCHEMA['properties']['sections']
+    assert sections['required'] == [key for key, _ in DIARY_SECTIONS]
+    assert sorted(sections['properties']) == sorted(BODIES)
+
+
+def test_validate_diary_reports_problems():
+    """スキーマや日記の規則に合わない箇所を、問題点ごとのメッセージで返すこと"""
+    cases = [
+        ("正しい日記", diary(), []),
+        ("トップレベルが配列", [diary()], ["JSONのトップレベルがオブジェクトではありません"]),
+        ("日付が空", diary(date='  '), ["'date' が空か文字列ではありません"]),
+        ("タイトルが数値", diary(title=1), ["'title' が空か文字列ではありません"]),
+        ("タイトルが複数行", diary(title='一行目\n二行目'), ["'title' が複数行になっています"]),
+        ("sections がない", {'date': DATE, 'title': TITLE}, ["'sections' がオブジェクトではありません"]),
+        ("セクションが足りない", diary(sections=without('insight')), ["「閃き - 真相への鍵」の本文がありません"]),
+        ("本文が空白だけ", diary(sections=dict(BODIES, encounter='\n  \n')), ["「遭遇 - 事件の発生」の本文がありません"]),
+        ("本文に見出し", diary(sections=dict(BODIES, reflection='### 結び\n本文。')),
+         ["「結びと内省 - 事件の後で」の本文に見出しが含まれています"]),
+        ("複数の問題", diary(date='', sections=without('introduction')),
+         ["'date' が空か文字列ではありません", "「導入 - その日の始まり」の本文がありません"]),
+    ]
+    for name, data, expected in cases:
+        assert validate_diary(data) == expected, name
+
+
+def test_parse_diary_response():
+    """レスポンスをJSONとして読み取り、問題がなければ辞書を、あれば None と問題点を返すこと"""
+    text = json.dumps(diary(), ensure_ascii=False)
+    cases = [
+        ("JSONのまま", text, diary(), []),
+        ("前後の空白", f'\n  {text}\n', diary(), []),
+        ("コードブロック", f'```json\n{text}\n```', diary(), []),
+        ("言語名のないコードブロック", f'```\n{text}\n```', diary(), []),
+        ("セクションが足りない", json.dumps(diary(sections=without('resolution')), ensure_ascii=False),
+         None, ["「真相解明 - 解決の舞台裏」の本文がありません"]),
+    ]
+    for name, response, expected_data, expected_problems in cases:
+        assert parse_diary_response(response) == (expected_data, expected_problems), name
+
+    malformed = [
+        ("空のレスポンス", None),
+        ("空文字列", ''),
+        ("途中で切れた", text[:-20]),
+        ("Markdownで返ってきた", f'## {DATE}\n\n### {TITLE}'),
+    ]
+    for name, response in malformed:
+        data, problems = parse_diary_response(response)
+        assert data is None and len(problems) == 1, name
+        assert problems[0].startswith("JSONとして読み取れません"), name
+
+
+def test_render_markdown():
+    """見出しの形式をローカルで決め、本文の段落を空行1行で区切り直すこと"""
+    sections = dict(BODIES, introduction='  一段落目。  \n\n\n\n二段落目。\n続きの行。\n')
+    markdown = render_markdown(diary(date=f' {DATE} ', title=f'{TITLE}\n', sections=sections))
+    expected_blocks = [f'## {DATE}', f'### {TITLE}']
+    for key, name in DIARY_SECTIONS:
+        expected_blocks += [f'### **{name}**', BODIES[key]]
+    expected_blocks[3] = '一段落目。\n\n二段落目。\n続きの行。'
+    assert markdown == '\n\n'.join(expected_blocks)
+
+    # セクションは sections のキーの順ではなく、DIARY_SECTIONS の順に並ぶ
+    reversed_sections = dict(reversed(list(BODIES.items())))
+    assert render_markdown(diary(sections=reversed_sections)) == render_markdown(diary())
+
+
+if __name__ == "__main__":
+    test_schema_requires_every_section()
+    test_validate_diary_reports_problems()
+    test_parse_diary_response()
+    test_render_markdown()
+    print("✅ diary_schema のテストがすべて成功しました")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+llm_executor のレート制限と同時実行をテストするスクリプト
+"""
+
+import asyncio
+import json
+import time
+
+from llm_errors import (
+    ERROR_MALFORMED, ERROR_OTHER, ERROR_QUOTA, ERROR_SAFETY, MalformedResponseError, RetryPolicy, classify_error,
+    response_text, retry_after_seconds,
+)
+from llm_executor import Job, RateLimiter, StopJobs, TokenBucket, run_jobs, run_jobs_async
+from llm_telemetry import Telemetry
+from ollama_client import OllamaResponseError
+
+
+def test_token_bucket_paces_requests():
+    """バケットが空になった後は補充速度どおりに待機すること"""
+    async def acquire_three():
+        bucket = TokenBucket(rate_per_minute=600, capacity=1)  # 0.1秒に1個
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(acquire_three())
+    assert 0.15 <= elapsed < 0.5
+
+
+def test_run_jobs_keeps_requests_in_flight():
+    """レイテンシの長いリクエストでも同時に複数件送信されること"""
+    in_flight = 0
+    peak = 0
+    results = {}
+
+    async def handler(job):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.1)
+        in_flight -= 1
+        return job.prompt.upper(), 10
+
+    def on_done(job, result_text, error):
+        results[job.key] = (result_text, error)
+
+    jobs = [Job(key=i, prompt=f"p{i}") for i in range(8)]
+    started = time.monotonic()
+    run_jobs(jobs, handler, RateLimiter(60000, request_burst=8), max_in_flight=4, on_done=on_done)
+    elapsed = time.monotonic() - started
+
+    assert peak == 4
+    assert elapsed < 0.5
+    assert results[3] == ("P3", None)
+
+
+def test_run_jobs_reports_errors():
+    """ハンドラーの例外がコールバックに渡されること"""
+    errors = []
+
+    async def handler(job):
+        raise RuntimeError("boom")
+
+    run_jobs([Job(key=0, prompt="x")], handler, RateLimiter(60000), 1,
+             on_done=lambda job, text, error: errors.append(error))
+
+    assert isinstance(errors[0], RuntimeError)
+
+
+def test_run_jobs_stops_when_on_done_raises():
+    """on_done が StopJobs を送出したら、残りのジョブを送信せずに終わること"""
+    sent = []
+
+    async def handler(job):
+        sent.append(job.key)
+        await asyncio.sleep(0.01)
+        return "ok", 1
+
+    def on_done(job, result_text, error):
+        raise StopJobs()
+
+    jobs = [Job(key=i, prompt=f"p{i}") for i in range(20)]
+    completed = run_jobs(jobs, handler, RateLimiter(60000, request_burst=20), max_in_flight=2, on_done=on_done)
+
+    assert completed is False
+    assert len(sent) <= 3
+
+
+def test_run_jobs_pulls_generator_lazily():
+    """max_queued を指定すると、ジェネレーターから未完了のジョブが上限を超えないように取り出すこと"""
+    pulled = 0
+    finished = []
+    ahead = []
+
+    def generate_jobs():
+        nonlocal pulled
+        for i in range(30):
+            pulled += 1
+            ahead.append(pulled - len(finished))
+            yield Job(key=i, prompt=f"p{i}")
+
+    async def handler(job):
+        await asyncio.sleep(0.005)
+        return "ok", 1
+
+    run_jobs(generate_jobs(), handler, RateLimiter(60000, request_burst=30), max_in_flight=2,
+             on_done=lambda job, text, error: finished.append(job.key), max_queued=4)
+
+    assert sorted(finished) == list(range(30))
+    assert max(ahead) <= 5
+
+
+class FakeQuotaError(Exception):
+    """google.api_core.exceptions.ResourceExhausted と同じ形の例外"""
+    code = 429
+
+
+class FakeServerError(Exception):
+    """google.api_core.exceptions.ServiceUnavailable と同じ形の例外"""
+    code = 503
+
+
+def test_classify_error_and_retry_hint():
+    """429とセーフティブロックを区別し、メッセージ中の待ち時間を読み取れること"""
+    error = FakeQuotaError("Resource exhausted. Please retry in 1.5s.")
+    assert classify_error(error) == ERROR_QUOTA
+    assert retry_after_seconds(error) == 1.5
+    assert classify_error(ValueError("response was blocked by safety filters")) == ERROR_SAFETY
+
+
+class EmptyResponse:
+    """候補が空のまま打ち切られた Gemini のレスポンスと同じく、text で ValueError を送出する"""
+
+    @property
+    def text(self):
+        raise ValueError("The `response.text` quick accessor only works when the response contains a valid `Part`")
+
+
+def test_only_response_errors_are_malformed():
+    """応答が読み取れない例外だけが再試行する malformed になり、入力の誤りによる ValueError は other になること"""
+    try:
+        response_text(EmptyResponse())
+    except MalformedResponseError as e:
+        empty = e
+    cases = [
+        ("空のレスポンス", empty, ERROR_MALFORMED),
+        ("壊れたJSON", json.JSONDecodeError("Expecting value", "{", 1), ERROR_MALFORMED),
+        ("Ollamaの応答の形式", OllamaResponseError("done を受け取る前に応答が終了しました"), ERROR_MALFORMED),
+        ("未対応のバックエンド", ValueError("未対応のバックエンドです: foo"), ERROR_OTHER),
+        ("環境変数がない", ValueError("環境変数 GEMINI_API_KEY が設定されていません"), ERROR_OTHER),
+    ]
+    for name, error, expected in cases:
+        assert classify_error(error) == expected, name
+    assert not RetryPolicy().should_retry(ValueError("未対応のバックエンドです: foo"), 1)
+
+
+def test_run_jobs_retries_throttled_requests():
+    """429は待ち時間の後に再試行され、リミッターが減速すること"""
+    calls = []
+    results = {}
+
+    async def handler(job):
+        calls.append(job.key)
+        if len(calls) == 1:
+            raise FakeQuotaError("quota exceeded, retry in 0.05s")
+        return "ok", 10
+
+    def on_done(job, result_text, error):
+        results[job.key] = (result_text, error, job.meta['attempts'])
+
+    limiter = RateLimiter(60000)
+    run_jobs([Job(key=0, prompt="x")], handler, limiter, 1, on_done=on_done,
+             retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01))
+
+    assert results[0] == ("ok", None, 2)
+    assert limiter.throttle_count == 1
+
+
+def test_run_jobs_stops_with_retries_pending():
+    """再試行の待ち中のジョブがキューの枠を埋めていても、StopJobs で打ち切れば実行が終わること"""
+    extra = Job(key='extra', prompt="x")  # on_done が追加したジョブ（ジェネレーターの枠を使わない）
+
+    async def handler(job):
+        if job.key in (0, 2):
+            raise FakeServerError("503 Service Unavailable")
+        await asyncio.sleep(0.01 if job.key == 1 else 0.05)
+        return "ok", 1
+
+    def on_done(job, result_text, error):
+        if job.key == 1:
+            return [extra]
+        if job is extra:
+            # このときジョブ0と2は再試行の待ち中で、ジェネレーターからの取り出しは枠が空くのを待っている
+            raise StopJobs()
+
+    async def run():
+        jobs = (Job(key=i, prompt=f"p{i}") for i in range(10))
+        return await asyncio.wait_for(run_jobs_async(
+            jobs, handler, RateLimiter(60000, request_burst=10), max_in_flight=2, on_done=on_done,
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=30), max_queued=2,
+        ), timeout=5)
+
+    assert asyncio.run(run()) is False
+
+
+def test_run_jobs_records_telemetry():
+    """呼び出しごとに待ち時間・レイテンシ・トークン数が記録されること"""
+    async def handler(job):
+        await asyncio.sleep(0.05)
+        job.meta['prompt_tokens'] = 7
+        job.meta['output_tokens'] = 3
+        return "ok", 10
+
+    telemetry = Telemetry()
+    run_jobs([Job(key=i, prompt="x") for i in range(2)], handler, RateLimiter(60000), 1, telemetry=telemetry)
+
+    first, second = telemetry.records
+    assert first['latency'] >= 0.05 and first['prompt_tokens'] == 7
+    assert second['queue_wait'] >= 0.05  # 1件目が終わるまで同時実行の空きを待つ
+    assert "同時実行の空き待ち" in telemetry.report()
+
+
+if __name__ == "__main__":
+    test_token_bucket_paces_requests()
+    test_run_jobs_keeps_requests_in_flight()
+    test_run_jobs_reports_errors()
+    test_run_jobs_stops_when_on_done_raises()
+    test_run_jobs_pulls_generator_lazily()
+    test_classify_error_and_retry_hint()
+    test_only_response_errors_are_malformed()
+    test_run_jobs_retries_throttled_requests()
+    test_run_jobs_stops_with_retries_pending()
+    test_run_jobs_records_telemetry()
+    print("✅ llm_executor のテストがすべて成功しました")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+llm_telemetry のメトリクスファイルへの記録とレポートの集計をテストするスクリプト
+"""
+
+import os
+import tempfile
+
+from llm_errors import MalformedResponseError
+from llm_executor import Job
+from llm_telemetry import Telemetry, build_report, load_records
+
+RECORD_FIELDS = {
+    'timestamp', 'key', 'backend', 'model', 'attempt', 'status', 'error_type', 'queue_wait', 'rate_limit_wait',
+    'first_token_seconds', 'latency', 'postprocess_seconds', 'prompt_tokens', 'output_tokens',
+}
+
+
+def make_record(backend, latency, timestamp, error_type=None, attempt=1, first_token_seconds=None, **times):
+    """build_report() に渡す1件分の記録（待ち時間などは times で上書きする）"""
+    record = {
+        'timestamp': timestamp, 'key': f'{backend}-{timestamp}', 'backend': backend, 'model': f'{backend}-model',
+        'attempt': attempt, 'status': 'ok' if error_type is None else 'error', 'error_type': error_type,
+        'queue_wait': 0.0, 'rate_limit_wait': 0.0, 'first_token_seconds': first_token_seconds, 'latency': latency,
+        'postprocess_seconds': 0.0, 'prompt_tokens': 100, 'output_tokens': 50,
+    }
+    record.update(times)
+    return record
+
+
+def test_records_are_appended_as_jsonl():
+    """呼び出し1件ごとに決まった項目の記録を1行追記し、Jobの計測値は次の試行に持ち越さないこと"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'metrics.jsonl')
+        telemetry = Telemetry(path, backend='gemini', model='gemini-2.5-flash')
+        job = Job(key=7, prompt='p', meta={'first_token_seconds': 0.123456, 'prompt_tokens': 120,
+                                           'output_tokens': 80, 'attempts': 2})
+        telemetry.record_job(job, latency=1.23456, queue_wait=0.5, rate_limit_wait=0.25, postprocess_seconds=0.01)
+        assert not {'first_token_seconds', 'prompt_tokens', 'output_tokens'} & set(job.meta)
+        telemetry.record_job(job, latency=0.5, error=TimeoutError("timed out"), backend='local', model='gpt-oss:20b')
+        telemetry.record('8', latency=0.1, error=MalformedResponseError("empty"))
+        telemetry.close()
+
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"timestamp": 1')  # 書き込みの途中で止まった行は読み飛ばす
+        records = load_records(path)
+
+    assert len(records) == 3 and all(set(record) == RECORD_FIELDS for record in records)
+    first, second, third = records
+    assert first['key'] == '7' and (first['backend'], first['model']) == ('gemini', 'gemini-2.5-flash')
+    assert (first['status'], first['error_type'], first['attempt']) == ('ok', None, 2)
+    assert (first['latency'], first['first_token_seconds']) == (1.2346, 0.1235)
+    assert (first['queue_wait'], first['rate_limit_wait'], first['postprocess_seconds']) == (0.5, 0.25, 0.01)
+    assert (first['prompt_tokens'], first['output_tokens']) == (120, 80)
+    assert (second['backend'], second['model']) == ('local', 'gpt-oss:20b')
+    assert (second['status'], second['error_type']) == ('error', 'timeout')
+    assert (second['first_token_seconds'], second['prompt_tokens']) == (None, 0)
+    assert third['error_type'] == 'malformed' and third['attempt'] == 1
+
+
+def test_report_aggregates_per_backend_and_error_class():
+    """件数・エラーの種別・再試行・バックエンド別の件数とレイテンシ・所要時間の内訳を集計すること"""
+    records = [
+        make_record('gemini', 2.0, timestamp=12.0, first_token_seconds=0.5, rate_limit_wait=10.0),
+        make_record('gemini', 4.0, timestamp=20.0, first_token_seconds=1.5),
+        make_record('gemini', 1.0, timestamp=21.0, error_type='quota'),
+        make_record('gemini', 1.0, timestamp=22.0, error_type='quota', attempt=2),
+        make_record('local', 3.0, timestamp=30.0, first_token_seconds=1.0, queue_wait=2.0),
+        make_record('local', 1.0, timestamp=40.0, error_type='timeout'),
+    ]
+    lines = build_report(records).split('\n')
+
+    # 最初の呼び出しは 12 - 2 - 10 = 0 秒に始まり、最後の記録は 40 秒
+    assert "経過時間: 40.0 秒 / 呼び出し 6 件 (成功 3 件, エラー 3 件, 再試行 1 件)" in lines
+    assert "エラーの種別: quota 2 件, timeout 1 件" in lines
+    assert "レイテンシ: p50 3.00 秒 / p95 4.00 秒 / 最大 4.00 秒" in lines
+    assert "最初のトークンまで: 中央値 1.00 秒" in lines
+    assert "スループット: 9.0 RPM, 入力 15 トークン/秒, 出力 8 トークン/秒" in lines
+    backends = lines.index("バックエンド別:")
+    assert lines[backends + 1:backends + 3] == ["  gemini: 4 件, p50 2.00 秒", "  local: 2 件, p50 3.00 秒"]
+    assert "  レート制限待ち: 平均 1.67 秒 (42%)" in lines
+    assert lines[-1] == "最も時間を使っているのは「レート制限待ち」です。"
+
+    # バックエンドが1つならバックエンド別は出さず、記録がなければその旨を返す
+    assert "バックエンド別:" not in build_report(records[:4])
+    assert build_report([]) == "計測データがありません。"
+
+
+if __name__ == "__main__":
+    test_records_are_appended_as_jsonl()
+    test_report_aggregates_per_backend_and_error_class()
+    print("✅ llm_telemetry のテストがすべて成功しました")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+markdown_normalizer のルールベースの整形をテストするスクリプト
+"""
+
+from diary_schema import DIARY_SECTIONS, PROMPT_SECTION_NAMES, render_markdown
+from markdown_normalizer import (
+    REASON_EMPTY, REASON_EMPTY_SECTION, REASON_EXTRA_PREAMBLE, REASON_NO_DATE, REASON_NO_TITLE, REASON_ORDER,
+    REASON_SECTIONS, TEMPLATE_SECTIONS, normalize_markdown,
+)
+
+DATE = '2023年1月3日'
+TITLE = '二十年目の殺意'
+BODIES = [f'{name.split(" - ")[0]}の本文。' for name in TEMPLATE_SECTIONS]
+
+# どの表記から整形しても、この出力になるはず
+EXPECTED = '\n\n'.join(
+    [f'## {DATE}', f'### {TITLE}'] +
+    [block for name, body in zip(TEMPLATE_SECTIONS, BODIES) for block in (f'### **{name}**', body)]
+)
+
+
+def diary(headings, preamble=(f'## {DATE}', f'### {TITLE}'), bodies=BODIES, separator='\n\n'):
+    """見出しの行と本文から日記のMarkdownを組み立てる"""
+    blocks = list(preamble)
+    for heading, body in zip(headings, bodies):
+        blocks += [heading, body]
+    return separator.join(blocks)
+
+
+def test_heading_variants_are_normalized():
+    """見出しのレベル・番号・太字の有無と、両方のプロンプトのセクション名のゆれに関係なく同じ出力になること"""
+    cases = [
+        ("出力テンプレートのまま", diary([f'### **{name}**' for name in TEMPLATE_SECTIONS])),
+        ("生成プロンプトの名前（##）", diary([f'## {name}' for name in PROMPT_SECTION_NAMES])),
+        ("生成プロンプトの名前（### 太字）", diary([f'### **{name}**' for name in PROMPT_SECTION_NAMES])),
+        ("番号付き", diary([f'{number}. {name}' for number, name in enumerate(TEMPLATE_SECTIONS, 1)])),
+        ("見出しと番号", diary([f'### {number}. {name}' for number, name in enumerate(PROMPT_SECTION_NAMES, 1)])),
+        ("全角の番号", diary([f'{chr(ord("０") + number)}．{name}' for number, name in enumerate(TEMPLATE_SECTIONS, 1)])),
+        ("太字だけ", diary([f'**{name}**' for name in PROMPT_SECTION_NAMES])),
+        ("短い名前とコロン", diary(['**導入：**', '## 遭遇', '### 捜査', '### 閃き', '### 真相解明', '### 結び'])),
+        ("言い回しの違う後半", diary([f'### {name.split(" - ")[0]} - 別の言い回し' for name in TEMPLATE_SECTIONS])),
+        ("日付とタイトルが見出しでない", diary([f'### {name}' for name in TEMPLATE_SECTIONS], preamble=(DATE, TITLE))),
+        ("太字の日付とタイトル", diary([f'## {name}' for name in TEMPLATE_SECTIONS], preamble=(f'**{DATE}**', f'**{TITLE}**'))),
+        ("コードブロックとCRLFと連続する空行",
+         '```markdown\r\n' + diary([f'### {name}' for name in TEMPLATE_SECTIONS], separator='\r\n\r\n\r\n') + '\r\n```'),
+        ("区切り線", diary([f'---\n### {name}' for name in TEMPLATE_SECTIONS])),
+    ]
+    for name, text in cases:
+        assert normalize_markdown(text) == (EXPECTED, None), name
+
+
+def test_body_paragraphs_are_kept():
+    """本文の段落は空行1行で区切り直し、本文中の太字は見出しとみなさないこと"""
+    bodies = ['**蘭**は言った。\n\n\n\n二段落目。  '] + BODIES[1:]
+    normalized, reason = normalize_markdown(diary([f'### {name}' for name in TEMPLATE_SECTIONS], bodies=bodies))
+    assert reason is None
+    assert '### **導入 - その日の始まり**\n\n**蘭**は言った。\n\n二段落目。\n\n### **遭遇' in normalized
+
+
+def test_rendered_diaries_are_already_normalized():
+    """構造化出力から組み立てた日記は、整形しても変わらないこと"""
+    data = {
+        'date': DATE, 'title': TITLE,
+        'sections': {key: body for (key, _), body in zip(DIARY_SECTIONS, BODIES)},
+    }
+    rendered = render_markdown(data)
+    assert rendered == EXPECTED
+    assert normalize_markdown(rendered) == (rendered, None)
+
+
+def test_unmatched_layouts_return_reason():
+    """確実に対応付けられない日記は整形せず、理由を返すこと"""
+    headings = [f'### **{name}**' for name in TEMPLATE_SECTIONS]
+    swapped = headings[:1] + [headings[2], headings[1]] + headings[3:]
+    cases = [
+        ("空", '', REASON_EMPTY),
+        ("コードブロックだけ", '```markdown\n\n```', REASON_EMPTY),
+        ("日付がない", diary(headings, preamble=(f'### {TITLE}',)), REASON_NO_DATE),
+        ("日付の前に前置き", diary(headings, preamble=('はい、整形しました。', f'## {DATE}', f'### {TITLE}')), REASON_NO_DATE),
+        ("タイトルがない", diary(headings, preamble=(f'## {DATE}',)), REASON_NO_TITLE),
+        ("見出しでない長いタイトル", diary(headings, preamble=(f'## {DATE}', 'あ' * 61)), REASON_NO_TITLE),
+        ("タイトルの後に余分な行", diary(headings, preamble=(f'## {DATE}', f'### {TITLE}', '以下が日記です。')),
+         REASON_EXTRA_PREAMBLE),
+        ("セクションが足りない", diary(headings[:5]), REASON_SECTIONS),
+        ("同じセクションが2回", diary(headings[:5] + headings[4:5]), REASON_SECTIONS),
+        ("セクションが多い", diary(headings + headings[:1], bodies=BODIES + ['余分']), REASON_SECTIONS),
+        ("セクションの順序が違う", diary(swapped), REASON_ORDER),
+        ("本文が空のセクション", diary(headings, bodies=BODIES[:2] + ['---'] + BODIES[3:]), REASON_EMPTY_SECTION),
+    ]
+    for name, text, expected in cases:
+        assert normalize_markdown(text) == (None, expected), name
+
+
+if __name__ == "__main__":
+    test_heading_variants_are_normalized()
+    test_body_paragraphs_are_kept()
+    test_rendered_diaries_are_already_normalized()
+    test_unmatched_layouts_return_reason()
+    print("✅ markdown_normalizer のテストがすべて成功しました")
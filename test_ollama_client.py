@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ollama_client のNDJSONの読み取り・締め切り時間・接続の使い回しをテストするスクリプト
+"""
+
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from ollama_client import OllamaClient, OllamaDeadlineExceeded, OllamaResponseError
+
+MESSAGES = [{"role": "user", "content": "日記を書いて"}]
+
+
+def ndjson(*chunks):
+    return ''.join(json.dumps(chunk, ensure_ascii=False) + '\n' for chunk in chunks).encode('utf-8')
+
+
+def content(text):
+    return {'message': {'role': 'assistant', 'content': text}, 'done': False}
+
+
+DONE = {'message': {'role': 'assistant', 'content': ''}, 'done': True, 'prompt_eval_count': 12, 'eval_count': 40,
+        'prompt_eval_duration': 100_000_000, 'eval_duration': 2_000_000_000, 'load_duration': 5_000_000}
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    """
+    /api/chat の代わりに、決めておいた応答を Ollama と同じく chunked で少しずつ返すハンドラー
+
+    server.replies の先頭から1件ずつ (ステータス, [(待つ秒数, 送るバイト列), ...]) を使い、
+    リクエストの本文と、送ってきたクライアントのポート番号を server.requests に記録します。
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((self.client_address[1], payload))
+        status, pieces = self.server.replies.pop(0)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for delay, data in pieces:
+            time.sleep(delay)
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_server(*replies):
+    """replies を順に返すサーバーと、そこにつないだクライアント"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOllama)
+    server.daemon_threads = True
+    server.replies = list(replies)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    client = OllamaClient(f'http://127.0.0.1:{server.server_address[1]}/api/chat', 'gpt-oss:20b', keep_alive='10m')
+    try:
+        yield server, client
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def ok(*pieces):
+    """待たずに pieces を順に送る 200 の応答"""
+    return 200, [(0, piece) for piece in pieces]
+
+
+def test_chat_joins_streamed_content():
+    """ストリーミングで届いた本文をつなげ、最後の行の計測値を返すこと"""
+    # 行の途中でチャンクが切れていても、空行が混ざっていても読み取れる
+    body = ndjson(content('## 2023年1月3日\n'), content('今日は'))
+    reply = ok(body[:15], body[15:] + b'\n', ndjson(content('蘭と出かけた。')), ndjson(DONE))
+    with stub_server(reply) as (server, client):
+        result = client.chat(MESSAGES, deadline_seconds=30, options={'temperature': 0.2})
+    assert result.text == '## 2023年1月3日\n今日は蘭と出かけた。'
+    assert (result.prompt_eval_count, result.eval_count, result.load_duration) == (12, 40, 5_000_000)
+    assert result.tokens_per_second == 20.0
+    assert result.first_token_seconds is not None
+    _, payload = server.requests[0]
+    assert payload == {'model': 'gpt-oss:20b', 'messages': MESSAGES, 'stream': True, 'keep_alive': '10m',
+                       'options': {'temperature': 0.2}}
+
+
+def test_malformed_streams_raise():
+    """途中で切れた応答・done のない応答・エラーの行は、形式が不正な応答として例外にすること"""
+    cases = [
+        ("最後の行が途中で切れた", ok(ndjson(content('今日は')), ndjson(content('蘭と'))[:-10])),
+        ("文字の途中で切れた", ok(ndjson(content('今日は')), ndjson(content('蘭と'))[:-20])),
+        ("done の前に終わった", ok(ndjson(content('今日は'), content('蘭と')))),
+        ("JSONでない行", ok(ndjson(content('今日は')), b'<html>502 Bad Gateway</html>\n')),
+        ("エラーの行", ok(ndjson({'error': 'model "gpt-oss:20b" not found'}))),
+        ("空の応答", ok()),
+    ]
+    with stub_server(*[reply for _, reply in cases]) as (server, client):
+        for name, _ in cases:
+            try:
+                client.chat(MESSAGES)
+            except OllamaResponseError:
+                continue
+            raise AssertionError(f"{name}: 例外になりませんでした")
+
+    # HTTPのエラーは通信エラーとしてそのまま伝える
+    with stub_server((500, [])) as (server, client):
+        try:
+            client.chat(MESSAGES)
+        except requests.exceptions.HTTPError as e:
+            assert e.response.status_code == 500
+        else:
+            raise AssertionError("HTTP 500 が例外になりませんでした")
+
+
+def test_deadline_stops_slow_generation():
+    """締め切り時間を過ぎても生成が続いていれば打ち切り、締め切りがなければ最後まで待つこと"""
+    slow = (200, [(0, ndjson(content('今日は'))), (0.5, ndjson(content('蘭と'))), (0, ndjson(DONE))])
+    with stub_server(slow, slow) as (server, client):
+        started = time.monotonic()
+        try:
+            client.chat(MESSAGES, deadline_seconds=0.2)
+        except OllamaDeadlineExceeded:
+            pass
+        else:
+            raise AssertionError("締め切り時間を過ぎても打ち切られませんでした")
+        assert time.monotonic() - started < 2
+        assert client.chat(MESSAGES).text == '今日は蘭と'
+
+
+def test_connection_is_reused():
+    """続けて呼び出しても、同じ接続を使い回すこと（done の後の終端まで読み切ってからプールに戻す）"""
+    reply = ok(ndjson(content('日記')), ndjson(DONE))
+    with stub_server(reply, reply, reply) as (server, client):
+        for _ in range(3):
+            assert client.chat(MESSAGES).text == '日記'
+    ports = [port for port, _ in server.requests]
+    assert len(ports) == 3 and len(set(ports)) == 1
+
+
+if __name__ == "__main__":
+    test_chat_joins_streamed_content()
+    test_malformed_streams_raise()
+    test_deadline_stops_slow_generation()
+    test_connection_is_reused()
+    print("✅ ollama_client のテストがすべて成功しました")
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+prompt_dedup の同じプロンプトのまとめ方をテストするスクリプト
+"""
+
+from llm_executor import Job
+from prompt_dedup import DUPLICATES_META, VARIANT_META, plan_requests, prompt_fingerprint
+
+
+def test_plan_requests_fans_out_duplicate_prompts():
+    """空白だけが違う同じ題材の行は1件にまとまり、バリエーション数を指定すると行が順番に振り分けられること"""
+    prompts = {"w1": "事件の概要", "w2": "事件の概要  ", "w3": "事件の概要", "other": "別の事件"}
+    jobs = [Job(key=key, prompt=prompt) for key, prompt in prompts.items()]
+
+    sent, plan = plan_requests(jobs, lambda job: prompt_fingerprint(job.prompt))
+    assert [job.key for job in sent] == ["w1", "other"]
+    assert sent[0].meta[DUPLICATES_META] == ["w2", "w3"]
+    assert plan.saved == 2 and "2 リクエストを節約" in plan.summary()
+
+    jobs = [Job(key=key, prompt=prompt) for key, prompt in prompts.items()]
+    sent, plan = plan_requests(jobs, lambda job: prompt_fingerprint(job.prompt), variants=2)
+    assert [(job.key, job.meta[VARIANT_META], job.meta[DUPLICATES_META]) for job in sent] == [
+        ("w1", 0, ["w3"]), ("w2", 1, []), ("other", 0, []),
+    ]
+
+
+if __name__ == "__main__":
+    test_plan_requests_fans_out_duplicate_prompts()
+    print("✅ prompt_dedup のテストがすべて成功しました")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+quota_planner の1日の使用量の記録と実行計画の見積もりをテストするスクリプト
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+
+import quota_planner
+from llm_errors import is_daily_quota_error
+from quota_planner import DailyUsage, TokenCounter, next_reset, plan_run
+
+
+def test_plan_run_waits_for_daily_reset():
+    """1日の上限を超える分は、リセットを待ってから送る見積もりになり、使用量は再起動しても引き継がれること"""
+    counter = TokenCounter.calibrate(["あいう" * 10] * 4, lambda prompt: 60)
+    assert counter.count("あいう" * 10) == 60
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'usage.json')
+        usage = DailyUsage('model', requests_per_day=20, path=path)
+        asyncio.run(usage.acquire())
+        usage.record_tokens(100)
+        usage.close()
+        usage = DailyUsage('model', requests_per_day=20, path=path)
+        assert (usage.requests, usage.tokens, usage.remaining_requests) == (1, 100, 19)
+
+        now = next_reset() - 3600  # リセットの1時間前
+        plan = plan_run('model', [100] * 10, output_tokens=50, requests_per_minute=60, usage=usage, now=now)
+        assert plan.days == 1 and plan.seconds == 10
+        plan = plan_run('model', [100] * 30, output_tokens=50, requests_per_minute=60, usage=usage, now=now)
+        # 今日の残り19件を送ったらリセットまで待ち、翌日に残りの11件を送る
+        assert plan.days == 2 and plan.remaining_today == 19
+        assert plan.seconds == 3600 + 11
+
+    daily = RuntimeError("429 Quota exceeded, quota_id: GenerateRequestsPerDayPerProjectPerModel-FreeTier")
+    assert is_daily_quota_error(daily)
+    assert not is_daily_quota_error(RuntimeError("429 Too Many Requests, quota_id: GenerateRequestsPerMinute"))
+
+
+def test_daily_usage_starts_new_day_from_zero():
+    """日付が変わったら、保存していなかった前日の使用量を新しい日に持ち越さないこと"""
+    original_quota_day = quota_planner.quota_day
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'usage.json')
+        try:
+            quota_planner.quota_day = lambda now=None: '2026-01-01'
+            usage = DailyUsage('model', requests_per_day=20, path=path)
+            asyncio.run(usage.acquire())
+            usage.record_tokens(100)  # 保存の間隔が来ていないので、まだファイルには書かれていない
+
+            quota_planner.quota_day = lambda now=None: '2026-01-02'
+            asyncio.run(usage.acquire())
+            usage.close()
+        finally:
+            quota_planner.quota_day = original_quota_day
+        with open(path, encoding='utf-8') as f:
+            entry = json.load(f)['model']
+        assert (entry['day'], entry['requests'], entry['tokens']) == ('2026-01-02', 1, 0)
+
+
+def test_daily_usage_is_shared_per_api_key():
+    """同じAPIキーのプロセスは1つの記録を共有し、別のキーとは分かれ、キーそのものはファイルに残らないこと"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'usage.json')
+        for api_key in ['key-a', 'key-a', 'key-b']:
+            usage = DailyUsage('model', requests_per_day=20, path=path, api_key=api_key)
+            asyncio.run(usage.acquire())
+            usage.close()
+
+        shard = DailyUsage('model', requests_per_day=20, path=path, api_key='key-a')
+        assert shard.remaining_requests == 18
+        assert DailyUsage('model', requests_per_day=20, path=path, api_key='key-b').remaining_requests == 19
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        assert sorted(json.loads(text)) == sorted([
+            f"model#{quota_planner.api_key_id('key-a')}", f"model#{quota_planner.api_key_id('key-b')}",
+        ])
+        assert 'key-a' not in text and 'key-b' not in text
+
+
+def test_runners_with_same_api_key_share_one_limit():
+    """同じAPIキーで同時に動く2つのランナーは、1日の上限を合わせて守ること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'usage.json')
+        flash = DailyUsage('gemini-2.5-flash', requests_per_day=3, path=path, api_key='key-a')
+        router = DailyUsage('gemini-2.5-flash', requests_per_day=3, path=path, api_key='key-a')
+        other_key = DailyUsage('gemini-2.5-flash', requests_per_day=3, path=path, api_key='key-b')
+
+        assert flash.try_acquire() and flash.try_acquire()
+        flash.save()
+        router.save()  # 保存のたびに、ほかのランナーの分も含めた使用量に合わせる
+        assert router.remaining_requests == 1
+        assert router.try_acquire() and not router.try_acquire()
+        router.save()
+        flash.save()
+        assert not flash.try_acquire()
+        assert other_key.try_acquire()
+
+
+def record_requests(path, count):
+    """別のプロセスで count 件のリクエストを数え、1件ごとに保存する"""
+    usage = DailyUsage('model', path=path)
+    for _ in range(count):
+        assert usage.try_acquire()
+        usage.save()
+
+
+def test_concurrent_saves_keep_every_request():
+    """同じ使用量ファイルに複数のプロセスが同時に保存しても、どのプロセスの分も失われないこと"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'usage.json')
+        processes = [multiprocessing.Process(target=record_requests, args=(path, 50)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert all(process.exitcode == 0 for process in processes)
+        assert DailyUsage('model', path=path).requests == 200
+
+
+if __name__ == "__main__":
+    test_plan_run_waits_for_daily_reset()
+    test_daily_usage_starts_new_day_from_zero()
+    test_daily_usage_is_shared_per_api_key()
+    test_runners_with_same_api_key_share_one_limit()
+    test_concurrent_saves_keep_every_request()
+    print("✅ quota_planner のテストがすべて成功しました")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+response_cache のキャッシュキー・保存と取り出し・LRUによる削除・統計をテストするスクリプト
+"""
+
+import contextlib
+import itertools
+import os
+import tempfile
+
+import response_cache
+from response_cache import ResponseCache, make_cache_key
+
+
+@contextlib.contextmanager
+def open_cache(max_bytes=None):
+    """一時ディレクトリにキャッシュを作り、参照時刻は呼ぶたびに1秒ずつ進む時計で記録する"""
+    original = response_cache.time.time
+    clock = itertools.count(1000)
+    response_cache.time.time = lambda: next(clock)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            cache = ResponseCache(os.path.join(work_dir, 'responses.sqlite3'), max_bytes=max_bytes)
+            try:
+                yield cache
+            finally:
+                cache.close()
+    finally:
+        response_cache.time.time = original
+
+
+def test_cache_key_depends_on_every_part():
+    """キーはバックエンド・モデル・生成設定・プロンプトの内容だけで決まり、どれかが変われば別のキーになること"""
+    base = make_cache_key('gemini', 'gemini-2.5-flash', {'temperature': 0.5, 'top_p': 0.9}, '日記を書いて')
+    same = [
+        ("同じ内容", make_cache_key('gemini', 'gemini-2.5-flash', {'temperature': 0.5, 'top_p': 0.9}, '日記を書いて')),
+        ("設定の順序が違う", make_cache_key('gemini', 'gemini-2.5-flash', {'top_p': 0.9, 'temperature': 0.5}, '日記を書いて')),
+    ]
+    for name, key in same:
+        assert key == base, name
+    assert make_cache_key('gemini', 'm', None, 'p') == make_cache_key('gemini', 'm', {}, 'p')
+
+    different = [
+        ("バックエンド", make_cache_key('ollama', 'gemini-2.5-flash', {'temperature': 0.5, 'top_p': 0.9}, '日記を書いて')),
+        ("モデル", make_cache_key('gemini', 'gemini-2.5-pro', {'temperature': 0.5, 'top_p': 0.9}, '日記を書いて')),
+        ("生成設定", make_cache_key('gemini', 'gemini-2.5-flash', {'temperature': 0.7, 'top_p': 0.9}, '日記を書いて')),
+        ("プロンプト", make_cache_key('gemini', 'gemini-2.5-flash', {'temperature': 0.5, 'top_p': 0.9}, '日記を書いて。')),
+    ]
+    for name, key in different:
+        assert key != base, name
+    assert len(base) == 64
+
+
+def test_get_returns_stored_response():
+    """保存していないキーはNone、保存したキーはレスポンスを返し、同じキーに保存し直すと置き換わること"""
+    with open_cache() as cache:
+        key = make_cache_key('gemini', 'm', None, 'p')
+        assert cache.get(key) is None
+        cache.put(key, '日記A', 'gemini', 'm')
+        assert cache.get(key) == '日記A'
+        cache.put(key, '日記B', 'gemini', 'm')
+        assert cache.get(key) == '日記B'
+        assert cache.stats()['entries'] == 1
+
+        # 別の実行（同じファイルを開いた別のキャッシュ）からも取り出せる
+        other = ResponseCache(cache.path)
+        try:
+            assert other.get(key) == '日記B'
+        finally:
+            other.close()
+
+
+def test_least_recently_used_entries_are_evicted():
+    """合計サイズが上限を超えたら、最後に参照された時刻が古いものから上限に収まるまで削除すること"""
+    with open_cache(max_bytes=30) as cache:
+        for key in 'abc':
+            cache.put(key, key * 10)
+        cache.get('a')  # a を参照したので、いちばん古いのは b になる
+        cache.put('d', 'd' * 10)
+        assert [key for key in 'abcd' if cache.get(key) is not None] == ['a', 'c', 'd']
+        assert cache.evictions == 1
+
+        # 上限より大きいレスポンスを保存すると、それ以外はすべて消える
+        cache.put('e', 'e' * 25)
+        assert [key for key in 'acde' if cache.get(key) is not None] == ['e']
+        stats = cache.stats()
+        assert (stats['entries'], stats['bytes'], stats['evictions']) == (1, 25, 4)
+
+
+def test_stats_count_hits_and_misses():
+    """ヒット数・ミス数・ヒット率・件数・合計サイズを数え、summary() に表示すること"""
+    with open_cache(max_bytes=1024 * 1024) as cache:
+        assert cache.stats()['hit_rate'] == 0.0
+        cache.put('a', 'あいう')  # UTF-8で9バイト
+        cache.get('a')
+        cache.get('a')
+        cache.get('a')
+        cache.get('missing')
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['hit_rate']) == (3, 1, 0.75)
+        assert (stats['entries'], stats['bytes'], stats['evictions'], stats['max_bytes']) == (1, 9, 0, 1024 * 1024)
+        assert 'ヒット 3 件 / ミス 1 件 (ヒット率 75.0%), 保存件数 1 件' in cache.summary()
+
+
+if __name__ == "__main__":
+    test_cache_key_depends_on_every_part()
+    test_get_returns_stored_response()
+    test_least_recently_used_entries_are_evicted()
+    test_stats_count_hits_and_misses()
+    print("✅ response_cache のテストがすべて成功しました")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+results_store の結果ストア（Parquet）とCSVの読み書きをテストするスクリプト
+"""
+
+import os
+import tempfile
+
+import pandas as pd
+
+from results_store import ATTEMPTS_COLUMN, MODEL_COLUMN, STORE_ONLY_COLUMNS, TableWriter, read_table, write_table
+
+
+def make_results(count=6):
+    """結果CSVと同じ列構成（結果ストアにだけ保存する列を除く）の結果"""
+    return pd.DataFrame({
+        'ID': [f'e{number}' for number in range(count)],
+        'エピソードタイトル': [f'{number}番目の事件' for number in range(count)],
+        '生成結果': [f'## 2023/01/0{number + 1}\n\n日記の本文、"引用"を含む。' * 3 for number in range(count)],
+        'ステータス': ['完了'] * (count - 1) + ['失敗'],
+        'エラー内容': [None] * (count - 1) + ['タイムアウト'],
+        'パラレルワールド名': [f'パラレルワールド{number % 2 + 1}' for number in range(count)],
+    })
+
+
+def read_text(path, encoding='utf-8'):
+    with open(path, encoding=encoding) as f:
+        return f.read()
+
+
+def values(series):
+    """欠損値を None にそろえた値のリスト"""
+    return [None if pd.isna(value) else value for value in series]
+
+
+def test_csv_round_trip_through_store():
+    """CSVを結果ストアに取り込んでCSVに書き戻すと、元のCSVと同じ内容になること"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        source = os.path.join(work_dir, 'results.csv')
+        store = os.path.join(work_dir, 'results.parquet')
+        restored = os.path.join(work_dir, 'restored.csv')
+        make_results().to_csv(source, index=False, encoding='utf-8-sig')
+
+        write_table(read_table(source, encoding='utf-8-sig'), store)
+        stored = read_table(store)
+        assert isinstance(stored['ステータス'].dtype, pd.CategoricalDtype)  # 値の種類が少ない列は辞書エンコード
+        assert not isinstance(stored['生成結果'].dtype, pd.CategoricalDtype)  # 日記の本文は文字列型のまま
+        write_table(stored, restored, encoding='utf-8-sig')
+
+        assert read_text(restored, 'utf-8-sig') == read_text(source, 'utf-8-sig')
+        assert not os.path.exists(store + '.tmp') and not os.path.exists(restored + '.tmp')
+
+
+def test_store_only_columns_are_dropped_from_csv():
+    """試行回数とモデル名の列は結果ストアにだけ保存し、CSVには書き出さないこと"""
+    df = make_results(count=2).assign(**{ATTEMPTS_COLUMN: [1, 3], MODEL_COLUMN: ['flash', 'pro']})
+    with tempfile.TemporaryDirectory() as work_dir:
+        csv_path = os.path.join(work_dir, 'results.csv')
+        store = os.path.join(work_dir, 'results.parquet')
+        write_table(df, csv_path)
+        assert list(read_table(csv_path).columns) == list(make_results().columns)
+
+        write_table(df, store)
+        stored = read_table(store)
+        assert values(stored[ATTEMPTS_COLUMN]) == [1, 3] and values(stored[MODEL_COLUMN]) == ['flash', 'pro']
+
+        with TableWriter(csv_path) as writer:
+            writer.write(df)
+        assert not set(STORE_ONLY_COLUMNS) & set(read_table(csv_path).columns)
+
+
+def test_table_writer_appends_chunks():
+    """チャンクごとに書き出した結果が、最初のチャンクで決めた型のままつながること"""
+    chunks = [
+        # 最初のチャンクではエラー内容がすべて欠けていて、モデル名はカテゴリ型
+        pd.DataFrame({'ID': ['a', 'b'], 'エラー内容': [None, None], ATTEMPTS_COLUMN: [1, 2],
+                      MODEL_COLUMN: pd.Series(['flash', 'flash'], dtype='category')}),
+        # 試行回数がすべて欠けていて、モデル名のカテゴリが最初のチャンクと違う
+        pd.DataFrame({'ID': ['c', 'd'], 'エラー内容': ['タイムアウト', None], ATTEMPTS_COLUMN: [None, None],
+                      MODEL_COLUMN: pd.Series(['pro', 'local'], dtype='category')}),
+        pd.DataFrame({'ID': ['e'], 'エラー内容': [None], ATTEMPTS_COLUMN: ['0'], MODEL_COLUMN: ['flash']}),
+    ]
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in ('results.parquet', 'results.csv'):
+            path = os.path.join(work_dir, name)
+            with TableWriter(path) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            assert writer.rows == 5 and not os.path.exists(path + '.tmp')
+
+            df = read_table(path)
+            assert values(df['ID']) == ['a', 'b', 'c', 'd', 'e'], name
+            assert values(df['エラー内容']) == [None, None, 'タイムアウト', None, None], name
+            if name.endswith('.parquet'):
+                assert values(df[ATTEMPTS_COLUMN]) == [1, 2, None, None, 0]
+                assert values(df[MODEL_COLUMN]) == ['flash', 'flash', 'pro', 'local', 'flash']
+            else:
+                assert list(df.columns) == ['ID', 'エラー内容']
+
+
+def test_table_writer_keeps_previous_output_on_error():
+    """書き出しの途中で失敗した場合は、前回の出力を残して一時ファイルを消すこと"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'results.parquet')
+        write_table(make_results(), path)
+        try:
+            with TableWriter(path) as writer:
+                writer.write(make_results(count=2))
+                raise RuntimeError("途中で失敗")
+        except RuntimeError:
+            pass
+        assert len(read_table(path)) == 6
+        assert not os.path.exists(path + '.tmp')
+
+
+if __name__ == "__main__":
+    test_csv_round_trip_through_store()
+    test_store_only_columns_are_dropped_from_csv()
+    test_table_writer_appends_chunks()
+    test_table_writer_keeps_previous_output_on_error()
+    print("✅ results_store のテストがすべて成功しました")
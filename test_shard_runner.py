@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shard_runner のシャードごとのジャーナルのマージをテストするスクリプト
+"""
+
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from checkpoint_journal import STATUS_COLUMN, STATUS_DONE, STATUS_FAILED
+from results_store import read_table
+from shard_runner import (
+    load_merged_done_keys, merge_records, merge_shards, merge_shards_streaming, merge_summary, shard_of, shard_path,
+)
+
+
+def append_journal(path, key, status, text, completed_at):
+    """記録時刻を指定して、ジャーナルの形式で1件を追記する"""
+    record = {'ID': key, '生成結果': text, STATUS_COLUMN: status, 'completed_at': completed_at}
+    if status == STATUS_FAILED:
+        record['エラー内容'] = 'APIエラー'
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def write_journal(path, records):
+    """(キー, ステータス, 生成結果, 記録時刻) のリストをジャーナルの形式で書き出す"""
+    for record in records:
+        append_journal(path, *record)
+
+
+def write_input(work_dir, keys):
+    path = os.path.join(work_dir, 'input.csv')
+    pd.DataFrame({'ID': keys, 'エピソードタイトル': [f'{key}の事件' for key in keys]}).to_csv(path, index=False)
+    return path
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_merge_records_prefers_completed_rows():
+    """完了は後から記録された失敗より優先し、同じステータスなら後の記録を使い、マージの順に関係なく同じ結果になること"""
+    first = {
+        'a': {'ID': 'a', STATUS_COLUMN: STATUS_DONE, '生成結果': '古い完了', 'completed_at': '2026-01-01T00:00:00'},
+        'b': {'ID': 'b', STATUS_COLUMN: STATUS_DONE, '生成結果': '古い', 'completed_at': '2026-01-01T00:00:00'},
+    }
+    second = {
+        'a': {'ID': 'a', STATUS_COLUMN: STATUS_FAILED, '生成結果': '', 'completed_at': '2026-01-02T00:00:00'},
+        'b': {'ID': 'b', STATUS_COLUMN: STATUS_DONE, '生成結果': '新しい', 'completed_at': '2026-01-02T00:00:00'},
+        'c': {'ID': 'c', STATUS_COLUMN: STATUS_FAILED, '生成結果': '', 'completed_at': '2026-01-02T00:00:00'},
+    }
+    merged = merge_records([first, second])
+    assert merged == merge_records([second, first])
+    assert (merged['a']['生成結果'], merged['b']['生成結果']) == ('古い完了', '新しい')
+    assert merged['c'][STATUS_COLUMN] == STATUS_FAILED
+
+
+def test_merge_shards_is_repeatable_across_shard_counts():
+    """前回と違うシャード数で実行した後でもすべてのジャーナルを拾い、何度マージしても同じファイルになること"""
+    keys = [f'id{number}' for number in range(8)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_path = write_input(work_dir, keys)
+        journal_path = os.path.join(work_dir, 'results.journal.jsonl')
+        # 前回は3シャードで実行し、id0〜id4 は完了、id5 は失敗した
+        previous = [(key, STATUS_DONE, f'前回の{key}') for key in keys[:5]] + [('id5', STATUS_FAILED, '')]
+        for key, status, text in previous:
+            append_journal(shard_path(journal_path, shard_of(key, 3)), key, status, text, '2026-01-01T00:00:00')
+        # 今回は2シャードで残りを実行し、id5 と id7 は完了、id6 は失敗した
+        for key, status, text in [('id5', STATUS_DONE, '今回のid5'), ('id6', STATUS_FAILED, ''),
+                                  ('id7', STATUS_DONE, '今回のid7')]:
+            append_journal(shard_path(journal_path, shard_of(key, 2)), key, status, text, '2026-01-02T00:00:00')
+
+        output_path = os.path.join(work_dir, 'results.csv')
+        df = merge_shards(read_table(input_path), journal_path, output_path, encoding='utf-8-sig')
+        first = read_bytes(output_path)
+        merge_shards(read_table(input_path), journal_path, output_path, encoding='utf-8-sig')
+        assert read_bytes(output_path) == first
+
+        assert df['ID'].tolist() == keys
+        assert df['生成結果'].tolist() == [f'前回の{key}' for key in keys[:5]] + ['今回のid5', '', '今回のid7']
+        assert df[STATUS_COLUMN].tolist() == [STATUS_DONE] * 6 + [STATUS_FAILED, STATUS_DONE]
+        assert load_merged_done_keys(journal_path) == set(keys) - {'id6'}
+
+
+def test_streaming_merge_matches_in_memory_merge():
+    """入力とジャーナルを少しずつ読むマージが、メモリに載せるマージと同じファイルと行数を返すこと"""
+    keys = [f'id{number}' for number in range(7)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_path = write_input(work_dir, keys)
+        journal_path = os.path.join(work_dir, 'results.journal.jsonl')
+        write_journal(shard_path(journal_path, 0), [
+            ('id0', STATUS_DONE, '一行目\n二行目, カンマ', '2026-01-01T00:00:00'),
+            ('id2', STATUS_FAILED, '', '2026-01-01T00:00:00'),
+            ('id5', STATUS_DONE, '完了', '2026-01-01T00:00:00'),
+        ])
+        write_journal(shard_path(journal_path, 1), [
+            ('id1', STATUS_DONE, '"引用符"', '2026-01-01T00:00:00'),
+            ('id2', STATUS_DONE, '再試行で完了', '2026-01-02T00:00:00'),
+        ])
+
+        in_memory_path = os.path.join(work_dir, 'in_memory.csv')
+        streamed_path = os.path.join(work_dir, 'streamed.csv')
+        df = merge_shards(read_table(input_path), journal_path, in_memory_path, encoding='utf-8-sig')
+        counts = merge_shards_streaming(input_path, journal_path, streamed_path, 2, encoding='utf-8-sig')
+        assert read_bytes(streamed_path) == read_bytes(in_memory_path)
+        assert merge_summary(counts) == merge_summary(df) == "完了 4 行 / 失敗 0 行 / 未処理 3 行 (全 7 行)"
+
+
+if __name__ == "__main__":
+    test_merge_records_prefers_completed_rows()
+    test_merge_shards_is_repeatable_across_shard_counts()
+    test_streaming_merge_matches_in_memory_merge()
+    print("✅ shard_runner のテストがすべて成功しました")